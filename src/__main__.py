@@ -136,7 +136,8 @@ class Launcher(object):
                     region='us-east-1', log=None, scratch=None,
                     ipython_profile=None, ipcontroller_json=None, common=None,
                     direct_write=False, json=False, sort=None,
-                    profile=None):
+                    profile=None, resume=False, speculate=False,
+                    shuffle_engine='python', pipeline=False):
         self.force = force
         self.num_processes = num_processes
         self.keep_intermediates = keep_intermediates
@@ -154,6 +155,10 @@ class Launcher(object):
         self.json = json
         self.sort = sort
         self.profile = profile
+        self.resume = resume
+        self.speculate = speculate
+        self.shuffle_engine = shuffle_engine
+        self.pipeline = pipeline
 
     def run(self, mode, payload):
         """ Replaces current process, using PyPy if it's available.
@@ -195,6 +200,13 @@ class Launcher(object):
                     runner_args.append('-f')
                 if self.keep_intermediates:
                     runner_args.append('--keep-intermediates')
+                if self.resume:
+                    runner_args.append('--resume')
+                if self.speculate:
+                    runner_args.append('--speculate')
+                if self.pipeline:
+                    runner_args.append('--pipeline')
+                runner_args.extend(['--shuffle-engine', self.shuffle_engine])
                 if self.gzip_intermediates:
                     runner_args.extend(['--gzip-outputs', '--gzip-level',
                                             str(self.gzip_level)])
@@ -224,6 +236,11 @@ class Launcher(object):
                     runner_args.append('-f')
                 if self.keep_intermediates:
                     runner_args.append('--keep-intermediates')
+                if self.resume:
+                    runner_args.append('--resume')
+                if self.speculate:
+                    runner_args.append('--speculate')
+                runner_args.extend(['--shuffle-engine', self.shuffle_engine])
                 if self.direct_write:
                     runner_args.append('--direct-write')
                 if self.gzip_intermediates:
@@ -652,6 +669,9 @@ if __name__ == '__main__':
                 sort_memory_cap=args.sort_memory_cap,
                 max_task_attempts=args.max_task_attempts,
                 keep_intermediates=args.keep_intermediates,
+                resume=args.resume,
+                alignment_store=args.alignment_store,
+                alignment_store_size=args.alignment_store_size,
                 check_manifest=(not args.do_not_check_manifest),
                 sort_exe=args.sort,
                 scratch=args.scratch,
@@ -712,6 +732,9 @@ if __name__ == '__main__':
                 sort_memory_cap=args.sort_memory_cap,
                 max_task_attempts=args.max_task_attempts,
                 keep_intermediates=args.keep_intermediates,
+                resume=args.resume,
+                alignment_store=args.alignment_store,
+                alignment_store_size=args.alignment_store_size,
                 sort_exe=args.sort,
                 scratch=args.scratch
             )
@@ -734,6 +757,7 @@ if __name__ == '__main__':
                 sort_memory_cap=args.sort_memory_cap,
                 max_task_attempts=args.max_task_attempts,
                 keep_intermediates=args.keep_intermediates,
+                resume=args.resume,
                 check_manifest=(not args.do_not_check_manifest),
                 sort_exe=args.sort,
                 scratch=args.scratch,
@@ -799,6 +823,9 @@ if __name__ == '__main__':
                 sort_memory_cap=args.sort_memory_cap,
                 max_task_attempts=args.max_task_attempts,
                 keep_intermediates=args.keep_intermediates,
+                resume=args.resume,
+                alignment_store=args.alignment_store,
+                alignment_store_size=args.alignment_store_size,
                 check_manifest=(not args.do_not_check_manifest),
                 ipython_profile=args.ipython_profile,
                 ipcontroller_json=args.ipcontroller_json,
@@ -862,6 +889,9 @@ if __name__ == '__main__':
                 sort_memory_cap=args.sort_memory_cap,
                 max_task_attempts=args.max_task_attempts,
                 keep_intermediates=args.keep_intermediates,
+                resume=args.resume,
+                alignment_store=args.alignment_store,
+                alignment_store_size=args.alignment_store_size,
                 ipython_profile=args.ipython_profile,
                 ipcontroller_json=args.ipcontroller_json,
                 scratch=args.scratch,
@@ -887,6 +917,7 @@ if __name__ == '__main__':
                 sort_memory_cap=args.sort_memory_cap,
                 max_task_attempts=args.max_task_attempts,
                 keep_intermediates=args.keep_intermediates,
+                resume=args.resume,
                 check_manifest=(not args.do_not_check_manifest),
                 ipython_profile=args.ipython_profile,
                 ipcontroller_json=args.ipcontroller_json,
@@ -1114,6 +1145,26 @@ if __name__ == '__main__':
                                        if mode in ['local', 'parallel']
                                        else False
                                     ),
+                                    resume=(
+                                       args.resume
+                                       if mode in ['local', 'parallel']
+                                       else False
+                                    ),
+                                    speculate=(
+                                       args.speculate
+                                       if mode in ['local', 'parallel']
+                                       else False
+                                    ),
+                                    shuffle_engine=(
+                                       args.shuffle_engine
+                                       if mode in ['local', 'parallel']
+                                       else 'python'
+                                    ),
+                                    pipeline=(
+                                       args.pipeline
+                                       if mode == 'local'
+                                       else False
+                                    ),
                                     gzip_intermediates=(
                                        args.gzip_intermediates
                                        if mode in ['local', 'parallel']
@@ -50,11 +50,17 @@ import socket
 import subprocess
 import glob
 import hashlib
+import heapq
+import itertools
+import zlib
+import re
 import tempfile
 import shutil
 import os
 import contextlib
-from tools import make_temp_dir, make_temp_dir_and_register_cleanup
+import threading
+from tools import make_temp_dir, make_temp_dir_and_register_cleanup, \
+    PartitionPlan
 from ansibles import Url
 import site
 import string
@@ -147,6 +153,56 @@ def add_args(parser):
             help=('Path to sort executable. Add arguments as necessary, '
                   'e.g. for specifying a directory for storing sort\'s '
                   'temporary files.'))
+    parser.add_argument('--shuffle-engine', type=str, required=False,
+            default='python', choices=['python', 'sort'],
+            help=('How map output is partitioned, sorted, and merged before '
+                  'it is passed to reducers. "python" does all of this '
+                  'in-process, spilling sorted runs to disk when --memcap is '
+                  'exceeded; "sort" invokes UNIX sort once per task file. '
+                  '"sort" is always used when a step\'s sort options can\'t '
+                  'be emulated in-process.'))
+    parser.add_argument('--merge-fan-in', type=int, required=False,
+            default=64,
+            help=('Maximum number of presorted files a reducer merges at '
+                  'once. When a reducer has more, they\'re first merged into '
+                  'intermediate runs, smallest first, which caps the numbers '
+                  'of open files and decompression processes per reducer.'))
+    parser.add_argument('--speculate', action='store_const', const=True,
+            default=False,
+            help=('Launches a backup attempt of a map or reduce task that '
+                  'runs much longer than expected once most of its step\'s '
+                  'tasks are done, as Hadoop does. Whichever attempt '
+                  'finishes first commits its output, and the other is '
+                  'killed. Ignored in --pipeline mode. Steps whose '
+                  'tasks write outside their output directories should '
+                  'turn it off with -D mapreduce.map.speculative=false '
+                  'and/or -D mapreduce.reduce.speculative=false.'))
+    parser.add_argument('--speculative-slowdown', type=float, required=False,
+            default=3.0,
+            help=('How many times longer than expected a task must run '
+                  'before it\'s backed up; relevant only if --speculate '
+                  'is invoked. A task is expected to take as long per byte '
+                  'of input as the median completed task of its phase.'))
+    parser.add_argument('--pipeline', action='store_const', const=True,
+            default=False,
+            help=('Run steps concurrently as soon as the steps whose outputs '
+                  'they read finish rather than one at a time. Steps with '
+                  'identity mappers also begin partitioning their inputs as '
+                  'soon as the reduce tasks that write them finish. Can\'t '
+                  'be combined with --ipy.'))
+    parser.add_argument('--resume', action='store_const', const=True,
+            default=False,
+            help=('Resumes a job flow whose previous run failed or whose '
+                  'steps changed. Each step records the configuration and '
+                  'inputs it completed with, including Bowtie indexes, '
+                  'manifests, and cached files its commands name, in '
+                  'dp.resume.log in its output directory; a step is skipped '
+                  'if neither has changed and its '
+                  'output is intact or unneeded, and only the tasks of a '
+                  'partly completed step that didn\'t succeed are rerun. '
+                  'Steps may be added, e.g., to write new deliverables. Use '
+                  'with --keep-intermediates to avoid rerunning steps whose '
+                  'outputs were deleted after they were read.'))
 
 def init_worker():
     """ Prevents KeyboardInterrupt from reaching a pool's workers.
@@ -185,6 +241,150 @@ def yopen(gzipped, *args):
         return gzip.open(*args)
     return open(*args)
 
+def path_fingerprint(path):
+    """ Summarizes a file or the files in a directory tree.
+
+        Sizes and modification times stand in for contents, which can span
+        hundreds of gigabytes, so a change is detected only if a file is
+        rewritten, resized, added, or removed. In a directory, the dp.map and
+        dp.tasks intermediates of a step and files and directories whose names
+        end in .log are skipped.
+
+        path: file or directory
+
+        Return value: sorted list of [path relative to path, size,
+            modification time] lists; it's empty if path doesn't exist
+    """
+    if os.path.isfile(path):
+        stat = os.stat(path)
+        return [['', stat.st_size, stat.st_mtime]]
+    fingerprint = []
+    for root, dirnames, filenames in os.walk(path):
+        dirnames[:] = [dirname for dirname in dirnames
+                        if not dirname.endswith('.log')
+                        and not (root == path
+                                    and dirname in ['dp.map', 'dp.tasks'])]
+        for filename in filenames:
+            if filename.endswith('.log'):
+                continue
+            filename = os.path.join(root, filename)
+            try:
+                stat = os.stat(filename)
+            except OSError:
+                # Deleted meanwhile
+                continue
+            fingerprint.append([os.path.relpath(filename, path),
+                                stat.st_size, stat.st_mtime])
+    fingerprint.sort()
+    return fingerprint
+
+_index_option = re.compile(r'--bowtie2?-idx[= ](\S+)')
+_file_option = re.compile(r'--manifest[= ](\S+)')
+_written_option = re.compile(r'--out[= ](\S+)')
+_index_extensions = ('.ebwt', '.ebwtl', '.bt2', '.bt2l')
+
+def step_commands(step_data):
+    """ Lists the streaming commands of a step.
+
+        step_data: dictionary describing step; see run_simulation()
+
+        Return value: list of mapper, combiner, and reducer commands present
+    """
+    return [step_data[command] for command in ['mapper', 'combiner', 'reducer']
+                if step_data.get(command)]
+
+def referenced_paths(step_data):
+    """ Finds local files a step reads that aren't among its inputs.
+
+        These are Bowtie and Bowtie 2 indexes named by --bowtie-idx and
+        --bowtie2-idx in the step's commands, manifests named by --manifest,
+        and files and archives distributed with -files, -archives, -cacheFile,
+        and -cacheArchive. Each index is listed by its basename.
+
+        step_data: dictionary describing step; see run_simulation()
+
+        Return value: sorted list of tuples (absolute path, True iff path is
+            an index basename)
+    """
+    paths = set()
+    for command in step_commands(step_data):
+        for option_values in _index_option.findall(command):
+            paths.update([(os.path.abspath(basename), True)
+                            for basename in option_values.split(',')
+                            if basename])
+        paths.update([(os.path.abspath(path), False)
+                        for path in _file_option.findall(command)])
+    for cache_key in ['files', 'archives', 'cacheFile', 'cacheArchive']:
+        if not step_data.get(cache_key):
+            continue
+        for cached in step_data[cache_key].split(','):
+            cached_url = Url(cached.partition('#')[0])
+            if cached_url.is_local:
+                paths.add((os.path.abspath(cached_url.to_url()), False))
+    return sorted(paths)
+
+def written_paths(step_data):
+    """ Lists where a step writes: its output and paths passed with --out.
+
+        step_data: dictionary describing step; see run_simulation()
+
+        Return value: list of absolute paths
+    """
+    paths = [os.path.abspath(step_data['output'])]
+    for command in step_commands(step_data):
+        paths.extend([os.path.abspath(path)
+                        for path in _written_option.findall(command)])
+    return paths
+
+def index_fingerprint(basename):
+    """ Summarizes the files of a Bowtie or Bowtie 2 index.
+
+        Only files with Bowtie's own extensions are included, so files that
+        steps write next to an index don't change its fingerprint.
+
+        basename: index basename
+
+        Return value: sorted list of [filename, size, modification time]
+            lists; it's empty if there are no index files
+    """
+    fingerprint = []
+    for index_file in glob.glob(basename + '.*'):
+        if index_file.endswith(_index_extensions):
+            fingerprint.extend([[os.path.basename(index_file)] + item[1:]
+                                    for item in path_fingerprint(index_file)])
+    fingerprint.sort()
+    return fingerprint
+
+def json_digest(obj):
+    """ Computes SHA-1 digest of an object's JSON serialization.
+
+        obj: JSON-serializable object
+
+        Return value: hex digest
+    """
+    return hashlib.sha1(json.dumps(obj, sort_keys=True)).hexdigest()
+
+def checkpointed_task(task_function, checkpoint_file, digest, *args):
+    """ Runs a task, recording that it succeeded for resuming a job flow.
+
+        On success, digest is written to checkpoint_file. If the job flow is
+        resumed and the task's digest is unchanged, the task isn't rerun.
+
+        task_function: function that returns None iff the task succeeded
+        checkpoint_file: path to checkpoint file
+        digest: digest of task's configuration and inputs
+        *args: arguments to pass to task_function
+
+        Return value: return value of task_function
+    """
+    return_value = task_function(*args)
+    if return_value is None:
+        temp_checkpoint_file = '%s.%d.tmp' % (checkpoint_file, os.getpid())
+        with open(temp_checkpoint_file, 'w') as checkpoint_stream:
+            checkpoint_stream.write(digest)
+        os.rename(temp_checkpoint_file, checkpoint_file)
+    return return_value
+
 def parsed_keys(partition_options, key_fields):
     """ Parses UNIX sort options to figure out what to partition on.
 
@@ -220,11 +420,808 @@ def parsed_keys(partition_options, key_fields):
         )
         return partitioned_key
 
+def _key_specs(options):
+    """ Parses -k options of UNIX sort.
+
+        options: UNIX sort options like -k1,1 -k2,3 -k4,4n
+
+        Return value: list of tuples (start field index, end field index or
+            None if key extends to end of line, True iff key is numeric), or
+            None if options include anything other than -kM, -kM,N, and
+            -kM,Nn
+    """
+    split_options = options.split('-k')
+    if split_options[0].strip():
+        # Some option other than -k was passed
+        return None
+    key_specs = []
+    for arg in split_options[1:]:
+        arg = arg.strip()
+        numeric = arg.endswith('n')
+        if numeric:
+            arg = arg[:-1]
+        try:
+            bounds = [int(el) for el in arg.split(',')]
+        except ValueError:
+            # Character offsets or options other than n aren't supported
+            return None
+        if len(bounds) == 1 and bounds[0] >= 1:
+            key_specs.append((bounds[0] - 1, None, numeric))
+        elif len(bounds) == 2 and bounds[1] >= bounds[0] >= 1:
+            key_specs.append((bounds[0] - 1, bounds[1], numeric))
+        else:
+            return None
+    return key_specs or None
+
+def sort_key_function(sort_options, separator):
+    """ Emulates ordering of LC_ALL=C sort -t<separator> <sort_options>.
+
+        Only key definitions of the form -kM, -kM,N, and -kM,Nn are supported,
+        since these are the only forms used by Rail. As with UNIX sort, lines
+        whose keys compare equal are ordered by comparing entire lines
+        bytewise. The returned function takes a line (with or without its
+        terminating newline) and returns a tuple whose final element is the
+        line stripped of its terminating newline.
+
+        The returned function has an attribute whole_line that is True iff
+        the keys are lexicographic and tile the fields of a line starting
+        from the first, as for -k1,2 -k3,4. Sorting undecorated lines stripped
+        of their newlines then gives exactly the same order as sorting with
+        the key function because the separator is a tab, which sorts before
+        any character found in a Rail field.
+
+        sort_options: UNIX sort options like -k1,1 -k2,3 -k4,4n
+        separator: separator between successive fields in a line
+
+        Return value: key function as described above, or None if sort_options
+            cannot be emulated
+    """
+    key_specs = _key_specs(sort_options)
+    if key_specs is None:
+        return None
+    key_fields = max([start + 1 for start, _, _ in key_specs]
+                        + [end for _, end, _ in key_specs if end is not None])
+    namespace = {'separator' : separator, '_sort_numeric' : _sort_numeric}
+    exec (
+"""def sort_key(line):
+    if line[-1:] == '\\n':
+        line = line[:-1]
+    fields = line.split(separator)
+    if len(fields) < {key_fields}:
+        fields.extend([''] * ({key_fields} - len(fields)))
+    return ({key_specs}, line)
+""".format(key_fields=key_fields, key_specs=', '.join([
+                ('{}(fields[{}])' if end == start + 1
+                    else '{}(separator.join(fields[{}:{}]))').format(
+                        '_sort_numeric' if numeric else '',
+                        start, '' if end is None else end
+                    ) for start, end, numeric in key_specs
+            ]))
+    ) in namespace
+    sort_key = namespace['sort_key']
+    next_field, sort_key.whole_line = 0, (separator == '\t')
+    for start, end, numeric in key_specs:
+        if numeric or start != next_field or not sort_key.whole_line:
+            sort_key.whole_line = False
+            break
+        if end is None:
+            break
+        next_field = end
+    return sort_key
+
+def partition_key_function(partition_options, separator):
+    """ Obtains function that extracts from a line what it's partitioned on.
+
+        Faster counterpart of parsed_keys() for the python shuffle engine;
+        the line is split only as far as the last field used for partitioning.
+
+        partition_options: UNIX sort-like options like -k1,1 -k3,4
+        separator: separator between successive fields in a line
+
+        Return value: function that takes a line and returns a list of the
+            fields to partition on, or None if partition options are invalid
+    """
+    key_specs = _key_specs(partition_options)
+    if key_specs is None:
+        return None
+    if any([end is None for _, end, _ in key_specs]):
+        max_split = -1
+    else:
+        max_split = max([end for _, end, _ in key_specs])
+    namespace = {'separator' : separator}
+    exec (
+"""def partition_key(line):
+    if line[-1:] == '\\n':
+        line = line[:-1]
+    fields = line.split(separator, {max_split})
+    return {key_specs}
+""".format(max_split=max_split,
+           key_specs='+'.join(['fields[{}:{}]'.format(
+                                        start, '' if end is None else end
+                                    ) for start, end, _ in key_specs]))
+    ) in namespace
+    return namespace['partition_key']
+
+_numeric_prefix = re.compile(r'\s*(-?\d*)(\.\d*)?')
+
+def _sort_numeric(field):
+    """ Obtains the value UNIX sort -n assigns to a field in the C locale.
+
+        field: string
+
+        Return value: int or float; 0 if field has no numeric prefix
+    """
+    if field.isdigit():
+        return int(field)
+    integer, fraction = _numeric_prefix.match(field).groups()
+    if fraction is None:
+        try:
+            return int(integer)
+        except ValueError:
+            return 0
+    try:
+        return float(integer + fraction)
+    except ValueError:
+        return 0
+
+def sorted_stream(input_file):
+    """ Opens a file for reading, decompressing it if it's gzip'd.
+
+        Decompression is performed by a gzip subprocess because Python's
+        gzip module is slow.
+
+        input_file: path to file
+
+        Return value: tuple (file object, subprocess.Popen object or None if
+            the file is not gzip'd)
+    """
+    with open(input_file, 'rb') as binary_input_stream:
+        gzipped = (binary_input_stream.read(2) == '\x1f\x8b')
+    if gzipped:
+        process = subprocess.Popen(['gzip', '-cd', input_file],
+                                    stdout=subprocess.PIPE, bufsize=-1)
+        return process.stdout, process
+    return open(input_file, 'rb', 1048576), None
+
+def _item_overhead(item):
+    """ Estimates memory a buffered line or key takes beyond its data.
+
+        item: line stripped of newline or key returned by a sort key function
+
+        Return value: number of bytes, counting the reference to item in a
+            list
+    """
+    if type(item) is str:
+        return sys.getsizeof(item) - len(item) + 8
+    return (sys.getsizeof(item) + sum([sys.getsizeof(field) for field in item])
+                - len(item[-1]) + 8)
+
+def merged_blocks(input_files, sort_key, block_size=1048576):
+    """ Performs k-way merge of presorted files a block at a time.
+
+        Each file is read a block at a time. All buffered lines that sort no
+        later than the smallest last line among the buffered blocks can't be
+        preceded by any unread line, so they're sorted together and yielded.
+        Because these lines form at most one sorted run per file, Python's
+        sort merges them at C speed, and no Python code is executed per line
+        when sort_key.whole_line is True. Each block is consumed from an
+        offset into it rather than by slicing off what's yielded, so a line
+        is copied only when it's yielded.
+
+        A block takes about block_size bytes of memory, including the
+        overhead of Python's string objects, key tuples, and list entries,
+        which can exceed the data itself for short lines. How much of a file
+        is read at once is adjusted accordingly.
+
+        input_files: list of paths to presorted files, each of which may or
+            may not be gzip'd
+        sort_key: key function returned by sort_key_function()
+        block_size: approximate number of bytes of memory a block may take
+
+        Yield value: successive sorted lists of merged lines, stripped of
+            newlines
+    """
+    from bisect import bisect_right
+    streams, processes = [], []
+    # Overhead per line, measured on the first line read
+    overheads = []
+    # Number of bytes of data to read from each file at once
+    read_sizes = []
+    def next_block(i):
+        stream = streams[i]
+        block = stream.read(read_sizes[i])
+        if not block:
+            return None
+        if block[-1] != '\n':
+            block += stream.readline()
+        lines = block.split('\n')
+        if lines[-1] == '':
+            lines.pop()
+        if not sort_key.whole_line:
+            lines = map(sort_key, lines)
+        if not overheads:
+            overheads.append(_item_overhead(lines[0]))
+        # Fit the next block's data and overhead into block_size
+        read_sizes[i] = max(block_size * len(block)
+                                // (len(block) + len(lines) * overheads[0]),
+                            4096)
+        return lines
+    try:
+        for input_file in input_files:
+            stream, process = sorted_stream(input_file)
+            streams.append(stream)
+            read_sizes.append(block_size)
+            if process is not None:
+                processes.append((input_file, process))
+        # Values are [block, offset of first line not yet yielded]
+        blocks = {}
+        for i in xrange(len(streams)):
+            block = next_block(i)
+            if block:
+                blocks[i] = [block, 0]
+        while blocks:
+            '''The block holding the bound is consumed whole, so the merge
+            ends even if input turns out to be unsorted because, say, a
+            truncated gzip'd file ended mid-line.'''
+            bound_index = min(blocks, key=lambda i: blocks[i][0][-1])
+            bound = blocks[bound_index][0][-1]
+            merged = []
+            for i in blocks.keys():
+                block, offset = blocks[i]
+                split = (len(block) if i == bound_index
+                            else bisect_right(block, bound, offset))
+                if split == len(block):
+                    merged.extend(block[offset:] if offset else block)
+                    block = next_block(i)
+                    if block:
+                        blocks[i] = [block, 0]
+                    else:
+                        del blocks[i]
+                else:
+                    merged.extend(block[offset:split])
+                    blocks[i][1] = split
+            merged.sort()
+            if sort_key.whole_line:
+                yield merged
+            else:
+                yield [key[-1] for key in merged]
+        for stream in streams:
+            stream.close()
+        for input_file, process in processes:
+            if process.wait():
+                raise RuntimeError(('Decompressing %s failed; exit level '
+                                    'was %d.') % (input_file,
+                                                    process.returncode))
+    finally:
+        for stream in streams:
+            stream.close()
+        for _, process in processes:
+            process.wait()
+
+def feed_merged_lines(input_files, sort_key, output_stream,
+                        block_size=1048576, errors=None):
+    """ Writes k-way merge of presorted files to a stream and closes it.
+
+        Used to feed a reducer's stdin directly. If the reducer exits before
+        consuming all of its input, the broken pipe is ignored here; the
+        reducer's exit level is checked elsewhere. Any other error, like a
+        failure to decompress an input file, is raised or recorded in errors.
+
+        input_files: list of paths to presorted files
+        sort_key: key function returned by sort_key_function()
+        output_stream: where to write merged lines
+        block_size: approximate number of bytes of memory each block of a
+            file may take
+        errors: None if errors should be raised; otherwise, a list to which
+            the traceback of an error is appended, for when the merge runs on
+            a thread whose caller must check
+
+        No return value.
+    """
+    import errno
+    try:
+        write_blocks(merged_blocks(input_files, sort_key, block_size),
+                        output_stream)
+    except Exception as e:
+        if isinstance(e, IOError) and e.errno == errno.EPIPE:
+            pass
+        elif errors is None:
+            raise
+        else:
+            from traceback import format_exc
+            errors.append(format_exc())
+    finally:
+        try:
+            output_stream.close()
+        except IOError:
+            pass
+
+def write_blocks(blocks, output_stream):
+    """ Writes lists of lines to a stream, terminating each line with newline.
+
+        blocks: iterable of lists of lines stripped of newlines
+        output_stream: where to write lines
+
+        No return value.
+    """
+    for block in blocks:
+        if block:
+            output_stream.write('\n'.join(block))
+            output_stream.write('\n')
+
+def write_sorted_run(blocks, output_file, gzip=False, gzip_level=3,
+                        combiner=None):
+    """ Writes lines to a file, compressing with a gzip subprocess if desired.
+
+        blocks: iterable of lists of lines stripped of newlines
+        output_file: path to output file
+        gzip: True iff output should be gzip'd
+        gzip_level: level of gzip compression to use, if applicable
+        combiner: shell command through which lines are piped before they're
+            written or None if there is no combiner; see presorted_tasks()
+
+        No return value.
+    """
+    if combiner is None and not gzip:
+        with open(output_file, 'wb', 1048576) as output_stream:
+            write_blocks(blocks, output_stream)
+        return
+    command = ' | '.join(([combiner] if combiner is not None else [])
+                            + (['gzip -%d' % gzip_level] if gzip else []))
+    with open(output_file, 'wb') as output_stream:
+        write_process = subprocess.Popen('set -eo pipefail; ' + command,
+                                          shell=True,
+                                          executable='/bin/bash',
+                                          stdin=subprocess.PIPE,
+                                          stdout=output_stream,
+                                          bufsize=-1)
+        try:
+            write_blocks(blocks, write_process.stdin)
+        finally:
+            try:
+                write_process.stdin.close()
+            except IOError:
+                pass
+            write_process_return = write_process.wait()
+            if write_process_return:
+                raise RuntimeError(('Command "%s" failed writing %s; exit '
+                                    'level was %d.') % (command, output_file,
+                                                        write_process_return))
+
+def merge_block_size(memcap, fan_in):
+    """ Chooses how much memory each presorted file's block may take when
+        merging.
+
+        merged_blocks() holds about one block per file being merged plus the
+        lines merged from them, so blocks are sized to keep a merge of fan_in
+        files within memcap; merged_blocks() counts the overhead of Python
+        objects against a block's size. Blocks are at least 64 KB and at most
+        4 MB so reads stay large and sequential.
+
+        memcap: maximum amount of memory in kilobytes to use for merging
+        fan_in: maximum number of files merged at once
+
+        Return value: block size in bytes
+    """
+    return max(min(max(memcap, 1) * 1024 // (2 * max(fan_in, 1)),
+                    4194304), 65536)
+
+def merge_plan(input_files, fan_in, run_dir):
+    """ Plans a multilevel merge of presorted files that caps fan-in.
+
+        As in Hadoop, files are merged into intermediate runs until no more
+        than fan_in remain, smallest first. The first merge combines only as
+        many files as it takes for every later merge to combine exactly
+        fan_in, so as little data as possible is rewritten. For example,
+        100 files with a fan-in of 64 call for one merge of the 37 smallest
+        files followed by the final merge of 64.
+
+        input_files: list of paths to presorted files
+        fan_in: maximum number of files to merge at once; at least 2
+        run_dir: directory in which intermediate runs are to be written
+
+        Return value: tuple (list of merges to perform in order, each a tuple
+            (list of input paths, path of intermediate run to write), list of
+            at most fan_in paths to merge last)
+    """
+    import heapq
+    fan_in = max(fan_in, 2)
+    if len(input_files) <= fan_in:
+        return [], list(input_files)
+    heap = [(os.path.getsize(input_file), i, input_file)
+                for i, input_file in enumerate(input_files)]
+    heapq.heapify(heap)
+    merges = []
+    merge_count = (len(heap) - 1) % (fan_in - 1) + 1
+    if merge_count == 1:
+        merge_count = fan_in
+    while len(heap) > fan_in:
+        group = [heapq.heappop(heap) for _ in xrange(merge_count)]
+        run = os.path.join(run_dir, str(len(merges)))
+        merges.append(([input_file for _, _, input_file in group], run))
+        heapq.heappush(heap, (sum([size for size, _, _ in group]),
+                                len(input_files) + len(merges), run))
+        merge_count = fan_in
+    return merges, [input_file for _, _, input_file in sorted(
+                                                heap, key=lambda item: item[1]
+                                            )]
+
+def sort_merge_command(input_files, sort, memcap, sort_options, separator,
+                        gzip=False):
+    """ Forms a command that merges presorted files with UNIX sort -m.
+
+        input_files: list of paths to presorted files or a single glob
+        sort: path to sort executable
+        memcap: maximum amount of memory in kilobytes sort should use
+        sort_options: options to use when merging
+        separator: separator between successive fields of a line
+        gzip: True iff the files are gzip'd; each is then decompressed by
+            a gzip subprocess via process substitution
+
+        Return value: command
+    """
+    if isinstance(input_files, basestring):
+        input_files = [input_files]
+    if gzip:
+        input_files = ['<(gzip -cd %s)' % input_file
+                        for input_file in input_files]
+    return 'LC_ALL=C %s -S %d %s -t$\'%s\' -m %s' % (
+                                        sort, memcap, sort_options,
+                                        separator.encode('string_escape'),
+                                        ' '.join(input_files)
+                                    )
+
+def hierarchical_merge(input_files, fan_in, run_dir, sort_key=None,
+                        sort='sort', memcap=(1024*300), sort_options=None,
+                        separator='\t', gzip=False, gzip_level=3):
+    """ Merges presorted files into intermediate runs until few remain.
+
+        Keeps the number of files merged at once, and thus the numbers of
+        open files and decompression processes, at most fan_in; see
+        merge_plan(). Runs are written to run_dir and deleted once they've
+        been merged into other runs.
+
+        input_files: list of paths to presorted files
+        fan_in: maximum number of files to merge at once
+        run_dir: directory in which to write intermediate runs
+        sort_key: key function returned by sort_key_function() to merge
+            in-process, or None to merge with UNIX sort -m
+        sort: path to sort executable; relevant only if sort_key is None
+        memcap: maximum amount of memory in kilobytes to use per merge
+        sort_options: options to pass to sort; relevant only if sort_key is
+            None
+        separator: separator between successive fields of a line
+        gzip: True iff input_files are gzip'd; runs are then gzip'd, too
+        gzip_level: level of gzip compression to use for runs
+
+        Return value: list of at most fan_in paths to presorted files whose
+            merge is the merge of input_files
+    """
+    merges, final_files = merge_plan(input_files, fan_in, run_dir)
+    block_size = merge_block_size(memcap, fan_in)
+    runs = set()
+    for merge_inputs, run in merges:
+        if sort_key is not None:
+            write_sorted_run(merged_blocks(merge_inputs, sort_key,
+                                            block_size),
+                                run, gzip, gzip_level)
+        else:
+            command = ' | '.join([sort_merge_command(merge_inputs, sort,
+                                                        memcap, sort_options,
+                                                        separator, gzip)]
+                                  + (['gzip -%d' % gzip_level]
+                                        if gzip else []))
+            merge_process_return = subprocess.call(
+                    'set -eo pipefail; %s >%s' % (command, run),
+                    shell=True, bufsize=-1, executable='/bin/bash'
+                )
+            if merge_process_return:
+                raise RuntimeError(('Command "%s" failed writing %s; exit '
+                                    'level was %d.') % (command, run,
+                                                        merge_process_return))
+        for merge_input in merge_inputs:
+            if merge_input in runs:
+                os.remove(merge_input)
+                runs.remove(merge_input)
+        runs.add(run)
+    return final_files
+
+def sample_partition_keys(input_files, partition_key, separator,
+                            split_field=None, samples=100000, seed=0):
+    """ Estimates how much of a step's input each partition key holds.
+
+        This is the sampling pre-pass of the plan partitioner, which samples
+        a step's input like Hadoop's InputSampler does for
+        TotalOrderPartitioner. Lines of an uncompressed file are sampled by
+        reading the line after the one in which a random byte offset falls,
+        so a file is never read in full; since a step's input is typically
+        sorted, this line almost always has the same key. A gzip'd file is
+        streamed once, and its lines are reservoir-sampled. Samples are
+        divided among files in proportion to their sizes.
+
+        input_files: list of files to sample
+        partition_key: function returned by partition_key_function()
+        separator: separator between successive fields in a line
+        split_field: index (from 0) of field whose sampled values are
+            recorded so keys can be split, or None if they aren't recorded
+        samples: total number of lines to sample
+        seed: seed of random number generator, which makes the sample the
+            same for the same input
+
+        Return value: tuple (dictionary mapping each sampled partition key to
+            an estimate of the number of bytes of input with that key,
+            dictionary mapping each sampled partition key to a list of
+            tuples (value of split field, estimated number of bytes
+            represented) or None if split_field is None)
+    """
+    import random
+    from collections import defaultdict
+    random_generator = random.Random(seed)
+    key_sizes = defaultdict(float)
+    key_values = defaultdict(list) if split_field is not None else None
+    input_files = [input_file for input_file in sorted(input_files)
+                    if os.path.getsize(input_file)]
+    total_size = float(sum([os.path.getsize(input_file)
+                                for input_file in input_files]))
+    for input_file in input_files:
+        file_size = os.path.getsize(input_file)
+        sample_count = max(int(samples * file_size / total_size), 1)
+        with open(input_file, 'rb') as binary_input_stream:
+            gzipped = (binary_input_stream.read(2) == '\x1f\x8b')
+        sampled_lines = []
+        if gzipped:
+            input_stream, process = sorted_stream(input_file)
+            try:
+                for i, line in enumerate(input_stream):
+                    if i < sample_count:
+                        sampled_lines.append(line)
+                    else:
+                        j = random_generator.randint(0, i)
+                        if j < sample_count:
+                            sampled_lines[j] = line
+            finally:
+                input_stream.close()
+                process.wait()
+            '''Lines are sampled uniformly rather than in proportion to
+            their lengths, so weight them by their lengths.'''
+            sampled_bytes = float(sum([len(line) for line in sampled_lines]))
+            weighted_lines = [(line, file_size * len(line) / sampled_bytes)
+                                for line in sampled_lines]
+        else:
+            with open(input_file, 'rb') as input_stream:
+                for offset in sorted([
+                            random_generator.randint(0, file_size - 1)
+                            for _ in xrange(sample_count)
+                        ]):
+                    input_stream.seek(offset)
+                    input_stream.readline()
+                    line = input_stream.readline()
+                    if not line:
+                        # Offset fell in last line; wrap around
+                        input_stream.seek(0)
+                        line = input_stream.readline()
+                    sampled_lines.append(line)
+            weighted_lines = [(line, float(file_size) / sample_count)
+                                for line in sampled_lines]
+        for line, weight in weighted_lines:
+            line = line.rstrip('\n')
+            if not line:
+                continue
+            key = separator.join(partition_key(line))
+            key_sizes[key] += weight
+            if key_values is not None:
+                try:
+                    key_values[key].append(
+                            (line.split(separator,
+                                        split_field + 1)[split_field],
+                             weight)
+                        )
+                except IndexError:
+                    pass
+    return (dict(key_sizes),
+            dict(key_values) if key_values is not None else None)
+
+def partition_plan(key_sizes, task_count, key_values=None, max_splits=1):
+    """ Assigns partition keys to reduce tasks so tasks get similar loads.
+
+        A key estimated to hold more than a task's share of the input is
+        split into up to max_splits sub-bins at quantiles of the sampled
+        values of the field that follows it, aiming for sub-bins half a
+        task's share in size. Keys and sub-bins are then assigned, largest
+        first, to the task with the least input assigned so far; this is the
+        longest-processing-time-first rule for bin packing.
+
+        key_sizes: dictionary mapping partition keys to estimated numbers of
+            bytes; see sample_partition_keys()
+        task_count: number of reduce tasks
+        key_values: dictionary mapping partition keys to lists of tuples
+            (value of split field, estimated number of bytes represented) or
+            None if keys shouldn't be split; see sample_partition_keys()
+        max_splits: maximum number of sub-bins into which to split a key
+
+        Return value: PartitionPlan object
+    """
+    import math
+    from bisect import bisect_right
+    target = float(sum(key_sizes.values())) / max(task_count, 1)
+    key_bounds, bins = {}, []
+    for key, size in key_sizes.iteritems():
+        bounds = []
+        if (key_values is not None and max_splits > 1 and size > target
+                and key in key_values):
+            split_count = min(max_splits, int(math.ceil(2 * size / target)))
+            values = sorted(key_values[key])
+            total_weight = sum([weight for _, weight in values])
+            cumulative_weight = 0.0
+            for value, weight in values:
+                if (cumulative_weight >= total_weight * (len(bounds) + 1)
+                                            / split_count
+                        and value > (bounds[-1] if bounds
+                                        else values[0][0])):
+                    bounds.append(value)
+                    if len(bounds) == split_count - 1:
+                        break
+                cumulative_weight += weight
+        if bounds:
+            key_bounds[key] = bounds
+            sub_bin_sizes = [0.0] * (len(bounds) + 1)
+            for value, weight in key_values[key]:
+                sub_bin_sizes[bisect_right(bounds, value)] += weight
+            for index, sub_bin_size in enumerate(sub_bin_sizes):
+                bins.append((size * sub_bin_size / total_weight, key, index))
+        else:
+            bins.append((size, key, 0))
+    loads = [(0.0, task) for task in xrange(task_count)]
+    assigned_tasks = {}
+    for size, key, index in sorted(bins, key=lambda a_bin: (-a_bin[0],)
+                                                            + a_bin[1:]):
+        load, task = heapq.heappop(loads)
+        assigned_tasks[(key, index)] = task
+        heapq.heappush(loads, (load + size, task))
+    plan = PartitionPlan()
+    for key in sorted(key_sizes):
+        plan.add(key, assigned_tasks[(key, 0)])
+        for index, bound in enumerate(key_bounds.get(key, []), 1):
+            plan.add(key, assigned_tasks[(key, index)], bound)
+    return plan
+
+def native_presorted_tasks(input_files, process_id, sort_key, output_dir,
+                            separator, partition_key, task_count, memcap,
+                            gzip=False, gzip_level=3, mod_partition=False,
+                            combiner=None, plan=None, fan_in=64):
+    """ Partitions input data into tasks and presorts them in-process.
+
+        Counterpart of the partition/sort portion of presorted_tasks() that
+        does not rely on one UNIX sort per task file. Lines are partitioned
+        with the CRC32 of their partition keys and accumulated in per-task
+        buffers. Each buffered line is charged its length plus the overhead
+        of its Python string object and list entry. When the buffers together
+        exceed memcap, the largest are sorted and spilled to disk as runs
+        until the buffers take at most half of memcap, so a task with little
+        data isn't spilled over and over. Each task's runs are merged at the
+        end with hierarchical_merge(), at most fan_in at once, so exactly one
+        sorted file x.y is written per task x, as before. As in Hadoop, a
+        combiner is run on every sorted run as it is spilled and again on the
+        final merge.
+
+        input_files: list of files on which to operate.
+        process_id: unique identifier for current process.
+        sort_key: key function returned by sort_key_function()
+        output_dir: directory in which to write output files.
+        separator: separator between successive fields from line.
+        partition_key: function returned by partition_key_function()
+        task_count: number of tasks in which to partition input.
+        memcap: maximum amount of memory in kilobytes to use for buffering
+            lines; this is how UNIX sort interprets -S by default
+        gzip: True iff all files written should be gzipped; else False.
+        gzip_level: Level of gzip compression to use, if applicable.
+        mod_partition: if True, task is assigned according to formula
+            (product of fields) % task_count
+        combiner: shell command through which each sorted run is piped or
+            None if there is no combiner
+        plan: dictionary mapping partition keys to tasks returned by
+            PartitionPlan.assignments() or None to hash all keys; lines whose
+            keys aren't in it are hashed.
+        fan_in: maximum number of runs of a task to merge at once
+
+        No return value.
+    """
+    from collections import defaultdict
+    budget = max(memcap, 1) * 1024
+    buffers, runs = defaultdict(list), defaultdict(list)
+    # Memory charged to each task's buffer
+    buffer_sizes = defaultdict(int)
+    buffered_bytes = 0
+    # Overhead of a line's string object and list entry
+    line_overhead = _item_overhead('')
+    line_key = None if sort_key.whole_line else sort_key
+    crc32 = zlib.crc32
+    run_dir = tempfile.mkdtemp(dir=output_dir, prefix='runs.')
+    def spill(task):
+        buffers[task].sort(key=line_key)
+        runs[task].append(os.path.join(run_dir, '%d.%d' % (
+                                                task, len(runs[task])
+                                            )))
+        write_sorted_run([buffers[task]], runs[task][-1],
+                            combiner=combiner)
+        del buffers[task]
+        del buffer_sizes[task]
+    try:
+        for input_file in input_files:
+            input_stream, process = sorted_stream(input_file)
+            try:
+                for line in input_stream:
+                    line = line.rstrip('\n')
+                    if plan is not None:
+                        key = separator.join(partition_key(line))
+                        try:
+                            task = plan[key]
+                        except KeyError:
+                            task = (crc32(key) & 0xffffffff) % task_count
+                    elif mod_partition:
+                        key = partition_key(line)
+                        try:
+                            if len(key) > 1:
+                                raise ValueError
+                            task = abs(int(key[0])) % task_count
+                        except (IndexError, ValueError):
+                            task = (crc32(separator.join(key))
+                                        & 0xffffffff) % task_count
+                    else:
+                        task = (crc32(separator.join(partition_key(line)))
+                                    & 0xffffffff) % task_count
+                    buffers[task].append(line)
+                    buffer_sizes[task] += len(line) + line_overhead
+                    buffered_bytes += len(line) + line_overhead
+                    if buffered_bytes >= budget:
+                        for task in sorted(buffer_sizes,
+                                            key=buffer_sizes.get,
+                                            reverse=True):
+                            buffered_bytes -= buffer_sizes[task]
+                            spill(task)
+                            if buffered_bytes <= budget // 2:
+                                break
+            finally:
+                input_stream.close()
+                if process is not None:
+                    process.wait()
+        for task in set(buffers.keys()) | set(runs.keys()):
+            task_file = os.path.join(output_dir, '%d.%s%s' % (
+                                            task, process_id,
+                                            '.gz' if gzip else ''
+                                        ))
+            if runs[task]:
+                if buffers[task]:
+                    spill(task)
+                task_run_dir = tempfile.mkdtemp(dir=run_dir)
+                write_sorted_run(
+                        merged_blocks(hierarchical_merge(
+                                                runs[task], fan_in,
+                                                task_run_dir,
+                                                sort_key=sort_key,
+                                                memcap=memcap
+                                            ), sort_key,
+                                        merge_block_size(memcap, fan_in)),
+                        task_file, gzip, gzip_level, combiner
+                    )
+                shutil.rmtree(task_run_dir)
+                for run in runs[task]:
+                    os.remove(run)
+                del runs[task]
+            else:
+                buffers[task].sort(key=line_key)
+                write_sorted_run([buffers[task]], task_file, gzip,
+                                    gzip_level, combiner)
+                del buffers[task]
+    finally:
+        shutil.rmtree(run_dir, ignore_errors=True)
+
 def presorted_tasks(input_files, process_id, sort_options, output_dir,
                     key_fields, separator, partition_options, task_count,
                     memcap, gzip=False, gzip_level=3, scratch=None,
                     direct_write=False, sort='sort', mod_partition=False,
-                    max_attempts=4):
+                    engine='python', combiner=None, dir_to_path=None,
+                    err_dir=None, plan_file=None, fan_in=64, max_attempts=4):
     """ Partitions input data into tasks and presorts them.
 
         Files in output directory are in the format x.y, where x is a task
@@ -232,8 +1229,12 @@ def presorted_tasks(input_files, process_id, sort_options, output_dir,
         ID that identifies which process created the file. y is unimportant;
         the glob x.* should be catted to the reducer.
 
-        Formula for computing task assignment: 
+        Formula for computing task assignment with the external sort engine:
             int(hashlib.md5(key).hexdigest(), 16) % (task_count)
+        and with the python engine:
+            (zlib.crc32(key) & 0xffffffff) % (task_count)
+        unless a plan assigns the key to a task; see PartitionPlan in
+        dooplicity.tools.
 
         input_files: list of files on which to operate.
         process_id: unique identifier for current process.
@@ -255,6 +1256,21 @@ def presorted_tasks(input_files, process_id, sort_options, output_dir,
         sort: path to sort executable
         mod_partition: if True, task is assigned according to formula
             (product of fields) % task_count
+        engine: 'python' to partition and sort in-process with
+            native_presorted_tasks() or 'sort' to write unsorted task files
+            and presort them with UNIX sort. Falls back to 'sort' if
+            sort_options can't be emulated by sort_key_function().
+        combiner: streaming command run on presorted task data before it's
+            written, or None if there is no combiner. Like a Hadoop combiner,
+            it must read and write lines with the same key fields and
+            preserve their sort order.
+        dir_to_path: directory from which to run combiner
+        err_dir: directory in which to write combiner errors; they are
+            written to combine.y.log, where y is the process ID
+        plan_file: path to PartitionPlan that assigns keys to tasks or None
+            to hash all keys; keys not in the plan are hashed
+        fan_in: maximum number of sorted runs of a task merged at once by
+            native_presorted_tasks()
         max_attempts: maximum number of times to attempt partitioning input.
             MUST BE FINAL ARG to be compatible with 
             execute_balanced_job_with_retries().
@@ -302,11 +1318,39 @@ def presorted_tasks(input_files, process_id, sort_options, output_dir,
         if not partitioned_key:
             # Invalid partition options
             return ('Partition options "%s" are invalid.' % partition_options)
+        if plan_file is not None:
+            plan = PartitionPlan(plan_file).assignments(task_count) or None
+        else:
+            plan = None
+        sort_key = (sort_key_function(sort_options, separator)
+                        if engine == 'python' else None)
+        partition_key = partition_key_function(partition_options, separator)
+        if combiner is not None:
+            combiner = '(%s%s 2>>%s)' % (
+                    ('cd %s; ' % dir_to_path) if dir_to_path is not None
+                    else '', combiner,
+                    os.path.abspath(os.path.join(
+                            err_dir if err_dir is not None else output_dir,
+                            'combine.%s.log' % process_id
+                        ))
+                )
+        if sort_key is not None and partition_key is not None:
+            native_presorted_tasks(input_files, process_id, sort_key,
+                                    output_dir, separator, partition_key,
+                                    task_count, memcap, gzip=gzip,
+                                    gzip_level=gzip_level,
+                                    mod_partition=mod_partition,
+                                    combiner=combiner, plan=plan,
+                                    fan_in=fan_in)
+            return None
         for input_file in input_files:
             with yopen(None, input_file) as input_stream:
                 for line in input_stream:
                     key = partitioned_key(line, separator)
-                    if mod_partition and len(key) <= 1:
+                    if (plan is not None and
+                            separator.join(key).rstrip('\n') in plan):
+                        task = plan[separator.join(key).rstrip('\n')]
+                    elif mod_partition and len(key) <= 1:
                         try:
                             task = abs(int(key[0])) % task_count
                         except (IndexError, ValueError):
@@ -355,11 +1399,13 @@ def presorted_tasks(input_files, process_id, sort_options, output_dir,
                                                     % process_id
                                                 )):
                 sort_command = (('set -eo pipefail; gzip -cd %s | '
-                                 'LC_ALL=C %s -S %d %s -t$\'%s\' | '
+                                 'LC_ALL=C %s -S %d %s -t$\'%s\' | %s'
                                  'gzip -c -%d >%s')
                                     % (unsorted_file, sort, memcap,
                                         sort_options,
                                         separator.encode('string_escape'),
+                                        (combiner + ' | ')
+                                        if combiner is not None else '',
                                         gzip_level,
                                         unsorted_file[:-12] + '.gz'))
                 try:
@@ -382,15 +1428,15 @@ def presorted_tasks(input_files, process_id, sort_options, output_dir,
                                                     '*.%s.unsorted'
                                                     % process_id
                                                 )):
-                sort_command = 'LC_ALL=C %s -S %d %s -t$\'%s\' %s >%s' % (
-                                                            sort, memcap,
-                                                            sort_options,
-                                                            separator.encode(
-                                                                'string_escape'
-                                                            ),
-                                                            unsorted_file,
-                                                            unsorted_file[:-9]
-                                                        )
+                sort_command = ('set -eo pipefail; '
+                                'LC_ALL=C %s -S %d %s -t$\'%s\' %s%s >%s') % (
+                                    sort, memcap, sort_options,
+                                    separator.encode('string_escape'),
+                                    unsorted_file,
+                                    (' | ' + combiner)
+                                    if combiner is not None else '',
+                                    unsorted_file[:-9]
+                                )
                 try:
                     subprocess.check_output(sort_command,
                                               shell=True,
@@ -440,7 +1486,8 @@ def step_runner_with_error_return(streaming_command, input_glob, output_dir,
                                   separator, sort_options, memcap,
                                   gzip=False, gzip_level=3, scratch=None,
                                   direct_write=False, sort='sort',
-                                  dir_to_path=None, attempt_number=None):
+                                  dir_to_path=None, engine='python',
+                                  fan_in=64, attempt_number=None):
     """ Runs a streaming command on a task, segregating multiple outputs. 
 
         streaming_command: streaming command to run.
@@ -455,7 +1502,15 @@ def step_runner_with_error_return(streaming_command, input_glob, output_dir,
             environment variable mapred_task_partition and determine
             output filename.
         multiple_outputs: True if output should be divided by key before
-            first instance of separator, described below.
+            first instance of separator, described below. The streaming
+            command may divide output itself and write it straight to
+            output_dir with a dooplicity.tools.MultipleOutputStream, which
+            reads where to write from the environment; whatever it writes to
+            stdout is divided here. Because a MultipleOutputStream appends,
+            the task's files in output_dir are removed before the streaming
+            command starts. Lines from stdout are staged in separate files
+            and appended to the task's files only after the command exits,
+            so an output may be written both ways, even at the same time.
         separator: character separating successive fields in a line from
             input_file.
         sort_options: None if no sort should be performed on input_glob;
@@ -472,6 +1527,14 @@ def step_runner_with_error_return(streaming_command, input_glob, output_dir,
             no matter what scratch is.
         sort: path to sort executable.
         dir_to_path: path to add to PATH.
+        engine: 'python' to merge presorted reducer input in-process and feed
+            it directly to the streaming command or 'sort' to merge it with
+            UNIX sort -m. Falls back to 'sort' unless lines can be compared
+            undecorated; see sort_key_function(). Binary records can only
+            be merged in-process, so they require the python engine.
+        fan_in: maximum number of presorted files a reducer merges at once.
+            If there are more, they're first merged into intermediate runs;
+            see hierarchical_merge().
         attempt_number: attempt number of current task or None if no retries.
             MUST BE FINAL ARG to be compatible with 
             execute_balanced_job_with_retries().
@@ -516,31 +1579,52 @@ def step_runner_with_error_return(streaming_command, input_glob, output_dir,
         if not input_files:
             # No input!
             return None
-        if sort_options is None:
-            # Mapper. Check if first input file is gzip'd
+        sort_key = None
+        if sort_options is None or len(input_files) == 1:
+            '''Mapper, or reducer with a single presorted input file that
+            needn't be merged. Check if first input file is gzip'd'''
             with open(input_files[0], 'rb') as binary_input_stream:
                 if binary_input_stream.read(2) == '\x1f\x8b':
                     # Magic number of gzip'd file found
                     prefix = 'gzip -cd %s' % input_glob
                 else:
                     prefix = 'cat %s' % input_glob
+        elif engine == 'python' and getattr(
+                        sort_key_function(sort_options, separator),
+                        'whole_line', False
+                    ):
+            '''Reducer. Merge presorted input in-process and feed reducer.
+            When lines must be decorated with keys to be compared, UNIX sort
+            merges faster, so it's used below instead.'''
+            sort_key = sort_key_function(sort_options, separator)
+            prefix = None
         else:
             # Reducer. Merge sort the input glob.
-            if gzip:
-                # Use process substitution
-                prefix = '(LC_ALL=C %s -S %d %s -t$\'%s\' -m %s' % (
-                        sort, memcap, sort_options,
-                        separator.encode('string_escape'),
-                        ' '.join(['<(gzip -cd %s)' % input_file
-                                    for input_file in input_files]) + ')'
+            prefix = sort_merge_command(input_files if gzip else input_glob,
+                                        sort, memcap, sort_options,
+                                        separator, gzip)
+        if sort_options is not None and len(input_files) > max(fan_in, 2):
+            '''Too many presorted files to merge at once; merge them into
+            intermediate runs first so open files and decompression processes
+            are capped.'''
+            if scratch == '-':
+                merge_dir = tempfile.mkdtemp(prefix='merge.')
+            elif scratch:
+                merge_dir = tempfile.mkdtemp(
+                        prefix='merge.',
+                        dir=os.path.expanduser(os.path.expandvars(scratch))
                     )
             else:
-                # Reducer. Merge sort the input glob.
-                prefix = 'LC_ALL=C %s -S %d %s -t$\'%s\' -m %s' % (sort,
-                                            memcap,
-                                            sort_options,
-                                            separator.encode('string_escape'),
-                                            input_glob)
+                merge_dir = tempfile.mkdtemp(
+                        prefix='merge.', dir=os.path.dirname(input_files[0])
+                    )
+            input_files = hierarchical_merge(input_files, fan_in, merge_dir,
+                                                sort_key, sort, memcap,
+                                                sort_options, separator,
+                                                gzip, gzip_level)
+            if sort_key is None:
+                prefix = sort_merge_command(input_files, sort, memcap,
+                                            sort_options, separator, gzip)
         err_file = os.path.abspath(os.path.join(err_dir, (
                                             ('%d.log' % task_id)
                                                 if attempt_number is None
@@ -552,10 +1636,31 @@ def step_runner_with_error_return(streaming_command, input_glob, output_dir,
         new_env = os.environ.copy()
         new_env['mapreduce_task_partition'] \
             = new_env['mapred_task_partition'] = str(task_id)
+        if prefix is None:
+            prefix = streaming_command
+        else:
+            prefix = ' | '.join([prefix, streaming_command])
         if multiple_outputs:
+            # For streaming commands that write outputs directly
+            new_env['dooplicity_output_dir'] = os.path.abspath(output_dir)
+            new_env['dooplicity_output_gzip_level'] = (
+                    str(gzip_level) if gzip else '0'
+                )
+            new_env['dooplicity_output_separator'] = separator
+            task_filename = str(task_id) + ('.gz' if gzip else '')
+            staged_filename = '.%d.stdout%s' % (task_id,
+                                                '.gz' if gzip else '')
+            # Clear files written by an earlier attempt at the task
+            for stale_file in (
+                    glob.glob(os.path.join(output_dir, '*', str(task_id)))
+                    + glob.glob(os.path.join(output_dir, '*',
+                                                str(task_id) + '.gz'))
+                    + glob.glob(os.path.join(output_dir, '*',
+                                                '.%d.stdout*' % task_id))
+                ):
+                os.remove(stale_file)
             # Must grab each line of output and separate by directory
-            command_to_run \
-                = prefix + ' | ' + streaming_command + (' 2>%s' % err_file)
+            command_to_run = prefix + (' 2>%s' % err_file)
             # Need bash or zsh for process substitution
             multiple_output_process = subprocess.Popen(
                     ' '.join([('set -eo pipefail; cd %s;' % dir_to_path)
@@ -563,12 +1668,25 @@ def step_runner_with_error_return(streaming_command, input_glob, output_dir,
                                 else 'set -eo pipefail;',
                               command_to_run]),
                     shell=True,
+                    stdin=(subprocess.PIPE if sort_key is not None
+                            else None),
                     stdout=subprocess.PIPE,
                     stderr=open(os.devnull, 'w'),
                     env=new_env,
                     bufsize=-1,
                     executable='/bin/bash'
                 )
+            if sort_key is not None:
+                feeder_errors = []
+                feeder = threading.Thread(
+                        target=feed_merged_lines,
+                        args=(input_files, sort_key,
+                                multiple_output_process.stdin,
+                                merge_block_size(memcap, fan_in),
+                                feeder_errors)
+                    )
+                feeder.daemon = True
+                feeder.start()
             task_file_streams = {}
             if gzip:
                 task_file_stream_processes = {}
@@ -592,7 +1710,7 @@ def step_runner_with_error_return(streaming_command, input_glob, output_dir,
                         task_file_stream_processes[key] = subprocess.Popen(
                                 'gzip -%d >%s' % 
                                 (gzip_level,
-                                 os.path.join(key_dir, str(task_id) + '.gz')),
+                                 os.path.join(key_dir, staged_filename)),
                                 shell=True, bufsize=-1,
                                 executable='/bin/bash',
                                 stdin=subprocess.PIPE
@@ -601,22 +1719,44 @@ def step_runner_with_error_return(streaming_command, input_glob, output_dir,
                             = task_file_stream_processes[key].stdin
                     else:
                         task_file_streams[key] = open(
-                                os.path.join(key_dir, str(task_id)), 'w'
+                                os.path.join(key_dir, staged_filename), 'w'
                             )
                     task_file_streams[key].write(line_to_write)
             multiple_output_process_return = multiple_output_process.wait()
+            if sort_key is not None:
+                feeder.join()
             if multiple_output_process_return != 0:
                 return (('Streaming command "%s" failed; exit level was %d.')
                          % (command_to_run, multiple_output_process_return))
+            if sort_key is not None and feeder_errors:
+                return (('Merging input of streaming command "%s" failed:'
+                         '\n\n%s') % (command_to_run, feeder_errors[0]))
             for key in task_file_streams:
                 task_file_streams[key].close()
+                if gzip and task_file_stream_processes[key].wait():
+                    return ('Compressing output %s of streaming command "%s" '
+                            'failed; exit level was %d.') % (
+                                    key, command_to_run,
+                                    task_file_stream_processes[key].returncode
+                                )
+                '''Append staged lines to what the command wrote directly;
+                concatenated gzip members decompress to concatenated data.'''
+                staged_file = os.path.join(output_dir, key, staged_filename)
+                task_file = os.path.join(output_dir, key, task_filename)
+                if os.path.exists(task_file):
+                    with open(task_file, 'ab') as task_stream:
+                        with open(staged_file, 'rb') as staged_stream:
+                            shutil.copyfileobj(staged_stream, task_stream)
+                    os.remove(staged_file)
+                else:
+                    os.rename(staged_file, task_file)
         else:
             if gzip:
                 out_file = os.path.abspath(
                                 os.path.join(output_dir, str(task_id) + '.gz')
                             )
                 command_to_run \
-                    = prefix + ' | ' + streaming_command + (
+                    = prefix + (
                             ' 2>%s | gzip -%d >%s'
                                 % (err_file,
                                     gzip_level,
@@ -627,16 +1767,31 @@ def step_runner_with_error_return(streaming_command, input_glob, output_dir,
                                 os.path.join(output_dir, str(task_id))
                             )
                 command_to_run \
-                    = prefix + ' | ' + streaming_command + (' >%s 2>%s'
-                                                             % (out_file,
-                                                                err_file))
+                    = prefix + (' >%s 2>%s' % (out_file, err_file))
+            full_command = ' '.join([('set -eo pipefail; cd %s;'
+                                        % dir_to_path)
+                                        if dir_to_path is not None
+                                        else 'set -eo pipefail;',
+                                      command_to_run])
+            if sort_key is not None:
+                streaming_process = subprocess.Popen(full_command,
+                                                        shell=True,
+                                                        env=new_env,
+                                                        bufsize=-1,
+                                                        stdin=subprocess.PIPE,
+                                                        executable='/bin/bash')
+                feed_merged_lines(input_files, sort_key,
+                                    streaming_process.stdin,
+                                    merge_block_size(memcap, fan_in))
+                streaming_process_return = streaming_process.wait()
+                if streaming_process_return != 0:
+                    return (('Streaming command "%s" failed; exit level was '
+                             '%d.') % (command_to_run,
+                                        streaming_process_return))
+                return None
             try:
                 # Need bash or zsh for process substitution
-                subprocess.check_output(' '.join([('set -eo pipefail; cd %s;'
-                                                    % dir_to_path)
-                                                    if dir_to_path is not None
-                                                    else 'set -eo pipefail;',
-                                                  command_to_run]),
+                subprocess.check_output(full_command,
                                             shell=True,
                                             env=new_env,
                                             bufsize=-1,
@@ -652,6 +1807,8 @@ def step_runner_with_error_return(streaming_command, input_glob, output_dir,
         return ('Error\n\n%s\nencountered executing task on input %s.'
                 % (format_exc(), input_glob))
     finally:
+        if 'merge_dir' in locals():
+            shutil.rmtree(merge_dir, ignore_errors=True)
         if 'task_file_stream_processes' in locals():
             for key in task_file_streams:
                 task_file_streams[key].close()
@@ -677,12 +1834,494 @@ def step_runner_with_error_return(streaming_command, input_glob, output_dir,
                         )
             shutil.rmtree(output_dir)
 
+def kill_descendants(pid):
+    """ Terminates every descendant of a process.
+
+        pid: process ID
+
+        No return value.
+    """
+    try:
+        process_table = subprocess.check_output(['ps', '-eo', 'pid=,ppid='])
+    except (OSError, subprocess.CalledProcessError):
+        return
+    children = {}
+    for line in process_table.splitlines():
+        tokens = line.split()
+        if len(tokens) == 2:
+            children.setdefault(int(tokens[1]), []).append(int(tokens[0]))
+    descendants, parents = [], [pid]
+    while parents:
+        parent = parents.pop()
+        for child in children.get(parent, []):
+            descendants.append(child)
+            parents.append(child)
+    for descendant in descendants:
+        try:
+            os.kill(descendant, signal.SIGTERM)
+        except OSError:
+            pass
+
+def committed_step_runner(commit_lock, streaming_command, input_glob,
+                            output_dir, err_dir, *args):
+    """ Runs one of possibly several concurrent attempts at a step task.
+
+        For speculative execution. The attempt writes to a private directory
+        in err_dir. If its streaming command succeeds, it creates commit_lock
+        exclusively and moves its output into output_dir. If another attempt
+        already created commit_lock, the output is discarded instead, and
+        while the streaming command is running, its processes are killed as
+        soon as commit_lock appears. Either way, the attempt whose output was
+        kept, identified by its attempt number, is recorded in commit_lock.
+        Because the streaming command's
+        processes are found among the descendants of the current process,
+        the attempt must run in a worker process or IPython engine.
+
+        commit_lock: path of file created by the attempt whose output is
+            kept
+        streaming_command, input_glob, output_dir, err_dir, *args: arguments
+            of step_runner_with_error_return(); the final one must be the
+            attempt number
+
+        Return value: None iff the task succeeded, whether or not it was this
+            attempt whose output was kept; otherwise error message.
+    """
+    import errno
+    attempt_dir = tempfile.mkdtemp(prefix='attempt.', dir=err_dir)
+    finished = threading.Event()
+    def kill_if_committed():
+        while not finished.wait(1):
+            if os.path.exists(commit_lock):
+                kill_descendants(os.getpid())
+                return
+    watcher = threading.Thread(target=kill_if_committed)
+    watcher.daemon = True
+    watcher.start()
+    try:
+        return_value = step_runner_with_error_return(streaming_command,
+                                                        input_glob,
+                                                        attempt_dir, err_dir,
+                                                        *args)
+        finished.set()
+        watcher.join()
+        if return_value is not None:
+            if os.path.exists(commit_lock):
+                # Killed because another attempt succeeded
+                return None
+            return return_value
+        try:
+            lock_fd = os.open(commit_lock,
+                                os.O_CREAT | os.O_EXCL | os.O_WRONLY)
+        except OSError as e:
+            if e.errno == errno.EEXIST:
+                return None
+            raise
+        os.write(lock_fd, '%s\n' % args[-1])
+        os.close(lock_fd)
+        for root, _, filenames in os.walk(attempt_dir):
+            destination = os.path.join(output_dir,
+                                        os.path.relpath(root, attempt_dir))
+            if filenames:
+                try:
+                    os.makedirs(destination)
+                except OSError:
+                    # Directory already exists
+                    pass
+            for filename in filenames:
+                shutil.move(os.path.join(root, filename),
+                            os.path.join(destination, filename))
+        return None
+    finally:
+        finished.set()
+        shutil.rmtree(attempt_dir, ignore_errors=True)
+
+class Speculator(object):
+    """ Picks straggling tasks to back up, as in Hadoop.
+
+        A running task is a straggler once it has run slowdown times longer
+        than expected. A task's expected run time is its input size divided
+        by the median rate at which completed tasks of the phase processed
+        input or, absent input sizes, the median run time of completed
+        tasks. Backups are considered only once min_completed of the
+        phase's tasks have completed and only for tasks that have run at
+        least min_run_time seconds; a task is backed up at most once.
+    """
+    def __init__(self, task_count, slowdown=3.0, min_completed=0.75,
+                    min_run_time=30.0):
+        """
+            task_count: number of tasks in phase
+            slowdown: how many times longer than expected a task must run
+                to be backed up
+            min_completed: fraction of tasks that must complete before any
+                is backed up
+            min_run_time: minimum number of seconds a task must run to be
+                backed up
+        """
+        self.task_count = task_count
+        self.slowdown = slowdown
+        self.min_completed = min_completed
+        self.min_run_time = min_run_time
+        self.running, self.backed_up = {}, set()
+        self.run_times, self.rates = [], []
+
+    def start(self, task, size=0):
+        """ Records that a task's first or retried attempt started.
+
+            task: identifier of task
+            size: bytes of input to task
+
+            No return value.
+        """
+        self.running[task] = (time.time(), size)
+
+    def backup(self, task):
+        """ Records that a task was backed up.
+
+            task: identifier of task
+
+            No return value.
+        """
+        self.backed_up.add(task)
+
+    def finish(self, task, succeeded=True):
+        """ Records that a task stopped running.
+
+            task: identifier of task
+            succeeded: True iff some attempt at the task succeeded
+
+            No return value.
+        """
+        try:
+            start_time, size = self.running.pop(task)
+        except KeyError:
+            return
+        if succeeded:
+            run_time = max(time.time() - start_time, 1e-6)
+            self.run_times.append(run_time)
+            if size:
+                self.rates.append(size / run_time)
+
+    def stragglers(self):
+        """ Lists running tasks that should be backed up.
+
+            Return value: list of identifiers of tasks, most overdue first
+        """
+        if (not self.run_times
+                or len(self.run_times) < self.min_completed * self.task_count):
+            return []
+        def median(values):
+            return sorted(values)[len(values) // 2]
+        median_run_time = median(self.run_times)
+        median_rate = median(self.rates) if self.rates else None
+        now, overdue = time.time(), []
+        for task, (start_time, size) in self.running.items():
+            if task in self.backed_up:
+                continue
+            expected = (float(size) / median_rate if size and median_rate
+                            else median_run_time)
+            elapsed = now - start_time
+            if elapsed >= max(self.slowdown * expected, self.min_run_time):
+                overdue.append((elapsed / max(expected, 1e-6), task))
+        return [task for _, task in sorted(overdue, reverse=True)]
+
+def task_paths(task_function, task_function_args, outputs=False):
+    """ Lists globs of files a task reads or writes.
+
+        Only tasks of step_runner_with_error_return() and presorted_tasks(),
+        possibly wrapped by checkpointed_task() and committed_step_runner(),
+        are understood; other tasks are taken to read and write nothing.
+
+        task_function: function executing task
+        task_function_args: list of task_function's args
+        outputs: True to list globs of files written rather than read
+
+        Return value: list of globs
+    """
+    if task_function is checkpointed_task:
+        task_function, task_function_args = (task_function_args[0],
+                                                task_function_args[3:])
+    if task_function is committed_step_runner:
+        task_function, task_function_args = (step_runner_with_error_return,
+                                                task_function_args[1:])
+    if task_function is step_runner_with_error_return:
+        if not outputs:
+            return [task_function_args[1]]
+        output_dir, task_id = task_function_args[2], task_function_args[4]
+        return [os.path.join(output_dir, key_dir, str(task_id) + extension)
+                    for key_dir in ['', '*'] for extension in ['', '.gz']]
+    if task_function is presorted_tasks:
+        if not outputs:
+            return list(task_function_args[0])
+        output_dir, process_id = task_function_args[3], task_function_args[1]
+        return [os.path.join(output_dir, '*.%s%s' % (process_id, extension))
+                    for extension in ['', '.gz']]
+    return []
+
+def avoided_engines(tried_engines, host_map, backup=False):
+    """ Finds engines on which an attempt at a task mustn't run in --ipy mode.
+
+        An attempt avoids the engines that already tried the task. After two
+        attempts, it avoids their hosts, too. So does a backup of a
+        straggler, unless no engine would be left, as on a single-host
+        cluster; the backup then runs on another engine of the same host.
+
+        tried_engines: list of engines that attempted the task
+        host_map: dictionary mapping every engine to its host
+        backup: True iff the attempt backs up a straggler
+
+        Return value: set of engines
+    """
+    avoided = set(tried_engines)
+    if len(avoided) >= 2 or backup:
+        tried_hosts = set([host_map[engine] for engine in tried_engines])
+        avoided_hosts = set([engine for engine in host_map
+                                if host_map[engine] in tried_hosts])
+        if len(avoided) >= 2 or len(avoided_hosts) < len(host_map):
+            avoided = avoided_hosts
+    return avoided
+
+class TaskScheduler(object):
+    """ Orders tasks and picks engines for them in --ipy mode.
+
+        Tasks are dispatched longest first by bytes of input so big tasks
+        don't start last and straggle. A task goes to an engine on the host
+        that wrote most of its input if one is free because that host is
+        likeliest to have the input cached. Queue waits, run times, and idle
+        engine time are recorded for summary().
+    """
+    def __init__(self, host_map, file_hosts=None, seed=None):
+        """
+            host_map: dictionary mapping engine IDs to hostnames
+            file_hosts: dictionary mapping absolute paths of files written
+                by tasks to hostnames; it's updated as tasks succeed, so the
+                same dictionary should be passed for every step
+            seed: seed for picking among equally preferred engines
+        """
+        from random import Random
+        self.host_map = host_map
+        self.file_hosts = file_hosts if file_hosts is not None else {}
+        self.free_engines = set(host_map)
+        self.random = Random(seed)
+        self.queue = []
+        self.tasks, self.enqueued, self.dispatched = {}, {}, {}
+        self.queue_waits, self.run_times = [], []
+        self.local_count, self.busy_seconds = 0, 0.0
+        self.order = itertools.count()
+        self.start_time = time.time()
+
+    def add(self, task, task_function, task_function_args):
+        """ Queues a task.
+
+            task: unique hashable identifier of task
+            task_function: function executing task
+            task_function_args: list of task_function's args
+
+            No return value.
+        """
+        size, host_sizes = 0, defaultdict(int)
+        for path_glob in task_paths(task_function, task_function_args):
+            for path in glob.glob(path_glob):
+                try:
+                    path_size = os.path.getsize(path)
+                except OSError:
+                    continue
+                size += path_size
+                try:
+                    host_sizes[self.file_hosts[os.path.abspath(path)]] \
+                        += path_size
+                except KeyError:
+                    pass
+        self.tasks[task] = (task_function, task_function_args, size,
+                            sorted(host_sizes, key=host_sizes.get,
+                                    reverse=True))
+        self.retry(task)
+
+    def retry(self, task):
+        """ Queues a task again after it failed.
+
+            task: identifier of task passed to add()
+
+            No return value.
+        """
+        self.enqueued[task] = time.time()
+        heapq.heappush(self.queue, (-self.tasks[task][2], self.order.next(),
+                                        task))
+
+    def cancel(self, task):
+        """ Removes a task from the queue if it's there.
+
+            task: identifier of task
+
+            No return value.
+        """
+        if self.enqueued.pop(task, None) is not None:
+            self.queue = [item for item in self.queue if item[-1] != task]
+            heapq.heapify(self.queue)
+
+    def assign(self, forbidden_engines=lambda task: set()):
+        """ Assigns queued tasks to free engines.
+
+            forbidden_engines: function mapping a task to the set of engines
+                on which it mustn't run; a task that mustn't run on any free
+                engine stays queued
+
+            Return value: list of tuples (task, engine)
+        """
+        assignments, skipped = [], []
+        while self.queue and self.free_engines:
+            item = heapq.heappop(self.queue)
+            task = item[-1]
+            allowed = self.free_engines - forbidden_engines(task)
+            if not allowed:
+                skipped.append(item)
+                continue
+            candidates = []
+            for host in self.tasks[task][3]:
+                candidates = [engine for engine in allowed
+                                if self.host_map[engine] == host]
+                if candidates:
+                    self.local_count += 1
+                    break
+            engine = self.random.choice(sorted(candidates or allowed))
+            self.free_engines.remove(engine)
+            now = time.time()
+            self.queue_waits.append(now - self.enqueued.pop(task))
+            self.dispatched[task] = (engine, now)
+            assignments.append((task, engine))
+        for item in skipped:
+            heapq.heappush(self.queue, item)
+        return assignments
+
+    def finish(self, task, succeeded=True):
+        """ Frees a task's engine after the task finishes.
+
+            task: identifier of task
+            succeeded: True iff task succeeded, in which case the host of
+                its engine is recorded as the writer of its outputs
+
+            Return value: engine on which task ran
+        """
+        engine, dispatch_time = self.dispatched.pop(task)
+        run_time = time.time() - dispatch_time
+        self.run_times.append(run_time)
+        self.busy_seconds += run_time
+        self.free_engines.add(engine)
+        if succeeded:
+            task_function, task_function_args = self.tasks[task][:2]
+            for path_glob in task_paths(task_function, task_function_args,
+                                        outputs=True):
+                for path in glob.glob(path_glob):
+                    self.file_hosts[os.path.abspath(path)] \
+                        = self.host_map[engine]
+        return engine
+
+    def summary(self):
+        """ Summarizes scheduling of tasks so far.
+
+            Return value: summary string
+        """
+        if not self.run_times:
+            return 'No tasks were scheduled.'
+        idle_seconds = max(
+                len(self.host_map) * (time.time() - self.start_time)
+                - self.busy_seconds, 0
+            )
+        return ('Queue wait (mean/max): %.1f/%.1f s | Run time (mean/max): '
+                '%.1f/%.1f s | Idle engine-seconds: %.1f | Dispatched to '
+                'input\'s host: %d/%d') % (
+                    sum(self.queue_waits) / len(self.queue_waits),
+                    max(self.queue_waits),
+                    sum(self.run_times) / len(self.run_times),
+                    max(self.run_times), idle_seconds, self.local_count,
+                    len(self.queue_waits)
+                )
+
+class TaskEvents(object):
+    """ Waits for IPython AsyncResults to finish without polling each one.
+
+        AsyncResults that are futures, as in ipyparallel, report to a queue
+        when they finish. Otherwise, the client is spun only when results
+        reach its sockets rather than at a fixed interval.
+    """
+    def __init__(self, pool):
+        """
+            pool: IPython Client object
+        """
+        import Queue
+        self.pool = pool
+        self.finished = Queue.Queue()
+        self.empty = Queue.Empty
+        self.pending = {}
+        try:
+            import zmq
+            self.poller = zmq.Poller()
+            for socket_name in ['_mux_socket', '_task_socket',
+                                '_notification_socket']:
+                self.poller.register(getattr(pool, socket_name), zmq.POLLIN)
+        except (ImportError, AttributeError):
+            self.poller = None
+
+    def add(self, task, asyncresult):
+        """ Watches an AsyncResult.
+
+            task: identifier of task whose result is asyncresult
+            asyncresult: AsyncResult object
+
+            No return value.
+        """
+        try:
+            asyncresult.add_done_callback(
+                    lambda _, task=task: self.finished.put(task)
+                )
+        except AttributeError:
+            self.pending[task] = set(asyncresult.msg_ids)
+
+    def wait(self, timeout=None):
+        """ Waits for watched AsyncResults to finish.
+
+            timeout: maximum number of seconds to wait or None to wait
+                indefinitely
+
+            Return value: list of identifiers of tasks whose AsyncResults
+                finished, at least one unless timeout elapsed
+        """
+        start_time = time.time()
+        while True:
+            finished = []
+            if self.pending:
+                self.pool.spin()
+                outstanding = self.pool.outstanding
+                for task in self.pending.keys():
+                    if not (self.pending[task] & outstanding):
+                        finished.append(task)
+                        del self.pending[task]
+            while True:
+                try:
+                    finished.append(self.finished.get_nowait())
+                except self.empty:
+                    break
+            if finished or (timeout is not None
+                                and time.time() - start_time >= timeout):
+                return finished
+            if not self.pending:
+                try:
+                    # Time out so KeyboardInterrupt is still handled
+                    return [self.finished.get(timeout=1)]
+                except self.empty:
+                    pass
+            elif self.poller is not None:
+                self.poller.poll(1000)
+            else:
+                time.sleep(0.01)
+
 def run_simulation(branding, json_config, force, memcap, num_processes,
                     separator, keep_intermediates, keep_last_output,
                     log, gzip=False, gzip_level=3, ipy=False,
                     ipcontroller_json=None, ipy_profile=None, scratch=None,
                     common=None, sort='sort', max_attempts=4,
-                    direct_write=False):
+                    direct_write=False, shuffle_engine='python',
+                    pipeline=False, resume=False, merge_fan_in=64,
+                    speculate=False, speculative_slowdown=3.0):
     """ Runs Hadoop Streaming simulation.
 
         FUNCTIONALITY IS IDIOSYNCRATIC; it is currently confined to those
@@ -722,6 +2361,19 @@ def run_simulation(branding, json_config, force, memcap, num_processes,
         max_attempts: maximum number of times to attempt a task in ipy mode.
         direct_write: always writes intermediate files directly to final
             destination, even when scratch is specified
+        shuffle_engine: 'python' to partition, sort, and merge intermediate
+            data in-process; 'sort' to use UNIX sort
+        pipeline: True iff steps should be scheduled as soon as their inputs
+            are ready rather than one at a time; see
+            execute_pipelined_job_flow()
+        resume: True iff steps and tasks completed by an earlier run of the
+            job flow should be skipped; see --resume
+        merge_fan_in: maximum number of presorted files a reducer merges at
+            once; see --merge-fan-in
+        speculate: True iff backup attempts of straggling map and reduce tasks
+            should be launched; see --speculate
+        speculative_slowdown: how many times longer than expected a task must
+            run to be backed up; see Speculator
 
         No return value.
     """
@@ -747,6 +2399,11 @@ def run_simulation(branding, json_config, force, memcap, num_processes,
     try:
         # Using IPython?
         if ipy:
+            if pipeline:
+                iface.fail('Pipelined execution is not supported in --ipy '
+                           'mode. Rerun without --pipeline.')
+                failed = True
+                raise RuntimeError
             try:
                 from IPython.parallel import Client
             except ImportError:
@@ -825,12 +2482,38 @@ def run_simulation(branding, json_config, force, memcap, num_processes,
                 import tempfile
                 import shutil
                 import os
+                import heapq
+                import zlib
+                import re
+                import threading
+                import signal
+                import sys
             direct_view.push(dict(
                     yopen=yopen,
                     step_runner_with_error_return=\
                         step_runner_with_error_return,
                     presorted_tasks=presorted_tasks,
-                    parsed_keys=parsed_keys
+                    parsed_keys=parsed_keys,
+                    _key_specs=_key_specs,
+                    sort_key_function=sort_key_function,
+                    partition_key_function=partition_key_function,
+                    _numeric_prefix=_numeric_prefix,
+                    _sort_numeric=_sort_numeric,
+                    sorted_stream=sorted_stream,
+                    _item_overhead=_item_overhead,
+                    merged_blocks=merged_blocks,
+                    merge_block_size=merge_block_size,
+                    merge_plan=merge_plan,
+                    sort_merge_command=sort_merge_command,
+                    hierarchical_merge=hierarchical_merge,
+                    feed_merged_lines=feed_merged_lines,
+                    write_blocks=write_blocks,
+                    write_sorted_run=write_sorted_run,
+                    native_presorted_tasks=native_presorted_tasks,
+                    PartitionPlan=PartitionPlan,
+                    checkpointed_task=checkpointed_task,
+                    kill_descendants=kill_descendants,
+                    committed_step_runner=committed_step_runner
                 ))
             iface.step('Loaded dependencies on IPython engines.')
             # Get host-to-engine and engine pids relations
@@ -842,6 +2525,8 @@ def run_simulation(branding, json_config, force, memcap, num_processes,
             engine_map = defaultdict(list)
             for engine in host_map:
                 engine_map[host_map[engine]].append(engine)
+            # Hosts that wrote intermediate files; see TaskScheduler
+            file_hosts = {}
             pid_map = apply_async_with_errors(
                                     pool, all_engines, os.getpid,
                                     dict_format=True
@@ -887,10 +2572,12 @@ def run_simulation(branding, json_config, force, memcap, num_processes,
                 finish_message='Completed tasks.', max_attempts=4):
                 """ Executes parallel job over IPython engines with retries.
 
-                    Tasks are assigned to free engines as they become
-                    available. If a task fails on one engine, it is retried on
-                    another engine. If a task has been tried on all engines but
-                    fails before max_attempts is exceeded, the step is failed.
+                    Tasks are assigned to free engines as soon as they become
+                    available, longest first and preferably on the host that
+                    wrote their inputs; see TaskScheduler. If a task fails on
+                    one engine, it is retried on another engine. If a task has
+                    been tried on all engines but fails before max_attempts is
+                    exceeded, the step is failed.
 
                     pool: IPython Client object; all engines it spans are used
                     iface: DooplicityInterface object for spewing log messages
@@ -911,110 +2598,129 @@ def run_simulation(branding, json_config, force, memcap, num_processes,
                     No return value.
                 """
                 global failed
-                random.seed(pool.ids[-1])
-                used_engines, free_engines = set(), set(pool.ids)
+                scheduler = TaskScheduler(host_map, file_hosts,
+                                            seed=pool.ids[-1])
+                task_function_args = list(task_function_args)
+                tried_engines, failures = {}, {}
+                for i, task_function_arg in enumerate(task_function_args):
+                    scheduler.add(i, task_function, task_function_arg)
+                    tried_engines[i], failures[i] = [], 0
+                task_count = len(task_function_args)
                 completed_tasks = 0
-                tasks_to_assign = deque([
-                        [task_function_arg, i, []] for i, task_function_arg
-                        in enumerate(task_function_args)
-                    ])
-                task_count = len(tasks_to_assign)
-                assigned_tasks, asyncresults = {}, {}
+                events = TaskEvents(pool)
+                asyncresults, completed = {}, set()
                 max_task_fails = 0
+                '''Straggling tasks are backed up only if attempts commit
+                output atomically; see committed_step_runner().'''
+                speculator = (Speculator(task_count, speculative_slowdown)
+                                if task_count and committed_step_runner in [
+                                    task_function, task_function_args[0][0]
+                                ] else None)
+                backups, backups_won = 0, 0
+                def forbidden_engines(key):
+                    task = key[0] if isinstance(key, tuple) else key
+                    return avoided_engines(tried_engines[task], host_map,
+                                            backup=(key != task))
                 iface.status(('    %s: '
                               '%d/%d | \\max_i (task_i fails): %d/%d')
                                 % (status_message, completed_tasks,
                                     task_count, max_task_fails,
                                     max_attempts - 1))
                 while completed_tasks < task_count:
-                    if tasks_to_assign:
-                        task_to_assign = tasks_to_assign.popleft()
-                        forbidden_engines = set(task_to_assign[2])
-                        if len(forbidden_engines) >= 2:
-                            # After two fails, do not allow reused nodes
-                            for forbidden_engine in task_to_assign[2]:
-                                forbidden_engines.update(
-                                    engine_map[host_map[forbidden_engine]]
-                                )
-                        if all_engines <= forbidden_engines:
-                            iface.fail(('No more running IPython engines '
-                                        'and/or nodes on which function-arg '
-                                        'combo (%s, %s) has not failed '
-                                        'attempt to execute. Check the '
-                                        'IPython cluster\'s integrity and '
-                                        'resource availability.')
-                                         % (task_function, task_to_assign[0]),
-                                         steps=(job_flow[step_number:]
-                                            if step_number != 0 else None))
-                            failed = True
-                            raise RuntimeError
-                        try:
-                            assigned_engine = random.choice(
-                                    list(free_engines - forbidden_engines)
-                                )
-                        except IndexError:
-                            # No engine to assign yet; add back to queue
-                            tasks_to_assign.append(task_to_assign)
-                        else:
-                            asyncresults[task_to_assign[1]] = (
-                                pool[assigned_engine].apply_async(
-                                    task_function,
-                                    *(task_to_assign[0] +
-                                      [len(task_to_assign[2])])
-                                )
+                    if (speculator is not None and not scheduler.queue
+                            and scheduler.free_engines):
+                        for task in speculator.stragglers():
+                            speculator.backup(task)
+                            scheduler.add((task, 'backup'), task_function,
+                                            task_function_args[task])
+                            backups += 1
+                    for key, engine in scheduler.assign(forbidden_engines):
+                        task = key[0] if isinstance(key, tuple) else key
+                        asyncresults[key] = pool[engine].apply_async(
+                                task_function,
+                                *(task_function_args[task] +
+                                  [len(tried_engines[task])])
                             )
-                            assigned_tasks[task_to_assign[1]] = [
-                                    task_to_assign[0], task_to_assign[1],
-                                    task_to_assign[2] + [assigned_engine]
-                                ]
-                            used_engines.add(assigned_engine)
-                            free_engines.remove(assigned_engine)
-                    asyncresults_to_remove = []
-                    for task in asyncresults:
-                        if asyncresults[task].ready():
-                            return_value = asyncresults[task].get()
-                            if return_value is not None:
-                                if max_attempts > len(assigned_tasks[task][2]):
-                                    # Add to queue for reattempt
-                                    tasks_to_assign.append(
-                                            assigned_tasks[task]
-                                        )
-                                    max_task_fails = max(
-                                            len(assigned_tasks[task][2]),
-                                            max_task_fails
-                                        )
-                                    asyncresults_to_remove.append(task)
-                                else:
-                                    # Bail if max_attempts is saturated
-                                    iface.fail(return_value,
-                                    steps=(job_flow[step_number:]
-                                            if step_number != 0 else None))
+                        tried_engines[task].append(engine)
+                        events.add(key, asyncresults[key])
+                        if speculator is not None and key == task:
+                            speculator.start(task, scheduler.tasks[task][2])
+                    for key in events.wait(
+                                    5 if speculator is not None else None
+                                ):
+                        task = key[0] if isinstance(key, tuple) else key
+                        return_value = asyncresults.pop(key).get()
+                        scheduler.finish(key, return_value is None
+                                                and task not in completed)
+                        if task in completed:
+                            # Another attempt at the task already succeeded
+                            continue
+                        if return_value is None:
+                            # Success
+                            completed_tasks += 1
+                            completed.add(task)
+                            if speculator is not None:
+                                speculator.finish(task)
+                                scheduler.cancel((task, 'backup'))
+                                if key != task:
+                                    backups_won += 1
+                        elif (task in asyncresults
+                                or (task, 'backup') in asyncresults):
+                            # Another attempt at the task is still running
+                            failures[task] += 1
+                        else:
+                            failures[task] += 1
+                            if speculator is not None:
+                                speculator.finish(task, False)
+                            if max_attempts > failures[task]:
+                                if all_engines <= forbidden_engines(task):
+                                    iface.fail(('No more running IPython '
+                                                'engines and/or nodes on '
+                                                'which function-arg combo '
+                                                '(%s, %s) has not failed '
+                                                'attempt to execute. Check '
+                                                'the IPython cluster\'s '
+                                                'integrity and resource '
+                                                'availability.')
+                                                % (task_function,
+                                                    task_function_args[task]),
+                                                steps=(job_flow[step_number:]
+                                                    if step_number != 0
+                                                    else None))
                                     failed = True
                                     raise RuntimeError
+                                # Add to queue for reattempt
+                                scheduler.cancel((task, 'backup'))
+                                scheduler.retry(task)
+                                max_task_fails = max(
+                                        failures[task],
+                                        max_task_fails
+                                    )
                             else:
-                                # Success
-                                completed_tasks += 1
-                                asyncresults_to_remove.append(task)
-                            iface.status(('    %s: '
-                                          '%d/%d | '
-                                          '\\max_i (task_i fails): '
-                                          '%d/%d')
-                                % (status_message, completed_tasks,
-                                    task_count, max_task_fails,
-                                    max_attempts - 1))
-                            assert assigned_tasks[task][-1][-1] == \
-                                asyncresults[task].engine_id
-                            # Free engine
-                            used_engines.remove(
-                                    assigned_tasks[task][-1][-1]
-                                )
-                            free_engines.add(assigned_tasks[task][-1][-1])
-                    for task in asyncresults_to_remove:
-                        del asyncresults[task]
-                        del assigned_tasks[task]
-                    time.sleep(0.1)
-                assert not used_engines
+                                # Bail if max_attempts is saturated
+                                iface.fail(return_value,
+                                steps=(job_flow[step_number:]
+                                        if step_number != 0 else None))
+                                failed = True
+                                raise RuntimeError
+                        iface.status(('    %s: '
+                                      '%d/%d | '
+                                      '\\max_i (task_i fails): '
+                                      '%d/%d')
+                            % (status_message, completed_tasks,
+                                task_count, max_task_fails,
+                                max_attempts - 1))
+                # Superseded attempts kill themselves; let them clean up
+                for asyncresult in asyncresults.values():
+                    asyncresult.wait()
                 iface.step(finish_message)
+                iface.step('    ' + scheduler.summary())
+                if backups:
+                    iface.step('    Launched %s of straggling tasks; %d '
+                               'finished first.'
+                                % (dp_iface.inflected(backups,
+                                                        'backup attempt'),
+                                    backups_won))
             @contextlib.contextmanager
             def cache(pool=None, file_or_archive=None, archive=True):
                 """ Places X.[tar.gz/tgz]#Y in dir Y, unpacked if archive
@@ -1307,14 +3013,34 @@ def run_simulation(branding, json_config, force, memcap, num_processes,
                     No return value.
                 """
                 global failed
+                task_function_args = list(task_function_args)
                 completed_tasks = 0
                 tasks_to_assign = deque([
                         [task_function_arg, i, 0] for i, task_function_arg
                         in enumerate(task_function_args)
                     ])
                 task_count = len(tasks_to_assign)
-                assigned_tasks, asyncresults = {}, {}
+                asyncresults, attempt_counts, failures = {}, {}, {}
+                completed = set()
                 max_task_fails = 0
+                '''Straggling tasks are backed up only if attempts commit
+                output atomically; see committed_step_runner(). Tasks are then
+                dispatched only to idle workers so their run times are
+                known.'''
+                speculator = (Speculator(task_count, speculative_slowdown)
+                                if task_count and committed_step_runner in [
+                                    task_function, tasks_to_assign[0][0][0]
+                                ] else None)
+                task_sizes, backup_attempts, backups_won = {}, set(), 0
+                if speculator is not None:
+                    for task_to_assign in tasks_to_assign:
+                        task_sizes[task_to_assign[1]] = sum([
+                                os.path.getsize(path)
+                                for path_glob in task_paths(
+                                        task_function, task_to_assign[0]
+                                    )
+                                for path in glob.glob(path_glob)
+                            ])
                 iface.status(('    %s: %d/%d%s')
                                 % (status_message, completed_tasks, task_count,
                                      (' | \\max_i (task_i fails): %d/%d'
@@ -1322,57 +3048,274 @@ def run_simulation(branding, json_config, force, memcap, num_processes,
                                             max_attempts - 1)
                                        if max_attempts > 1 else '')))
                 while completed_tasks < task_count:
-                    if tasks_to_assign:
+                    if tasks_to_assign and (speculator is None
+                                    or len(asyncresults) < num_processes):
                         task_to_assign = tasks_to_assign.popleft()
-                        asyncresults[task_to_assign[1]] = (
+                        task = task_to_assign[1]
+                        attempt_counts[task] = task_to_assign[2] + 1
+                        failures.setdefault(task, 0)
+                        asyncresults[(task, task_to_assign[2])] = (
                                 pool.apply_async(
                                     task_function,
                                     args=(task_to_assign[0] +
                                             [task_to_assign[2]])
                                 )
                             )
-                        assigned_tasks[task_to_assign[1]] = [
-                                task_to_assign[0], task_to_assign[1],
-                                task_to_assign[2] + 1
-                            ]
-                    asyncresults_to_remove = []
-                    for task in asyncresults:
-                        if asyncresults[task].ready():
-                            return_value = asyncresults[task].get()
+                        if speculator is not None:
+                            speculator.start(task, task_sizes[task])
+                    elif (speculator is not None and not tasks_to_assign
+                            and len(asyncresults) < num_processes):
+                        for task in speculator.stragglers()[
+                                    :num_processes - len(asyncresults)
+                                ]:
+                            speculator.backup(task)
+                            backup_attempts.add((task, attempt_counts[task]))
+                            asyncresults[(task, attempt_counts[task])] = (
+                                    pool.apply_async(
+                                        task_function,
+                                        args=(task_function_args[task] +
+                                                [attempt_counts[task]])
+                                    )
+                                )
+                            attempt_counts[task] += 1
+                    for task, attempt in asyncresults.keys():
+                        if not asyncresults[(task, attempt)].ready():
+                            continue
+                        return_value = asyncresults.pop(
+                                                    (task, attempt)
+                                                ).get()
+                        if task in completed:
+                            # Another attempt at the task already succeeded
+                            continue
+                        if return_value is None:
+                            # Success
+                            completed_tasks += 1
+                            completed.add(task)
+                            if speculator is not None:
+                                speculator.finish(task)
+                                if (task, attempt) in backup_attempts:
+                                    backups_won += 1
+                        elif any([running_task == task for running_task, _
+                                    in asyncresults]):
+                            # Another attempt at the task is still running
+                            failures[task] += 1
+                        else:
+                            failures[task] += 1
+                            if speculator is not None:
+                                speculator.finish(task, False)
+                            if max_attempts > failures[task]:
+                                # Add to queue for reattempt
+                                tasks_to_assign.append([
+                                        task_function_args[task], task,
+                                        attempt_counts[task]
+                                    ])
+                                max_task_fails = max(
+                                        failures[task],
+                                        max_task_fails
+                                    )
+                            else:
+                                # Bail if max_attempts is saturated
+                                iface.fail(return_value,
+                                steps=(job_flow[step_number:]
+                                        if step_number != 0 else None))
+                                failed = True
+                                raise RuntimeError
+                        iface.status(('    %s: %d/%d%s')
+                                % (status_message, completed_tasks,
+                                    task_count,
+                                    (' | \\max_i (task_i fails): %d/%d'
+                                        % (max_task_fails,
+                                            max_attempts - 1)
+                                        if max_attempts > 1 else '')))
+                    time.sleep(0.1)
+                # Superseded attempts kill themselves; let them clean up
+                for asyncresult in asyncresults.values():
+                    asyncresult.wait()
+                iface.step(finish_message)
+                if backup_attempts:
+                    iface.step('    Launched %s of straggling tasks; %d '
+                               'finished first.'
+                                % (dp_iface.inflected(len(backup_attempts),
+                                                        'backup attempt'),
+                                    backups_won))
+            def execute_pipelined_job_flow(pool, iface, step_names,
+                step_phases, dependencies, streamable, ready_inputs_function,
+                finish_step, max_attempts=4):
+                """ Executes steps of a job flow concurrently on a local pool.
+
+                    A step starts as soon as every step whose output it reads
+                    has finished or, if it's streamable, as soon as each of
+                    those steps has begun its final phase. Tasks from all
+                    running steps share the pool, and at most num_processes
+                    tasks are outstanding at once; when a worker frees up, it
+                    is given a task from the earliest running step in the job
+                    flow so later steps don't starve it. Failed tasks are
+                    retried as by execute_balanced_job_with_retries().
+
+                    pool: multiprocessing.Pool object
+                    iface: DooplicityInterface object for spewing log messages
+                        to console
+                    step_names: list of step names in job flow order
+                    step_phases: function that takes a step name, its index,
+                        and a ready_inputs function or None and returns a
+                        generator of the step's phases
+                    dependencies: list whose ith item is the set of indexes of
+                        steps whose outputs step i reads
+                    streamable: list whose ith item is True iff step i can
+                        start before the steps it depends on finish
+                    ready_inputs_function: function that takes the index of a
+                        step, a dictionary mapping step indexes to sets of
+                        names of final outputs written so far, a dictionary
+                        mapping step indexes to task counts of final phases,
+                        and the set of indexes of finished steps and returns a
+                        ready_inputs function for step_phases()
+                    finish_step: function called with the index of each step
+                        and the set of indexes of finished steps after the
+                        step finishes
+                    max_attempts: max number of times to attempt any given
+                        task
+
+                    No return value.
+                """
+                global failed
+                step_count = len(step_names)
+                started_steps, finished_steps = set(), set()
+                final_output_names = defaultdict(set)
+                final_task_counts = {}
+                generators, phases, asyncresults = {}, {}, {}
+                completed_tasks, task_count, max_task_fails = 0, 0, 0
+                status = None
+                try:
+                    while len(finished_steps) < step_count:
+                        for i in xrange(step_count):
+                            if i in started_steps:
+                                continue
+                            if dependencies[i] <= finished_steps:
+                                ready_inputs = None
+                            elif streamable[i] and dependencies[i] <= (
+                                        set(final_task_counts)
+                                        | finished_steps
+                                    ):
+                                ready_inputs = ready_inputs_function(
+                                        i, final_output_names,
+                                        final_task_counts, finished_steps
+                                    )
+                            else:
+                                continue
+                            started_steps.add(i)
+                            generators[i] = step_phases(
+                                    step_names[i], i, ready_inputs
+                                )
+                            phases[i] = None
+                        for i in sorted(generators):
+                            while (phases[i] is None
+                                    or (phases[i]['exhausted']
+                                        and not phases[i]['pending']
+                                        and not phases[i]['running'])):
+                                if phases[i] is not None:
+                                    iface.step('    Step %d/%d: %s'
+                                                % (i + 1, step_count,
+                                                    phases[i]['finish_message']
+                                                        .strip()))
+                                try:
+                                    (task_function, task_function_args,
+                                        status_message, finish_message,
+                                        output_names) = generators[i].next()
+                                except StopIteration:
+                                    del generators[i]
+                                    del phases[i]
+                                    finished_steps.add(i)
+                                    finish_step(i, finished_steps)
+                                    break
+                                if output_names is not None:
+                                    final_task_counts[i] \
+                                        = len(task_function_args)
+                                phases[i] = {
+                                        'task_function' : task_function,
+                                        'finish_message' : finish_message,
+                                        'pending' : deque(),
+                                        'running' : 0
+                                    }
+                                if callable(task_function_args):
+                                    phases[i]['source'] = task_function_args
+                                    phases[i]['exhausted'] = False
+                                else:
+                                    phases[i]['exhausted'] = True
+                                    phases[i]['pending'].extend([
+                                            [task_function_arg, 0,
+                                                output_names[j]
+                                                if output_names is not None
+                                                else None]
+                                            for j, task_function_arg
+                                            in enumerate(task_function_args)
+                                        ])
+                                    task_count += len(task_function_args)
+                        for i in phases:
+                            if not phases[i]['exhausted']:
+                                (task_function_args,
+                                    phases[i]['exhausted']) \
+                                    = phases[i]['source']()
+                                phases[i]['pending'].extend([
+                                        [task_function_arg, 0, None]
+                                        for task_function_arg
+                                        in task_function_args
+                                    ])
+                                task_count += len(task_function_args)
+                        for i in sorted(phases):
+                            while (phases[i]['pending']
+                                    and len(asyncresults) < num_processes):
+                                task = phases[i]['pending'].popleft()
+                                asyncresults[pool.apply_async(
+                                        phases[i]['task_function'],
+                                        args=(task[0] + [task[1]])
+                                    )] = (i, task)
+                                task[1] += 1
+                                phases[i]['running'] += 1
+                        progress = False
+                        for asyncresult in asyncresults.keys():
+                            if not asyncresult.ready():
+                                continue
+                            progress = True
+                            i, task = asyncresults.pop(asyncresult)
+                            phases[i]['running'] -= 1
+                            return_value = asyncresult.get()
                             if return_value is not None:
-                                if max_attempts > assigned_tasks[task][2]:
+                                if max_attempts > task[1]:
                                     # Add to queue for reattempt
-                                    tasks_to_assign.append(
-                                            assigned_tasks[task]
-                                        )
-                                    max_task_fails = max(
-                                            assigned_tasks[task][2],
-                                            max_task_fails
-                                        )
-                                    asyncresults_to_remove.append(task)
+                                    phases[i]['pending'].append(task)
+                                    max_task_fails = max(task[1],
+                                                         max_task_fails)
                                 else:
                                     # Bail if max_attempts is saturated
                                     iface.fail(return_value,
-                                    steps=(job_flow[step_number:]
-                                            if step_number != 0 else None))
+                                        steps=([job_flow[j] for j
+                                                in xrange(step_count)
+                                                if j not in finished_steps]
+                                                if finished_steps else None))
                                     failed = True
                                     raise RuntimeError
                             else:
                                 # Success
                                 completed_tasks += 1
-                                asyncresults_to_remove.append(task)
-                            iface.status(('    %s: %d/%d%s')
-                                    % (status_message, completed_tasks,
-                                        task_count,
-                                        (' | \\max_i (task_i fails): %d/%d'
-                                            % (max_task_fails,
-                                                max_attempts - 1)
-                                            if max_attempts > 1 else '')))
-                    for task in asyncresults_to_remove:
-                        del asyncresults[task]
-                        del assigned_tasks[task]
-                    time.sleep(0.1)
-                iface.step(finish_message)
+                                if task[2] is not None:
+                                    final_output_names[i].add(task[2])
+                        new_status = ('    Tasks completed: %d/%d across %s%s'
+                                        % (completed_tasks, task_count,
+                                            dp_iface.inflected(len(phases),
+                                                               'step'),
+                                            (' | \\max_i (task_i fails): '
+                                             '%d/%d'
+                                                % (max_task_fails,
+                                                    max_attempts - 1)
+                                                if max_attempts > 1 else '')))
+                        if new_status != status:
+                            status = new_status
+                            iface.status(status)
+                        if not progress:
+                            time.sleep(0.1)
+                finally:
+                    for i in generators:
+                        generators[i].close()
             @contextlib.contextmanager
             def cache(pool=None, file_or_archive=None, archive=True):
                 """ Places X.[tar.gz/tgz]#Y in dir Y, unpacked if archive
@@ -1516,6 +3459,23 @@ def run_simulation(branding, json_config, force, memcap, num_processes,
                             in ['mapred.text.key.comparator.options',
                                 'mapreduce.partition.keycomparator.options']:
                             step_args['sort_options'] = D_arg[1]
+                        elif D_arg[0] \
+                            in ['mapred.map.tasks.speculative.execution',
+                                'mapreduce.map.speculative']:
+                            step_args['speculative_map'] = (
+                                    D_arg[1].strip().lower() != 'false'
+                                )
+                        elif D_arg[0] \
+                            in ['mapred.reduce.tasks.speculative.execution',
+                                'mapreduce.reduce.speculative']:
+                            step_args['speculative_reduce'] = (
+                                    D_arg[1].strip().lower() != 'false'
+                                )
+                        elif D_arg[0] == 'edu.jhu.cs.planpartitioner.path':
+                            step_args['partition_plan'] = D_arg[1]
+                        elif D_arg[0] \
+                            == 'edu.jhu.cs.planpartitioner.max.splits':
+                            step_args['plan_splits'] = int(D_arg[1])
                         j += 2
                     elif arg_name == 'input':
                         try:
@@ -1544,6 +3504,9 @@ def run_simulation(branding, json_config, force, memcap, num_processes,
                     step_args['partition_options'] = '-k1'
                 if 'sort_options' not in step_args:
                     step_args['sort_options'] = '-k1'
+                for phase in ['map', 'reduce']:
+                    if 'speculative_' + phase not in step_args:
+                        step_args['speculative_' + phase] = True
                 steps[step['Name']] = step_args
         except (KeyError, IndexError):
             iface.fail(
@@ -1568,7 +3531,8 @@ def run_simulation(branding, json_config, force, memcap, num_processes,
             for required_parameter in required_data:
                 if required_parameter not in step_data:
                     missing_data[step].append('-' + required_parameter)
-                elif not force and required_parameter == 'output' \
+                elif not force and not resume \
+                    and required_parameter == 'output' \
                     and os.path.exists(step_data['output']):
                     bad_output_data.append(step)
             try:
@@ -1589,8 +3553,9 @@ def run_simulation(branding, json_config, force, memcap, num_processes,
                                 for step in missing_data])
         if bad_output_data:
             errors.extend(['Output directory name "%s" of step "%s" already '
-                           'exists as a file or directory, and --force was '
-                           'not invoked to permit overwriting it.' 
+                           'exists as a file or directory, and neither '
+                           '--force nor --resume was invoked to permit '
+                           'overwriting it.' 
                            % (steps[step]['output'], step)
                            for step in bad_output_data])
         if errors:
@@ -1618,44 +3583,173 @@ def run_simulation(branding, json_config, force, memcap, num_processes,
                                 step_input
                             )
                         marked_intermediates.add(step_input)
+        def step_manifest(step):
+            """ Reads manifest recording how a step last completed.
+
+                step: name of step
+
+                Return value: dictionary with keys "identity" (digest of
+                    step's configuration and inputs), "outputs" (fingerprint
+                    of output; see path_fingerprint()), and possibly
+                    "discarded" (True iff output was deleted after it was
+                    read) or {} if the step never completed
+            """
+            try:
+                with open(os.path.join(steps[step]['output'],
+                                        'dp.resume.log',
+                                        'manifest.json')) as manifest_stream:
+                    return json.load(manifest_stream)
+            except (IOError, ValueError):
+                return {}
+        def write_step_manifest(step, manifest):
+            """ Writes manifest of a step; see step_manifest().
+
+                step: name of step
+                manifest: dictionary to write
+
+                No return value.
+            """
+            manifest_file = os.path.join(steps[step]['output'],
+                                            'dp.resume.log', 'manifest.json')
+            with open(manifest_file + '.tmp', 'w') as manifest_stream:
+                json.dump(manifest, manifest_stream)
+            os.rename(manifest_file + '.tmp', manifest_file)
+        def discard_step_outputs(output):
+            """ Records that a step's output was deleted after it was read.
+
+                output: absolute path to output of step
+
+                No return value.
+            """
+            for step in steps:
+                if os.path.abspath(steps[step]['output']) != output:
+                    continue
+                manifest = step_manifest(step)
+                if manifest:
+                    manifest['discarded'] = True
+                    write_step_manifest(step, manifest)
+        '''Identify each step by a digest of its configuration and inputs,
+        including files its commands name, like Bowtie indexes and manifests.
+        An input written by a preceding step is identified by that step's
+        identity rather than by its contents, which may have been deleted
+        after they were read.'''
+        step_identities, step_producers = {}, defaultdict(list)
+        for j, step in enumerate(steps):
+            step_data = steps[step]
+            input_identities = []
+            for step_input in step_data['input'].split(','):
+                step_input = os.path.abspath(step_input)
+                producers = []
+                for producer in steps.keys()[:j]:
+                    step_output = os.path.abspath(steps[producer]['output'])
+                    if (step_input == step_output
+                            or step_input.startswith(step_output + os.sep)
+                            or step_output.startswith(step_input + os.sep)):
+                        producers.append(producer)
+                if producers:
+                    input_identities.extend([step_identities[producer]
+                                                for producer in producers])
+                    step_producers[step].extend(producers)
+                else:
+                    input_identities.append(path_fingerprint(step_input))
+            for referenced_path, is_index in referenced_paths(step_data):
+                producers = [producer for producer in steps.keys()[:j]
+                                if any([referenced_path == written_path
+                                        or referenced_path.startswith(
+                                                written_path + os.sep
+                                            )
+                                        for written_path in written_paths(
+                                                steps[producer]
+                                            )])]
+                if producers:
+                    input_identities.extend([step_identities[producer]
+                                                for producer in producers])
+                    step_producers[step].extend(producers)
+                else:
+                    input_identities.append([
+                            referenced_path,
+                            index_fingerprint(referenced_path) if is_index
+                            else path_fingerprint(referenced_path)
+                        ])
+            step_identities[step] = json_digest(
+                    [step, step_data, separator, gzip, gzip_level,
+                        input_identities]
+                )
+        '''Decide which steps to run, proceeding from the last step. A step
+        runs if it didn't complete with its current identity; if its output
+        isn't intact and a step that reads it runs; or if its output isn't
+        intact, no step reads it, and it wasn't deleted by design.'''
+        run_steps, partial_steps = set(), set()
+        for step in reversed(steps.keys()):
+            manifest = step_manifest(step) if resume else {}
+            if manifest.get('identity') != step_identities[step]:
+                run_steps.add(step)
+                if not resume:
+                    continue
+                try:
+                    with open(os.path.join(steps[step]['output'],
+                                            'dp.resume.log',
+                                            'identity')) as identity_stream:
+                        if identity_stream.read() == step_identities[step]:
+                            # Reuse tasks that succeeded
+                            partial_steps.add(step)
+                except IOError:
+                    pass
+                continue
+            if manifest.get('outputs') == path_fingerprint(
+                                                steps[step]['output']
+                                            ):
+                continue
+            consumers = [consumer for consumer in run_steps
+                            if step in step_producers[consumer]]
+            if consumers or not (manifest.get('discarded')
+                                    or any([step in step_producers[consumer]
+                                            for consumer in steps])):
+                run_steps.add(step)
+        if resume:
+            iface.step('Resuming job flow; %s of %s complete.'
+                        % (len(steps) - len(run_steps),
+                            dp_iface.inflected(len(steps), 'step')))
         # Create intermediate directories
         for step in steps:
-            try:
-                shutil.rmtree(steps[step]['output'])
-            except OSError:
-                # May be a file then
+            if step not in run_steps:
+                continue
+            if step not in partial_steps:
                 try:
-                    os.remove(steps[step]['output'])
+                    shutil.rmtree(steps[step]['output'])
                 except OSError:
-                    # Just didn't exist
-                    pass
+                    # May be a file then
+                    try:
+                        os.remove(steps[step]['output'])
+                    except OSError:
+                        # Just didn't exist
+                        pass
             try:
-                os.makedirs(steps[step]['output'])
+                if not os.path.isdir(steps[step]['output']):
+                    os.makedirs(steps[step]['output'])
             except OSError:
                 iface.fail(('Problem encountered trying to create '
                             'directory %s.') % steps[step]['output'])
                 failed = True
                 raise
-            map_err_dir = os.path.join(steps[step]['output'], 'dp.map.log')
-            try:
-                os.makedirs(map_err_dir)
-            except OSError:
-                iface.fail(('Problem encountered trying to create '
-                            'directory %s.') % map_err_dir)
-                failed = True
-                raise
-            reduce_err_dir = os.path.join(steps[step]['output'],
-                                            'dp.reduce.log')
-            try:
-                os.makedirs(reduce_err_dir)
-            except OSError:
-                iface.fail(('Problem encountered trying to create '
-                            'directory %s.') % reduce_err_dir)
-                failed = True
-                raise
+            for err_dir in ['dp.map.log', 'dp.reduce.log', 'dp.resume.log']:
+                err_dir = os.path.join(steps[step]['output'], err_dir)
+                try:
+                    if not os.path.isdir(err_dir):
+                        os.makedirs(err_dir)
+                except OSError:
+                    iface.fail(('Problem encountered trying to create '
+                                'directory %s.') % err_dir)
+                    failed = True
+                    raise
+            with open(os.path.join(steps[step]['output'], 'dp.resume.log',
+                                    'identity'), 'w') as identity_stream:
+                identity_stream.write(step_identities[step])
         # Run steps
         step_number = 0
         total_steps = len(steps)
+        # NLineInputFormat splits, which are removed if the job flow fails
+        split_input_dirs = []
         if not ipy:
             # Pool's only for if we're in local mode
             try:
@@ -1664,8 +3758,108 @@ def run_simulation(branding, json_config, force, memcap, num_processes,
             except Exception:
                 # maxtasksperchild doesn't work, somehow? Supported only in 2.7
                 pool = multiprocessing.Pool(num_processes, init_worker)
-        for step in steps:
+        def checkpointed(step, phase, task_function, task_function_args,
+                            task_keys, output_names=None, reuse=True):
+            """ Wraps a phase's tasks so each records when it succeeds.
+
+                When resuming, tasks that succeeded in an earlier run with the
+                same configuration and inputs are dropped.
+
+                step: name of step
+                phase: name of phase
+                task_function: function executing each task
+                task_function_args: list of lists of task_function's args
+                task_keys: list of lists [task ID, summary of inputs], one
+                    per task; inputs are typically summarized with
+                    path_fingerprint()
+                output_names: list of output names, one per task, or None;
+                    see step_phases()
+                reuse: False iff no task should be dropped
+
+                Return value: tuple (task function, list of lists of its
+                    args for tasks that must run, output names of the same
+                    tasks, list of IDs of dropped tasks)
+            """
+            resume_dir = os.path.join(steps[step]['output'], 'dp.resume.log')
+            checkpointed_args = []
+            checkpointed_output_names = (
+                    None if output_names is None else []
+                )
+            reused_task_ids = []
+            for j, task_key in enumerate(task_keys):
+                checkpoint_file = os.path.join(resume_dir, '%s.%s'
+                                                % (phase, task_key[0]))
+                digest = json_digest([step_identities[step], phase, task_key])
+                if reuse and step in partial_steps:
+                    try:
+                        with open(checkpoint_file) as checkpoint_stream:
+                            if checkpoint_stream.read() == digest:
+                                reused_task_ids.append(task_key[0])
+                                continue
+                    except IOError:
+                        pass
+                checkpointed_args.append(
+                        [task_function, checkpoint_file, digest]
+                        + task_function_args[j]
+                    )
+                if output_names is not None:
+                    checkpointed_output_names.append(output_names[j])
+            return (checkpointed_task, checkpointed_args,
+                        checkpointed_output_names, reused_task_ids)
+        def speculative(task_function_args, err_dir, enabled=True):
+            """ Lets step runner tasks of a phase be backed up if they straggle.
+
+                Each task is made to commit its output atomically with
+                committed_step_runner() so that concurrent attempts can't
+                clobber each other's output. A fresh token in the names of
+                commit locks keeps locks from earlier runs from applying.
+
+                task_function_args: list of lists of
+                    step_runner_with_error_return()'s args, one per task
+                err_dir: directory in which to write commit locks
+                enabled: False iff the step forbids speculative execution
+
+                Return value: tuple (task function, list of lists of its args)
+            """
+            if not (speculate and enabled):
+                return step_runner_with_error_return, task_function_args
+            token = os.urandom(4).encode('hex')
+            return committed_step_runner, [
+                    [os.path.join(err_dir, '%d.%s.commit'
+                                    % (task_function_arg[4], token))]
+                    + task_function_arg
+                    for task_function_arg in task_function_args
+                ]
+        def step_phases(step, step_number, ready_inputs=None):
+            """ Runs a step, yielding each of its phases for execution.
+
+                A phase is a tuple (task function, task function args,
+                status message, finish message, output names) that is
+                executed by execute_balanced_job_with_retries() or
+                execute_pipelined_job_flow(); the generator resumes once all
+                of the phase's tasks have succeeded. Output names is None
+                unless the phase writes the step's final output, in which case
+                its ith item is the basename of the file written by task i in
+                every output directory.
+
+                step: name of step
+                step_number: index of step in job flow
+                ready_inputs: None if all of the step's inputs are already
+                    written; otherwise, a function that returns a tuple
+                    (list of input files that are completely written, True iff
+                    no more input files will be written, expected number of
+                    input files). In this case, task function args of the
+                    partitioning phase is a function that returns a tuple
+                    (list of args of newly ready tasks, True iff no more tasks
+                    will be ready).
+
+                No return value.
+            """
             step_data = steps[step]
+            if step not in run_steps:
+                iface.step('Step %d/%d: %s (complete; skipped)' % 
+                            (step_number + 1, total_steps, step))
+                return
             step_inputs = []
             # Handle multiple input files/directories
             for input_file_or_dir in step_data['input'].split(','):
@@ -1675,6 +3869,58 @@ def run_simulation(branding, json_config, force, memcap, num_processes,
                     step_inputs.extend(
                             glob.glob(os.path.join(input_file_or_dir, '*'))
                         )
+            plan_file = None
+            if (step_data.get('partitioner') == 'edu.jhu.cs.PlanPartitioner'
+                    and step_data['reducer'] not in identity_reducers):
+                '''Mappers may read the plan to split keys into sub-bins, so
+                it's drawn up from the step's input before the map phase.'''
+                plan_file = step_data.get(
+                        'partition_plan',
+                        os.path.join(step_data['output'], 'dp.plan.log',
+                                        'partition.plan')
+                    )
+                key_specs = _key_specs(step_data['partition_options'])
+                if ready_inputs is not None or key_specs is None:
+                    '''Inputs are still being written, so keys are hashed;
+                    remove any plan from an earlier run so mappers don't
+                    split keys by it.'''
+                    try:
+                        os.remove(plan_file)
+                    except OSError:
+                        pass
+                    plan_file = None
+                else:
+                    iface.status('    Sampling inputs to plan partitioning...')
+                    max_splits = step_data.get('plan_splits', 1)
+                    if (max_splits > 1 and
+                            all([end is not None
+                                    for _, end, _ in key_specs])):
+                        split_field = max([end for _, end, _ in key_specs])
+                    else:
+                        split_field = None
+                    key_sizes, key_values = sample_partition_keys(
+                            [input_file for input_file in step_inputs
+                                if os.path.isfile(input_file)],
+                            partition_key_function(
+                                    step_data['partition_options'], separator
+                                ),
+                            separator, split_field
+                        )
+                    plan = partition_plan(key_sizes, step_data['task_count'],
+                                            key_values, max_splits)
+                    try:
+                        os.makedirs(os.path.dirname(plan_file))
+                    except OSError:
+                        if not os.path.isdir(os.path.dirname(plan_file)):
+                            raise
+                    plan.write(plan_file)
+                    iface.step('    Planned partitioning of %s; %s split '
+                               'into sub-bins.' % (
+                                    dp_iface.inflected(len(key_sizes),
+                                                        'sampled key'),
+                                    dp_iface.inflected(len(plan.bounds),
+                                                        'key')
+                                ))
             # TODO: support cacheArchives and cacheFile simultaneously
             if 'archives' in step_data or 'cacheArchive' in step_data:
                 # Prefer archives to cacheArchives
@@ -1748,6 +3994,7 @@ def run_simulation(branding, json_config, force, memcap, num_processes,
                     if nline_input:
                         # Create temporary input files
                         split_input_dir = make_temp_dir(common)
+                        split_input_dirs.append(split_input_dir)
                         input_files = []
                         try:
                             with open(step_inputs[0]) as nline_stream:
@@ -1776,27 +4023,45 @@ def run_simulation(branding, json_config, force, memcap, num_processes,
                     iface.step('Step %d/%d: %s' % 
                                 (step_number + 1, total_steps, step))
                     iface.status('    Starting step runner...')
-                    execute_balanced_job_with_retries(
-                            pool, iface, step_runner_with_error_return,
-                                       [[step_data['mapper'], input_file,
-                                         output_dir, err_dir,
-                                         i, multiple_outputs,
-                                         separator, None, None, gzip,
-                                         gzip_level, scratch, direct_write,
-                                         sort, dir_to_path]
-                                         for i, input_file
-                                         in enumerate(input_files)
-                                         if os.path.isfile(input_file)],
-                            status_message='Tasks completed',
-                            finish_message=(
-                                '    Completed %s.'
-                                % dp_iface.inflected(input_file_count, 'task')
-                            ),
-                            max_attempts=max_attempts
+                    task_ids = [i for i, input_file in enumerate(input_files)
+                                if os.path.isfile(input_file)]
+                    if nline_input:
+                        # Split files are recreated, so key on contents
+                        task_keys = []
+                        for i in task_ids:
+                            with open(input_files[i]) as nline_stream:
+                                task_keys.append([i, nline_stream.read()])
+                    else:
+                        task_keys = [[i, input_files[i],
+                                        path_fingerprint(input_files[i])]
+                                        for i in task_ids]
+                    task_function, task_function_args = speculative(
+                            [[step_data['mapper'], input_files[i],
+                              output_dir, err_dir,
+                              i, multiple_outputs,
+                              separator, None, None, gzip,
+                              gzip_level, scratch, direct_write,
+                              sort, dir_to_path, shuffle_engine,
+                              merge_fan_in]
+                              for i in task_ids],
+                            err_dir, step_data['speculative_map']
                         )
+                    task_function, task_function_args, output_names, _ \
+                        = checkpointed(step, 'map',
+                            task_function, task_function_args,
+                            task_keys,
+                            [str(i) for i in task_ids]
+                            if step_data['reducer'] in identity_reducers
+                            else None)
+                    yield (task_function, task_function_args,
+                            'Tasks completed',
+                            '    Completed %s.'
+                            % dp_iface.inflected(input_file_count, 'task'),
+                            output_names)
                     # Adjust step inputs in case a reducer follows
                     step_inputs = [input_file for input_file 
-                                    in glob.glob(output_dir)
+                                    in glob.glob(os.path.join(output_dir,
+                                                                '*'))
                                     if os.path.isfile(input_file)]
                 if step_data['reducer'] not in identity_reducers:
                     '''Determine whether to use "mod" partitioner that uses
@@ -1810,6 +4075,11 @@ def run_simulation(branding, json_config, force, memcap, num_processes,
                     except KeyError:
                         # Default to no mod partition
                         mod_partition = False
+                    if ('combiner' in step_data and step_data['combiner']
+                            not in identity_reducers):
+                        combiner = step_data['combiner']
+                    else:
+                        combiner = None
                     # Partition inputs into tasks, presorting
                     output_dir = os.path.join(step_data['output'], 'dp.tasks')
                     try:
@@ -1824,42 +4094,145 @@ def run_simulation(branding, json_config, force, memcap, num_processes,
                                                 if step_number != 0 else None))
                             failed = True
                             raise
-                    input_files = [input_file for input_file in step_inputs
-                                    if os.path.isfile(input_file)]
-                    input_file_count = len(input_files)
-                    if input_file_count > num_processes:
-                        file_count_per_group = input_file_count / num_processes
-                        input_file_groups = [
-                                input_files[k:k+file_count_per_group]
-                                for k in
-                                xrange(0, input_file_count,
-                                        file_count_per_group)
-                            ]
-                    else:
-                        input_file_groups = [[input_file]
-                                                for input_file in input_files]
-                    input_file_group_count = len(input_file_groups)
-                    iface.step('Step %d/%d: %s'
-                                 % (step_number + 1, total_steps, step))
-                    execute_balanced_job_with_retries(
-                            pool, iface, presorted_tasks,
-                            [[input_file_group, i,
+                    def input_file_groups(input_files, group_size=None):
+                        """ Groups input files for partitioning tasks.
+
+                            input_files: list of input files
+                            group_size: number of files per group or None
+                                to split input_files into num_processes
+                                groups
+
+                            Return value: list of lists of input files
+                        """
+                        input_file_count = len(input_files)
+                        if group_size is None:
+                            if input_file_count <= num_processes:
+                                return [[input_file]
+                                            for input_file in input_files]
+                            group_size = input_file_count / num_processes
+                        return [input_files[k:k+group_size]
+                                    for k in xrange(0, input_file_count,
+                                                        group_size)]
+                    def partition_key(input_file_group, process_id):
+                        """ Summarizes inputs of a presorted_tasks() task.
+
+                            input_file_group: list of input files
+                            process_id: unique identifier for task
+
+                            Return value: task key; see checkpointed()
+                        """
+                        return [process_id,
+                                [[input_file, path_fingerprint(input_file)]
+                                    for input_file in input_file_group]]
+                    def partition_args(input_file_group, process_id):
+                        """ Returns args of presorted_tasks() for a group.
+
+                            input_file_group: list of input files
+                            process_id: unique identifier for task
+
+                            Return value: list of args
+                        """
+                        return [input_file_group, process_id,
                                 step_data['sort_options'], output_dir,
                                 step_data['key_fields'], separator,
                                 step_data['partition_options'],
                                 step_data['task_count'], memcap, gzip,
                                 gzip_level, scratch, direct_write,
-                                sort, mod_partition]
+                                sort, mod_partition, shuffle_engine,
+                                combiner, dir_to_path,
+                                os.path.join(step_data['output'],
+                                             'dp.map.log'),
+                                plan_file, merge_fan_in]
+                    iface.step('Step %d/%d: %s'
+                                 % (step_number + 1, total_steps, step))
+                    if ready_inputs is None:
+                        groups = input_file_groups(
+                                [input_file for input_file in step_inputs
+                                    if os.path.isfile(input_file)]
+                            )
+                        task_function, task_function_args, _, reused_ids \
+                            = checkpointed(step, 'partition',
+                                presorted_tasks,
+                                [partition_args(input_file_group, i)
+                                    for i, input_file_group
+                                    in enumerate(groups)],
+                                [partition_key(input_file_group, i)
                                     for i, input_file_group
-                                    in enumerate(input_file_groups)],
-                            status_message='Inputs partitioned',
-                            finish_message=(
+                                    in enumerate(groups)])
+                        if step in partial_steps:
+                            '''Task files are named
+                            [task].[process ID][.gz]; delete those not written
+                            by reused tasks.'''
+                            reused_ids = set([str(i) for i in reused_ids])
+                            for task_file in os.listdir(output_dir):
+                                if (task_file.partition('.')[2]
+                                        .partition('.')[0] in reused_ids):
+                                    continue
+                                task_file = os.path.join(output_dir,
+                                                            task_file)
+                                if os.path.isdir(task_file):
+                                    shutil.rmtree(task_file)
+                                else:
+                                    os.remove(task_file)
+                        yield (task_function, task_function_args,
+                                'Inputs partitioned',
                                 '    Partitioned %s into tasks.'
-                                % dp_iface.inflected(input_file_group_count,
-                                                     'input')
-                            ),
-                            max_attempts=max_attempts
-                        )
+                                % dp_iface.inflected(len(groups), 'input'),
+                                None)
+                    else:
+                        '''Partition inputs as they're written by the steps
+                        that precede this one rather than waiting for them to
+                        finish.'''
+                        claimed_input_files = set()
+                        process_ids = itertools.count()
+                        if step in partial_steps:
+                            '''Inputs may be grouped differently than in the
+                            earlier run, so partition them all again.'''
+                            shutil.rmtree(output_dir)
+                            os.makedirs(output_dir)
+                        def ready_partition_args():
+                            """ Returns args of newly ready partition tasks.
+
+                                Return value: tuple (list of args, True iff
+                                    no more tasks will be ready)
+                            """
+                            input_files, exhausted, expected_count \
+                                = ready_inputs()
+                            input_files = [
+                                    input_file for input_file in input_files
+                                    if input_file not in claimed_input_files
+                                ]
+                            if exhausted:
+                                groups = input_file_groups(input_files)
+                            else:
+                                group_size = max(
+                                        expected_count / num_processes, 1
+                                    )
+                                groups = input_file_groups(
+                                        input_files[:len(input_files)
+                                                     - len(input_files)
+                                                     % group_size],
+                                        group_size
+                                    )
+                            for input_file_group in groups:
+                                claimed_input_files.update(input_file_group)
+                            process_id_group = [process_ids.next()
+                                                    for _ in groups]
+                            return (checkpointed(step, 'partition',
+                                        presorted_tasks,
+                                        [partition_args(input_file_group,
+                                                         process_id)
+                                            for input_file_group, process_id
+                                            in zip(groups, process_id_group)],
+                                        [partition_key(input_file_group,
+                                                        process_id)
+                                            for input_file_group, process_id
+                                            in zip(groups, process_id_group)],
+                                        reuse=False
+                                    )[1], exhausted)
+                        yield (checkpointed_task, ready_partition_args,
+                                'Inputs partitioned',
+                                '    Partitioned inputs into tasks.', None)
                     iface.status('    Starting step runner...')
                     input_files = [os.path.join(output_dir, '%d.*' % i) 
                                    for i in xrange(step_data['task_count'])]
@@ -1882,23 +4255,31 @@ def run_simulation(branding, json_config, force, memcap, num_processes,
                                     'dp.reduce.log'
                                 )
                     output_dir = step_data['output']
-                    return_values = []
-                    execute_balanced_job_with_retries(
-                            pool, iface, step_runner_with_error_return,
-                                [[step_data['reducer'], input_file, output_dir, 
-                                err_dir, i, multiple_outputs, separator,
-                                step_data['sort_options'], memcap, gzip,
-                                gzip_level, scratch, direct_write,
-                                sort, dir_to_path]
-                                    for i, input_file
-                                    in enumerate(input_files)],
-                            status_message='Tasks completed',
-                            finish_message=(
-                                '    Completed %s.'
-                                % dp_iface.inflected(input_file_count, 'task')
-                            ),
-                            max_attempts=max_attempts
+                    task_function, task_function_args = speculative(
+                            [[step_data['reducer'], input_file, output_dir, 
+                              err_dir, i, multiple_outputs, separator,
+                              step_data['sort_options'], memcap, gzip,
+                              gzip_level, scratch, direct_write,
+                              sort, dir_to_path, shuffle_engine,
+                              merge_fan_in]
+                              for i, input_file
+                              in enumerate(input_files)],
+                            err_dir, step_data['speculative_reduce']
                         )
+                    task_function, task_function_args, output_names, _ \
+                        = checkpointed(step, 'reduce',
+                            task_function, task_function_args,
+                            [[i, input_file,
+                                [[task_file, path_fingerprint(task_file)]
+                                    for task_file
+                                    in sorted(glob.glob(input_file))]]
+                                for i, input_file in enumerate(input_files)],
+                            [str(i) for i in xrange(input_file_count)])
+                    yield (task_function, task_function_args,
+                            'Tasks completed',
+                            '    Completed %s.'
+                            % dp_iface.inflected(input_file_count, 'task'),
+                            output_names)
             # Really close open file handles in PyPy
             gc.collect()
             if not keep_intermediates:
@@ -1924,38 +4305,198 @@ def run_simulation(branding, json_config, force, memcap, num_processes,
                         )
                 except OSError:
                     pass
-                for to_remove in post_step_cleanups[step_number]:
-                    if to_remove not in all_outputs:
-                        '''Remove directory only if it's an -output of some
-                        step and an -input of another step.'''
-                        continue
-                    if os.path.isfile(to_remove):
+            write_step_manifest(step, {
+                    'identity' : step_identities[step],
+                    'outputs' : path_fingerprint(step_data['output'])
+                })
+        def remove_intermediates(intermediates):
+            """ Deletes step outputs that no remaining step reads.
+
+                intermediates: list of step inputs to remove
+
+                No return value.
+            """
+            for to_remove in intermediates:
+                if to_remove not in all_outputs:
+                    '''Remove directory only if it's an -output of some
+                    step and an -input of another step.'''
+                    continue
+                discard_step_outputs(to_remove)
+                if os.path.isfile(to_remove):
+                    try:
+                        os.remove(to_remove)
+                    except OSError:
+                        pass
+                elif os.path.isdir(to_remove):
+                    for detritus in glob.iglob(
+                                        os.path.join(to_remove, '*')
+                                    ):
+                        if detritus[-4:] != '.log':
+                            try:
+                                os.remove(detritus)
+                            except OSError:
+                                try:
+                                    shutil.rmtree(detritus)
+                                except OSError:
+                                    pass
+                    if not os.listdir(to_remove):
                         try:
-                            os.remove(to_remove)
+                            os.rmdir(to_remove)
                         except OSError:
                             pass
-                    elif os.path.isdir(to_remove):
-                        for detritus in glob.iglob(
-                                            os.path.join(to_remove, '*')
-                                        ):
-                            if detritus[-4:] != '.log':
-                                try:
-                                    os.remove(detritus)
-                                except OSError:
-                                    try:
-                                        shutil.rmtree(detritus)
-                                    except OSError:
-                                        pass
-                        if not os.listdir(to_remove):
-                            try:
-                                os.rmdir(to_remove)
-                            except OSError:
-                                pass
+        if pipeline:
+            step_names = steps.keys()
+            step_outputs = [os.path.abspath(steps[step]['output'])
+                                for step in step_names]
+            step_input_lists = [[os.path.abspath(step_input)
+                                    for step_input
+                                    in steps[step]['input'].split(',')]
+                                for step in step_names]
+            def producer(step_input, step_index):
+                """ Finds the step preceding a given step that writes an input.
+
+                    step_input: absolute path to input of step
+                    step_index: index of step in job flow
+
+                    Return value: tuple (index of last step before step_index
+                        whose output contains step_input or None if there is
+                        none, True iff step_input is inside the output rather
+                        than containing it)
+                """
+                for i in reversed(xrange(step_index)):
+                    if (step_input == step_outputs[i] or
+                            step_input.startswith(step_outputs[i] + os.sep)):
+                        return i, True
+                    if step_outputs[i].startswith(step_input + os.sep):
+                        return i, False
+                return None, False
+            dependencies, streamable = [], []
+            consumers = defaultdict(set)
+            for j, step in enumerate(step_names):
+                producers = [producer(step_input, j)
+                                for step_input in step_input_lists[j]]
+                '''A step must also wait for preceding steps that read what
+                it overwrites.'''
+                readers = set([i for i in xrange(j)
+                                if any([step_outputs[j] == step_input
+                                        or step_outputs[j].startswith(
+                                                step_input + os.sep
+                                            )
+                                        or step_input.startswith(
+                                                step_outputs[j] + os.sep
+                                            )
+                                        for step_input
+                                        in step_input_lists[i]])])
+                dependencies.append(
+                        set([i for i, _ in producers if i is not None])
+                        | readers
+                    )
+                step_data = steps[step]
+                streamable.append(
+                        step_data['mapper'] in identity_mappers
+                        and step_data['reducer'] not in identity_reducers
+                        and step_data.get('inputformat') !=
+                            'org.apache.hadoop.mapred.lib.NLineInputFormat'
+                        and all([contained for i, contained in producers
+                                    if i is not None])
+                        and not readers
+                    )
+            for step_input in set(sum(step_input_lists, [])):
+                '''A step consumes an input if it reads the input or a path
+                that contains or is contained by the input.'''
+                for j, step_input_list in enumerate(step_input_lists):
+                    if any([other_input == step_input
+                            or other_input.startswith(step_input + os.sep)
+                            or step_input.startswith(other_input + os.sep)
+                            for other_input in step_input_list]):
+                        consumers[step_input].add(j)
+            def ready_inputs_function(step_index, final_output_names,
+                                        final_task_counts, finished_steps):
+                """ Creates ready_inputs function for step_phases().
+
+                    step_index: index of step in job flow
+                    final_output_names: dictionary mapping the index of each
+                        step to the set of output names written by tasks of
+                        its final phase that have succeeded so far
+                    final_task_counts: dictionary mapping the index of each
+                        step in its final phase to the number of tasks in
+                        that phase
+                    finished_steps: set of indexes of finished steps
+
+                    Return value: ready_inputs function; see step_phases()
+                """
+                def ready_inputs():
+                    input_files, exhausted, expected_count = [], True, 0
+                    for step_input in step_input_lists[step_index]:
+                        i, _ = producer(step_input, step_index)
+                        if os.path.isfile(step_input):
+                            candidates = [step_input]
+                        else:
+                            candidates = [
+                                    input_file for input_file in glob.glob(
+                                            os.path.join(step_input, '*')
+                                        ) if os.path.isfile(input_file)
+                                ]
+                        if i is None or i in finished_steps:
+                            input_files.extend(candidates)
+                            expected_count += len(candidates)
+                            continue
+                        exhausted = False
+                        expected_count += final_task_counts[i]
+                        input_files.extend([
+                                input_file for input_file in candidates
+                                if (input_file[:-3]
+                                    if input_file.endswith('.gz')
+                                    else input_file).rpartition(os.sep)[2]
+                                in final_output_names[i]
+                            ])
+                    return input_files, exhausted, expected_count
+                return ready_inputs
+            def finish_step(step_index, finished_steps):
+                """ Cleans up after a step finishes in pipelined mode.
+
+                    step_index: index of finished step
+                    finished_steps: set of indexes of finished steps
+
+                    No return value.
+                """
+                if keep_intermediates:
+                    return
+                remove_intermediates([
+                        step_input
+                        for step_input in step_input_lists[step_index]
+                        if consumers[step_input] <= finished_steps
+                    ])
                 iface.step('    Deleted temporary files.')
-            step_number += 1
+            step_number = 0
+            execute_pipelined_job_flow(pool, iface, step_names, step_phases,
+                                        dependencies, streamable,
+                                        ready_inputs_function, finish_step,
+                                        max_attempts=max_attempts)
+            step_number = len(step_names)
+        else:
+            for step_number, step in enumerate(steps):
+                phases = step_phases(step, step_number)
+                try:
+                    for (task_function, task_function_args, status_message,
+                            finish_message, _) in phases:
+                        execute_balanced_job_with_retries(
+                                pool, iface, task_function,
+                                task_function_args,
+                                status_message=status_message,
+                                finish_message=finish_message,
+                                max_attempts=max_attempts
+                            )
+                finally:
+                    phases.close()
+                if not keep_intermediates:
+                    remove_intermediates(post_step_cleanups[step_number])
+                    iface.step('    Deleted temporary files.')
+        step_data = steps[steps.keys()[-1]]
         if not ipy:
             pool.close()
         if not keep_last_output and not keep_intermediates:
+            discard_step_outputs(os.path.abspath(step_data['output']))
             try:
                 os.remove(step_data['output'])
             except OSError:
@@ -1976,6 +4517,7 @@ def run_simulation(branding, json_config, force, memcap, num_processes,
         if not keep_intermediates:
             for step in steps:
                 step_data = steps[step]
+                discard_step_outputs(os.path.abspath(step_data['output']))
                 try:
                     os.remove(step_data['output'])
                 except OSError:
@@ -2005,11 +4547,12 @@ def run_simulation(branding, json_config, force, memcap, num_processes,
                             if step_number != 0 else None))
             else:
                 iface.fail()
-        if 'split_input_dir' in locals():
+        if 'split_input_dirs' in locals():
             '''raise below refers to last exception, so can't try-except
             OSError here'''
-            if os.path.isdir(split_input_dir):
-                shutil.rmtree(split_input_dir)
+            for split_input_dir in split_input_dirs:
+                if os.path.isdir(split_input_dir):
+                    shutil.rmtree(split_input_dir)
         raise
     except (KeyboardInterrupt, SystemExit):
         if 'interrupt_engines' in locals():
@@ -2023,13 +4566,1186 @@ def run_simulation(branding, json_config, force, memcap, num_processes,
         if 'pool' in locals() and 'interrupt_engines' not in locals():
             pool.terminate()
             pool.join()
-        if 'split_input_dir' in locals():
+        if 'split_input_dirs' in locals():
+            for split_input_dir in split_input_dirs:
+                try:
+                    shutil.rmtree(split_input_dir)
+                except OSError:
+                    pass
+
+if __name__ == '__main__' and '--test' in sys.argv:
+    import unittest
+    import random
+
+    class TestSortKeyFunction(unittest.TestCase):
+        """ Tests emulation of UNIX sort. """
+        def setUp(self):
+            self.temp_dir_path = tempfile.mkdtemp()
+            random.seed(5)
+            self.lines = ['\t'.join([random.choice(['chr1', 'chr10', 'chr2',
+                                                     'chrM', 'a', ''])]
+                                     + [random.choice(['0', '1', '-3', '12',
+                                                       '007', '2.5', 'x',
+                                                       '', '10'])
+                                        for _ in xrange(random.randint(0, 5))])
+                                + '\n' for _ in xrange(2000)]
+
+        def unix_sorted(self, sort_options):
+            input_file = os.path.join(self.temp_dir_path, 'unsorted')
+            with open(input_file, 'w') as output_stream:
+                output_stream.writelines(self.lines)
+            return subprocess.check_output(
+                        'LC_ALL=C sort %s -t$\'\\t\' %s' % (sort_options,
+                                                            input_file),
+                        shell=True, executable='/bin/bash'
+                    )
+
+        def test_lexicographic_keys(self):
+            """ Fails if -kM,N ordering differs from UNIX sort's. """
+            for sort_options in ['-k1', '-k1,1', '-k1,2', '-k1,1 -k2,3',
+                                 '-k2,2 -k1,1', '-k1,6 -k7,7']:
+                self.assertEqual(
+                        ''.join(sorted(self.lines,
+                                key=sort_key_function(sort_options, '\t'))),
+                        self.unix_sorted(sort_options)
+                    )
+
+        def test_whole_line_keys(self):
+            """ Fails if undecorated sort misorders keys that tile lines. """
+            for sort_options in ['-k1', '-k1,1', '-k1,2', '-k1,1 -k2,3',
+                                 '-k1,6 -k7,7']:
+                sort_key = sort_key_function(sort_options, '\t')
+                self.assertTrue(sort_key.whole_line)
+                self.assertEqual(
+                        sorted([line[:-1] for line in self.lines]),
+                        self.unix_sorted(sort_options).splitlines()
+                    )
+            for sort_options in ['-k2,2 -k1,1', '-k1,1 -k3,3', '-k1,1 -k2,2n']:
+                self.assertFalse(
+                        sort_key_function(sort_options, '\t').whole_line
+                    )
+
+        def test_numeric_keys(self):
+            """ Fails if -kM,Nn ordering differs from UNIX sort's. """
+            for sort_options in ['-k1,1 -k2,2n', '-k1,5 -k6,6n', '-k3,3n']:
+                self.assertEqual(
+                        ''.join(sorted(self.lines,
+                                key=sort_key_function(sort_options, '\t'))),
+                        self.unix_sorted(sort_options)
+                    )
+
+        def test_unsupported_options(self):
+            """ Fails if options that can't be emulated are accepted. """
+            for sort_options in ['-s -k1,1', '-k1,1r', '-k1.2,2', '-k2,1',
+                                 '']:
+                self.assertEqual(sort_key_function(sort_options, '\t'), None)
+
+        def tearDown(self):
+            shutil.rmtree(self.temp_dir_path)
+
+    class TestShuffleEngines(unittest.TestCase):
+        """ Compares python shuffle engine with UNIX sort engine. """
+        def setUp(self):
+            self.temp_dir_path = tempfile.mkdtemp()
+            random.seed(7)
+            self.input_files = []
+            for i in xrange(3):
+                self.input_files.append(
+                        os.path.join(self.temp_dir_path, 'input%d' % i)
+                    )
+                with open(self.input_files[-1], 'w') as output_stream:
+                    for _ in xrange(3000):
+                        print >>output_stream, '\t'.join([
+                                random.choice(['chr1', 'chr2', 'chrX']),
+                                str(random.randint(0, 200)),
+                                str(random.randint(-5, 5)),
+                                random.choice('ACGT')
+                            ])
+
+        def shuffled_and_reduced(self, engine, gzip, memcap,
+                                    reducer='cat', combiner=None):
+            task_dir = os.path.join(self.temp_dir_path, engine + '.tasks')
+            output_dir = os.path.join(self.temp_dir_path, engine + '.out')
+            err_dir = os.path.join(self.temp_dir_path, engine + '.log')
+            for directory in [task_dir, output_dir, err_dir]:
+                os.makedirs(directory)
+            for i, input_file in enumerate(self.input_files):
+                self.assertEqual(presorted_tasks(
+                        [input_file], i, '-k1,1 -k2,2n', task_dir, 2, '\t',
+                        '-k1,1', 4, memcap, gzip, 3, None, False, 'sort',
+                        False, engine, combiner, None, err_dir
+                    ), None)
+            task_outputs = {}
+            for task in xrange(4):
+                if not glob.glob(os.path.join(task_dir, '%d.*' % task)):
+                    continue
+                self.assertEqual(step_runner_with_error_return(
+                        reducer, os.path.join(task_dir, '%d.*' % task),
+                        output_dir, err_dir, task, False, '\t',
+                        '-k1,1 -k2,2n', 1024, gzip, 3, None, False, 'sort',
+                        None, engine
+                    ), None)
+                with yopen(None, os.path.join(
+                                    output_dir,
+                                    str(task) + ('.gz' if gzip else '')
+                                )) as output_stream:
+                    task_outputs[task] = output_stream.read()
+            return task_outputs
+
+        def check_engines(self, gzip, memcap):
+            sort_key = sort_key_function('-k1,1 -k2,2n', '\t')
+            python_outputs = self.shuffled_and_reduced('python', gzip, memcap)
+            sort_outputs = self.shuffled_and_reduced('sort', gzip, memcap)
+            for outputs in [python_outputs, sort_outputs]:
+                # Each task's output must be sorted and keys can't straddle
+                keys_seen = set()
+                for task in outputs:
+                    lines = outputs[task].splitlines(True)
+                    self.assertEqual(lines, sorted(lines, key=sort_key))
+                    keys = set([line.split('\t')[0] for line in lines])
+                    self.assertFalse(keys & keys_seen)
+                    keys_seen.update(keys)
+            self.assertEqual(
+                    sorted(''.join(python_outputs.values()).splitlines()),
+                    sorted(''.join(sort_outputs.values()).splitlines())
+                )
+            self.assertEqual(
+                    len(''.join(python_outputs.values()).splitlines()), 9000
+                )
+
+        def test_uncompressed(self):
+            """ Fails if engines disagree on uncompressed intermediates. """
+            self.check_engines(False, 1024)
+
+        def test_compressed_with_spills(self):
+            """ Fails if engines disagree when sorted runs are spilled. """
+            self.check_engines(True, 8)
+
+        def test_combiner(self):
+            """ Fails if combiner changes reducer output for either engine.
+            """
+            summer = ('awk -F\'\\t\' -v OFS=\'\\t\' '
+                      '\'{ key = $1 FS $2; if (NR > 1 && key != last) '
+                      'print last, total; if (key != last) total = 0; '
+                      'last = key; total += $3 } '
+                      'END { if (NR) print last, total }\'')
+            expected = sorted(''.join(self.shuffled_and_reduced(
+                    'sort', False, 1024, reducer=summer
+                ).values()).splitlines())
+            for engine in ['python', 'sort']:
+                for gzip, memcap in [(False, 1024), (True, 8)]:
+                    engine_dir = os.path.join(self.temp_dir_path, engine)
+                    for directory in glob.glob(engine_dir + '.*'):
+                        shutil.rmtree(directory)
+                    self.assertEqual(sorted(''.join(
+                            self.shuffled_and_reduced(
+                                    engine, gzip, memcap, reducer=summer,
+                                    combiner=summer
+                                ).values()).splitlines()), expected)
+                    # Combined intermediates must be smaller
+                    combined_line_count = 0
+                    for task_file in glob.glob(engine_dir + '.tasks/*'):
+                        with yopen(None, task_file) as task_stream:
+                            combined_line_count += sum(1 for _ in task_stream)
+                    self.assertTrue(combined_line_count < 9000)
+
+        def test_spills_with_fan_in(self):
+            """ Fails if runs of a task aren't merged within the fan-in or
+                lines are lost when spilling.
+            """
+            global merged_blocks
+            sort_key = sort_key_function('-k1,1 -k2,2n', '\t')
+            merge_sizes = []
+            unwrapped_merged_blocks = merged_blocks
+            def recorded_merged_blocks(input_files, *args, **kwargs):
+                merge_sizes.append(len(input_files))
+                return unwrapped_merged_blocks(input_files, *args, **kwargs)
+            task_dir = os.path.join(self.temp_dir_path, 'fan_in.tasks')
+            os.makedirs(task_dir)
+            merged_blocks = recorded_merged_blocks
             try:
-                shutil.rmtree(split_input_dir)
-            except OSError:
-                pass
+                native_presorted_tasks(
+                        self.input_files, 0, sort_key, task_dir, '\t',
+                        partition_key_function('-k1,1', '\t'), 4, 8,
+                        fan_in=3
+                    )
+            finally:
+                merged_blocks = unwrapped_merged_blocks
+            # Short lines fill 8 KB many times over with overhead counted
+            self.assertTrue(len(merge_sizes) > 4)
+            self.assertTrue(max(merge_sizes) <= 3)
+            lines = []
+            for task_file in glob.glob(os.path.join(task_dir, '*.0')):
+                with open(task_file) as task_stream:
+                    task_lines = task_stream.read().splitlines()
+                self.assertEqual(task_lines, sorted(task_lines,
+                                                    key=sort_key))
+                lines.extend(task_lines)
+            expected = []
+            for input_file in self.input_files:
+                with open(input_file) as input_stream:
+                    expected.extend(input_stream.read().splitlines())
+            self.assertEqual(sorted(lines), sorted(expected))
+            # Runs are cleaned up
+            self.assertFalse(glob.glob(os.path.join(task_dir, 'runs.*')))
+
+        def test_small_blocks(self):
+            """ Fails if merging many small blocks loses or misorders lines.
+            """
+            for sort_options in ['-k1,1 -k2,2', '-k1,1 -k2,2n']:
+                sort_key = sort_key_function(sort_options, '\t')
+                sorted_files, lines = [], []
+                for i, input_file in enumerate(self.input_files):
+                    with open(input_file) as input_stream:
+                        file_lines = sorted(input_stream.read().splitlines(),
+                                            key=sort_key)
+                    lines.extend(file_lines)
+                    sorted_files.append(input_file + '.sorted')
+                    with open(sorted_files[-1], 'w') as output_stream:
+                        output_stream.write('\n'.join(file_lines) + '\n')
+                self.assertEqual(
+                        list(itertools.chain.from_iterable(
+                                merged_blocks(sorted_files, sort_key, 300)
+                            )),
+                        sorted(lines, key=sort_key)
+                    )
+
+        def test_corrupt_input(self):
+            """ Fails if a reducer is fed truncated input without failing.
+            """
+            corrupt_file = os.path.join(self.temp_dir_path, 'corrupt.gz')
+            with open(self.input_files[0]) as input_stream:
+                compressed = zlib.compressobj(6, zlib.DEFLATED, 31)
+                data = compressed.compress(''.join(sorted(input_stream)))
+                data += compressed.flush()
+            with open(corrupt_file, 'wb') as output_stream:
+                output_stream.write(data[:len(data) // 2])
+            sort_key = sort_key_function('-k1,1 -k2,2', '\t')
+            with self.assertRaises(RuntimeError):
+                list(merged_blocks([corrupt_file], sort_key))
+            for multiple_outputs in [False, True]:
+                output_dir = os.path.join(self.temp_dir_path,
+                                            'corrupt%d' % multiple_outputs)
+                os.makedirs(output_dir)
+                self.assertNotEqual(step_runner_with_error_return(
+                        'cat', corrupt_file, output_dir, output_dir, 0,
+                        multiple_outputs, '\t', '-k1,1 -k2,2', 1024, False,
+                        3, None, False, 'sort', None, 'python'
+                    ), None)
+
+        def tearDown(self):
+            shutil.rmtree(self.temp_dir_path)
+
+    class TestPipelinedExecution(unittest.TestCase):
+        """ Compares pipelined execution of a job flow with serial execution.
+        """
+        def setUp(self):
+            self.temp_dir_path = tempfile.mkdtemp()
+            random.seed(11)
+            self.input_dir = os.path.join(self.temp_dir_path, 'input')
+            os.makedirs(self.input_dir)
+            for i in xrange(4):
+                with open(os.path.join(self.input_dir, str(i)), 'w') \
+                    as output_stream:
+                    for _ in xrange(1000):
+                        print >>output_stream, '\t'.join([
+                                random.choice(['chr1', 'chr2', 'chrX']),
+                                str(random.randint(0, 100)),
+                                str(random.randint(1, 9))
+                            ])
+
+        def job_flow_outputs(self, pipeline):
+            def step(name, step_input, step_output, mapper='cat',
+                        reducer='cat', extra_args=[]):
+                return {
+                        'Name' : name,
+                        'HadoopJarStep' : {
+                            'Args' : ['-D', 'mapreduce.job.reduces=3',
+                                      '-D',
+                                      'stream.num.map.output.key.fields=2',
+                                      '-D',
+                                      'mapreduce.partition.keypartitioner.'
+                                      'options=-k1,1',
+                                      '-input', step_input,
+                                      '-output', step_output,
+                                      '-mapper', mapper,
+                                      '-reducer', reducer] + extra_args
+                        }
+                    }
+            output_dir = os.path.join(self.temp_dir_path,
+                                        'pipelined' if pipeline
+                                        else 'serial')
+            splitter = ('awk -F\'\\t\' -v OFS=\'\\t\' '
+                        '\'{ print ($3 > 4 ? "hi" : "lo"), $0 }\'')
+            steps = [
+                    step('Copy lines', self.input_dir,
+                            os.path.join(output_dir, 'copied'),
+                            reducer='cat -n | cut -f 2-'),
+                    step('Cut lines', os.path.join(self.input_dir, '0'),
+                            os.path.join(output_dir, 'cut'),
+                            mapper='cut -f 1,2'),
+                    step('Split lines', os.path.join(output_dir, 'copied'),
+                            os.path.join(output_dir, 'split'),
+                            reducer=splitter, extra_args=['-multiOutput']),
+                    step('Join lines', ','.join([
+                                os.path.join(output_dir, 'split', 'hi'),
+                                os.path.join(output_dir, 'cut')
+                            ]), os.path.join(output_dir, 'joined'),
+                            reducer='sort')
+                ]
+            json_config = os.path.join(self.temp_dir_path, 'flow.json')
+            with open(json_config, 'w') as json_stream:
+                json.dump({'Steps' : steps}, json_stream)
+            stdout, stderr = sys.stdout, sys.stderr
+            sys.stdout = sys.stderr = open(os.devnull, 'w')
+            try:
+                run_simulation(None, json_config, True, 1024, 3, '\t',
+                                True, True, None, pipeline=pipeline)
+            finally:
+                sys.stdout.close()
+                sys.stdout, sys.stderr = stdout, stderr
+            outputs = {}
+            for step_output in ['copied', 'cut', 'split/hi', 'split/lo',
+                                'joined']:
+                lines = []
+                for output_file in glob.glob(os.path.join(output_dir,
+                                                          step_output, '*')):
+                    if os.path.isfile(output_file):
+                        with open(output_file) as output_stream:
+                            lines.extend(output_stream.read().splitlines())
+                outputs[step_output] = sorted(lines)
+            return outputs
+
+        def test_pipelined_outputs(self):
+            """ Fails if pipelined execution changes any step's output. """
+            serial_outputs = self.job_flow_outputs(False)
+            self.assertEqual(len(serial_outputs['joined']), 5000
+                                - len(serial_outputs['split/lo']))
+            self.assertEqual(self.job_flow_outputs(True), serial_outputs)
+
+        def test_rejected_with_ipy(self):
+            """ Fails if --pipeline is accepted in --ipy mode. """
+            stdout, stderr = sys.stdout, sys.stderr
+            sys.stdout = sys.stderr = open(os.devnull, 'w')
+            try:
+                with self.assertRaises(RuntimeError):
+                    run_simulation(None, os.path.join(self.temp_dir_path,
+                                                        'flow.json'),
+                                    True, 1024, 3, '\t', True, True, None,
+                                    ipy=True, pipeline=True)
+            finally:
+                sys.stdout.close()
+                sys.stdout, sys.stderr = stdout, stderr
+
+        def tearDown(self):
+            shutil.rmtree(self.temp_dir_path)
+
+    class TestResume(unittest.TestCase):
+        """ Tests resuming job flows. """
+        def setUp(self):
+            self.temp_dir_path = tempfile.mkdtemp()
+            random.seed(13)
+            self.input_dir = os.path.join(self.temp_dir_path, 'input')
+            os.makedirs(self.input_dir)
+            for i in xrange(4):
+                with open(os.path.join(self.input_dir, str(i)), 'w') \
+                    as output_stream:
+                    for _ in xrange(1000):
+                        print >>output_stream, '\t'.join([
+                                random.choice(['chr1', 'chr2', 'chrX']),
+                                str(random.randint(0, 100))
+                            ])
+            self.output_dir = os.path.join(self.temp_dir_path, 'output')
+            # Reducer that fails on chrX while flag file exists
+            self.flag = os.path.join(self.temp_dir_path, 'flag')
+            self.failing_reducer = os.path.join(self.temp_dir_path,
+                                                'failing_reducer.py')
+            with open(self.failing_reducer, 'w') as script_stream:
+                print >>script_stream, '\n'.join([
+                        'import os, sys, time',
+                        'lines = sys.stdin.readlines()',
+                        'if os.path.exists(%r) and any(' % self.flag,
+                        '        [line.startswith("chrX") for line in lines]):',
+                        '    # Let other tasks succeed first',
+                        '    time.sleep(1)',
+                        '    sys.exit(1)',
+                        'sys.stdout.write("".join(lines))'
+                    ])
+
+        def step(self, name, step_input, step_output, mapper='cat',
+                    reducer='cat'):
+            return {
+                    'Name' : name,
+                    'HadoopJarStep' : {
+                        'Args' : ['-D', 'mapreduce.job.reduces=3',
+                                  '-D',
+                                  'mapreduce.partition.keypartitioner.'
+                                  'options=-k1,1',
+                                  '-input', step_input,
+                                  '-output', os.path.join(self.output_dir,
+                                                          step_output),
+                                  '-mapper', mapper,
+                                  '-reducer', reducer]
+                    }
+                }
+
+        def run_job_flow(self, steps, resume, pipeline=False,
+                            keep_intermediates=True):
+            """ Runs job flow, returning whether it succeeded. """
+            json_config = os.path.join(self.temp_dir_path, 'flow.json')
+            with open(json_config, 'w') as json_stream:
+                json.dump({'Steps' : steps}, json_stream)
+            stdout, stderr = sys.stdout, sys.stderr
+            sys.stdout = sys.stderr = open(os.devnull, 'w')
+            try:
+                run_simulation(None, json_config, True, 1024, 3, '\t',
+                                keep_intermediates, True, None,
+                                max_attempts=1, pipeline=pipeline,
+                                resume=resume)
+            except RuntimeError:
+                return False
+            finally:
+                sys.stdout.close()
+                sys.stdout, sys.stderr = stdout, stderr
+            return True
+
+        def outputs(self, step_output):
+            """ Returns dictionary mapping output files to (mtime, lines). """
+            outputs = {}
+            for output_file in glob.glob(os.path.join(self.output_dir,
+                                                      step_output, '*')):
+                if os.path.isfile(output_file):
+                    with open(output_file) as output_stream:
+                        outputs[output_file] = (
+                                os.path.getmtime(output_file),
+                                sorted(output_stream.read().splitlines())
+                            )
+            return outputs
+
+        def test_skipped_and_added_steps(self):
+            """ Fails if completed steps are rerun or new ones aren't run. """
+            steps = [
+                    self.step('Copy lines', self.input_dir, 'copied',
+                                reducer='cat -n | cut -f 2-'),
+                    self.step('Sort lines',
+                                os.path.join(self.output_dir, 'copied'),
+                                'sorted', reducer='sort')
+                ]
+            self.assertTrue(self.run_job_flow(steps, False))
+            copied, sorted_lines = (self.outputs('copied'),
+                                    self.outputs('sorted'))
+            self.assertTrue(self.run_job_flow(steps, True))
+            self.assertEqual(self.outputs('copied'), copied)
+            self.assertEqual(self.outputs('sorted'), sorted_lines)
+            # Change last step and add another
+            steps[1] = self.step('Sort lines',
+                                    os.path.join(self.output_dir, 'copied'),
+                                    'sorted', reducer='sort -r')
+            steps.append(self.step('Cut lines',
+                                    os.path.join(self.output_dir, 'sorted'),
+                                    'cut', mapper='cut -f 1'))
+            self.assertTrue(self.run_job_flow(steps, True))
+            self.assertEqual(self.outputs('copied'), copied)
+            self.assertNotEqual(
+                    [mtime for mtime, _
+                        in self.outputs('sorted').values()],
+                    [mtime for mtime, _ in sorted_lines.values()]
+                )
+            self.assertEqual(
+                    sorted(sum([lines for _, lines
+                                in self.outputs('cut').values()], [])),
+                    sorted([line.partition('\t')[0] for _, lines
+                            in sorted_lines.values() for line in lines])
+                )
+
+        def test_rerun_failed_tasks(self):
+            """ Fails if tasks that succeeded before a failure are rerun. """
+            for pipeline in [False, True]:
+                steps = [
+                        self.step('Copy lines', self.input_dir, 'copied',
+                                    reducer='python %s'
+                                            % self.failing_reducer),
+                        self.step('Sort lines',
+                                    os.path.join(self.output_dir, 'copied'),
+                                    'sorted', reducer='sort')
+                    ]
+                open(self.flag, 'w').close()
+                self.assertFalse(self.run_job_flow(steps, False,
+                                                    pipeline=pipeline))
+                copied = self.outputs('copied')
+                succeeded = [
+                        os.path.join(self.output_dir, 'copied',
+                                        checkpoint_file.rpartition('.')[2])
+                        for checkpoint_file in glob.glob(
+                                os.path.join(self.output_dir, 'copied',
+                                                'dp.resume.log', 'reduce.*')
+                            )
+                    ]
+                self.assertTrue(succeeded)
+                os.remove(self.flag)
+                self.assertTrue(self.run_job_flow(steps, True,
+                                                    pipeline=pipeline))
+                resumed = self.outputs('copied')
+                for output_file in succeeded:
+                    self.assertEqual(resumed[output_file],
+                                        copied[output_file])
+                self.assertEqual(
+                        sorted(sum([lines for _, lines
+                                    in self.outputs('sorted').values()], [])),
+                        sorted(sum([lines for _, lines
+                                    in resumed.values()], []))
+                    )
+                self.assertEqual(len(sum([lines for _, lines
+                                            in resumed.values()], [])), 4000)
+
+        def test_rebuilt_referenced_files(self):
+            """ Fails if files named in commands don't identify a step. """
+            index_basename = os.path.join(self.temp_dir_path, 'genome')
+            manifest = os.path.join(self.temp_dir_path, 'sample.manifest')
+            for filename in [index_basename + '.1.ebwt', manifest]:
+                with open(filename, 'w') as output_stream:
+                    output_stream.write('0')
+            steps = [
+                    self.step('Copy lines', self.input_dir, 'copied',
+                                mapper=('awk -v i=--bowtie-idx=%s '
+                                        '-v m=--manifest=%s 1')
+                                        % (index_basename, manifest))
+                ]
+            self.assertTrue(self.run_job_flow(steps, False))
+            copied = self.outputs('copied')
+            # Files written next to an index don't change its fingerprint
+            with open(index_basename + '.rail.ref', 'w') as output_stream:
+                output_stream.write('0')
+            self.assertTrue(self.run_job_flow(steps, True))
+            self.assertEqual(self.outputs('copied'), copied)
+            for filename in [index_basename + '.1.ebwt', manifest]:
+                with open(filename, 'w') as output_stream:
+                    output_stream.write('01')
+                self.assertTrue(self.run_job_flow(steps, True))
+                self.assertNotEqual(
+                        [mtime for mtime, _
+                            in self.outputs('copied').values()],
+                        [mtime for mtime, _ in copied.values()]
+                    )
+                copied = self.outputs('copied')
+
+        def test_deleted_intermediates(self):
+            """ Fails if steps whose deleted outputs are needed aren't rerun.
+            """
+            steps = [
+                    self.step('Copy lines', self.input_dir, 'copied',
+                                reducer='cat -n | cut -f 2-'),
+                    self.step('Sort lines',
+                                os.path.join(self.output_dir, 'copied'),
+                                'sorted', reducer='sort')
+                ]
+            self.assertTrue(self.run_job_flow(steps, False,
+                                                keep_intermediates=False))
+            self.assertEqual(self.outputs('copied'), {})
+            # Nothing needs rerunning
+            self.assertTrue(self.run_job_flow(steps, True,
+                                                keep_intermediates=False))
+            self.assertEqual(self.outputs('copied'), {})
+            steps.append(self.step('Cut lines',
+                                    os.path.join(self.output_dir, 'copied'),
+                                    'cut', mapper='cut -f 1'))
+            self.assertTrue(self.run_job_flow(steps, True))
+            self.assertEqual(len(sum([lines for _, lines
+                                        in self.outputs('copied').values()],
+                                      [])), 4000)
+            self.assertEqual(len(sum([lines for _, lines
+                                        in self.outputs('cut').values()],
+                                      [])), 4000)
+            self.assertEqual(self.outputs('sorted'), {})
+
+        def tearDown(self):
+            shutil.rmtree(self.temp_dir_path)
+
+    class TestDirectMultipleOutputs(unittest.TestCase):
+        """ Tests streaming commands that write multiple outputs directly. """
+        def setUp(self):
+            self.temp_dir_path = tempfile.mkdtemp()
+            random.seed(13)
+            self.input_file = os.path.join(self.temp_dir_path, 'input')
+            with open(self.input_file, 'w') as input_stream:
+                for i in xrange(20000):
+                    print >>input_stream, '\t'.join([
+                            random.choice(['sam', 'exon_diff', 'unique']),
+                            str(i), 'x' * random.randint(0, 40)
+                        ])
+            '''Streaming command writes a line of dummy output to stdout and
+            copies input with a MultipleOutputStream in pieces that split
+            lines.'''
+            self.script = os.path.join(self.temp_dir_path, 'direct.py')
+            with open(self.script, 'w') as script_stream:
+                script_stream.write('\n'.join([
+                    'import sys',
+                    'sys.path.insert(0, %r)' % os.path.dirname(
+                                                os.path.abspath(__file__)
+                                            ),
+                    'from tools import MultipleOutputStream',
+                    'with MultipleOutputStream(buffer_size=1000) as stream:',
+                    '    data = sys.stdin.read()',
+                    '    for i in xrange(0, len(data), 77):',
+                    '        stream.write(data[i:i+77])',
+                    'print "dummy\\t-\\tdummy"'
+                ]) + '\n')
+
+        def outputs(self, streaming_command, gzip, output_dir=None):
+            if output_dir is None:
+                output_dir = os.path.join(self.temp_dir_path,
+                                          'out%d' % len(os.listdir(
+                                                        self.temp_dir_path
+                                                    )))
+            err_dir = output_dir + '.logs'
+            if not os.path.exists(err_dir):
+                os.makedirs(err_dir)
+            self.assertEqual(step_runner_with_error_return(
+                    streaming_command, self.input_file, output_dir, err_dir,
+                    7, True, '\t', None, 1024, gzip, 3
+                ), None)
+            outputs = {}
+            for output_file in glob.glob(os.path.join(output_dir, '*', '*')):
+                with yopen(None, output_file) as output_stream:
+                    outputs[os.path.relpath(output_file, output_dir)] = (
+                            output_stream.read()
+                        )
+            return outputs
+
+        def test_direct_outputs(self):
+            """ Fails if direct outputs differ from demultiplexed stdout. """
+            for gzip in [False, True]:
+                expected = self.outputs(
+                        '(cat; echo -e "dummy\\t-\\tdummy")', gzip
+                    )
+                self.assertEqual(
+                        sorted(expected.keys()),
+                        sorted([os.path.join(key, '7.gz' if gzip else '7')
+                                for key in ['dummy', 'exon_diff', 'sam',
+                                            'unique']])
+                    )
+                self.assertEqual(self.outputs('python %s' % self.script,
+                                                gzip), expected)
+
+        def test_two_writers(self):
+            """ Fails if a second writer in a task truncates the first's
+                outputs or a retry keeps an earlier attempt's. """
+            staged_file = os.path.join(self.temp_dir_path, 'staged')
+            for gzip in [False, True]:
+                expected = self.outputs(
+                        ('(cat; echo -e "dummy\\t-\\tdummy"; '
+                         'echo -e "dummy\\t-\\tdummy")'), gzip
+                    )
+                two_writers = ('cat >{0}; head -n 10000 {0} | python {1}; '
+                               'tail -n +10001 {0} | python {1}').format(
+                                    staged_file, self.script
+                                )
+                output_dir = os.path.join(self.temp_dir_path,
+                                            'two%d' % gzip)
+                self.assertEqual(self.outputs(two_writers, gzip, output_dir),
+                                    expected)
+                self.assertEqual(self.outputs(two_writers, gzip, output_dir),
+                                    expected)
+
+        def test_stdout_and_direct_writes(self):
+            """ Fails if lines an output gets from stdout and from a
+                concurrent direct writer aren't all kept. """
+            staged_file = os.path.join(self.temp_dir_path, 'staged')
+            for gzip in [False, True]:
+                expected = self.outputs(
+                        ('(cat; echo -e "dummy\\t-\\tdummy")'), gzip
+                    )
+                mixed = ('cat >{0}; tail -n +10001 {0} | python {1} & '
+                         'head -n 10000 {0}; wait').format(
+                                    staged_file, self.script
+                                )
+                output_dir = os.path.join(self.temp_dir_path,
+                                            'mixed%d' % gzip)
+                for _ in xrange(2):
+                    outputs = self.outputs(mixed, gzip, output_dir)
+                    self.assertEqual(sorted(outputs.keys()),
+                                        sorted(expected.keys()))
+                    for key in expected:
+                        self.assertEqual(
+                                sorted(outputs[key].splitlines()),
+                                sorted(expected[key].splitlines())
+                            )
+
+        def test_passthrough(self):
+            """ Fails if writes don't pass through without the simulator. """
+            from StringIO import StringIO
+            from tools import MultipleOutputStream
+            output_stream = StringIO()
+            old_output_dir = os.environ.pop('dooplicity_output_dir', None)
+            try:
+                with MultipleOutputStream(output_stream) as direct_stream:
+                    print >>direct_stream, 'sam\tline'
+                    direct_stream.write('unique\t')
+            finally:
+                if old_output_dir is not None:
+                    os.environ['dooplicity_output_dir'] = old_output_dir
+            self.assertEqual(output_stream.getvalue(), 'sam\tline\nunique\t')
+
+        def tearDown(self):
+            shutil.rmtree(self.temp_dir_path)
+
+    class TestHierarchicalMerge(unittest.TestCase):
+        """ Tests capping reducers' merge fan-in. """
+        def setUp(self):
+            import random
+            random.seed(7)
+            self.temp_dir_path = tempfile.mkdtemp()
+            self.sort_key = sort_key_function('-k1,1 -k2,2', '\t')
+            self.lines = []
+            self.task_dir = os.path.join(self.temp_dir_path, 'tasks')
+            os.makedirs(self.task_dir)
+            for i in xrange(23):
+                lines = sorted(['\t'.join([random.choice(['chr1', 'chr2']),
+                                            str(random.randint(0, 99999)),
+                                            'x' * random.randint(0, 10)])
+                                for _ in xrange(random.randint(0, 300))],
+                                key=self.sort_key)
+                self.lines.extend(lines)
+                with open(os.path.join(self.task_dir, '0.%d' % i),
+                            'w') as output_stream:
+                    for line in lines:
+                        print >>output_stream, line
+            self.lines.sort(key=self.sort_key)
+
+        def test_merge_plan(self):
+            """ Fails if merges exceed fan-in or rewrite too much. """
+            input_files = sorted(glob.glob(os.path.join(self.task_dir,
+                                                        '0.*')))
+            for fan_in in [2, 3, 5, 22, 23, 40]:
+                merges, final_files = merge_plan(input_files, fan_in,
+                                                    self.temp_dir_path)
+                self.assertTrue(len(final_files) <= fan_in)
+                for merge_inputs, _ in merges:
+                    self.assertTrue(1 < len(merge_inputs) <= fan_in)
+                for merge_inputs, _ in merges[1:]:
+                    self.assertEqual(len(merge_inputs), fan_in)
+                if merges:
+                    self.assertEqual(len(final_files), fan_in)
+                # Every file is merged exactly once
+                merged = [input_file for merge_inputs, _ in merges
+                            for input_file in merge_inputs] + final_files
+                self.assertEqual(sorted(merged), sorted(
+                        input_files + [run for _, run in merges]
+                    ))
+            self.assertEqual(len(merge_plan(input_files, 22,
+                                            self.temp_dir_path)[0][0][0]), 2)
+
+        def test_reducer_input(self):
+            """ Fails if capping fan-in changes reducer input. """
+            for engine in ['python', 'sort']:
+                for gzip in [False, True]:
+                    if gzip:
+                        for task_file in glob.glob(os.path.join(
+                                    self.task_dir, '0.*[0-9]'
+                                )):
+                            subprocess.check_call(['gzip', task_file])
+                    for fan_in in [3, 64]:
+                        output_dir = os.path.join(
+                                self.temp_dir_path, '%s.%d.%d' % (
+                                        engine, gzip, fan_in
+                                    )
+                            )
+                        os.makedirs(output_dir)
+                        self.assertEqual(step_runner_with_error_return(
+                                'cat', os.path.join(self.task_dir, '0.*'),
+                                output_dir, self.temp_dir_path, 0, False,
+                                '\t', '-k1,1 -k2,2', 1024, gzip, 3, None,
+                                False, 'sort', None, engine, fan_in
+                            ), None)
+                        with yopen(None, os.path.join(
+                                    output_dir, '0.gz' if gzip else '0'
+                                )) as output_stream:
+                            self.assertEqual(output_stream.read(),
+                                ''.join([line + '\n'
+                                            for line in self.lines]))
+                        # Intermediate runs are cleaned up
+                        self.assertEqual(sorted(os.listdir(self.task_dir)),
+                            sorted(['0.%d%s' % (i, '.gz' if gzip else '')
+                                        for i in xrange(23)]))
+                    if gzip:
+                        for task_file in glob.glob(os.path.join(
+                                    self.task_dir, '0.*.gz'
+                                )):
+                            subprocess.check_call(['gzip', '-d', task_file])
+
+        def tearDown(self):
+            shutil.rmtree(self.temp_dir_path)
+
+    class TestTaskScheduler(unittest.TestCase):
+        """ Tests ordering tasks and picking engines in --ipy mode. """
+        def setUp(self):
+            self.temp_dir_path = tempfile.mkdtemp()
+            self.input_dir = os.path.join(self.temp_dir_path, 'input')
+            self.output_dir = os.path.join(self.temp_dir_path, 'output')
+            os.makedirs(self.input_dir)
+            os.makedirs(self.output_dir)
+            for i, size in enumerate([10, 1000, 100, 10000, 0]):
+                with open(os.path.join(self.input_dir, str(i)),
+                            'w') as output_stream:
+                    output_stream.write('x' * size)
+            self.host_map = {0 : 'a', 1 : 'a', 2 : 'b'}
+
+        def task_args(self, i, input_dir=None):
+            return [step_runner_with_error_return, None, None, 'cat',
+                    os.path.join(input_dir or self.input_dir, str(i)),
+                    self.output_dir, self.temp_dir_path, i, False, '\t',
+                    None, None]
+
+        def test_longest_first(self):
+            """ Fails if tasks aren't dispatched longest first. """
+            scheduler = TaskScheduler(self.host_map, seed=0)
+            for i in xrange(5):
+                scheduler.add(i, checkpointed_task, self.task_args(i))
+            assignments = scheduler.assign()
+            self.assertEqual([task for task, _ in assignments], [3, 1, 2])
+            self.assertEqual(sorted([engine for _, engine in assignments]),
+                                [0, 1, 2])
+            self.assertEqual(scheduler.assign(), [])
+            scheduler.finish(1)
+            self.assertEqual(scheduler.assign(), [(0, dict(assignments)[1])])
+            # Task that mustn't run on free engine stays queued
+            scheduler.finish(3)
+            self.assertEqual(scheduler.assign(lambda task: set([0, 1, 2])),
+                                [])
+            self.assertEqual([task for task, _ in scheduler.assign()], [4])
+            for task in [0, 2, 4]:
+                scheduler.finish(task)
+            self.assertTrue('Idle engine-seconds' in scheduler.summary())
+
+        def test_locality(self):
+            """ Fails if tasks don't go to hosts that wrote their inputs. """
+            file_hosts = {}
+            scheduler = TaskScheduler(self.host_map, file_hosts, seed=0)
+            for i in xrange(3):
+                scheduler.add(i, checkpointed_task, self.task_args(i))
+            engines = dict(scheduler.assign())
+            for i in xrange(3):
+                with open(os.path.join(self.output_dir, str(i)),
+                            'w') as output_stream:
+                    output_stream.write('x' * (i + 1))
+                scheduler.finish(i)
+            self.assertEqual(sorted(file_hosts.values()), ['a', 'a', 'b'])
+            # Next step reads outputs of previous step
+            for _ in xrange(10):
+                scheduler = TaskScheduler(self.host_map, file_hosts)
+                for i in xrange(3):
+                    scheduler.add(i, checkpointed_task,
+                                    self.task_args(i, self.output_dir))
+                for task, engine in scheduler.assign():
+                    self.assertEqual(self.host_map[engine],
+                                        self.host_map[engines[task]])
+                    scheduler.finish(task, False)
+                self.assertTrue(scheduler.summary().endswith('3/3'))
+
+        def test_avoided_engines(self):
+            """ Fails if retries and backups go to the wrong engines. """
+            self.assertEqual(avoided_engines([], self.host_map), set())
+            self.assertEqual(avoided_engines([0], self.host_map), set([0]))
+            self.assertEqual(avoided_engines([0, 2], self.host_map),
+                                set([0, 1, 2]))
+            self.assertEqual(avoided_engines([0], self.host_map, True),
+                                set([0, 1]))
+            # Single-host cluster: a backup runs on another engine
+            self.assertEqual(avoided_engines([0], {0 : 'a', 1 : 'a'}, True),
+                                set([0]))
+
+        def test_events(self):
+            """ Fails if finished AsyncResults aren't reported. """
+            class Pool(object):
+                def __init__(self):
+                    self.outstanding = set(['x', 'y', 'z'])
+                def spin(self):
+                    self.outstanding.discard(min(self.outstanding))
+            class AsyncResult(object):
+                def __init__(self, msg_id):
+                    self.msg_ids = [msg_id]
+            events = TaskEvents(Pool())
+            for task, msg_id in enumerate(['y', 'x', 'z']):
+                events.add(task, AsyncResult(msg_id))
+            self.assertEqual([events.wait() for _ in xrange(3)],
+                                [[1], [0], [2]])
+
+        def tearDown(self):
+            shutil.rmtree(self.temp_dir_path)
+
+    class TestSpeculativeExecution(unittest.TestCase):
+        """ Tests backing up straggling tasks. """
+        def setUp(self):
+            self.temp_dir_path = tempfile.mkdtemp()
+            self.input_file = os.path.join(self.temp_dir_path, 'input')
+            with open(self.input_file, 'w') as output_stream:
+                for i in xrange(1000):
+                    print >>output_stream, 'sam\t%d' % i
+            self.output_dir = os.path.join(self.temp_dir_path, 'output')
+            self.err_dir = os.path.join(self.temp_dir_path, 'log')
+            os.makedirs(self.output_dir)
+            os.makedirs(self.err_dir)
+            self.commit_lock = os.path.join(self.err_dir, '0.x.commit')
+
+        def attempt_args(self, streaming_command, attempt,
+                            multiple_outputs=False):
+            return [self.commit_lock, streaming_command, self.input_file,
+                    self.output_dir, self.err_dir, 0, multiple_outputs,
+                    '\t', None, None, False, 3, None, False, 'sort', None,
+                    'python', 64, attempt]
+
+        def test_stragglers(self):
+            """ Fails if wrong tasks are picked for backup. """
+            speculator = Speculator(4, slowdown=3.0, min_run_time=0)
+            for task in xrange(4):
+                speculator.start(task, 1000 if task != 1 else 10000)
+            for task in [0, 2]:
+                speculator.finish(task)
+            self.assertEqual(speculator.stragglers(), [])
+            speculator.finish(3)
+            start_time = time.time()
+            # Task 1 has 10x the input, so it's expected to take 10x longer
+            speculator.running[1] = (start_time - speculator.run_times[0]
+                                        * 20, 10000)
+            self.assertEqual(speculator.stragglers(), [])
+            speculator.running[1] = (start_time - speculator.run_times[0]
+                                        * 40 - 1, 10000)
+            self.assertEqual(speculator.stragglers(), [1])
+            speculator.backup(1)
+            self.assertEqual(speculator.stragglers(), [])
+
+        def test_first_attempt_commits(self):
+            """ Fails if a later attempt's output replaces the first's. """
+            for multiple_outputs in [False, True]:
+                self.assertEqual(committed_step_runner(*self.attempt_args(
+                        'cat', 0, multiple_outputs
+                    )), None)
+                self.assertEqual(committed_step_runner(*self.attempt_args(
+                        'sed s/sam/bam/', 1, multiple_outputs
+                    )), None)
+                output_file = os.path.join(self.output_dir,
+                                            'sam' if multiple_outputs
+                                            else '', '0')
+                with open(output_file) as output_stream:
+                    self.assertEqual(output_stream.read(), ''.join([
+                            ('%d\n' if multiple_outputs else 'sam\t%d\n') % i
+                            for i in xrange(1000)
+                        ]))
+                self.assertFalse(os.path.exists(
+                        os.path.join(self.output_dir, 'bam')
+                    ))
+                with open(self.commit_lock) as lock_stream:
+                    self.assertEqual(lock_stream.read(), '0\n')
+                # Attempt directories are removed
+                self.assertEqual(glob.glob(os.path.join(self.err_dir,
+                                                        'attempt.*')), [])
+                os.remove(self.commit_lock)
+
+        def test_straggler_killed(self):
+            """ Fails if a straggler keeps running after a backup commits.
+            """
+            import multiprocessing
+            pool = multiprocessing.Pool(2)
+            try:
+                start_time = time.time()
+                straggler = pool.apply_async(committed_step_runner,
+                        self.attempt_args('sleep 60; cat', 0))
+                time.sleep(1)
+                backup = pool.apply_async(committed_step_runner,
+                        self.attempt_args('cat', 1))
+                self.assertEqual(backup.get(30), None)
+                self.assertEqual(straggler.get(30), None)
+                self.assertTrue(time.time() - start_time < 30)
+            finally:
+                pool.terminate()
+            with open(self.commit_lock) as lock_stream:
+                self.assertEqual(lock_stream.read(), '1\n')
+            with open(os.path.join(self.output_dir, '0')) as output_stream:
+                self.assertEqual(len(output_stream.read().splitlines()),
+                                    1000)
+
+        def test_job_flow(self):
+            """ Fails if committing attempts changes a job flow's output. """
+            json_config = os.path.join(self.temp_dir_path, 'flow.json')
+            outputs = {}
+            for speculate in [False, True]:
+                output_dir = os.path.join(self.temp_dir_path,
+                                            'flow%d' % speculate)
+                with open(json_config, 'w') as json_stream:
+                    json.dump({'Steps' : [{
+                            'Name' : 'Split lines',
+                            'HadoopJarStep' : {
+                                'Args' : ['-D', 'mapreduce.job.reduces=3',
+                                          '-input', self.input_file,
+                                          '-output', output_dir,
+                                          '-mapper', 'cat',
+                                          '-reducer',
+                                          'awk -F\'\\t\' -v OFS=\'\\t\' '
+                                          '\'{ print $2 % 2, $0 }\'',
+                                          '-multiOutput']
+                            }
+                        }]}, json_stream)
+                stdout, stderr = sys.stdout, sys.stderr
+                sys.stdout = sys.stderr = open(os.devnull, 'w')
+                try:
+                    run_simulation(None, json_config, True, 1024, 2, '\t',
+                                    True, True, None, speculate=speculate)
+                finally:
+                    sys.stdout.close()
+                    sys.stdout, sys.stderr = stdout, stderr
+                outputs[speculate] = {}
+                for output_file in glob.glob(os.path.join(output_dir,
+                                                            '[01]', '*')):
+                    with open(output_file) as output_stream:
+                        outputs[speculate][
+                                os.path.relpath(output_file, output_dir)
+                            ] = output_stream.read()
+                self.assertEqual(len(glob.glob(os.path.join(
+                        output_dir, 'dp.reduce.log', '*.commit'
+                    ))), 3 if speculate else 0)
+            self.assertEqual(len(outputs[False]), 6)
+            self.assertEqual(outputs[True], outputs[False])
+
+        def tearDown(self):
+            shutil.rmtree(self.temp_dir_path)
+
+    class TestPlanPartitioner(unittest.TestCase):
+        """ Tests sample_partition_keys(), partition_plan(), and the
+            plan partitioner. """
+        def setUp(self):
+            self.temp_dir_path = tempfile.mkdtemp()
+            self.input_file = os.path.join(self.temp_dir_path, 'input')
+            '''Key k7 holds over half of the lines; all others hold the same
+            number of lines.'''
+            self.lines = []
+            for i in xrange(20):
+                for j in xrange(2000 if i == 7 else 100):
+                    self.lines.append('k%d\t%012d\tx' % (i, j))
+            self.lines.sort()
+            with open(self.input_file, 'w') as input_stream:
+                for line in self.lines:
+                    print >>input_stream, line
+
+        def loads(self, plan, task_count):
+            """ Computes number of lines partitioned to each task by plan.
+
+                plan: PartitionPlan object
+                task_count: number of tasks
+
+                Return value: list of line counts, one per task
+            """
+            assignments = plan.assignments(task_count)
+            loads = [0] * task_count
+            for line in self.lines:
+                key, value, _ = line.split('\t')
+                loads[assignments[plan.split(key, value)]] += 1
+            return loads
+
+        def test_sample(self):
+            """ Fails if sampled key sizes are far from actual sizes. """
+            gzipped_file = self.input_file + '.gz'
+            subprocess.check_call('gzip -c %s >%s' % (self.input_file,
+                                                        gzipped_file),
+                                    shell=True)
+            for input_file in [self.input_file, gzipped_file]:
+                key_sizes, key_values = sample_partition_keys(
+                        [input_file],
+                        partition_key_function('-k1,1', '\t'), '\t', 1,
+                        samples=5000
+                    )
+                self.assertEqual(len(key_sizes), 20)
+                self.assertTrue(0.45 < key_sizes['k7'] / sum(
+                                            key_sizes.values()
+                                        ) < 0.6)
+                self.assertTrue(all([value.isdigit()
+                                        for value, _ in key_values['k7']]))
+            # Samples are the same for the same input
+            self.assertEqual(*[sample_partition_keys(
+                                        [self.input_file],
+                                        partition_key_function('-k1,1',
+                                                                '\t'),
+                                        '\t'
+                                    )[0] for _ in xrange(2)])
+
+        def test_plan(self):
+            """ Fails if hot key isn't split or tasks are unbalanced. """
+            key_sizes, key_values = sample_partition_keys(
+                    [self.input_file], partition_key_function('-k1,1', '\t'),
+                    '\t', 1, samples=5000
+                )
+            plan = partition_plan(key_sizes, 4)
+            self.assertEqual(plan.bounds, {})
+            # k7 alone must hold more than half of the lines
+            self.assertEqual(max(self.loads(plan, 4)), 2000)
+            plan = partition_plan(key_sizes, 4, key_values, max_splits=8)
+            self.assertEqual(plan.bounds.keys(), ['k7'])
+            loads = self.loads(plan, 4)
+            self.assertEqual(sum(loads), len(self.lines))
+            self.assertTrue(max(loads) < 1.25 * len(self.lines) / 4)
+
+        def test_job_flow(self):
+            """ Fails if partitioning by plan changes a job flow's output. """
+            json_config = os.path.join(self.temp_dir_path, 'flow.json')
+            outputs = {}
+            for partitioner in [
+                    'org.apache.hadoop.mapred.lib.KeyFieldBasedPartitioner',
+                    'edu.jhu.cs.PlanPartitioner'
+                ]:
+                output_dir = os.path.join(self.temp_dir_path,
+                                            partitioner.rpartition('.')[2])
+                with open(json_config, 'w') as json_stream:
+                    json.dump({'Steps' : [{
+                            'Name' : 'Count lines by key',
+                            'HadoopJarStep' : {
+                                'Args' : ['-D', 'mapreduce.job.reduces=4',
+                                          '-D',
+                                          'stream.num.map.output.key.fields'
+                                          '=2',
+                                          '-D',
+                                          'mapreduce.partition.'
+                                          'keypartitioner.options=-k1,1',
+                                          '-partitioner', partitioner,
+                                          '-input', self.input_file,
+                                          '-output', output_dir,
+                                          '-mapper', 'cut -f 1-',
+                                          '-reducer',
+                                          'awk -F\'\\t\' -v OFS=\'\\t\' '
+                                          '\'{ counts[$1] += 1 } END { '
+                                          'for (key in counts) '
+                                          'print key, counts[key] }\'']
+                            }
+                        }]}, json_stream)
+                stdout, stderr = sys.stdout, sys.stderr
+                sys.stdout = sys.stderr = open(os.devnull, 'w')
+                try:
+                    run_simulation(None, json_config, True, 1024, 2, '\t',
+                                    True, True, None)
+                finally:
+                    sys.stdout.close()
+                    sys.stdout, sys.stderr = stdout, stderr
+                outputs[partitioner] = []
+                for output_file in glob.glob(os.path.join(output_dir,
+                                                            '[0-9]*')):
+                    with open(output_file) as output_stream:
+                        outputs[partitioner].extend(output_stream.readlines())
+                outputs[partitioner].sort()
+            self.assertEqual(len(outputs['edu.jhu.cs.PlanPartitioner']), 20)
+            self.assertEqual(
+                    outputs['edu.jhu.cs.PlanPartitioner'],
+                    outputs['org.apache.hadoop.mapred.lib.'
+                            'KeyFieldBasedPartitioner']
+                )
+            self.assertEqual(len(PartitionPlan(os.path.join(
+                    self.temp_dir_path, 'PlanPartitioner', 'dp.plan.log',
+                    'partition.plan'
+                ))), 20)
+
+        def tearDown(self):
+            shutil.rmtree(self.temp_dir_path)
 
-if __name__ == '__main__':
+    unittest.main(argv=[sys.argv[0]])
+    sys.exit(0)
+elif __name__ == '__main__':
     parser = argparse.ArgumentParser(description=__doc__, 
                     formatter_class=argparse.RawDescriptionHelpFormatter)
     add_args(parser)
@@ -2041,4 +5757,6 @@ if __name__ == '__main__':
                     args.log, args.gzip_outputs, args.gzip_level,
                     args.ipy, args.ipcontroller_json, args.ipy_profile,
                     args.scratch, args.common, args.sort, args.max_attempts,
-                    args.direct_write)
+                    args.direct_write, args.shuffle_engine, args.pipeline,
+                    args.resume, args.merge_fan_in, args.speculate,
+                    args.speculative_slowdown)
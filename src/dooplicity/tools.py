@@ -32,7 +32,8 @@ OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
 THE SOFTWARE.
 """
 
-from itertools import groupby
+from itertools import groupby, chain, islice, imap
+from operator import itemgetter
 import threading
 import signal
 import subprocess
@@ -43,6 +44,9 @@ import time
 from traceback import format_exc
 import os
 import tempfile
+import struct
+import array
+import zlib
 
 @contextlib.contextmanager
 def cd(dir_name):
@@ -258,6 +262,274 @@ def xopen(gzipped, *args):
         if 'old_read_eof' in locals():
             gzip.GzipFile._read_eof = old_read_eof
 
+class MultipleOutputStream(object):
+    """ Stream for the output of a streaming command with multiple outputs.
+
+        A step with multiple outputs writes lines whose first field is the
+        name of an output. Hadoop and, by default, the EMR simulator divide
+        these lines among outputs after the streaming command writes them to
+        stdout. When the EMR simulator sets the environment variable
+        dooplicity_output_dir, however, lines written here are instead
+        divided among outputs in the streaming command's own process and
+        written to the files the simulator would write, compressed there if
+        dooplicity_output_gzip_level is nonzero; the simulator never reads
+        them. Otherwise, writes pass straight through to the output stream.
+
+        Files are appended to, so a task may write with several
+        MultipleOutputStreams one after another, as Rail-RNA-align_reads does
+        in its two passes; the simulator removes a task's files before each
+        attempt at it. MultipleOutputStreams in a task must not run at the
+        same time, but lines for an output may also be written to stdout at
+        any time: the simulator appends them to the output's file once the
+        streaming command exits.
+    """
+    def __init__(self, output_stream=None, separator='\t',
+                    buffer_size=1048576):
+        """
+            output_stream: where to write when dooplicity_output_dir isn't
+                set; sys.stdout if None
+            separator: separator between name of output and rest of line;
+                overridden by dooplicity_output_separator
+            buffer_size: number of bytes to accumulate before dividing lines
+                among outputs
+        """
+        if output_stream is None:
+            import sys
+            output_stream = sys.stdout
+        self.output_stream = output_stream
+        self.output_dir = os.environ.get('dooplicity_output_dir', None)
+        self.closed = False
+        if self.output_dir is None:
+            self.write = output_stream.write
+            return
+        self.task_id = os.environ['mapred_task_partition']
+        self.gzip_level = int(
+                os.environ.get('dooplicity_output_gzip_level', 0)
+            )
+        self.separator = os.environ.get('dooplicity_output_separator',
+                                        separator)
+        self.buffer_size = buffer_size
+        self._buffer = []
+        self._buffered = 0
+        self._streams = {}
+        self._processes = []
+
+    def write(self, data):
+        """ Writes data; replaced by output stream's write() in passthrough
+            mode.
+
+            data: string
+
+            No return value.
+        """
+        self._buffer.append(data)
+        self._buffered += len(data)
+        if self._buffered >= self.buffer_size:
+            self._demultiplex()
+
+    def _stream(self, key):
+        """ Opens file for an output.
+
+            key: name of output
+
+            Return value: file object
+        """
+        key_dir = os.path.join(self.output_dir, key)
+        try:
+            os.makedirs(key_dir)
+        except OSError:
+            # Another process could have created output directory
+            if not os.path.isdir(key_dir):
+                raise
+        if self.gzip_level:
+            # Concatenated gzip members decompress to concatenated data
+            output_file = open(os.path.join(key_dir, self.task_id + '.gz'),
+                                'ab')
+            gzip_process = subprocess.Popen(['gzip', '-%d' % self.gzip_level],
+                                            bufsize=-1,
+                                            stdin=subprocess.PIPE,
+                                            stdout=output_file)
+            output_file.close()
+            self._processes.append(gzip_process)
+            stream = gzip_process.stdin
+        else:
+            stream = open(os.path.join(key_dir, self.task_id), 'a')
+        self._streams[key] = stream
+        return stream
+
+    def _demultiplex(self, final=False):
+        """ Writes complete buffered lines to their outputs.
+
+            final: True iff an incomplete last line should be written too
+
+            No return value.
+        """
+        data = ''.join(self._buffer)
+        end = len(data) if final else data.rfind('\n') + 1
+        remainder = data[end:]
+        self._buffer, self._buffered = [remainder], len(remainder)
+        if not end:
+            return
+        lines_by_key = defaultdict(list)
+        separator = self.separator
+        for line in data[:end].splitlines(True):
+            key, _, rest = line.partition(separator)
+            lines_by_key[key].append(rest)
+        for key, rests in lines_by_key.iteritems():
+            try:
+                stream = self._streams[key]
+            except KeyError:
+                stream = self._stream(key)
+            stream.write(''.join(rests))
+
+    def flush(self):
+        """ Writes complete buffered lines. No return value. """
+        if self.output_dir is None:
+            self.output_stream.flush()
+            return
+        self._demultiplex()
+        for stream in self._streams.itervalues():
+            stream.flush()
+
+    def close(self):
+        """ Writes everything buffered and closes outputs; the output
+            stream passed to the constructor is only flushed.
+
+            No return value.
+        """
+        if self.closed:
+            return
+        self.closed = True
+        if self.output_dir is None:
+            self.output_stream.flush()
+            return
+        self._demultiplex(final=True)
+        for stream in self._streams.itervalues():
+            stream.close()
+        for gzip_process in self._processes:
+            if gzip_process.wait():
+                raise RuntimeError('gzip process failed with exit code %d.'
+                                    % gzip_process.returncode)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+class PartitionPlan(object):
+    """ Assignment of partition keys to reduce tasks drawn up from a sample.
+
+        Hashing partition keys to reduce tasks leaves a task with a key that
+        holds far more data than the median key, or with several such keys,
+        running long after the others finish. A plan instead assigns keys to
+        tasks explicitly and can split a key into sub-bins, each a range of
+        the values of the field that follows the key's fields. Sub-bin 0 of
+        key K keeps the name K; sub-bin j > 0 is renamed K.j, which is what
+        sub_key() returns. Keys not in the plan are hashed as before.
+
+        A plan is stored as text, one line per sub-bin (or per key that isn't
+        split) with the tab-separated fields
+        1. Partition key
+        2. Lower bound of sub-bin, or an empty string for sub-bin 0
+        3. Reduce task
+        Sub-bins of a key appear in order of their lower bounds. Lower bounds
+        are compared with field values as strings, so they're meaningful only
+        for fields that sort that way, like Rail-RNA's zero-padded positions.
+    """
+    def __init__(self, plan_file=None):
+        """
+            plan_file: path to plan to load or None for an empty plan; a plan
+                file that doesn't exist is also taken to be empty
+        """
+        self.tasks = {}
+        self.bounds = {}
+        self.entries = []
+        if plan_file is None or not os.path.exists(plan_file):
+            return
+        with open(plan_file) as plan_stream:
+            for line in plan_stream:
+                key, lower_bound, task = line.rstrip('\n').rsplit('\t', 2)
+                self.add(key, int(task), lower_bound or None)
+
+    @staticmethod
+    def sub_key(key, index):
+        """ Names sub-bin of a key.
+
+            key: partition key
+            index: index of sub-bin
+
+            Return value: name of sub-bin
+        """
+        if not index:
+            return key
+        return '%s.%d' % (key, index)
+
+    def add(self, key, task, lower_bound=None):
+        """ Assigns a key or its next sub-bin to a task.
+
+            key: partition key
+            task: reduce task
+            lower_bound: None if key isn't split or this is sub-bin 0;
+                otherwise, smallest value of the splitting field in the
+                sub-bin, which must exceed the lower bounds of sub-bins added
+                before it
+
+            No return value.
+        """
+        if lower_bound is None:
+            index = 0
+        else:
+            self.bounds.setdefault(key, []).append(lower_bound)
+            index = len(self.bounds[key])
+        self.tasks[self.sub_key(key, index)] = task
+        self.entries.append((key, lower_bound, task))
+
+    def split(self, key, value):
+        """ Finds sub-bin of a key in which a value of splitting field falls.
+
+            key: partition key
+            value: value of the field that follows the key's fields
+
+            Return value: name of sub-bin
+        """
+        try:
+            bounds = self.bounds[key]
+        except KeyError:
+            return key
+        from bisect import bisect_right
+        return self.sub_key(key, bisect_right(bounds, value))
+
+    def assignments(self, task_count):
+        """ Obtains tasks to which keys and sub-bins are assigned.
+
+            task_count: number of reduce tasks; a key assigned to a task
+                outside [0, task_count) is left to be hashed
+
+            Return value: dictionary mapping keys and names of sub-bins to
+                tasks
+        """
+        return dict([(key, task) for key, task in self.tasks.iteritems()
+                        if 0 <= task < task_count])
+
+    def write(self, plan_file):
+        """ Writes plan to a file, replacing it atomically.
+
+            plan_file: path to plan
+
+            No return value.
+        """
+        temp_plan_file = '%s.%d.tmp' % (plan_file, os.getpid())
+        with open(temp_plan_file, 'w') as plan_stream:
+            for key, lower_bound, task in self.entries:
+                print >>plan_stream, '\t'.join(
+                        [key, lower_bound or '', str(task)]
+                    )
+        os.rename(temp_plan_file, plan_file)
+
+    def __len__(self):
+        return len(self.tasks)
+
 def make_temp_dir(scratch=None):
     """ Creates temporary directory in some scratch directory.
 
@@ -458,41 +730,137 @@ def apply_async_with_errors(rc, ids, function_to_apply, *args, **kwargs):
             to_return[asyncresult.metadata['engine_id']] = asyncresult.get()
     return to_return
 
+# Header of a block spilled by dlist: item count, lengths size, data size
+_dlist_block_header = struct.Struct('=QQQ')
+
 class dlist(object):
-    """ List data type that spills to disk if a memlimit is reached.
+    """ List data type that spills to disk if a memory budget is reached.
 
         Keeping memory usage low can be important in Hadoop, so this class
         is included in Dooplicity.
 
+        Items are packed pack_size at a time into one string with an array of
+        their lengths, so a list costs little more memory than its contents.
+        When packed items exceed byte_limit bytes or limit items, they're
+        written to a temporary file in blocks, each optionally
+        zlib-compressed, and memory is cleared.
+
         Random access is not currently permitted. The list should properly
         be used by appending all elements, then iterating through them to
-        read them.
+        read them. Iterations are independent: several may be in progress
+        at once.
     """
-    def __init__(self, limit=5000000):
+    def __init__(self, limit=5000000, byte_limit=67108864, compress_level=0,
+                    pack_size=1024):
         """
-            limit: maximum number of elements allowed in list before
+            limit: maximum number of elements allowed in memory before
                 spilling to disk
+            byte_limit: maximum number of bytes of elements and their lengths
+                allowed in memory before spilling to disk
+            compress_level: level of zlib compression to use for spilled
+                blocks; 0 for none
+            pack_size: number of elements to pack together
         """
-        self.mem_list = []
-        self.disk_stream = None
         self.limit = limit
+        self.byte_limit = byte_limit
+        self.compress_level = compress_level
+        self.pack_size = pack_size
+        self.disk_stream = None
+        self._pending = []
+        # Tuples (array of item lengths, packed items)
+        self._packs = []
+        self._packed_count = 0
+        self._packed_size = 0
+        # Byte offsets of spilled blocks in disk_stream
+        self._blocks = []
+        self._disk_size = 0
+        self._spilled_count = 0
 
     def __enter__(self):
         return self
 
+    def _pack(self):
+        """ Packs pending items and spills packs if memory budget is reached.
+
+            No return value.
+        """
+        lengths = array.array('L', map(len, self._pending))
+        self._packs.append((lengths, ''.join(self._pending)))
+        self._packed_count += len(self._pending)
+        self._packed_size += (len(self._packs[-1][1])
+                                + len(lengths) * lengths.itemsize)
+        self._pending = []
+        if (self._packed_count >= self.limit
+                or self._packed_size >= self.byte_limit):
+            self._spill()
+
+    def _spill(self):
+        """ Writes packs to disk as blocks and clears them from memory.
+
+            A block is a header giving the number of items, the size of their
+            lengths, and the size of the (possibly compressed) data, followed
+            by the lengths and the data.
+
+            No return value.
+        """
+        if self.disk_stream is None:
+            self.disk_stream = tempfile.TemporaryFile()
+        self.disk_stream.seek(self._disk_size)
+        for lengths, data in self._packs:
+            item_count, lengths = len(lengths), lengths.tostring()
+            if self.compress_level:
+                data = zlib.compress(data, self.compress_level)
+            self.disk_stream.write(_dlist_block_header.pack(
+                    item_count, len(lengths), len(data)
+                ))
+            self.disk_stream.write(lengths)
+            self.disk_stream.write(data)
+            self._blocks.append(self._disk_size)
+            self._disk_size += (_dlist_block_header.size + len(lengths)
+                                    + len(data))
+        self._spilled_count += self._packed_count
+        self._packs, self._packed_count, self._packed_size = [], 0, 0
+
+    def _block(self, block_start):
+        """ Reads a spilled block.
+
+            block_start: byte offset of block in disk_stream
+
+            Return value: tuple (array of item lengths, packed items)
+        """
+        self.disk_stream.flush()
+        self.disk_stream.seek(block_start)
+        _, lengths_size, data_size = _dlist_block_header.unpack(
+                self.disk_stream.read(_dlist_block_header.size)
+            )
+        lengths = array.array('L')
+        lengths.fromstring(self.disk_stream.read(lengths_size))
+        data = self.disk_stream.read(data_size)
+        if self.compress_level:
+            data = zlib.decompress(data)
+        return lengths, data
+
     def __iter__(self):
         """ Iterates through list.
 
-            NOTE THAT seek to beginning of file is performed if some of the
-            list is not in memory!
+            Blocks are read from disk one at a time, so an iteration holds
+            at most one block in memory besides the list's own packs.
         """
-        for item in self.mem_list:
+        for lengths, data in chain(
+                    (self._block(block_start)
+                        for block_start in self._blocks[:]),
+                    self._packs[:]
+                ):
+            start = 0
+            for length in lengths:
+                yield data[start:start + length]
+                start += length
+        for item in self._pending[:]:
             yield item
-        if self.disk_stream is not None:
-            self.disk_stream.flush()
-            self.disk_stream.seek(0)
-            for line in self.disk_stream:
-                yield line.strip()
+
+    def __len__(self):
+        return (self._spilled_count + self._packed_count
+                    + len(self._pending))
 
     def append(self, item):
         """ Appends item to list. Only strings are permitted right now.
@@ -501,32 +869,28 @@ class dlist(object):
         """
         if type(item) is not str:
             raise TypeError('An item appended to a dlist must be a string.')
-        if self.disk_stream is None:
-            if len(self.mem_list) < self.limit:
-                self.mem_list.append(item)
-            else:
-                # Open new temporary file
-                import tempfile
-                self.disk_stream = tempfile.TemporaryFile()
-                print >>self.disk_stream, item
-        else:
-            print >>self.disk_stream, item
+        self._pending.append(item)
+        if len(self._pending) >= self.pack_size:
+            self._pack()
 
     def tear_down(self):
         if self.disk_stream is not None:
             self.disk_stream.close()
+            self.disk_stream = None
+        self._pending, self._packs, self._blocks = [], [], []
+        self._packed_count = self._packed_size = 0
+        self._disk_size = self._spilled_count = 0
 
     def __exit__(self, type, value, traceback):
         self.tear_down()
- 
+
 class xstream(object):
     """ Permits Pythonic iteration through partitioned/sorted input streams.
 
-        All iterators are implemented as generators. Could have subclassed
-        itertools.groupby here; however, implementation of itertools.groupby
-        may change from version to version of Python. Implementation is thus
-        just based on itertools.groupby from
-        https://docs.python.org/2/library/itertools.html .
+        Lines are read in blocks of about block_size bytes, and each block
+        is split into lines and fields in bulk. Partitions are then found
+        with itertools.groupby, so keys are sliced and compared in C rather
+        than by a Python generator per line.
 
         Usage: for key, xpartition in xstream(hadoop_stream):
                    for value in xpartition:
@@ -534,12 +898,11 @@ class xstream(object):
 
         Each of key and value above is a tuple of strings.
 
-        Properties
-        -------------
-        key: key tuple that denotes current partition; this is an attribute
-            of both an xstream. None when no lines have been read yet.
-        value: tuple that denotes current value. None when no lines have been
-            read yet.
+        In raw mode, each value is instead the rest of
+        its line after the key, not split into fields, for steps that pass
+        values through. Lines are then split only as far as the end of the
+        key, and partitions are told apart by comparing the raw text of
+        their keys.
 
         Init vars
         -------------
@@ -548,54 +911,113 @@ class xstream(object):
             considered the key denoting a partition
         separator: delimiter separating fields from each input line
         skip_duplicates: skip any duplicate lines that may follow a line
+        raw: True iff values should be strings rather than tuples of fields
+        block_size: approximate number of bytes of lines to read at once
     """
+    @staticmethod
+    def record_blocks(
+            input_stream,
+            separator='\t',
+            skip_duplicates=False,
+            raw_key_fields=None,
+            block_size=65536
+        ):
+        """ Reads lines from a stream in blocks.
+
+            input_stream: where to find input lines
+            separator: delimiter separating fields from each input line
+            skip_duplicates: skip any duplicate lines that may follow a line
+            raw_key_fields: number of key fields if lines should be split
+                only into key and rest or None if they should be split into
+                all their fields
+            block_size: approximate number of bytes of lines to read at once
+
+            Yield value: list of tuples of fields, one per line. If
+                raw_key_fields is not None, each item instead ends with the
+                value, i.e., the rest of the line, and the key fields precede
+                it; a line with no more than raw_key_fields fields has the
+                value ''. If raw_key_fields is 1, each item is a tuple
+                (key, separator or '', value).
+        """
+        if hasattr(input_stream, 'readlines'):
+            blocks = iter(lambda: input_stream.readlines(block_size), [])
+        else:
+            input_stream = iter(input_stream)
+            blocks = iter(lambda: list(islice(input_stream, 1024)), [])
+        last_line = None
+        for lines in blocks:
+            if skip_duplicates:
+                lines = [line for line, _ in groupby(lines)]
+                if lines[0] == last_line:
+                    del lines[0]
+                    if not lines:
+                        continue
+                last_line = lines[-1]
+            if raw_key_fields is None:
+                yield [tuple(line.strip().split(separator)) for line in lines]
+            elif raw_key_fields == 1:
+                yield [line.strip().partition(separator) for line in lines]
+            else:
+                block = [line.strip().split(separator, raw_key_fields)
+                            for line in lines]
+                if min(map(len, block)) <= raw_key_fields:
+                    block = [fields if len(fields) > raw_key_fields
+                                else fields + [''] for fields in block]
+                yield block
+
     @staticmethod
     def stream_iterator(
             input_stream,
             separator='\t',
             skip_duplicates=False
         ):
-        if skip_duplicates:
-            for line, _ in groupby(input_stream):
-                yield tuple(line.strip().split(separator))
-        else:
-            for line in input_stream:
-                yield tuple(line.strip().split(separator))
+        """ Iterates through tuples of fields of lines. """
+        return chain.from_iterable(xstream.record_blocks(
+                        input_stream,
+                        separator=separator,
+                        skip_duplicates=skip_duplicates
+                    ))
 
     def __init__(
             self, 
             input_stream,
             key_fields=1,
             separator='\t',
-            skip_duplicates=False
+            skip_duplicates=False,
+            raw=False,
+            block_size=65536
         ):
-        self._key_fields = key_fields
-        self.it = self.stream_iterator(
+        self._records = chain.from_iterable(self.record_blocks(
                         input_stream,
                         separator=separator,
-                        skip_duplicates=skip_duplicates
-                    )
-        self.tgtkey = self.currkey = self.currvalue = object()
+                        skip_duplicates=skip_duplicates,
+                        raw_key_fields=(key_fields if raw else None),
+                        block_size=block_size
+                    ))
+        if not raw:
+            key = itemgetter(slice(0, key_fields))
+            self._value = itemgetter(slice(key_fields, None))
+        else:
+            key = itemgetter(0 if key_fields == 1 else slice(0, -1))
+            self._value = itemgetter(-1)
+        self._groups = groupby(self._records, key)
 
     def __iter__(self):
         return self
 
     def next(self):
-        while self.currkey == self.tgtkey:
-            self.currvalue = next(self.it)    # Exit on StopIteration
-            self.currkey = self.currvalue[:self._key_fields]
-        self.tgtkey = self.currkey
-        return self.currkey, self._grouper(self.tgtkey)
-
-    def _grouper(self, tgtkey):
-        while self.currkey == tgtkey:
-            yield self.currvalue[self._key_fields:]
-            self.currvalue = next(self.it)    # Exit on StopIteration
-            self.currkey = self.currvalue[:self._key_fields]
+        key, group = next(self._groups)    # Exit on StopIteration
+        if type(key) is list:
+            key = tuple(key)
+        elif type(key) is not tuple:
+            # Sole key field in raw mode
+            key = (key,)
+        return key, imap(self._value, group)
 
 if __name__ == '__main__':
     # Run unit tests
     import unittest
+    import sys
     import os
     import shutil
 
@@ -713,10 +1135,106 @@ if __name__ == '__main__':
                     for value in xpartition:
                         pass
 
+        def test_raw_values(self):
+            """ Fails if raw values aren't the rest of each line. """
+            with open(self.input_file, 'w') as input_stream:
+                input_stream.write(
+                        'chr1\t1\ta\t20\n'
+                        'chr1\t1\n'
+                        'chr1\t2\ti\t90\t1300\n'
+                        'chr2\n'
+                    )
+            for key_fields, expected in [
+                    (1, [(('chr1',), ['1\ta\t20', '1', '2\ti\t90\t1300']),
+                         (('chr2',), [''])]),
+                    (2, [(('chr1', '1'), ['a\t20', '']),
+                         (('chr1', '2'), ['i\t90\t1300']),
+                         (('chr2',), [''])])
+                ]:
+                with open(self.input_file) as input_stream:
+                    self.assertEqual(
+                            [(key, list(xpartition)) for key, xpartition
+                                in xstream(input_stream, key_fields,
+                                            raw=True)],
+                            expected
+                        )
+
+        def test_small_blocks(self):
+            """ Fails if partitions or duplicates span blocks wrongly. """
+            lines = ['%d\t%d\n' % (i / 7, i / 2) for i in xrange(200)]
+            with open(self.input_file, 'w') as input_stream:
+                input_stream.write(''.join(lines))
+            for skip_duplicates in [False, True]:
+                expected = [tuple(line.strip().split('\t')) for line in (
+                                [line for line, _ in groupby(lines)]
+                                if skip_duplicates else lines
+                            )]
+                with open(self.input_file) as input_stream:
+                    self.assertEqual(
+                            [key + value for key, xpartition
+                                in xstream(input_stream, 1,
+                                            skip_duplicates=skip_duplicates,
+                                            block_size=5)
+                                for value in xpartition],
+                            expected
+                        )
+
         def tearDown(self):
             # Kill temporary directory
             shutil.rmtree(self.temp_dir_path)
 
+    class TestDlist(unittest.TestCase):
+        """ Tests dlist class. """
+        def setUp(self):
+            self.items = [str(i) * (i % 7) for i in xrange(10000)] + [
+                            'tab\tand\nnewline', ' padded ']
+
+        def test_in_memory(self):
+            """ Fails if items held in memory aren't returned in order. """
+            with dlist() as a_list:
+                for item in self.items:
+                    a_list.append(item)
+                self.assertEqual(list(a_list), self.items)
+                self.assertEqual(len(a_list), len(self.items))
+                self.assertTrue(a_list.disk_stream is None)
+
+        def test_spill(self):
+            """ Fails if spilled items aren't returned in order. """
+            for compress_level in [0, 6]:
+                for limit, byte_limit, pack_size in [(1000, 67108864, 1024),
+                                                     (5000000, 4096, 100),
+                                                     (1, 67108864, 1)]:
+                    with dlist(limit=limit, byte_limit=byte_limit,
+                                compress_level=compress_level,
+                                pack_size=pack_size) as a_list:
+                        for item in self.items:
+                            a_list.append(item)
+                        self.assertTrue(a_list.disk_stream is not None)
+                        self.assertEqual(list(a_list), self.items)
+                        self.assertEqual(len(a_list), len(self.items))
+
+        def test_independent_iterations(self):
+            """ Fails if concurrent iterations interfere. """
+            with dlist(byte_limit=1024, pack_size=64) as a_list:
+                for item in self.items:
+                    a_list.append(item)
+                first, second = iter(a_list), iter(a_list)
+                interleaved = [(next(first), next(second), next(second))
+                                for _ in xrange(len(self.items) / 2)]
+                self.assertEqual([items[0] for items in interleaved],
+                                    self.items[:len(self.items) / 2])
+                self.assertEqual(
+                        [item for items in interleaved for item in items[1:]],
+                        self.items
+                    )
+                self.assertEqual(list(first),
+                                    self.items[len(self.items) / 2:])
+
+        def test_type(self):
+            """ Fails if a non-string can be appended. """
+            with dlist() as a_list:
+                self.assertRaises(TypeError, a_list.append, 5)
+
     class TestXopen(unittest.TestCase):
         """ Tests xopen function. """
         def setUp(self):
@@ -766,4 +1284,49 @@ if __name__ == '__main__':
             # Kill temporary directory
             shutil.rmtree(self.temp_dir_path)
 
-    unittest.main()
+    class TestPartitionPlan(unittest.TestCase):
+        """ Tests PartitionPlan class. """
+        def setUp(self):
+            # Set up temporary directory
+            self.temp_dir_path = tempfile.mkdtemp()
+            self.plan_file = os.path.join(self.temp_dir_path, 'plan')
+
+        def test_round_trip(self):
+            """ Fails if plan isn't the same after it's written and read. """
+            plan = PartitionPlan()
+            plan.add('chr1;0', 2)
+            plan.add('chr2;7', 0)
+            plan.add('chr2;7', 1, '000000035500')
+            plan.add('chr2;7', 3, '000000037000')
+            plan.write(self.plan_file)
+            read_plan = PartitionPlan(self.plan_file)
+            self.assertEqual(read_plan.entries, plan.entries)
+            self.assertEqual(read_plan.assignments(4),
+                                {'chr1;0' : 2, 'chr2;7' : 0,
+                                 'chr2;7.1' : 1, 'chr2;7.2' : 3})
+            # Tasks beyond task count are left to be hashed
+            self.assertEqual(read_plan.assignments(2),
+                                {'chr2;7' : 0, 'chr2;7.1' : 1})
+
+        def test_split(self):
+            """ Fails if values don't fall in the right sub-bins. """
+            plan = PartitionPlan()
+            plan.add('chr2;7', 0)
+            plan.add('chr2;7', 1, '000000035500')
+            plan.add('chr2;7', 3, '000000037000')
+            self.assertEqual(plan.split('chr2;7', '000000035001'), 'chr2;7')
+            self.assertEqual(plan.split('chr2;7', '000000035500'),
+                                'chr2;7.1')
+            self.assertEqual(plan.split('chr2;7', '000000039999'),
+                                'chr2;7.2')
+            self.assertEqual(plan.split('chr1;0', '000000000001'), 'chr1;0')
+
+        def test_missing_plan(self):
+            """ Fails if a plan file that doesn't exist isn't empty. """
+            self.assertEqual(len(PartitionPlan(self.plan_file)), 0)
+
+        def tearDown(self):
+            # Kill temporary directory
+            shutil.rmtree(self.temp_dir_path)
+
+    unittest.main(argv=[sys.argv[0]])
@@ -0,0 +1,110 @@
+package edu.jhu.cs;
+
+import java.io.BufferedReader;
+import java.io.IOException;
+import java.io.InputStreamReader;
+import java.util.HashMap;
+import java.util.Map;
+import java.util.regex.Matcher;
+import java.util.regex.Pattern;
+
+import org.apache.hadoop.fs.FileSystem;
+import org.apache.hadoop.fs.Path;
+import org.apache.hadoop.mapred.JobConf;
+import org.apache.hadoop.mapred.lib.KeyFieldBasedPartitioner;
+
+/*
+ * Assigns keys to reducers as directed by a plan drawn up from a sample of
+ * the job's input; see PartitionPlan in dooplicity/tools.py for the format.
+ * The plan is read from edu.jhu.cs.planpartitioner.path. Keys not in the
+ * plan, or all keys if there is no plan, are hashed like
+ * KeyFieldBasedPartitioner does. Only partitioner options of the form
+ * -kM[,N] spanning consecutive fields are supported.
+ */
+public class PlanPartitioner<K2, V2> extends KeyFieldBasedPartitioner<K2, V2> {
+
+  private Map<String, Integer> plan = new HashMap<String, Integer>();
+  private int firstField = 0;
+  private int lastField = -1;
+  private String separator = "\t";
+
+  @Override
+  public void configure(JobConf job) {
+    super.configure(job);
+    separator = job.get("mapreduce.map.output.key.field.separator",
+                        job.get("map.output.key.field.separator", "\t"));
+    Matcher matcher = Pattern.compile("-k\\s*(\\d+)[a-z]*(?:,(\\d+))?")
+      .matcher(job.get("mapreduce.partition.keypartitioner.options",
+                       job.get("mapred.text.key.partitioner.options", "-k1")));
+    boolean first = true;
+    while (matcher.find()) {
+      if (first) {
+        firstField = Integer.parseInt(matcher.group(1)) - 1;
+        first = false;
+      }
+      // Key extends to end of line if no end field is given
+      lastField = (matcher.group(2) == null) ? -1
+                    : Integer.parseInt(matcher.group(2)) - 1;
+    }
+    String planPath = job.get("edu.jhu.cs.planpartitioner.path");
+    if (planPath == null) {
+      return;
+    }
+    try {
+      Path path = new Path(planPath);
+      FileSystem fs = path.getFileSystem(job);
+      if (!fs.exists(path)) {
+        return;
+      }
+      BufferedReader reader
+        = new BufferedReader(new InputStreamReader(fs.open(path), "UTF-8"));
+      try {
+        Map<String, Integer> subBins = new HashMap<String, Integer>();
+        String line;
+        while ((line = reader.readLine()) != null) {
+          // Fields are key, lower bound of sub-bin, and reducer
+          int taskStart = line.lastIndexOf('\t');
+          int boundStart = line.lastIndexOf('\t', taskStart - 1);
+          String key = line.substring(0, boundStart);
+          int task = Integer.parseInt(line.substring(taskStart + 1));
+          if (boundStart + 1 == taskStart) {
+            plan.put(key, task);
+          } else {
+            // Sub-bin j > 0 of key K is named K.j
+            Integer index = subBins.containsKey(key) ? subBins.get(key) + 1
+                              : 1;
+            subBins.put(key, index);
+            plan.put(key + "." + index, task);
+          }
+        }
+      } finally {
+        reader.close();
+      }
+    } catch (IOException e) {
+      throw new RuntimeException("Partition plan " + planPath
+                                 + " could not be read.", e);
+    }
+  }
+
+  @Override
+  public int getPartition(K2 key, V2 value, int numReduceTasks) {
+    if (!plan.isEmpty()) {
+      String[] fields = key.toString().split(Pattern.quote(separator), -1);
+      int end = (lastField < 0) ? fields.length - 1
+                  : Math.min(lastField, fields.length - 1);
+      StringBuilder partitionKey = new StringBuilder();
+      for (int i = firstField; i <= end; i++) {
+        if (i > firstField) {
+          partitionKey.append(separator);
+        }
+        partitionKey.append(fields[i]);
+      }
+      Integer task = plan.get(partitionKey.toString());
+      if (task != null && task < numReduceTasks) {
+        return task;
+      }
+    }
+    return super.getPartition(key, value, numReduceTasks);
+  }
+
+}
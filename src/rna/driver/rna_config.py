@@ -127,6 +127,7 @@ _jar_target = '/mnt/lib'
 _custom_output_formats_jar = _jar_target + '/custom-output-formats.jar'
 _relevant_elephant_jar = _jar_target + '/relevant-elephant.jar'
 _mod_partitioner_jar = _jar_target + '/mod-partitioner.jar'
+_plan_partitioner_jar = _jar_target + '/plan-partitioner.jar'
 _hadoop_lzo_jar = ('/home/hadoop/.versions/2.4.0/share/hadoop'
                    '/common/lib/hadoop-lzo.jar')
 _s3distcp_jar = '/home/hadoop/lib/emr-s3distcp-1.0.jar'
@@ -688,7 +689,8 @@ def step(name, inputs, output,
     action_on_failure='TERMINATE_JOB_FLOW', jar=_hadoop_streaming_jar,
     tasks=0, partition_options=None, sort_options=None, archives=None,
     files=None, multiple_outputs=False, mod_partitioner=False,
-    inputformat=None, outputformat=None, extra_args=[]):
+    inputformat=None, outputformat=None, extra_args=[], combiner=None,
+    partition_plan=None, plan_splits=1):
     """ Outputs JSON for a given step.
 
         name: name of step
@@ -708,6 +710,13 @@ def step(name, inputs, output,
         inputformat: -inputformat option
         outputformat: -outputformat option; overrides multiple_outputs
         extra_args: extra '-D' args
+        combiner: combiner command or None if there is no combiner
+        partition_plan: path to plan assigning keys to reducers, or None if
+            keys should be hashed; see PartitionPlan in dooplicity/tools.py.
+            Dooplicity's EMR simulator draws up the plan from a sample of the
+            step's input before the step runs.
+        plan_splits: maximum number of sub-bins into which a key may be split
+            by the plan
 
         Return value: step dictionary
     """
@@ -745,6 +754,11 @@ def step(name, inputs, output,
                                                     sort_options
                                                 )
             ])
+    if partition_plan is not None:
+        to_return['HadoopJarStep']['Args'].extend([
+            '-D', 'edu.jhu.cs.planpartitioner.path=%s' % partition_plan,
+            '-D', 'edu.jhu.cs.planpartitioner.max.splits=%d' % plan_splits
+        ])
     for extra_arg in extra_args:
         to_return['HadoopJarStep']['Args'].extend(
             ['-D', extra_arg]
@@ -757,6 +771,9 @@ def step(name, inputs, output,
     if mod_partitioner:
         to_return['HadoopJarStep']['Args'][-1] \
             +=  (',%s' % _mod_partitioner_jar)
+    elif partition_plan is not None:
+        to_return['HadoopJarStep']['Args'][-1] \
+            +=  (',%s' % _plan_partitioner_jar)
     if archives is not None:
         to_return['HadoopJarStep']['Args'].extend([
                 '-archives', archives
@@ -770,6 +787,11 @@ def step(name, inputs, output,
                 '-partitioner',
                 'edu.jhu.cs.ModPartitioner',
             ])
+    elif partition_plan is not None:
+        to_return['HadoopJarStep']['Args'].extend([
+                '-partitioner',
+                'edu.jhu.cs.PlanPartitioner',
+            ])
     else:
         to_return['HadoopJarStep']['Args'].extend([
                 '-partitioner',
@@ -783,6 +805,10 @@ def step(name, inputs, output,
             '-mapper', mapper,
             '-reducer', reducer
         ])
+    if combiner is not None:
+        to_return['HadoopJarStep']['Args'].extend([
+                '-combiner', combiner
+            ])
     if outputformat is not None:
         to_return['HadoopJarStep']['Args'].extend([
                 '-outputformat', outputformat
@@ -819,9 +845,13 @@ def steps(protosteps, action_on_failure, jar, step_dir, reducer_count,
             {
                 'name' : [name of step]
                 'mapper' : argument of Hadoop Streaming's -mapper; if left
-                    unspecified, use IdentityMapper
+                    unspecified or None, use IdentityMapper
                 'reducer' : argument of Hadoop Streaming's -reducer; if left
                     unspecified, use IdentityReducer
+                'combiner' : argument of Hadoop Streaming's -combiner; present
+                    only if map output should be aggregated before it's
+                    shuffled. Must preserve key fields and sort order of
+                    its input, so typically a sum.py reducer.
                 'inputs' : list of input directories
                 'no_input_prefix' : key that's present iff intermediate dir
                     should not be prepended to inputs
@@ -847,6 +877,10 @@ def steps(protosteps, action_on_failure, jar, step_dir, reducer_count,
                 'index_output' : key that's present iff output LZOs should be
                     indexed after step; applicable only in Hadoop modes
                 'extra_args' : list of '-D' args
+                'partition_plan' : path to plan assigning keys to reducers,
+                    or None if keys should be hashed; see step()
+                'plan_splits' : maximum number of sub-bins into which the
+                    plan may split a key; present only if partition_plan is
             }
 
         protosteps: array of protosteps
@@ -918,6 +952,14 @@ def steps(protosteps, action_on_failure, jar, step_dir, reducer_count,
                     reducer_task_count = int(tasks[0])
         else:
             reducer_task_count = 0
+        '''Concurrent attempts at a task that writes outside the step's
+        output (with --out or to an alignment store) could clobber each
+        other's files, so speculative execution is turned off for such
+        steps.'''
+        writes_outside_output = any([re.search('--out[= ]|--alignment-store ',
+                                                protostep[phase])
+                                        for phase in ['mapper', 'reducer']
+                                        if protostep.get(phase)])
         true_steps.append(step(
                 name=protostep['name'],
                 inputs=([path_join(unix, intermediate_dir,
@@ -930,12 +972,17 @@ def steps(protosteps, action_on_failure, jar, step_dir, reducer_count,
                         else _executable, 
                         path_join(unix, step_dir,
                                         protostep['mapper'])])
-                        if 'mapper' in protostep else identity_mapper,
+                        if protostep.get('mapper') else identity_mapper,
                 reducer=' '.join(['pypy' if unix
                         else _executable, 
                         path_join(unix, step_dir,
                                         protostep['reducer'])]) 
                         if 'reducer' in protostep else 'cat',
+                combiner=' '.join(['pypy' if unix
+                        else _executable, 
+                        path_join(unix, step_dir,
+                                        protostep['combiner'])])
+                        if 'combiner' in protostep else None,
                 action_on_failure=action_on_failure,
                 jar=jar,
                 tasks=reducer_task_count,
@@ -964,6 +1011,11 @@ def steps(protosteps, action_on_failure, jar, step_dir, reducer_count,
                 extra_args=([extra_arg.format(task_count=reducer_count)
                     for extra_arg in protostep['extra_args']]
                     if 'extra_args' in protostep else [])
+                    + (['mapreduce.map.speculative=false',
+                        'mapreduce.reduce.speculative=false']
+                        if writes_outside_output else []),
+                partition_plan=protostep.get('partition_plan', None),
+                plan_splits=protostep.get('plan_splits', 1)
             )
         )
         if unix and 'index_output' in protostep:
@@ -1485,7 +1537,8 @@ class RailRnaLocal(object):
                     sort_memory_cap=(300*1024), parallel=False,
                     local=True, scratch=None, direct_write=False,
                     ansible=None, do_not_copy_index_to_nodes=False,
-                    sort_exe=None, fastq_dump_exe=None, vdb_config_exe=None):
+                    sort_exe=None, fastq_dump_exe=None, vdb_config_exe=None,
+                    resume=False):
         """ base: instance of RailRnaErrors """
         # Initialize ansible for easy checks
         if not ansible:
@@ -1521,7 +1574,7 @@ class RailRnaLocal(object):
         base.direct_write = direct_write
         if not parallel:
             if output_dir_url.is_local:
-                if os.path.exists(output_dir_url.to_url()):
+                if os.path.exists(output_dir_url.to_url()) and not resume:
                     if not base.force:
                         base.errors.append(('Output directory {0} exists, '
                                             'and --force was not invoked to '
@@ -2002,6 +2055,12 @@ class RailRnaLocal(object):
                       'specified with dollar signs are recognized here '
                       '(def: securely created temporary directory)')
             )
+            general_parser.add_argument(
+                '--pipeline', action='store_const', const=True,
+                default=False,
+                help=('start each step as soon as the steps whose outputs it '
+                      'reads finish rather than one step at a time')
+            )
         else:
             general_parser.add_argument(
                 '--ipcontroller-json', type=str, required=False,
@@ -2048,6 +2107,27 @@ class RailRnaLocal(object):
             help='keep intermediate files in log directory after job flow ' \
                  'is complete'
         )
+        general_parser.add_argument(
+            '--resume', action='store_const', const=True,
+            default=False,
+            help='skip steps completed by an earlier run with the same ' \
+                 'output and log directories; add --keep-intermediates ' \
+                 'to both runs to avoid recomputing deleted intermediates'
+        )
+        general_parser.add_argument(
+            '--speculate', action='store_const', const=True,
+            default=False,
+            help='launch backup attempts of tasks that run much longer ' \
+                 'than others in their step; whichever attempt finishes ' \
+                 'first is kept'
+        )
+        general_parser.add_argument(
+            '--shuffle-engine', type=str, required=False, metavar='<choice>',
+            default='python', choices=['python', 'sort'],
+            help='how map output is partitioned, sorted, and merged for ' \
+                 'reducers in local and parallel modes: "python" does it ' \
+                 'in-process; "sort" invokes UNIX sort (def: python)'
+        )
         general_parser.add_argument(
             '-g', '--gzip-intermediates', action='store_const', const=True,
             default=False,
@@ -2668,7 +2748,8 @@ mkdir -p sandbox
 cd sandbox
 unzip ../{rail_zipped} -d ./
 cd hadoop
-for JAR in relevant-elephant custom-output-formats mod-partitioner
+for JAR in relevant-elephant custom-output-formats mod-partitioner \\
+    plan-partitioner
 do
     rm -rf ${{JAR}}_out
     mkdir -p ${{JAR}}_out
@@ -3785,7 +3866,8 @@ class RailRnaAlign(object):
         do_not_output_ave_bw_by_chr=False, output_sam=False,
         do_not_drop_polyA_tails=False, deliverables='idx,tsv,bed,bw',
         bam_basename='alignments', bed_basename='', tsv_basename='',
-        assembly='hg19', s3_ansible=None):
+        assembly='hg19', s3_ansible=None, alignment_store=None,
+        alignment_store_size=10240):
         if not elastic:
             '''Programs and Bowtie indexes should be checked only in local
             mode. First grab Bowtie index paths.'''
@@ -4227,6 +4309,23 @@ class RailRnaAlign(object):
                                                     ','.join(indel_criteria)
                                                 ))
         base.do_not_drop_polyA_tails = do_not_drop_polyA_tails
+        if alignment_store is not None and elastic:
+            base.errors.append('An alignment store (--alignment-store) '
+                               'persists only across local and parallel '
+                               'mode runs.')
+        elif alignment_store is not None:
+            alignment_store = os.path.abspath(
+                                    os.path.expanduser(alignment_store)
+                                )
+        base.alignment_store = alignment_store
+        if not (float(alignment_store_size).is_integer()
+                    and alignment_store_size > 0):
+            base.errors.append('Alignment store size '
+                               '(--alignment-store-size) must be an integer '
+                               '> 0, but {0} was entered.'.format(
+                                                    alignment_store_size
+                                                ))
+        base.alignment_store_size = alignment_store_size
         base.drop_deletions = drop_deletions
         base.do_not_output_bam_by_chr = do_not_output_bam_by_chr
         base.do_not_output_ave_bw_by_chr = do_not_output_ave_bw_by_chr
@@ -4429,6 +4528,22 @@ class RailRnaAlign(object):
                             if exe_paths.bedgraphtobigwig is not None
                             else 'bedGraphToBigWig'))
             )
+            algo_parser.add_argument(
+                '--alignment-store', type=str, required=False,
+                metavar='<dir>',
+                default=None,
+                help=('directory of store of end-to-end alignments shared '
+                      'by runs with the same Bowtie 2 index and arguments; '
+                      'read sequences found there are not realigned '
+                      '(def: no store)')
+            )
+            algo_parser.add_argument(
+                '--alignment-store-size', type=int, required=False,
+                metavar='<int>',
+                default=10240,
+                help=('maximum size of alignment store in MB; least '
+                      'recently used alignments are evicted first')
+            )
         else:
             required_parser.add_argument(
                 '-a', '--assembly', type=str, required=True,
@@ -4684,6 +4799,12 @@ class RailRnaAlign(object):
                             if not base.do_not_output_bam_by_chr
                             else '')
         realign = (base.bam or base.tsv or base.bed or base.bw)
+        '''Highly expressed genes make some genome partitions far bigger than
+        others; in local and parallel modes, the EMR simulator samples the
+        input of the step that compiles coverages to draw up a plan that
+        splits these partitions into sub-bins and balances reducers.'''
+        coverage_plan = (os.path.join(base.intermediate_dir, 'precoverage.plan')
+                            if not elastic else None)
         nodemanager_mem = (base.nodemanager_mem if hasattr(
                                                         base, 
                                                         'nodemanager_mem'
@@ -4712,7 +4833,7 @@ class RailRnaAlign(object):
                          '--gzip-level {10} '
                          '--index-count {11} '
                          '--tie-margin {12} '
-                         '{13} {14} {15} {16} {17} {18} {19} -- {20}'
+                         '{13} {14} {15} {16} {17} {18} {19} {21} -- {20}'
                         ).format(
                                     base.bowtie1_idx,
                                     base.bowtie2_idx,
@@ -4744,7 +4865,14 @@ class RailRnaAlign(object):
                                                     min(4, max_tasks)
                                                 )
                                             if elastic else ''
-                                        ) # 2x threads on EMR cuz reducers/2
+                                        ), # 2x threads on EMR cuz reducers/2
+                                    ('--alignment-store {0} '
+                                     '--alignment-store-size {1}').format(
+                                            base.alignment_store,
+                                            base.alignment_store_size
+                                        ) if getattr(base, 'alignment_store',
+                                                        None) is not None
+                                    else ''
                                 ),
                 'inputs' : [input_dir],
                 'no_input_prefix' : True,
@@ -5148,9 +5276,9 @@ class RailRnaAlign(object):
                             else 'Count mapped reads by contig/sample'),
                 'reducer' : (
                          'bam.py --out={0} --bowtie-idx={1} '
-                         '--samtools-exe={2} --bam-basename={3} '
-                         '--manifest={4} {5} {6} {7} {8} {9} '
-                         '--tie-margin {10}').format(
+                         '--bam-basename={2} '
+                         '--manifest={3} {4} {5} {6} {7} {8} '
+                         '--tie-margin {9}').format(
                                         ab.Url(
                                             path_join(elastic,
                                             base.output_dir, 'alignments')
@@ -5159,7 +5287,6 @@ class RailRnaAlign(object):
                                         else path_join(elastic,
                                             base.output_dir, 'alignments'),
                                         base.bowtie1_idx,
-                                        base.samtools_exe,
                                         base.bam_basename,
                                         manifest,
                                         keep_alive,
@@ -5229,6 +5356,7 @@ class RailRnaAlign(object):
                 'reducer' : 'sum.py {0}'.format(
                                         keep_alive
                                     ),
+                'combiner' : 'sum.py',
                 'inputs' : [path_join(elastic, 'align_reads', 'exon_diff'),
                             path_join(elastic, 'compare_alignments',
                                                'exon_diff'),
@@ -5248,6 +5376,10 @@ class RailRnaAlign(object):
             } if base.bw else {},
             {
                 'name' : 'Compile sample coverages from exon differentials',
+                'mapper' : ('split_bins.py --plan={0}'.format(
+                                                    coverage_plan
+                                                )
+                            if not elastic else None),
                 'reducer' : ('coverage_pre.py --bowtie-idx={0} '
                              '--library-size {1} --read-counts {2} '
                              '--partition-stats --manifest={3} {4}').format(
@@ -5264,6 +5396,8 @@ class RailRnaAlign(object):
                                 if elastic else '1x',
                 'partition' : '-k1,1',
                 'sort' : '-k1,1 -k2,3',
+                'partition_plan' : (coverage_plan if not elastic else None),
+                'plan_splits' : 16,
                 'files' : base.read_counts_file,
                 'multiple_outputs' : True,
                 'extra_args' : [
@@ -5279,8 +5413,8 @@ class RailRnaAlign(object):
                 'name' : 'Write bigWigs with exome coverage by sample',
                 'reducer' : (
                          'coverage.py --bowtie-idx={0} --percentile={1} '
-                         '--out={2} --bigwig-exe={3} '
-                         '--manifest={4} {5} {6}').format(base.bowtie1_idx,
+                         '--out={2} '
+                         '--manifest={3} {4} {5}').format(base.bowtie1_idx,
                                                      base.normalize_percentile,
                                                      ab.Url(
                                                         path_join(elastic,
@@ -5291,7 +5425,6 @@ class RailRnaAlign(object):
                                                      else path_join(elastic,
                                                         base.output_dir,
                                                         'coverage_bigwigs'),
-                                                     base.bedgraphtobigwig_exe,
                                                      manifest,
                                                      verbose,
                                                      scratch),
@@ -5321,6 +5454,7 @@ class RailRnaAlign(object):
                                         verbose,
                                         keep_alive
                                     ),
+                'combiner' : 'sum.py',
                 'inputs' : [path_join(elastic, 'compare_alignments',
                                                'indel_bed'),
                             path_join(elastic, 'break_ties', 'indel_bed'),
@@ -5342,13 +5476,41 @@ class RailRnaAlign(object):
                         'elephantbird.combined.split.count={task_count}'
                     ]
             } if (base.tsv or base.bed) else {},
+            {
+                'name' : ('Compress normalization factors/junctions/indels'
+                            if base.tsv else 'Compress normalization factors'),
+                'reducer' : ('tsv_pre.py --bowtie-idx={0} --manifest={1} '
+                             '--gzip-level={2} {3}').format(
+                                                    base.bowtie1_idx,
+                                                    manifest,
+                                                    base.gzip_level
+                                                    if 'gzip_level' in
+                                                    dir(base) else 3,
+                                                    keep_alive
+                                                ),
+                'inputs' : ['coverage']
+                            + ([path_join(elastic, 'prebed', 'collect')]
+                                if base.tsv else []),
+                'output' : 'tsv_pre',
+                'tasks' : ('%d,' % (base.sample_count * 12))
+                            if elastic else '1x',
+                'partition' : '-k1,2',
+                'sort' : '-k1,2 -k3,3 -k4,4n -k5,5n -k6,6',
+                'extra_args' : [
+                        'elephantbird.use.combine.input.format=true',
+                        'elephantbird.check.is.splitable=false',
+                        'elephantbird.lzo.output.index=true',
+                        'elephantbird.combine.split.size=%d'
+                            % (_base_combine_split_size),
+                        'elephantbird.combined.split.count={task_count}'
+                    ]
+            } if (base.tsv or base.bw) else {},
             {
                 'name' : ('Write normalization factors/junctions/indels'
                             if base.tsv else 'Write normalization factors'),
-                'reducer' : ('tsv.py --bowtie-idx={0} --out={1} '
-                             '--manifest={2} --gzip-level={3} '
-                             '--tsv-basename={4} {5} {6}').format(
-                                                    base.bowtie1_idx,
+                'reducer' : ('tsv.py --out={0} '
+                             '--manifest={1} --gzip-level={2} '
+                             '--tsv-basename={3} {4} {5}').format(
                                                     ab.Url(
                                                         path_join(elastic,
                                                         base.output_dir,
@@ -5366,14 +5528,12 @@ class RailRnaAlign(object):
                                                     scratch,
                                                     keep_alive
                                                 ),
-                'inputs' : ['coverage']
-                            + ([path_join(elastic, 'prebed', 'collect')]
-                                if base.tsv else []),
+                'inputs' : ['tsv_pre'],
                 'output' : 'tsv',
                 'mod_partitioner' : True,
                 'tasks' : '1x',
                 'partition' : '-k1,1',
-                'sort' : '-k1,1 -k2,5',
+                'sort' : '-k1,3',
                 'extra_args' : [
                         'elephantbird.use.combine.input.format=true',
                         'elephantbird.check.is.splitable=false',
@@ -5467,7 +5627,7 @@ class RailRnaLocalPreprocessJson(object):
         sort_memory_cap=(300*1024), max_task_attempts=4, 
         keep_intermediates=False, check_manifest=True,
         scratch=None, sort_exe=None, dbgap_key=None,
-        fastq_dump_exe=None, vdb_config_exe=None):
+        fastq_dump_exe=None, vdb_config_exe=None, resume=False):
         base = RailRnaErrors(manifest, output_dir, isofrag_idx=isofrag_idx,
             intermediate_dir=intermediate_dir,
             force=force, aws_exe=aws_exe, profile=profile,
@@ -5478,7 +5638,7 @@ class RailRnaLocalPreprocessJson(object):
             gzip_level=gzip_level, sort_memory_cap=sort_memory_cap,
             keep_intermediates=keep_intermediates, scratch=scratch,
             sort_exe=sort_exe, fastq_dump_exe=fastq_dump_exe,
-            vdb_config_exe=vdb_config_exe)
+            vdb_config_exe=vdb_config_exe, resume=resume)
         RailRnaPreprocess(base, nucleotides_per_input=nucleotides_per_input,
             gzip_input=gzip_input, do_not_bin_quals=do_not_bin_quals,
             short_read_names=short_read_names,
@@ -5512,7 +5672,8 @@ class RailRnaParallelPreprocessJson(object):
         sort_memory_cap=(300*1024), max_task_attempts=4, ipython_profile=None,
         ipcontroller_json=None, scratch=None, direct_write=False,
         keep_intermediates=False, check_manifest=True, sort_exe=None,
-        dbgap_key=None, fastq_dump_exe=None, vdb_config_exe=None):
+        dbgap_key=None, fastq_dump_exe=None, vdb_config_exe=None,
+        resume=False):
         rc = ipython_client(ipython_profile=ipython_profile,
                                 ipcontroller_json=ipcontroller_json)
         base = RailRnaErrors(manifest, output_dir, isofrag_idx=isofrag_idx,
@@ -5526,7 +5687,7 @@ class RailRnaParallelPreprocessJson(object):
             keep_intermediates=keep_intermediates, scratch=scratch,
             direct_write=direct_write, local=False, parallel=False,
             sort_exe=sort_exe, fastq_dump_exe=fastq_dump_exe,
-            vdb_config_exe=vdb_config_exe)
+            vdb_config_exe=vdb_config_exe, resume=resume)
         if ab.Url(base.output_dir).is_local:
             '''Add NFS prefix to ensure tasks first copy files to temp dir and
             subsequently upload to final destination.'''
@@ -5718,7 +5879,8 @@ class RailRnaLocalAlignJson(object):
         bed_basename='', tsv_basename='', num_processes=1,
         gzip_intermediates=False, gzip_level=3, sort_memory_cap=(300*1024),
         max_task_attempts=4, keep_intermediates=False, scratch=None,
-        sort_exe=None):
+        sort_exe=None, resume=False,
+        alignment_store=None, alignment_store_size=10240):
         base = RailRnaErrors(manifest, output_dir, isofrag_idx=isofrag_idx,
             intermediate_dir=intermediate_dir,
             force=force, aws_exe=aws_exe, profile=profile,
@@ -5728,7 +5890,7 @@ class RailRnaLocalAlignJson(object):
             gzip_intermediates=gzip_intermediates, gzip_level=gzip_level,
             sort_memory_cap=sort_memory_cap,
             keep_intermediates=keep_intermediates,
-            scratch=scratch, sort_exe=sort_exe)
+            scratch=scratch, sort_exe=sort_exe, resume=resume)
         RailRnaAlign(base, input_dir=input_dir,
             elastic=False, bowtie1_exe=bowtie1_exe,
             bowtie_idx=bowtie_idx, bowtie1_build_exe=bowtie1_build_exe,
@@ -5763,7 +5925,9 @@ class RailRnaLocalAlignJson(object):
             do_not_output_ave_bw_by_chr=do_not_output_ave_bw_by_chr,
             do_not_drop_polyA_tails=do_not_drop_polyA_tails,
             deliverables=deliverables, bam_basename=bam_basename,
-            bed_basename=bed_basename, tsv_basename=tsv_basename)
+            bed_basename=bed_basename, tsv_basename=tsv_basename,
+            alignment_store=alignment_store,
+            alignment_store_size=alignment_store_size)
         raise_runtime_error(base)
         print_to_screen(base.detect_message)
         self._json_serial = {}
@@ -5805,7 +5969,8 @@ class RailRnaParallelAlignJson(object):
         direct_write=False, gzip_intermediates=False, gzip_level=3,
         sort_memory_cap=(300*1024), max_task_attempts=4,
         keep_intermediates=False, do_not_copy_index_to_nodes=False,
-        sort_exe=None):
+        sort_exe=None, resume=False,
+        alignment_store=None, alignment_store_size=10240):
         rc = ipython_client(ipython_profile=ipython_profile,
                                 ipcontroller_json=ipcontroller_json)
         base = RailRnaErrors(manifest, output_dir, isofrag_idx=isofrag_idx,
@@ -5818,7 +5983,7 @@ class RailRnaParallelAlignJson(object):
             gzip_level=gzip_level, sort_memory_cap=sort_memory_cap,
             keep_intermediates=keep_intermediates,
             local=False, parallel=False, scratch=scratch,
-            direct_write=direct_write, sort_exe=sort_exe)
+            direct_write=direct_write, sort_exe=sort_exe, resume=resume)
         if ab.Url(base.output_dir).is_local:
             '''Add NFS prefix to ensure tasks first copy files to temp dir and
             subsequently upload to S3.'''
@@ -5859,7 +6024,9 @@ class RailRnaParallelAlignJson(object):
             do_not_output_ave_bw_by_chr=do_not_output_ave_bw_by_chr,
             do_not_drop_polyA_tails=do_not_drop_polyA_tails,
             deliverables=deliverables, bam_basename=bam_basename,
-            tsv_basename=tsv_basename, bed_basename=bed_basename)
+            tsv_basename=tsv_basename, bed_basename=bed_basename,
+            alignment_store=alignment_store,
+            alignment_store_size=alignment_store_size)
         raise_runtime_error(base)
         temp_base_path = ready_engines(rc, base, prep=False)
         engine_bases = {}
@@ -5912,7 +6079,9 @@ class RailRnaParallelAlignJson(object):
             do_not_output_ave_bw_by_chr=do_not_output_ave_bw_by_chr,
             do_not_drop_polyA_tails=do_not_drop_polyA_tails,
             deliverables=deliverables, bam_basename=bam_basename,
-            tsv_basename=tsv_basename, bed_basename=bed_basename)
+            tsv_basename=tsv_basename, bed_basename=bed_basename,
+            alignment_store=alignment_store,
+            alignment_store_size=alignment_store_size)
         engine_base_checks = {}
         for i in rc.ids:
             engine_base_checks[i] = engine_bases[i].check_program
@@ -6114,7 +6283,8 @@ class RailRnaLocalAllJson(object):
         sort_memory_cap=(300*1024), max_task_attempts=4,
         keep_intermediates=False, check_manifest=True, scratch=None,
         sort_exe=None, dbgap_key=None, fastq_dump_exe=None,
-        vdb_config_exe=None):
+        vdb_config_exe=None, resume=False,
+        alignment_store=None, alignment_store_size=10240):
         base = RailRnaErrors(manifest, output_dir, isofrag_idx=isofrag_idx,
             intermediate_dir=intermediate_dir,
             force=force, aws_exe=aws_exe, profile=profile,
@@ -6130,7 +6300,7 @@ class RailRnaLocalAllJson(object):
             gzip_level=gzip_level, sort_memory_cap=sort_memory_cap,
             keep_intermediates=keep_intermediates, scratch=scratch,
             sort_exe=sort_exe, fastq_dump_exe=fastq_dump_exe,
-            vdb_config_exe=vdb_config_exe)
+            vdb_config_exe=vdb_config_exe, resume=resume)
         RailRnaAlign(base, bowtie1_exe=bowtie1_exe,
             bowtie_idx=bowtie_idx, bowtie1_build_exe=bowtie1_build_exe,
             bowtie2_exe=bowtie2_exe, bowtie2_build_exe=bowtie2_build_exe,
@@ -6164,7 +6334,9 @@ class RailRnaLocalAllJson(object):
             do_not_output_ave_bw_by_chr=do_not_output_ave_bw_by_chr,
             do_not_drop_polyA_tails=do_not_drop_polyA_tails,
             deliverables=deliverables, bam_basename=bam_basename,
-            bed_basename=bed_basename, tsv_basename=tsv_basename)
+            bed_basename=bed_basename, tsv_basename=tsv_basename,
+            alignment_store=alignment_store,
+            alignment_store_size=alignment_store_size)
         raise_runtime_error(base)
         print_to_screen(base.detect_message)
         self._json_serial = {}
@@ -6217,7 +6389,9 @@ class RailRnaParallelAllJson(object):
         max_task_attempts=4, ipython_profile=None, ipcontroller_json=None,
         scratch=None, direct_write=False, keep_intermediates=False,
         check_manifest=True, do_not_copy_index_to_nodes=False, sort_exe=None,
-        dbgap_key=None, fastq_dump_exe=None, vdb_config_exe=None):
+        dbgap_key=None, fastq_dump_exe=None, vdb_config_exe=None,
+        resume=False,
+        alignment_store=None, alignment_store_size=10240):
         rc = ipython_client(ipython_profile=ipython_profile,
                                 ipcontroller_json=ipcontroller_json)
         base = RailRnaErrors(manifest, output_dir, isofrag_idx=isofrag_idx,
@@ -6230,7 +6404,8 @@ class RailRnaParallelAllJson(object):
             gzip_level=gzip_level, sort_memory_cap=sort_memory_cap,
             direct_write=direct_write, keep_intermediates=keep_intermediates,
             local=False, parallel=False, scratch=scratch, sort_exe=sort_exe,
-            fastq_dump_exe=fastq_dump_exe, vdb_config_exe=vdb_config_exe)
+            fastq_dump_exe=fastq_dump_exe, vdb_config_exe=vdb_config_exe,
+            resume=resume)
         if ab.Url(base.output_dir).is_local:
             '''Add NFS prefix to ensure tasks first copy files to temp dir and
             subsequently upload to S3.'''
@@ -6275,7 +6450,9 @@ class RailRnaParallelAllJson(object):
             do_not_output_ave_bw_by_chr=do_not_output_ave_bw_by_chr,
             do_not_drop_polyA_tails=do_not_drop_polyA_tails,
             deliverables=deliverables, bam_basename=bam_basename,
-            bed_basename=bed_basename, tsv_basename=tsv_basename)
+            bed_basename=bed_basename, tsv_basename=tsv_basename,
+            alignment_store=alignment_store,
+            alignment_store_size=alignment_store_size)
         raise_runtime_error(base)
         temp_base_path = ready_engines(rc, base, prep=False)
         engine_bases = {}
@@ -6330,7 +6507,9 @@ class RailRnaParallelAllJson(object):
             do_not_output_ave_bw_by_chr=do_not_output_ave_bw_by_chr,
             do_not_drop_polyA_tails=do_not_drop_polyA_tails,
             deliverables=deliverables, bam_basename=bam_basename,
-            bed_basename=bed_basename, tsv_basename=tsv_basename)
+            bed_basename=bed_basename, tsv_basename=tsv_basename,
+            alignment_store=alignment_store,
+            alignment_store_size=alignment_store_size)
         engine_base_checks = {}
         for i in rc.ids:
             engine_base_checks[i] = engine_bases[i].check_program
@@ -64,6 +64,8 @@ import sys
 import os
 import site
 import subprocess
+import threading
+import Queue
 
 base_path = os.path.abspath(
                     os.path.dirname(os.path.dirname(os.path.dirname(
@@ -81,9 +83,41 @@ import tempdel
 # Initialize global variable for tracking number of input lines
 _input_line_count = 0
 
+# Number of readlets to send to Bowtie at once when streaming
+_readlets_per_write = 1024
+
+class QnameWriterThread(threading.Thread):
+    """ Writes blocks of qnames from a queue to a named pipe.
+
+        The delegate reads qnames in step with Bowtie's output, so qnames
+        must reach it independently of the readlets written to Bowtie.
+    """
+    def __init__(self, qnames_fifo, qname_queue):
+        """
+            qnames_fifo: path to named pipe read by delegate
+            qname_queue: Queue.Queue of blocks of qnames to write, ending
+                with None
+        """
+        super(QnameWriterThread, self).__init__()
+        self.daemon = True
+        self.qnames_fifo = qnames_fifo
+        self.qname_queue = qname_queue
+        self.exc_info = None
+
+    def run(self):
+        try:
+            with open(self.qnames_fifo, 'w') as qname_stream:
+                while True:
+                    qnames = self.qname_queue.get()
+                    if qnames is None:
+                        break
+                    qname_stream.write(qnames)
+        except Exception:
+            self.exc_info = sys.exc_info()
+
 def go(input_stream=sys.stdin, output_stream=sys.stdout, bowtie_exe='bowtie',
     bowtie_index_base='genome', bowtie_args='', gzip_level=3, verbose=False,
-    report_multiplier=1.2, scratch=None):
+    report_multiplier=1.2, scratch=None, stream=True):
     """ Runs Rail-RNA-align_readlets.
 
         Aligns input readlet sequences and writes a single output line per
@@ -157,6 +191,9 @@ def go(input_stream=sys.stdin, output_stream=sys.stdout, bowtie_exe='bowtie',
             report_multiplier.
         scratch: scratch directory for storing temporary files or None if 
             securely created temporary directory
+        stream: True iff readlets should be piped to Bowtie and qnames to
+            the delegate as they're read rather than first written to
+            temporary files
 
         No return value.
     """
@@ -164,6 +201,71 @@ def go(input_stream=sys.stdin, output_stream=sys.stdout, bowtie_exe='bowtie',
     # For storing long qnames
     temp_dir = make_temp_dir(scratch)
     register_cleanup(tempdel.remove_temporary_directories, [temp_dir])
+    bowtie_command = ' '.join([bowtie_exe, bowtie_args,
+        '-S -t --sam-nohead --mm', bowtie_index_base, '--12 -'])
+    if stream:
+        qnames_fifo = os.path.join(temp_dir, 'qnames.fifo')
+        os.mkfifo(qnames_fifo)
+        delegate_command = ''.join(
+                [sys.executable, ' ', os.path.realpath(__file__)[:-3],
+                    '_delegate.py --report-multiplier %08f --qnames-file %s '
+                    '--qnames-uncompressed %s'
+                        % (report_multiplier, qnames_fifo,
+                            '--verbose' if verbose else '')]
+            )
+        full_command = ' | '.join([bowtie_command, delegate_command])
+        print >>sys.stderr, 'Starting Bowtie with command: ' + full_command
+        bowtie_process = subprocess.Popen(' '.join(
+                        ['set -exo pipefail;', full_command]
+                    ),
+                bufsize=-1, stdin=subprocess.PIPE, stdout=sys.stdout,
+                stderr=sys.stderr, shell=True, executable='/bin/bash')
+        qname_queue = Queue.Queue()
+        qname_writer_thread = QnameWriterThread(qnames_fifo, qname_queue)
+        qname_writer_thread.start()
+        readlets, qnames = [], []
+        try:
+            for (seq_count, ((seq,), xpartition)) \
+                in enumerate(xstream(input_stream, 1)):
+                readlets.append(
+                        '\t'.join([str(seq_count), seq, 'I'*len(seq)])
+                    )
+                qnames.append(next(iter(xpartition))[0])
+                for (qname,) in xpartition:
+                    _input_line_count += 1
+                    qnames.append(qname)
+                # Separate qnames with single + character
+                qnames.append('+')
+                if len(readlets) == _readlets_per_write:
+                    '''Queue qnames before Bowtie can see their readlets so
+                    the delegate never waits on qnames that are stuck
+                    here.'''
+                    qnames.append('')
+                    qname_queue.put('\n'.join(qnames))
+                    readlets.append('')
+                    bowtie_process.stdin.write('\n'.join(readlets))
+                    readlets, qnames = [], []
+            if readlets:
+                qnames.append('')
+                qname_queue.put('\n'.join(qnames))
+                readlets.append('')
+                bowtie_process.stdin.write('\n'.join(readlets))
+            bowtie_process.stdin.close()
+        except IOError:
+            # Bowtie or the delegate died; its exit level is reported below
+            pass
+        finally:
+            qname_queue.put(None)
+        return_code = bowtie_process.wait()
+        if return_code:
+            raise RuntimeError('Error occurred while reading Bowtie output; '
+                               'exitlevel was %d.' % return_code)
+        qname_writer_thread.join()
+        if qname_writer_thread.exc_info is not None:
+            raise qname_writer_thread.exc_info[0], \
+                qname_writer_thread.exc_info[1], \
+                qname_writer_thread.exc_info[2]
+        return
     qnames_file = os.path.join(temp_dir, 'qnames.temp.gz')
     readlet_file = os.path.join(temp_dir, 'readlets.temp.gz')
     with xopen(True, qnames_file, 'w', gzip_level) as qname_stream:
@@ -179,8 +281,6 @@ def go(input_stream=sys.stdin, output_stream=sys.stdout, bowtie_exe='bowtie',
                 # Separate qnames with single + character
                 print >>qname_stream, '+'
     input_command = 'gzip -cd %s' % readlet_file
-    bowtie_command = ' '.join([bowtie_exe, bowtie_args,
-        '-S -t --sam-nohead --mm', bowtie_index_base, '--12 -'])
     delegate_command = ''.join(
                 [sys.executable, ' ', os.path.realpath(__file__)[:-3],
                     '_delegate.py --report-multiplier %08f --qnames-file %s %s'
@@ -227,8 +327,12 @@ if __name__ == '__main__':
         help='Print out extra debugging statements')
     parser.add_argument('--gzip-level', type=int, required=False,
         default=3,
-        help=('Level of gzip compression to use for temporary file storing '
-              'qnames.'))
+        help=('Level of gzip compression to use for temporary files storing '
+              'readlets and qnames; ignored unless --no-stream is invoked'))
+    parser.add_argument('--no-stream', action='store_const', const=True,
+        default=False,
+        help=('Write readlets and qnames to temporary gzipped files before '
+              'starting Bowtie rather than piping them'))
     parser.add_argument('--keep-alive', action='store_const', const=True,
         default=False,
         help='Periodically print Hadoop status messages to stderr to keep ' \
@@ -268,6 +372,7 @@ if __name__ == '__main__':
         gzip_level=args.gzip_level,
         verbose=args.verbose,
         report_multiplier=args.report_multiplier,
-        scratch=tempdel.silentexpandvars(args.scratch))
+        scratch=tempdel.silentexpandvars(args.scratch),
+        stream=not args.no_stream)
     print >>sys.stderr, 'DONE with align_readlets.py; in=%d; ' \
         'time=%0.3f s' % (_input_line_count, time.time() - start_time)
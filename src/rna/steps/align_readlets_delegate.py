@@ -141,6 +141,11 @@ if __name__ == '__main__':
     parser.add_argument('--qnames-file', type=str, required=True,
         help=('Where to find extended QNAMEs storing read sequence IDs to '
               'which readlets belong and other pertinent information'))
+    parser.add_argument('--qnames-uncompressed', action='store_const',
+        const=True,
+        default=False,
+        help=('Read QNAMEs file as uncompressed text without first checking '
+              'for gzip compression, as is necessary for a named pipe'))
     parser.add_argument('--report-multiplier', type=float, required=False,
         default=1.2,
         help='When --verbose is also invoked, the only lines of lengthy '
@@ -148,6 +153,7 @@ if __name__ == '__main__':
              'increases exponentially with this base')
     args = parser.parse_args()
 
-    with xopen(None, args.qnames_file) as qname_stream:
+    with xopen(False if args.qnames_uncompressed else None,
+                args.qnames_file) as qname_stream:
         go(qname_stream, verbose=args.verbose,
             report_multiplier=args.report_multiplier)
@@ -150,7 +150,6 @@ import os
 import site
 import subprocess
 import time
-import string
 
 base_path = os.path.abspath(
                     os.path.dirname(os.path.dirname(os.path.dirname(
@@ -169,12 +168,14 @@ import tempdel
 import group_reads
 from dooplicity.tools import xstream, dlist, register_cleanup, xopen, \
     make_temp_dir
+from dooplicity.counters import Counter
+import alignment_store
 from alignment_handlers import AlignmentPrinter
+from sequence_kernels import reversed_complement
 
 # Initialize global variables for tracking number of input lines
 _input_line_count = 0
 
-_reversed_complement_translation_table = string.maketrans('ATCG', 'TAGC')
 
 def go(input_stream=sys.stdin, output_stream=sys.stdout, bowtie2_exe='bowtie2',
     bowtie_index_base='genome', bowtie2_index_base='genome2', 
@@ -183,13 +184,19 @@ def go(input_stream=sys.stdin, output_stream=sys.stdout, bowtie2_exe='bowtie2',
     min_exon_size=8, search_filter=1, min_readlet_size=15, max_readlet_size=25,
     readlet_interval=12, capping_multiplier=1.5, drop_deletions=False,
     gzip_level=3, scratch=None, index_count=1, output_bam_by_chr=False,
-    tie_margin=0, no_realign=False, no_polyA=False):
+    tie_margin=0, no_realign=False, no_polyA=False, alignment_store_dir=None,
+    alignment_store_size=0):
     """ Runs Rail-RNA-align_reads.
 
         A single pass of Bowtie is run to find end-to-end alignments. Unmapped
         reads are saved for readletizing to determine junctions in sucessive
         reduce steps as well as for realignment in a later map step.
 
+        If alignment_store_dir is specified, first-pass alignments of read
+        sequences aligned by earlier runs are taken from the alignment store
+        there (see alignment_store.py) rather than from Bowtie 2, and
+        first-pass alignments of other read sequences are added to it.
+
         Input (read from stdin)
         ----------------------------
         Tab-delimited input tuple columns in a mix of any of the following
@@ -383,6 +390,9 @@ def go(input_stream=sys.stdin, output_stream=sys.stdout, bowtie2_exe='bowtie2',
         no_polyA: kill noncapping readlets that are all As and write as
             unmapped all reads with polyA prefixes whose suffixes are <
             min_exon_size
+        alignment_store_dir: directory of persistent store of first-pass
+            alignments shared across runs or None if it isn't used
+        alignment_store_size: maximum total size of alignment store in bytes
 
         No return value.
     """
@@ -415,12 +425,32 @@ def go(input_stream=sys.stdin, output_stream=sys.stdout, bowtie2_exe='bowtie2',
     align_file = os.path.join(temp_dir, 'first_pass_reads.temp.gz')
     other_reads_file = os.path.join(temp_dir, 'other_reads.temp.gz')
     second_pass_file = os.path.join(temp_dir, 'second_pass_reads.temp.gz')
+    plan_file = os.path.join(temp_dir, 'alignment_plan.temp.gz')
+    new_alignments_file = os.path.join(temp_dir, 'new_alignments.temp.gz')
     k_value, _, _ = bowtie.parsed_bowtie_args(bowtie2_args)
+    if alignment_store_dir is not None:
+        counter = Counter('align_reads')
+        store = alignment_store.AlignmentStore(
+                alignment_store_dir,
+                alignment_store.namespace(
+                        bowtie2_index_base, bowtie2_args,
+                        alignment_store.bowtie2_version(bowtie2_exe)
+                    ),
+                alignment_store_size,
+                counter
+            )
+    else:
+        store = None
+    # Whether store keys depend only on read sequences
+    ignore_quals = alignment_store.ignores_quals(bowtie2_args)
+    # Number of read sequences sent to first-pass Bowtie 2
+    to_align_count = 0
     nothing_doing = True
     # Required length of prefix after poly(A) is trimmed
     remaining_seq_size = max(min_exon_size - 1, 1)
     with xopen(True, align_file, 'w', gzip_level) as align_stream, \
-        xopen(True, other_reads_file, 'w', gzip_level) as other_stream:
+        xopen(True, other_reads_file, 'w', gzip_level) as other_stream, \
+        xopen(True, plan_file, 'w', gzip_level) as plan_stream:
         for seq_number, ((seq,), xpartition) in enumerate(
                                                         xstream(sys.stdin, 1)
                                                     ):
@@ -440,9 +470,7 @@ def go(input_stream=sys.stdin, output_stream=sys.stdout, bowtie2_exe='bowtie2',
                     make all reads with that sequence unmapped. Technically,
                     this also kills poly(A)s at 5' ends, but we probably
                     couldn't align those sequences anyway.'''
-                    reversed_complement_seq = seq[::-1].translate(
-                                        _reversed_complement_translation_table
-                                    )
+                    reversed_complement_seq = reversed_complement(seq)
                     for is_reversed, name, qual in xpartition:
                         if is_reversed == '0':
                             alignment_printer.print_unmapped_read(
@@ -477,10 +505,8 @@ def go(input_stream=sys.stdin, output_stream=sys.stdout, bowtie2_exe='bowtie2',
                     best_qual_index = i
                     best_mean_qual = mean_qual
                     best_name = name
-                    to_align = '\t'.join([
-                                        '%s\x1d%s' % (is_reversed, name),
-                                        seq, qual
-                                    ])
+                    best_qname = '%s\x1d%s' % (is_reversed, name)
+                    best_qual = qual
                 i += 1
             assert i >= 1
             if i == 1:
@@ -489,7 +515,21 @@ def go(input_stream=sys.stdin, output_stream=sys.stdout, bowtie2_exe='bowtie2',
                 for j, other_to_print in enumerate(others_to_print):
                     if j != best_qual_index:
                         print >>other_stream, other_to_print
-            print >>align_stream, to_align
+            if store is not None:
+                if ignore_quals:
+                    key = alignment_store.record_key(seq)
+                else:
+                    key = alignment_store.record_key(seq, best_qual)
+                alignments = store.get(key)
+                if alignments is not None:
+                    alignment_store.plan_hit(
+                            plan_stream, best_qname, alignments,
+                            best_qual if ignore_quals else None
+                        )
+                    continue
+                alignment_store.plan_miss(plan_stream, key)
+            print >>align_stream, '\t'.join([best_qname, seq, best_qual])
+            to_align_count += 1
     # Print dummy line
     print 'dummy\t-\tdummy'
     sys.stdout.flush() # this is REALLY important b/c called script will stdout
@@ -522,7 +562,8 @@ def go(input_stream=sys.stdin, output_stream=sys.stdout, bowtie2_exe='bowtie2',
                      '--tie-margin {tie_margin} '
                      '{no_realign} '
                      '{no_polyA} '
-                     '{output_bam_by_chr}').format(
+                     '{output_bam_by_chr} '
+                     '{alignment_plan}').format(
                         task_partition=task_partition,
                         other_reads=other_reads_file,
                         second_pass_reads=second_pass_file,
@@ -550,11 +591,20 @@ def go(input_stream=sys.stdin, output_stream=sys.stdout, bowtie2_exe='bowtie2',
                         no_polyA=('--no-polyA' if no_polyA else ''),
                         output_bam_by_chr=('--output-bam-by-chr'
                                             if output_bam_by_chr
-                                            else '')
+                                            else ''),
+                        alignment_plan=(('--alignment-plan %s '
+                                         '--new-alignments %s') % (
+                                                plan_file,
+                                                new_alignments_file
+                                            ) if store is not None else '')
                      )]
             )
-    full_command = ' | '.join([input_command, 
-                                bowtie_command, delegate_command])
+    if to_align_count:
+        full_command = ' | '.join([input_command, 
+                                    bowtie_command, delegate_command])
+    else:
+        # Every read sequence was in the alignment store
+        full_command = delegate_command + ' </dev/null'
     print >>sys.stderr, \
         'Starting first-pass Bowtie 2 with command: ' + full_command
     bowtie_process = subprocess.Popen(' '.join(
@@ -568,6 +618,13 @@ def go(input_stream=sys.stdin, output_stream=sys.stdout, bowtie2_exe='bowtie2',
                            'output; exitlevel was %d.' % return_code)
     os.remove(align_file)
     os.remove(other_reads_file)
+    if store is not None:
+        with xopen(None, new_alignments_file) as new_alignments_stream:
+            store.add(alignment_store.stored_records(new_alignments_stream))
+        store.close()
+        counter.flush()
+        os.remove(plan_file)
+        os.remove(new_alignments_file)
     if not no_realign:
         input_command = 'gzip -cd %s' % second_pass_file
         bowtie_command = ' '.join([bowtie2_exe,
@@ -715,6 +772,14 @@ if __name__ == '__main__':
         const=True,
         default=False, 
         help='Disallows any capping readlet that is a string of A nucleotides')
+    parser.add_argument('--alignment-store', type=str, required=False,
+        default=None,
+        help='Directory of persistent store of first-pass alignments shared '
+             'across runs with the same index and Bowtie 2 arguments; '
+             'omit to align every read sequence with Bowtie 2')
+    parser.add_argument('--alignment-store-size', type=int, required=False,
+        default=10240,
+        help='Maximum total size of alignment store in MB')
     
     # Add command-line arguments for dependencies
     partition.add_args(parser)
@@ -771,7 +836,11 @@ if __name__ == '__main__':
         output_bam_by_chr=args.output_bam_by_chr,
         tie_margin=args.tie_margin,
         no_realign=args.no_realign,
-        no_polyA=args.no_polyA)
+        no_polyA=args.no_polyA,
+        alignment_store_dir=(os.path.expandvars(args.alignment_store)
+                                if args.alignment_store is not None
+                                else None),
+        alignment_store_size=args.alignment_store_size * 1048576)
 
     print >>sys.stderr, 'DONE with align_reads.py; in=%d; ' \
         'time=%0.3f s' % (_input_line_count, time.time() - start_time)
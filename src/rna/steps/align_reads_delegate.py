@@ -8,7 +8,6 @@ first and second-pass output. See align_reads.py for output format information.
 import sys
 import os
 import site
-import string
 from collections import defaultdict
 import re
 
@@ -26,7 +25,7 @@ utils_path = os.path.join(base_path, 'rna', 'utils')
 site.addsitedir(utils_path)
 site.addsitedir(base_path)
 
-from dooplicity.tools import xstream, xopen
+from dooplicity.tools import xstream, xopen, MultipleOutputStream
 from alignment_handlers import AlignmentPrinter
 import bowtie_index
 import bowtie
@@ -34,15 +33,18 @@ import manifest
 import partition
 import group_reads
 from encode import decode_sequence
+from sequence_kernels import reversed_complement, Readletizer, is_poly_a
+from alignment_store import merged_alignments
 
-_reversed_complement_translation_table = string.maketrans('ATCG', 'TAGC')
 _output_line_count = 0
-_polyA = set(['A'])
+# Number of reads to readletize together
+_readletize_batch_size = 1000
 
 def print_readletized_output(seq, sample_indexes,
         reversed_complement_sample_indexes, seq_id, cap_sizes,
         output_stream=sys.stdout, min_readlet_size=8, max_readlet_size=25,
-        readlet_interval=5, verbose=False, no_polyA=False):
+        readlet_interval=5, verbose=False, no_polyA=False, readletizer=None,
+        readlets=None):
     """ Readletizes the unique read sequence seq.
 
         The function divides a sequence seq into several overlapping segments,
@@ -75,6 +77,11 @@ def print_readletized_output(seq, sample_indexes,
             first readlet written to stderr increases exponentially with base
             report_multiplier.
         no_polyA: kill readlets that are all As
+        readletizer: sequence_kernels.Readletizer object that caches readlet
+            layouts across calls or None to make one from cap_sizes,
+            max_readlet_size, readlet_interval, and no_polyA
+        readlets: readlets of seq as returned by readletizer.readlets(seq) if
+            they're already known or None to find them here
 
         No return value.
     """
@@ -99,57 +106,22 @@ def print_readletized_output(seq, sample_indexes,
     "mapred_task_partition" environment variable -- a unique index for a task
     within a job -- and Y is the index of the read sequence relative to the
     beginning of the input stream.'''
-    to_write = []
-    seq_size = len(seq)
-    # Add capping readlets
-    for cap_size in cap_sizes:
-        readlet_seq = seq[:cap_size]
-        reversed_complement_readlet_seq = readlet_seq[::-1].translate(
-                        _reversed_complement_translation_table
-                    )
-        if readlet_seq < reversed_complement_readlet_seq:
-            if not no_polyA or set(readlet_seq) != _polyA:
-                to_write.append('%s\t%s\x1e%d\x1e%d' % (readlet_seq, seq_id 
-                                                        + '+', 0,
-                                                        seq_size - cap_size))
-        else:
-            if not no_polyA or set(reversed_complement_readlet_seq) != _polyA:
-                to_write.append('%s\t%s\x1e%d\x1e%d' \
-                                    % (reversed_complement_readlet_seq,
-                                        seq_id + '-', 0, seq_size - cap_size))
-        readlet_seq = seq[-cap_size:]
-        reversed_complement_readlet_seq = readlet_seq[::-1].translate(
-                        _reversed_complement_translation_table
-                    )
-        if readlet_seq < reversed_complement_readlet_seq:
-            if not no_polyA or set(readlet_seq) != _polyA:
-                to_write.append('%s\t%s\x1e%d\x1e%d' % (readlet_seq,
-                                                    seq_id + '+',
-                                                    seq_size - cap_size, 0))
-        else:
-            if not no_polyA or set(reversed_complement_readlet_seq) != _polyA:
-                to_write.append('%s\t%s\x1e%d\x1e%d' \
-                                    % (reversed_complement_readlet_seq,
-                                        seq_id + '-', seq_size - cap_size, 0))
-    # Add noncapping readlets
-    for j in xrange(readlet_interval, seq_size - max_readlet_size,
-                        readlet_interval):
-        readlet_seq = seq[j:j+max_readlet_size]
-        reversed_complement_readlet_seq = readlet_seq[::-1].translate(
-                        _reversed_complement_translation_table
-                    )
-        if readlet_seq < reversed_complement_readlet_seq:
-            if not no_polyA or set(readlet_seq) != _polyA:
-                to_write.append('%s\t%s\x1e%d\x1e%d' % (readlet_seq,
-                                                    seq_id + '+', j, 
-                                                    seq_size - j
-                                                        - max_readlet_size))
-        else:
-            if not no_polyA or set(reversed_complement_readlet_seq) != _polyA:
-                to_write.append('%s\t%s\x1e%d\x1e%d' \
-                                    % (reversed_complement_readlet_seq,
-                                        seq_id + '-', j, 
-                                        seq_size - j - max_readlet_size))
+    if readlets is None:
+        if readletizer is None:
+            readletizer = Readletizer(cap_sizes, max_readlet_size,
+                                        readlet_interval,
+                                        drop_poly_a=no_polyA)
+        readlets = readletizer.readlets(seq)
+    forward_id, reversed_id = seq_id + '+', seq_id + '-'
+    to_write = ['readletized\t%s\t%s\x1e%d\x1e%d' % (readlet_seq,
+                                        reversed_id if reversed_readlet
+                                        else forward_id,
+                                        five_prime_displacement,
+                                        three_prime_displacement)
+                    for (readlet_seq, reversed_readlet,
+                            five_prime_displacement,
+                            three_prime_displacement)
+                    in readlets]
     # Add additional info to first readlet in to_write
     try:
         to_write[0] = '\x1e'.join([to_write[0], seq,
@@ -172,9 +144,48 @@ def print_readletized_output(seq, sample_indexes,
             % (i + 1, to_write[0])
         next_report_line = int((next_report_line + 1)
             * report_multiplier + 1) - 1
-    for readlet in to_write:
-        print >>output_stream, 'readletized\t%s' % readlet
-    _output_line_count += len(to_write)
+    to_write.append('')
+    output_stream.write('\n'.join(to_write))
+    _output_line_count += len(to_write) - 1
+
+def print_readletized_outputs(reads, cap_sizes, output_stream=sys.stdout,
+        min_readlet_size=8, max_readlet_size=25, readlet_interval=5,
+        no_polyA=False, readletizer=None):
+    """ Readletizes a batch of unique read sequences.
+
+        The reads are readletized together with Readletizer.readletized(),
+        which reverse-complements all their sequences in one pass, and each
+        read's output is then written as print_readletized_output() writes it.
+
+        reads: list of tuples (sequence to readletize, sample_indexes,
+            reversed_complement_sample_indexes, seq_id, verbose), where all
+            but the first item are as in print_readletized_output()
+        cap_sizes, output_stream, min_readlet_size, max_readlet_size,
+            readlet_interval, no_polyA, readletizer: as in
+            print_readletized_output()
+
+        No return value.
+    """
+    reads = [read for read in reads if len(read[0]) >= min_readlet_size]
+    if readletizer is None:
+        readletizer = Readletizer(cap_sizes, max_readlet_size,
+                                    readlet_interval, drop_poly_a=no_polyA)
+    for (seq, sample_indexes, reversed_complement_sample_indexes, seq_id,
+            verbose), readlets in zip(reads, readletizer.readletized(
+                                                [read[0] for read in reads]
+                                            )):
+        print_readletized_output(
+                seq=seq,
+                sample_indexes=sample_indexes,
+                reversed_complement_sample_indexes=\
+                    reversed_complement_sample_indexes,
+                seq_id=seq_id,
+                cap_sizes=cap_sizes,
+                output_stream=output_stream,
+                min_readlet_size=min_readlet_size,
+                verbose=verbose,
+                readlets=readlets
+            )
 
 def qname_and_mate(qname):
     """ Removes mate sequence from qname.
@@ -254,6 +265,8 @@ def handle_bowtie_output(input_stream, reference_index, manifest_object,
     global _output_line_count
     next_report_line = 0
     i = 0
+    readletizer = Readletizer(cap_sizes, max_readlet_size, readlet_interval,
+                                drop_poly_a=no_polyA)
     # Shortcut if no realignment is to be done in job flow
     if other_stream and no_realign:
         # First-pass alignment
@@ -261,6 +274,7 @@ def handle_bowtie_output(input_stream, reference_index, manifest_object,
             print >>sys.stderr, ('Processing alignments; suppressing some '
                                  'output.')
         readletized_index = 0
+        readletized_reads = []
         other_xstream = xstream(other_stream, 1)
         for (qname,), xpartition in xstream(input_stream, 1):
             is_reverse, _, qname = qname.partition('\x1d')
@@ -310,9 +324,7 @@ def handle_bowtie_output(input_stream, reference_index, manifest_object,
                                 ]
             if k_value == 1 and exact_match and not clip_present:
                 continue
-            reversed_complement_seq = seq[::-1].translate(
-                _reversed_complement_translation_table
-            )
+            reversed_complement_seq = reversed_complement(seq)
             if seq < reversed_complement_seq:
                 seq_to_print = seq
                 qual_to_print = qual
@@ -358,21 +370,30 @@ def handle_bowtie_output(input_stream, reference_index, manifest_object,
                         reversed_complement_sample_indexes[sample_index] += 1
                     else:
                         sample_indexes[sample_index] += 1
-                    print_readletized_output(
-                            seq=seq_to_print,
-                            sample_indexes=sample_indexes,
-                            reversed_complement_sample_indexes=\
-                                reversed_complement_sample_indexes,
-                            seq_id=(':'.join([task_partition,
-                                                str(readletized_index)])),
-                            cap_sizes=cap_sizes,
-                            output_stream=output_stream,
-                            min_readlet_size=min_readlet_size,
-                            max_readlet_size=max_readlet_size,
-                            readlet_interval=readlet_interval,
-                            verbose=(verbose and next_report_line == i),
-                            no_polyA=no_polyA)
+                    readletized_reads.append((
+                            seq_to_print, sample_indexes,
+                            reversed_complement_sample_indexes,
+                            ':'.join([task_partition,
+                                        str(readletized_index)]),
+                            verbose and next_report_line == i
+                        ))
                     readletized_index += 1
+                    if len(readletized_reads) >= _readletize_batch_size:
+                        print_readletized_outputs(
+                                readletized_reads,
+                                cap_sizes=cap_sizes,
+                                output_stream=output_stream,
+                                min_readlet_size=min_readlet_size,
+                                readletizer=readletizer
+                            )
+                        readletized_reads = []
+        print_readletized_outputs(
+                readletized_reads,
+                cap_sizes=cap_sizes,
+                output_stream=output_stream,
+                min_readlet_size=min_readlet_size,
+                readletizer=readletizer
+            )
         return
     alignment_printer = AlignmentPrinter(
             manifest_object,
@@ -390,6 +411,7 @@ def handle_bowtie_output(input_stream, reference_index, manifest_object,
         if verbose:
             print >>sys.stderr, 'Processing first-pass alignments.'
         readletized_index = 0
+        readletized_reads = []
         other_xstream = xstream(other_stream, 1)
         for (qname,), xpartition in xstream(input_stream, 1):
             is_reverse, _, qname = qname.partition('\x1d')
@@ -526,20 +548,21 @@ def handle_bowtie_output(input_stream, reference_index, manifest_object,
                                 ])
                         else:
                             print >>align_stream, '\t'.join([
-                                    qname, seq[::-1].translate(
-                                        _reversed_complement_translation_table
-                                    ), qual[::-1], decoded, len(decoded)*'I'
+                                    qname, reversed_complement(seq),
+                                        qual[::-1], decoded,
+                                        len(decoded)*'I'
                                 ])
                     else:
                         if flag & 16:
                             print >>align_stream, '\t'.join([
-                                    qname, seq[::-1].translate(
-                                        _reversed_complement_translation_table
-                                    ), qual[::-1], decoded, len(decoded)*'I'
+                                    qname, reversed_complement(seq),
+                                        qual[::-1], decoded,
+                                        len(decoded)*'I'
                                 ])
                         else:
                             print >>align_stream, '\t'.join([
-                                    qname, seq, qual, decoded, len(decoded)*'I'
+                                    qname, seq, qual,
+                                        decoded, len(decoded)*'I'
                                 ])
                 else:
                     # Final alignment can be written if no tie+mate
@@ -559,9 +582,7 @@ def handle_bowtie_output(input_stream, reference_index, manifest_object,
                                 )
             else:
                 print >>output_stream, 'unique\t%s' % seq
-            reversed_complement_seq = seq[::-1].translate(
-                _reversed_complement_translation_table
-            )
+            reversed_complement_seq = reversed_complement(seq)
             if seq < reversed_complement_seq:
                 seq_to_print = seq
                 qual_to_print = qual
@@ -647,21 +668,23 @@ def handle_bowtie_output(input_stream, reference_index, manifest_object,
                         reversed_complement_sample_indexes[sample_index] += 1
                     else:
                         sample_indexes[sample_index] += 1
-                    print_readletized_output(
-                            seq=seq_to_print,
-                            sample_indexes=sample_indexes,
-                            reversed_complement_sample_indexes=\
-                                reversed_complement_sample_indexes,
-                            seq_id=(':'.join([task_partition,
-                                                str(readletized_index)])),
-                            cap_sizes=cap_sizes,
-                            output_stream=output_stream,
-                            min_readlet_size=min_readlet_size,
-                            max_readlet_size=max_readlet_size,
-                            readlet_interval=readlet_interval,
-                            verbose=(verbose and next_report_line == i),
-                            no_polyA=no_polyA)
+                    readletized_reads.append((
+                            seq_to_print, sample_indexes,
+                            reversed_complement_sample_indexes,
+                            ':'.join([task_partition,
+                                        str(readletized_index)]),
+                            verbose and next_report_line == i
+                        ))
                     readletized_index += 1
+                    if len(readletized_reads) >= _readletize_batch_size:
+                        print_readletized_outputs(
+                                readletized_reads,
+                                cap_sizes=cap_sizes,
+                                output_stream=output_stream,
+                                min_readlet_size=min_readlet_size,
+                                readletizer=readletizer
+                            )
+                        readletized_reads = []
                 elif tie_present:
                     try:
                         for current_is_reverse, current_qname, current_qual \
@@ -815,6 +838,13 @@ def handle_bowtie_output(input_stream, reference_index, manifest_object,
                                 qname,
                                 qual_to_print
                             )
+        print_readletized_outputs(
+                readletized_reads,
+                cap_sizes=cap_sizes,
+                output_stream=output_stream,
+                min_readlet_size=min_readlet_size,
+                readletizer=readletizer
+            )
     else:
         # Second-pass alignment
         if verbose:
@@ -831,9 +861,7 @@ def handle_bowtie_output(input_stream, reference_index, manifest_object,
             rname = rest_of_line[1]
             pos = int(rest_of_line[2])
             seq, qual = rest_of_line[8], rest_of_line[9]
-            reversed_complement_seq = seq[::-1].translate(
-                _reversed_complement_translation_table
-            )
+            reversed_complement_seq = reversed_complement(seq)
             if seq < reversed_complement_seq:
                 seq_to_print = seq
                 qual_to_print = qual
@@ -879,9 +907,7 @@ def handle_bowtie_output(input_stream, reference_index, manifest_object,
                     print >>output_stream, \
                         '\t'.join(('postponed_sam',) + alignment)
                     _output_line_count += 1
-                reversed_complement_seq = seq[::-1].translate(
-                    _reversed_complement_translation_table
-                )
+                reversed_complement_seq = reversed_complement(seq)
                 print >>output_stream, 'unmapped\t%s\t%s\t%d\t%s\t%s' % (
                                 group_reads_object.index_group(seq_to_print),
                                 seq_to_print,
@@ -899,7 +925,8 @@ def go(task_partition='0', other_reads=None, second_pass_reads=None,
         manifest_file='manifest', exon_differentials=True,
         exon_intervals=False, gzip_level=3, search_filter=9,
         index_count=1, output_bam_by_chr=False, tie_margin=0,
-        no_realign=False, no_polyA=False):
+        no_realign=False, no_polyA=False, alignment_plan=None,
+        new_alignments=None):
     """ Emits output specified in align_reads.py by processing Bowtie 2 output.
 
         This script containing this function is invoked twice to process each
@@ -959,6 +986,11 @@ def go(task_partition='0', other_reads=None, second_pass_reads=None,
         no_realign: True iff job flow does not need more than readlets: this
             usually means only a transcript index is being constructed
         no_polyA: kill readlets that are all As
+        alignment_plan: on first pass, plan written by align_reads.py when
+            it consults an alignment store or None if there is none; Bowtie 2
+            output is then only for read sequences not in the store
+        new_alignments: where to write alignments of read sequences not in
+            the alignment store for adding to it; None if there's no plan
     """
     reference_index = bowtie_index.BowtieIndexReference(bowtie_index_base)
     manifest_object = manifest.LabelsAndIndices(manifest_file)
@@ -978,7 +1010,13 @@ def go(task_partition='0', other_reads=None, second_pass_reads=None,
             # Always have a start or end read of length max_readlet_size
             cap_sizes.append(max_readlet_size)
         with xopen(None, other_reads) as other_stream, \
-            xopen(True, second_pass_reads, 'w') as align_stream:
+            xopen(True, second_pass_reads, 'w') as align_stream, \
+            xopen(None, alignment_plan or os.devnull) as plan_stream, \
+            xopen(new_alignments is not None, new_alignments or os.devnull,
+                    'w', gzip_level) as new_alignments_stream:
+            if alignment_plan is not None:
+                input_stream = merged_alignments(input_stream, plan_stream,
+                                                    new_alignments_stream)
             handle_bowtie_output(
                     input_stream,
                     reference_index,
@@ -1111,6 +1149,15 @@ if __name__ == '__main__':
         const=True,
         default=False, 
         help='Disallows any readlet that is a string of A nucleotides')
+    parser.add_argument('--alignment-plan', type=str, required=False,
+        default=None,
+        help=('Path to plan of stored and Bowtie 2 alignments written when '
+              'align_reads.py consults an alignment store; included only on '
+              'first invocation of script'))
+    parser.add_argument('--new-alignments', type=str, required=False,
+        default=None,
+        help=('Path to file to write containing alignments to add to '
+              'alignment store; included only with --alignment-plan'))
 
     # Add command-line arguments for dependencies
     partition.add_args(parser)
@@ -1123,31 +1170,36 @@ if __name__ == '__main__':
     args = parser.parse_args()
 
 if __name__ == '__main__' and not args.test:
-    go(task_partition=args.task_partition,
-        other_reads=args.other_reads,
-        second_pass_reads=args.second_pass_reads,
-        min_readlet_size=args.min_readlet_size,
-        drop_deletions=args.drop_deletions,
-        max_readlet_size=args.max_readlet_size,
-        readlet_interval=args.readlet_interval,
-        capping_multiplier=args.capping_multiplier,
-        output_stream=sys.stdout,
-        input_stream=sys.stdin,
-        verbose=args.verbose,
-        report_multiplier=args.report_multiplier,
-        k_value=args.k_value,
-        bowtie_index_base=args.bowtie_idx,
-        bin_size=args.partition_length,
-        manifest_file=args.manifest,
-        exon_differentials=args.exon_differentials,
-        exon_intervals=args.exon_intervals,
-        search_filter=args.search_filter,
-        gzip_level=args.gzip_level,
-        index_count=args.index_count,
-        output_bam_by_chr=args.output_bam_by_chr,
-        tie_margin=args.tie_margin,
-        no_realign=args.no_realign,
-        no_polyA=args.no_polyA)
+    '''Outputs are written straight to their files when the EMR simulator
+    allows it; otherwise, they're written to stdout.'''
+    with MultipleOutputStream(sys.stdout) as output_stream:
+        go(task_partition=args.task_partition,
+            other_reads=args.other_reads,
+            second_pass_reads=args.second_pass_reads,
+            min_readlet_size=args.min_readlet_size,
+            drop_deletions=args.drop_deletions,
+            max_readlet_size=args.max_readlet_size,
+            readlet_interval=args.readlet_interval,
+            capping_multiplier=args.capping_multiplier,
+            output_stream=output_stream,
+            input_stream=sys.stdin,
+            verbose=args.verbose,
+            report_multiplier=args.report_multiplier,
+            k_value=args.k_value,
+            bowtie_index_base=args.bowtie_idx,
+            bin_size=args.partition_length,
+            manifest_file=args.manifest,
+            exon_differentials=args.exon_differentials,
+            exon_intervals=args.exon_intervals,
+            search_filter=args.search_filter,
+            gzip_level=args.gzip_level,
+            index_count=args.index_count,
+            output_bam_by_chr=args.output_bam_by_chr,
+            tie_margin=args.tie_margin,
+            no_realign=args.no_realign,
+            no_polyA=args.no_polyA,
+            alignment_plan=args.alignment_plan,
+            new_alignments=args.new_alignments)
 
 elif __name__ == '__main__':
     # Test units
@@ -1335,7 +1387,36 @@ elif __name__ == '__main__':
                             )
             # Ensure no polyA readlets
             self.assertEquals([readlet for readlet in collected_readlets
-                                if set(readlet[0]) == _polyA], [])
+                                if is_poly_a(readlet[0])], [])
+
+        def test_batch_output(self):
+            """ Fails if batched readletization changes output. """
+            input_seqs = ['TTACATACCATACAGTGCGCTAGCGGGTGACAGATATAATGCAGATCCAT',
+                          'AAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAA',
+                          'ACGT',
+                          'CAGAGTGCCGCAATGACGTGCGCCAAAGCGGACAAAGCACCATGACAAGT'
+                          'ACACAGGTGACAGTGACAAGACAG']
+            reads = [(seq, {'1' : 2}, {'2' : 1}, '0:' + str(i), False)
+                        for i, seq in enumerate(input_seqs)]
+            cap_sizes = [8, 12, 25]
+            with open(self.output_file, 'w') as output_stream:
+                for read in reads:
+                    print_readletized_output(
+                            read[0], read[1], read[2], read[3], cap_sizes,
+                            output_stream=output_stream,
+                            min_readlet_size=8, max_readlet_size=25,
+                            readlet_interval=5, no_polyA=True
+                        )
+            batch_file = os.path.join(self.temp_dir_path, 'batch_output.tsv')
+            with open(batch_file, 'w') as output_stream:
+                print_readletized_outputs(
+                        reads, cap_sizes, output_stream=output_stream,
+                        min_readlet_size=8, max_readlet_size=25,
+                        readlet_interval=5, no_polyA=True
+                    )
+            with open(self.output_file) as one_stream, \
+                open(batch_file) as batch_stream:
+                self.assertEqual(one_stream.read(), batch_stream.read())
 
         def tearDown(self):
             # Kill temporary directory
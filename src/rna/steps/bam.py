@@ -84,7 +84,6 @@ import filemover
 from dooplicity.ansibles import Url
 from dooplicity.tools import register_cleanup, make_temp_dir, xstream
 from alignment_handlers import SampleAndRnameIndexes
-import subprocess
 import tempdel
 
 # Print file's docstring if -h is invoked
@@ -112,9 +111,11 @@ parser.add_argument(\
          'RNAME. Ignored if --out is not specified (that is, if --out is '
          'stdout)')
 parser.add_argument(\
-    '--samtools-exe', metavar='EXE', type=str, required=False,
-    default='samtools',
-    help='Path to executable for samtools')
+    '--compression-threads', type=int, required=False, default=2,
+    help='Number of threads on which to compress each BAM\'s blocks')
+parser.add_argument(\
+    '--gzip-level', type=int, required=False, default=6,
+    help='Level of gzip compression to use for BAMs')
 parser.add_argument(\
     '--keep-alive', action='store_const', const=True, default=False,
     help='Prints reporter:status:alive messages to stderr to keep EMR '
@@ -197,9 +198,7 @@ if args.suppress_bam:
                                                  total_count, unique_count)
 else:
     # Grab stats _and_ output SAM/BAMs
-    if not args.output_sam:
-        # Only need subprocess to start samtools if outputting bam
-        import subprocess
+    from bam_writer import BamWriter, SamWriter
 
     # Get RNAMEs in order of descending length
     sorted_rnames = [reference_index.string_to_rname['%012d' % i]
@@ -228,8 +227,11 @@ else:
     from contextlib import contextmanager
     @contextmanager
     def stream_and_upload(rnames, filename=None, mover=None, output_url=None,
-                            sam=False, samtools_exe=None):
-        """ Yields output stream to write to and uploads as necessary
+                            sam=False):
+        """ Yields alignment writer and uploads as necessary
+
+            BAMs other than those of unmapped reads are indexed as they're
+            written.
 
             sorted_rnames: list of rnames in order of descending length
             filename: full path to file to write or None if writing to stdout
@@ -237,9 +239,9 @@ else:
             output_url: url to which to write or None if no moving should be
                 performed
             sam: True iff sam should be output
-            samtools_exe: path to samtools exe if necessary; else None
 
-            Yield value: stream
+            Yield value: SamWriter or BamWriter object; its write() method
+                takes a list of SAM fields
         """
         '''Write SAM header; always include all reference sequences to
         avoid confusing users.'''
@@ -257,15 +259,13 @@ else:
             )
         if filename is None:
             try:
-                print header
-                yield sys.stdout
+                yield SamWriter(sys.stdout, header)
             finally:
                 pass
         elif sam:
             try:
                 output_stream = open(filename, 'w')
-                print >>output_stream, header
-                yield output_stream
+                yield SamWriter(output_stream, header)
             finally:
                 output_stream.close()
                 if not output_url.is_local:
@@ -273,38 +273,23 @@ else:
                               output_url.plus(os.path.basename(filename)))
                     os.remove(filename)
         else:
+            unmapped = filename.endswith('.unmapped.bam')
+            bai = None if unmapped else filename + '.bai'
             try:
-                samtools_stream = open(filename, 'wb')
-                samtools_process = subprocess.Popen(
-                            [samtools_exe, 'view', '-bS', '-'],
-                            stdin=subprocess.PIPE,
-                            stdout=samtools_stream
-                        )
-                output_stream = samtools_process.stdin
-                print >>output_stream, header
-                yield output_stream
+                bam_writer = BamWriter(filename, header, rnames,
+                                        reference_index.rname_lengths,
+                                        index_filename=bai,
+                                        level=args.gzip_level,
+                                        threads=args.compression_threads)
+                yield bam_writer
             finally:
-                output_stream.close()
-                samtools_return = samtools_process.wait()
-                if samtools_return:
-                    raise RuntimeError(
-                            'samtools returned exit code %d' 
-                                % samtools_return
-                        )
-                samtools_stream.close()
-                # Index bam
-                unmapped = filename.endswith('.unmapped.bam')
-                if not unmapped:
-                    subprocess.check_call([samtools_exe, 'index',
-                                            filename],
-                                            bufsize=-1)
+                bam_writer.close()
                 if not output_url.is_local:
                     mover.put(filename, 
                               output_url.plus(os.path.basename(filename)))
                     if not unmapped:
-                        bai = filename + '.bai'
                         mover.put(
-                                filename, 
+                                bai, 
                                 output_url.plus(os.path.basename(bai))
                             )
                         os.remove(bai)
@@ -334,9 +319,8 @@ else:
                                          and not output_url.is_local)
                                else None),
                         output_url=(None if args.out is None else output_url),
-                        sam=args.output_sam,
-                        samtools_exe=args.samtools_exe
-                    ) as output_stream:
+                        sam=args.output_sam
+                    ) as alignment_writer:
                 for record in xpartition:
                     sam_line_to_print = [record[1][:254], record[2], rname,
                                          str(int(record[0]))] + [
@@ -345,7 +329,7 @@ else:
                                                 else token)
                                                 for token in record[3:]]
                     try:
-                        print >>output_stream, '\t'.join(sam_line_to_print)
+                        alignment_writer.write(sam_line_to_print)
                     except IOError:
                         raise IOError(
                                 'Error writing line "%s".' % sam_line_to_print
@@ -382,9 +366,8 @@ else:
                                          and not output_url.is_local)
                                else None),
                         output_url=(None if args.out is None else output_url),
-                        sam=args.output_sam,
-                        samtools_exe=args.samtools_exe
-                    ) as output_stream:
+                        sam=args.output_sam
+                    ) as alignment_writer:
                 for record in xpartition:
                     sam_line_to_print = [record[1][:254], record[2], rname,
                                          str(int(record[0]))] + [
@@ -393,7 +376,7 @@ else:
                                                 else token)
                                                 for token in record[3:]]
                     try:
-                        print >>output_stream, '\t'.join(sam_line_to_print)
+                        alignment_writer.write(sam_line_to_print)
                     except IOError:
                         raise IOError(
                                 'Error writing line "%s".' % sam_line_to_print
@@ -57,16 +57,19 @@ Tab-delimited output tuple columns (bed):
 
 Tab-delimited output tuple columns (collect)
 1. '0' if insertion, '1' if deletion, or '2' if junction line
-2. Number string representing RNAME (+ '+ or -' if junction; same as field 6)
-3. Start position (Last base before insertion, first base of deletion,
+2. Shard of cross-sample TSV: number string representing RNAME + '.' +
+    start position // --tsv-shard-size, zero-padded; shards sort in the order
+    of their features
+3. Number string representing RNAME (+ '+ or -' if junction; same as field 6)
+4. Start position (Last base before insertion, first base of deletion,
                     or first base of intron)
-4. End position (Last base before insertion, last base of deletion (exclusive),
+5. End position (Last base before insertion, last base of deletion (exclusive),
                     or last base of intron (INCLUSIVE HERE))
-5. '+' or '-' indicating which strand is the sense strand for junctions,
+6. '+' or '-' indicating which strand is the sense strand for junctions,
    inserted sequence for insertions, or deleted sequence for deletions
-6. Coverage of feature for sample with index N
+7. Coverage of feature for sample with index N
 ...
-N + 6. Coverage of feature in sample with index N
+N + 7. Coverage of feature in sample with index N
 --------------------------------------------------------------------
 10. SUMMED number of instances of junction, insertion, or deletion in sample
 
@@ -90,8 +93,20 @@ site.addsitedir(base_path)
 from dooplicity.tools import xstream
 import manifest
 
+def tsv_shard(rname, pos, tsv_shard_size):
+    """ Finds shard of cross-sample TSV in which a feature is written.
+
+        rname: number string representing RNAME
+        pos: start position of feature
+        tsv_shard_size: number of bases of an RNAME spanned by a shard
+
+        Return value: shard; shards sort in the order of their features
+    """
+    return '%s.%012d' % (rname, int(pos) // tsv_shard_size)
+
 def go(manifest_object, input_stream=sys.stdin, output_stream=sys.stdout,
-        sample_fraction=0.05, coverage_threshold=5, verbose=False):
+        sample_fraction=0.05, coverage_threshold=5, verbose=False,
+        tsv_shard_size=10000000):
     """ Runs Rail-RNA-bed_pre
 
         Writes indels and junctions for outputting BEDs by sample and
@@ -155,18 +170,19 @@ def go(manifest_object, input_stream=sys.stdin, output_stream=sys.stdout,
 
         Tab-delimited output tuple columns (collect)
         1. '0' if insertion, '1' if deletion, or '2' if junction line
-        2. Number string representing RNAME (+ '+ or -' if junction; same as
+        2. Shard of cross-sample TSV; see tsv_shard()
+        3. Number string representing RNAME (+ '+ or -' if junction; same as
                                                 field 6)
-        3. Start position (Last base before insertion, first base of deletion,
+        4. Start position (Last base before insertion, first base of deletion,
                             or first base of intron)
-        4. End position (Last base before insertion, last base of deletion
+        5. End position (Last base before insertion, last base of deletion
                             (exclusive), or last base of intron (exclusive))
-        5. '+' or '-' indicating which strand is the sense strand for
+        6. '+' or '-' indicating which strand is the sense strand for
             junctions, inserted sequence for insertions, or deleted sequence
             for deletions
-        6. Coverage of feature for sample with index N
+        7. Coverage of feature for sample with index N
         ...
-        N + 6. Coverage of feature in sample with index N
+        N + 7. Coverage of feature in sample with index N
         --------------------------------------------------------------------
         10. SUMMED number of instances of junction, insertion, or deletion in
             sample
@@ -183,6 +199,8 @@ def go(manifest_object, input_stream=sys.stdin, output_stream=sys.stdout,
             least one sample to pass filter of sample_fraction criterion is not
             satisfied
         verbose: output extra debugging statements
+        tsv_shard_size: number of bases of an RNAME spanned by a shard of a
+            cross-sample TSV; shards are compressed in parallel
 
         Return value: tuple (input line count, output line count)
     """
@@ -196,18 +214,19 @@ def go(manifest_object, input_stream=sys.stdin, output_stream=sys.stdout,
             ))
 
     for (line_type, rname, pos, end_pos, strand_or_seq), xpartition in xstream(
-                input_stream, 5
+                input_stream, 5, raw=True
             ):
-        collect_specs = [rname, pos, end_pos if line_type != 'N'
+        collect_specs = [tsv_shard(rname, pos, tsv_shard_size),
+                            rname, pos, end_pos if line_type != 'N'
                                              else str(int(end_pos) - 1),
-                                     strand_or_seq]
+                            strand_or_seq]
         coverages = []
         i = 0
         if line_type == 'N':
             for sample_index, data in itertools.groupby(
-                                                    xpartition, 
-                                                    key=lambda val: val[0]
-                                                ):
+                                    (value.split('\t') for value in xpartition),
+                                    key=lambda val: val[0]
+                                ):
                 sample_index = int(sample_index)
                 while i != sample_index:
                     # Write 0 coverage for sample indexes reporting 0 junctions
@@ -251,19 +270,21 @@ def go(manifest_object, input_stream=sys.stdin, output_stream=sys.stdout,
         else:
             assert line_type in 'ID'
             sample_count = 0
+            '''Only an indel's sample index and coverage are needed, so
+            they're cut from the ends of raw values without splitting.'''
             for sample_index, data in itertools.groupby(
-                                                    xpartition, 
-                                                    key=lambda val: val[0]
-                                                ):
+                                    xpartition,
+                                    key=lambda val: val.partition('\t')[0]
+                                ):
                 sample_index = int(sample_index)
                 while i != sample_index:
                     # Write 0 coverage for sample indexes reporting 0 indels
                     coverages.append(0)
                     i += 1
                 coverage_sum = 0
-                for _, _, _, coverage in data:
+                for value in data:
                     input_line_count += 1
-                    coverage_sum += int(coverage)
+                    coverage_sum += int(value.rpartition('\t')[2])
                 print >>output_stream, \
                     'bed\t%s\t%s\t%s\t%s\t%s\t%s\t\x1c\t\x1c\t\x1c\t%d' % (
                         line_type, sample_index, rname, pos, end_pos,
@@ -312,6 +333,10 @@ if __name__ == '__main__':
               'many reads in a single sample; if the indel meets neither '
               'this criterion nor the --sample-fraction criterion, it is '
               'filtered out; use -1 to disable'))
+    parser.add_argument('--tsv-shard-size', type=int, required=False,
+        default=10000000,
+        help=('Number of bases of an RNAME spanned by a shard of a '
+              'cross-sample TSV'))
     parser.add_argument('--keep-alive', action='store_const', const=True,
         default=False,
         help='Periodically print Hadoop status messages to stderr to keep ' \
@@ -349,7 +374,8 @@ if __name__ == '__main__' and not args.test:
             output_stream=sys.stdout,
             sample_fraction=args.sample_fraction,
             coverage_threshold=args.coverage_threshold,
-            verbose=args.verbose
+            verbose=args.verbose,
+            tsv_shard_size=args.tsv_shard_size
         )
     print >>sys.stderr, 'DONE with bed_pre.py; in/out =%d/%d; time=%0.3f s' \
                          % (input_line_count, output_line_count,
@@ -405,7 +431,8 @@ elif __name__ == '__main__':
                     output_stream=output_stream,
                     sample_fraction=0.5,
                     coverage_threshold=5,
-                    verbose=False
+                    verbose=False,
+                    tsv_shard_size=1000
                 )
             self.assertEquals(
                     input_line_count, 6
@@ -442,15 +469,18 @@ elif __name__ == '__main__':
                     in output_lines
                 )
             self.assertTrue(
-                    'collect\t0\t000000000000\t140\t140\tATAC\t12\t0\t0'
+                    ('collect\t0\t000000000000.000000000000\t000000000000'
+                     '\t140\t140\tATAC\t12\t0\t0')
                     in output_lines
                 )
             self.assertTrue(
-                    'collect\t1\t000000000001\t150\t156\tAACCTT\t3\t3\t0'
+                    ('collect\t1\t000000000001.000000000000\t000000000001'
+                     '\t150\t156\tAACCTT\t3\t3\t0')
                     in output_lines
                 )
             self.assertTrue(
-                    'collect\t2\t000000000003\t3567\t3889\t+\t0\t0\t2'
+                    ('collect\t2\t000000000003.000000000003\t000000000003'
+                     '\t3567\t3889\t+\t0\t0\t2')
                     in output_lines
                 )
             self.assertEquals(
@@ -23,9 +23,7 @@ site.addsitedir(base_path)
 from dooplicity.tools import xstream
 from alignment_handlers import multiread_with_junctions, \
     indels_junctions_exons_mismatches
-
-import string
-_reversed_complement_translation_table = string.maketrans('ATCG', 'TAGC')
+from sequence_kernels import reversed_complement
 
 def cojunction_length(cojunction):
     """ Computes number of exonic bases spanned by cojunction
@@ -220,9 +218,7 @@ def go(input_stream=sys.stdin, output_stream=sys.stdout, fudge=5,
                     if field[:5] == 'MD:Z:'][0][5:]
             pos = int(alignment[3])
             seq = alignment[9]
-            reversed_complement_seq = seq[::-1].translate(
-                    _reversed_complement_translation_table
-                )
+            reversed_complement_seq = reversed_complement(seq)
             if seq < reversed_complement_seq:
                 seq_to_print = seq
             else:
@@ -130,7 +130,6 @@ ALL OUTPUT COORDINATES ARE 1-INDEXED.
 import sys
 import os
 import site
-import string
 import time
 import argparse
 
@@ -155,6 +154,7 @@ import partition
 import manifest
 import bowtie
 import bowtie_index
+from sequence_kernels import reversed_complement
 
 if __name__ == '__main__':
     # Print file's docstring if -h is invoked
@@ -205,7 +205,6 @@ if __name__ == '__main__':
 
     args = parser.parse_args(argv[1:])
 
-    reversed_complement_translation_table = string.maketrans('ATCG', 'TAGC')
     manifest_object = manifest.LabelsAndIndices(
                                     os.path.expandvars(args.manifest)
                                 )
@@ -261,9 +260,7 @@ if __name__ == '__main__':
                 '''This is effectively an unmapped read; write
                 corresponding SAM output.'''
                 if flag & 16:
-                    seq_to_write = initial_multiread[0][9][::-1].translate(
-                                    reversed_complement_translation_table
-                                )
+                    seq_to_write = reversed_complement(initial_multiread[0][9])
                     qual_to_write = initial_multiread[0][10][::-1]
                 else:
                     seq_to_write = initial_multiread[0][9]
@@ -11,8 +11,10 @@ base coverage (horizontal axis: number of exonic chunks covering given base;
     vertical axis: number of bases covered) as the (k*100)-th coverage
 percentile, where k is input by the user via the command-line parameter
 --percentile. bigwig files encoding coverage per sample are also written to a
-specified destination, local or remote. Rail-RNA-coverage_post merely collects
-the normalization factors and writes them to a file.
+specified destination, local or remote. Both of a sample's bigwigs and its
+histograms are built in one pass over its coverage; see bigwig_writer.py.
+Rail-RNA-coverage_post merely collects the normalization factors and writes
+them to a file.
 
 Input (read from stdin)
 ----------------------------
@@ -33,12 +35,13 @@ Hadoop output (written to stdout)
 ----------------------------
 Tab-delimited output tuple columns (only 1 per sample):
 1. '3' to denote the output is a normalization factor
-2. Sample index
-3. '\x1c'
+2. '\x1c', the only shard of the normalization factor TSV
+3. Sample index
 4. '\x1c'
 5. '\x1c'
-6. Normalization factor for coverage vector counting all primary alignments
-7. Normalization factor for coverage vector counting only "uniquely mapping"
+6. '\x1c'
+7. Normalization factor for coverage vector counting all primary alignments
+8. Normalization factor for coverage vector counting only "uniquely mapping"
     reads
 
 Other output (written to directory specified by command-line parameter --out)
@@ -51,8 +54,6 @@ import os
 import sys
 import site
 import argparse
-import subprocess
-import threading
 
 if '--test' in sys.argv:
     print("No unit tests")
@@ -78,6 +79,7 @@ from dooplicity.tools import xstream, register_cleanup, make_temp_dir
 from dooplicity.ansibles import Url
 import tempdel
 from re import search
+from bigwig_writer import BigWigWriter
 
 # Print file's docstring if -h is invoked
 parser = argparse.ArgumentParser(description=__doc__, 
@@ -94,9 +96,6 @@ parser.add_argument(
 parser.add_argument('--manifest', type=str, required=False,
         default='manifest',
         help='Path to manifest file')
-parser.add_argument(
-    '--bigwig-exe', type=str, required=False, default='bedGraphToBigWig',
-    help='Location of the Kent Tools bedGraphToBigWig executable')
 parser.add_argument('--bigwig-basename', type=str, required=False, default='',
     help='The basename (excluding path) of all bigwig output. Basename is'
          'followed by ".[sample label].bw"; if basename is an empty string, '
@@ -121,19 +120,6 @@ if args.keep_alive:
     keep_alive_thread = KeepAlive(sys.stderr)
     keep_alive_thread.start()
 
-if args.keep_alive:
-    class BedTobigwigThread(threading.Thread):
-        """ Wrapper class for bedtobigwig that permits polling for completion.
-        """
-        def __init__(self, command_list):
-            super(BedTobigwigThread, self).__init__()
-            self.command_list = command_list
-            self.bedtobigwig_process = None
-        def run(self):
-            self.bedtobigwig_process = subprocess.Popen(self.command_list,
-                                            stdout=sys.stderr,
-                                            stderr=sys.stderr).wait()
-
 def percentile(histogram, percentile=0.75):
     """ Given histogram, computes desired percentile.
 
@@ -157,16 +143,6 @@ def percentile(histogram, percentile=0.75):
 import time
 start_time = time.time()
 
-temp_dir_path = make_temp_dir(tempdel.silentexpandvars(args.scratch))
-# Clean up after script
-register_cleanup(tempdel.remove_temporary_directories, [temp_dir_path])
-bed_filename = os.path.join(temp_dir_path, 'temp.bed')
-unique_bed_filename = os.path.join(temp_dir_path, 'temp.unique.bed')
-if args.verbose:
-    print >>sys.stderr, 'Writing to temporary beds %s and %s.' % (
-            bed_filename,
-            unique_bed_filename
-        )
 output_filename, output_url = None, None
 
 '''Make RNAME lengths available from reference FASTA so SAM header can be
@@ -178,14 +154,6 @@ reference_index = bowtie_index.BowtieIndexReference(
 manifest_object = manifest.LabelsAndIndices(
                         os.path.expandvars(args.manifest)
                     )
-# Create file with chromosome sizes for bedTobigwig
-sizes_filename = os.path.join(temp_dir_path, 'chrom.sizes')
-if args.verbose:
-    print >>sys.stderr, 'Sizes file: %s .' % sizes_filename
-with open(sizes_filename, 'w') as sizes_stream:
-    for rname in reference_index.rname_lengths:
-        print >>sizes_stream, '%s %d' % (rname, 
-            reference_index.rname_lengths[rname])
 
 input_line_count, output_line_count = 0, 0
 output_url = Url(args.out)
@@ -193,10 +161,12 @@ if output_url.is_local:
     # Set up destination directory
     try: os.makedirs(output_url.to_url())
     except: pass
+else:
+    # Write bigwigs to temporary directory, and later upload to URL
+    temp_dir_path = make_temp_dir(tempdel.silentexpandvars(args.scratch))
+    # Clean up after script
+    register_cleanup(tempdel.remove_temporary_directories, [temp_dir_path])
 mover = filemover.FileMover(args=args)
-track_line = ('track type=bedGraph name="{name}" '
-         'description="{description}" visibility=full '
-         'color=227,29,118 altColor=0,179,220 priority=400')
 for (sample_index,), xpartition in xstream(sys.stdin, 1):
     real_sample = True
     try:
@@ -218,6 +188,22 @@ for (sample_index,), xpartition in xstream(sys.stdin, 1):
         else:
             raise RuntimeError('Sample label index "%s" was not recorded.'
                                 % sample_index)
+    bigwig_filenames = [((args.bigwig_basename + '.') 
+                        if args.bigwig_basename != '' else '')
+                        + sample_label]*2
+    bigwig_filenames[0] += '.bw'
+    bigwig_filenames[1] += '.unique.bw'
+    if output_url.is_local:
+        # Write directly to local destination
+        bigwig_file_paths = [os.path.join(args.out, bigwig_filename)
+                                for bigwig_filename in bigwig_filenames]
+    else:
+        bigwig_file_paths = [os.path.join(temp_dir_path, bigwig_filename)
+                                for bigwig_filename in bigwig_filenames]
+    if args.verbose:
+        print >>sys.stderr, 'Writing bigwigs %s and %s .' % tuple(
+                                                            bigwig_file_paths
+                                                        )
     '''Dictionary for which each key is a coverage (i.e., number of ECs
     covering a given base). Its corresponding value is the number of bases with
     that coverage.'''
@@ -225,121 +211,69 @@ for (sample_index,), xpartition in xstream(sys.stdin, 1):
             defaultdict(int),
             defaultdict(int)
         )
-    with open(bed_filename, 'w') as bed_stream, \
-        open(unique_bed_filename, 'w') as unique_bed_stream:
-        print >>bed_stream, track_line.format(name=sample_label,
-                                              description=(
-                                                    'base coverage by '
-                                                    'primary alignments'
-                                                ))
-        print >>unique_bed_stream, track_line.format(name=sample_label,
-                                                     description=(
-                                                        'base coverage by '
-                                                        'uniquely mapping '
-                                                        'reads')
-                                                     )
-        for rname, coverages in itertools.groupby(xpartition, 
-                                                    key=lambda val: val[0]):
-            try:
-                rname = reference_index.l_string_to_rname[rname]
-            except KeyError:
-                raise RuntimeError(
-                        'RNAME number string "%s" not in Bowtie index.' 
-                        % rname
-                    )
-            (last_pos, last_coverage,
-                last_unique_pos, last_unique_coverage) = 0, 0, 0, 0
-            for _, pos, coverage, unique_coverage in coverages:
-                # BED is zero-indexed, while input is 1-indexed
-                pos, coverage, unique_coverage = (
-                        int(pos) - 1, float(coverage), float(unique_coverage)
-                    )
-                input_line_count += 1
-                if coverage != last_coverage:
-                    print >>bed_stream, '%s\t%d\t%d\t%08f' % (rname,
-                        last_pos, pos, last_coverage)
-                    if last_coverage != 0:
-                        # Only care about nonzero-coverage regions
-                        coverage_histogram[last_coverage] += pos - last_pos
-                    last_pos, last_coverage = pos, coverage
-                if unique_coverage != last_unique_coverage:
-                    print >>unique_bed_stream, '%s\t%d\t%d\t%08f' % (rname,
-                        last_unique_pos, pos, last_unique_coverage)
-                    if last_unique_coverage != 0:
-                        # Only care about nonzero-coverage regions
-                        unique_coverage_histogram[last_unique_coverage] \
-                            += pos - last_unique_pos
-                    last_unique_pos, last_unique_coverage = (
-                            pos,
-                            unique_coverage
-                        )
-            if last_pos != reference_index.rname_lengths[rname]:
-                # Print coverage up to end of strand
-                print >>bed_stream, '%s\t%d\t%d\t%08f' % (
-                        rname,
-                        last_pos,
-                        reference_index.rname_lengths[rname],
-                        coverage
-                    )
-            if last_unique_pos != reference_index.rname_lengths[rname]:
-                # Print unique coverage up to end of strand
-                print >>unique_bed_stream, '%s\t%d\t%d\t%08f' % (
-                        rname,
-                        last_unique_pos,
-                        reference_index.rname_lengths[rname],
+    bigwig_writer, unique_bigwig_writer = [
+            BigWigWriter(bigwig_file_path, reference_index.rname_lengths)
+            for bigwig_file_path in bigwig_file_paths
+        ]
+    for rname, coverages in itertools.groupby(xpartition, 
+                                                key=lambda val: val[0]):
+        try:
+            rname = reference_index.l_string_to_rname[rname]
+        except KeyError:
+            raise RuntimeError(
+                    'RNAME number string "%s" not in Bowtie index.' 
+                    % rname
+                )
+        (last_pos, last_coverage,
+            last_unique_pos, last_unique_coverage) = 0, 0, 0, 0
+        for _, pos, coverage, unique_coverage in coverages:
+            # BED is zero-indexed, while input is 1-indexed
+            pos, coverage, unique_coverage = (
+                    int(pos) - 1, float(coverage), float(unique_coverage)
+                )
+            input_line_count += 1
+            if coverage != last_coverage:
+                bigwig_writer.add(rname, last_pos, pos, last_coverage)
+                if last_coverage != 0:
+                    # Only care about nonzero-coverage regions
+                    coverage_histogram[last_coverage] += pos - last_pos
+                last_pos, last_coverage = pos, coverage
+            if unique_coverage != last_unique_coverage:
+                unique_bigwig_writer.add(rname, last_unique_pos, pos,
+                                            last_unique_coverage)
+                if last_unique_coverage != 0:
+                    # Only care about nonzero-coverage regions
+                    unique_coverage_histogram[last_unique_coverage] \
+                        += pos - last_unique_pos
+                last_unique_pos, last_unique_coverage = (
+                        pos,
                         unique_coverage
                     )
+        # Write coverage up to end of strand
+        bigwig_writer.add(rname, last_pos,
+                            reference_index.rname_lengths[rname],
+                            last_coverage)
+        unique_bigwig_writer.add(rname, last_unique_pos,
+                                    reference_index.rname_lengths[rname],
+                                    last_unique_coverage)
+    bigwig_writer.close()
+    unique_bigwig_writer.close()
     # Output normalization factors iff working with real sample
     if real_sample:
-        print '3\t%s\t\x1c\t\x1c\t\x1c\t%d\t%d' % (sample_index,
+        print '3\t\x1c\t%s\t\x1c\t\x1c\t\x1c\t%d\t%d' % (
+                                                sample_index,
                                                 percentile(coverage_histogram,
                                                             args.percentile),
                                                 percentile(
                                                     unique_coverage_histogram,
                                                     args.percentile))
     output_line_count += 1
-    # Write bigwigs
-    assert os.path.exists(sizes_filename)
-    bigwig_filenames = [((args.bigwig_basename + '.') 
-                        if args.bigwig_basename != '' else '')
-                        + sample_label]*2
-    bigwig_filenames[0] += '.bw'
-    bigwig_filenames[1] += '.unique.bw'
-    if output_url.is_local:
-        # Write directly to local destination
-        bigwig_file_paths = [os.path.join(args.out, bigwig_filename)
-                                for bigwig_filename in bigwig_filenames]
-    else:
-        # Write to temporary directory, and later upload to URL
-        bigwig_file_paths = [os.path.join(temp_dir_path, bigwig_filename)
-                                for bigwig_filename in bigwig_filenames]
-    bigwig_commands = [[args.bigwig_exe, bed_filename, sizes_filename,
-                        bigwig_file_paths[0]], 
-                       [args.bigwig_exe, unique_bed_filename, sizes_filename,
-                        bigwig_file_paths[1]]]
-    for i, bigwig_command in enumerate(bigwig_commands):
-        if args.verbose:
-            print >>sys.stderr, 'Writing bigwig with command %s .' \
-                % ' '.join(bigwig_command)
-        bedtobigwig_process = subprocess.Popen(
-                                    bigwig_command,
-                                    stderr=sys.stderr,
-                                    stdout=sys.stderr,
-                                    bufsize=-1
-                                )
-        bedtobigwig_process.wait()
-        if bedtobigwig_process.returncode:
-            raise RuntimeError('bedgraphtobigwig process failed w/ '
-                               'exitlevel %d.'
-                                % bedtobigwig_process.returncode)
-        if args.verbose:
-            print >>sys.stderr, ('bedTobigwig command %s succeeded .'
-                                  % ' '.join(bigwig_command))
-        if not output_url.is_local:
-            # bigwig must be uploaded to URL and deleted
-            mover.put(bigwig_file_paths[i],
-                        output_url.plus(bigwig_filenames[i]))
-            os.remove(bigwig_file_paths[i])
+    if not output_url.is_local:
+        # bigwigs must be uploaded to URL and deleted
+        for bigwig_file_path, bigwig_filename in zip(bigwig_file_paths,
+                                                        bigwig_filenames):
+            mover.put(bigwig_file_path, output_url.plus(bigwig_filename))
+            os.remove(bigwig_file_path)
 
 print >>sys.stderr, 'DONE with coverage.py; in/out=%d/%d; time=%0.3f s' \
                         % (input_line_count, output_line_count,
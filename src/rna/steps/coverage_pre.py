@@ -13,13 +13,17 @@ alignments.
 Input (read from stdin)
 ----------------------------
 Tab-delimited input tuple columns:
-1. Reference name (RNAME in SAM format) + ';' + bin number
+1. Reference name (RNAME in SAM format) + ';' + bin number, followed by
+    '.' + sub-bin number if Rail-RNA-split_bins split the bin
 2. Position at which diff should be subtracted or added to coverage
 3. Sample index
 4. '1' if alignment from which diff originates is "unique" according to
     --tie-margin criterion; else '0'
 5. A diff -- that is, by how much coverage increases or decreases at the 
     given genomic position: +n or -n for some natural number n.
+6. (optional) 'carried' if Rail-RNA-split_bins added the diff to carry
+    coverage into a sub-bin; positions with only carried diffs aren't output,
+    and neither are samples at a position with only carried diffs
 Input is partitioned by genome partition (field 1) and sorted by position, then
 sample index (fields 2-3).
 
@@ -155,7 +159,7 @@ try:
 except ZeroDivisionError:
     unique_mean_weight = 0.0
 
-for (partition_id,), xpartition in xstream(sys.stdin, 1):
+for (partition_id,), xpartition in xstream(sys.stdin, 1, raw=True):
     bin_count += 1
     bin_start_time, bin_diff_count = time.time(), 0
     rname = partition_id.rpartition(';')[0]
@@ -167,15 +171,19 @@ for (partition_id,), xpartition in xstream(sys.stdin, 1):
             defaultdict(int), defaultdict(int)
         )
     for (pos, sample_indexes_and_diffs) in itertools.groupby(
-                                            xpartition, lambda val: val[0]
-                                        ):
-        input_line_count += 1
+                                    (value.split('\t') for value in xpartition),
+                                    lambda val: val[0]
+                                ):
         pos = int(pos)
+        position_carried_only = True
         for sample_index, diffs in itertools.groupby(
                                 sample_indexes_and_diffs, lambda val: val[1]
                             ):
-            for _, _, uniqueness, diff in diffs:
-                diff = int(diff)
+            carried_only = True
+            for diff_tokens in diffs:
+                uniqueness, diff = diff_tokens[2], int(diff_tokens[3])
+                if len(diff_tokens) == 4:
+                    carried_only = False
                 coverages[sample_index] += diff
                 if uniqueness == '1':
                     unique_coverages[sample_index] += diff
@@ -186,12 +194,19 @@ for (partition_id,), xpartition in xstream(sys.stdin, 1):
                     if uniqueness == '1':
                         unique_nonref_coverages[real_sample_index] += diff
                 bin_diff_count += 1
+            if carried_only:
+                # Coverage at a sub-bin's start; the unsplit bin has no row
+                continue
+            position_carried_only = False
             print 'coverage\t%s\t%s\t%012d\t%d\t%d' % (
                         sample_index, 
                         rname_index, pos, coverages[sample_index],
                         unique_coverages[sample_index]
                     )
             output_line_count += 1
+        if position_carried_only:
+            continue
+        input_line_count += 1
         # Now output measures of center
         coverage_row = [float(coverages[sample_index])
                          / mapped_read_counts[sample_index]
@@ -44,9 +44,7 @@ ALL OUTPUT COORDINATES ARE 1-INDEXED.
 import sys
 import os
 import site
-import string
 import subprocess
-import re
 import random
 import itertools
 from collections import defaultdict
@@ -65,8 +63,7 @@ import bowtie_index
 import partition
 from dooplicity.tools import xstream
 from alignment_handlers import pairwise
-
-_reversed_complement_translation_table = string.maketrans('ATCG', 'TAGC')
+from sequence_kernels import reversed_complement
 
 # Initialize global variables for tracking number of input/output lines
 _input_line_count = 0
@@ -86,223 +83,206 @@ _right_forward_elements = set(['AG', 'AC'])
 _left_elements = _left_reverse_elements | _left_forward_elements
 _right_elements = _right_reverse_elements | _right_forward_elements
 
-if 'pypy' not in sys.version.lower():
-    # For fast global alignment without PyPy
-    from scipy import weave
-    class GlobalAlignment(object):
-        """ Invokes Weave to obtain alignment score matrix with C. """
-
-        def __init__(self, substitution_matrix=[[ 0,-1,-1,-1,-1,-1],
-                                                [-1, 0,-1,-1,-1,-1],
-                                                [-1,-1, 0,-1,-1,-1],
-                                                [-1,-1,-1, 0,-1,-1],
-                                                [-1,-1,-1,-1,-1,-1],
-                                                [-1,-1,-1,-1,-1,-1]]):
-            """ Constructor for GlobalAlignment.
-
-                Places substitution_matrix directly in string containing C code
-                that obtains score matrix for global alignment. Executes C with
-                Weave on trivial case (two sequences, each one character) to 
-                ensure code is precompiled.
-
-                substitution_matrix: 6 x 6 substitution matrix (list of
-                    lists); rows and columns correspond to ACGTN-, where N is
-                    aNy and - is a gap. Default: +1 for match, -5 for gap,
-                    -1 for everything else.
-            """
-            '''Set supporting code including libraries and the function 
-            integer_sequence(), which converts a sequence of nucleotides to
-            an array of indices that correspond to indices of the substitution
-            matrix---also set in the constructor.'''
-            self.support_code = """ 
-                        int* integer_sequence(const char* seq, int length) {
-                            int i;
-                            int* int_seq = (int *)malloc(sizeof(int)*length);
-                            for (i = 0; seq[i]; i++) {
-                                switch (seq[i]) {
-                                    case 'A':
-                                    case 'a':
-                                        int_seq[i] = 0;
-                                        break;
-                                    case 'C':
-                                    case 'c':
-                                        int_seq[i] = 1;
-                                        break;
-                                    case 'G':
-                                    case 'g':
-                                        int_seq[i] = 2;
-                                        break;
-                                    case 'T':
-                                    case 't':
-                                        int_seq[i] = 3;
-                                        break;
-                                    case 'N':
-                                        int_seq[i] = 4;
-                                        break;
-                                    case '-':
-                                        int_seq[i] = 5;
-                                        break;
-                                    default:
-                                        int_seq[i] = 4;
-                                }
-                            }
-                            return int_seq;
-                        }
-                        """
-            '''Score matrix code is written in C/C++; see self.support_code
-            above for dependencies. substitution_matrix is embedded in code
-            below.'''
-            self.score_matrix_code = """
-                const char* c_first_seq = first_seq.c_str();
-                const char* c_second_seq = second_seq.c_str();
-                int row_count = first_seq.length() + 1;
-                int column_count = second_seq.length() + 1;
-                npy_intp dims[2] = {row_count, column_count};
-                PyObject* to_return = PyArray_SimpleNew(2, dims, NPY_INT);
-                int* score_matrix = (int *)((PyArrayObject*) to_return)->data;
-                int* substitution_matrix = (int *)malloc(sizeof(int)*6*6);
-                int* int_first_seq = integer_sequence(c_first_seq,
-                                                        row_count - 1);
-                int* int_second_seq = integer_sequence(c_second_seq,
-                                                        column_count - 1);
-            """ + """""".join(
-                            [("""substitution_matrix[%d] = %d;""" % ((i*6 + j), 
-                                substitution_matrix[i][j])) 
-                                for i in xrange(6) for j in xrange(6)]
-                        ) \
-            + """
-                int i, j;
-                score_matrix[0] = 0;
-                for (i = 1; i < row_count; i++) {
-                    score_matrix[i*column_count] = i 
-                        * substitution_matrix[int_first_seq[i-1]*6+5];
-                }
-                for (j = 1; j < column_count; j++) {
-                    score_matrix[j] = j 
-                        * substitution_matrix[5*6+int_second_seq[j-1]];
-                }
-                int diagonal, vertical, horizontal;
-                for (i = 1; i < row_count; i++) {
-                    for (j = 1; j < column_count; j++) {
-                        diagonal = score_matrix[(i-1)*column_count + j-1]
-                            + substitution_matrix[int_first_seq[i-1]*6
-                                                    +int_second_seq[j-1]];
-                        vertical = score_matrix[(i-1)*column_count + j]
-                            + substitution_matrix[int_first_seq[i-1]*6+5];
-                        horizontal = score_matrix[i*column_count + j-1]
-                            + substitution_matrix[5*6+int_second_seq[j-1]];
-                        score_matrix[i*column_count + j] = std::max(
-                                horizontal, std::max(diagonal, vertical)
-                            );
-                    }
-                }
-                free(int_first_seq);
-                free(int_second_seq);
-                free(substitution_matrix);
-                return_val = to_return;
-            """
-            stdout_holder = os.dup(sys.stdout.fileno())
-            try:
-                # Suppress compiler output by redirecting stdout temporarily
-                devnull = open(os.devnull, 'w')
-                os.dup2(devnull.fileno(), sys.stdout.fileno())
-                self.score_matrix('N', 'N')
-            except Exception as e:
-                print >>sys.stderr, 'C code for computing score matrix ' \
-                                    'failed to compile. Get Python\'s ' \
-                                    'distutils to use g++, and try again.'
-                raise
-            finally:
-                # Turn the tap back on
-                os.dup2(stdout_holder, sys.stdout.fileno())
-
-        def score_matrix(self, first_seq, second_seq):
-            """ Computes score matrix for global alignment of two sequences.
-
-                The substitution matrix is specified when the GlobalAlignment
-                class is instantiated.
-
-                first_seq: first sequence (string).
-                second_seq: second sequence (string).
-
-                Return value: score_matrix, a numpy array whose dimensions are
-                    (len(first_seq) + 1) x (len(second_seq) + 1). It can be
-                    used to trace back the best global alignment.
-            """
-            return weave.inline(
-                                    self.score_matrix_code,
-                                    ['first_seq', 'second_seq'], 
-                                    support_code=self.support_code,
-                                    verbose=0
-                                )
-else:
-    # Use Python version of class
-    class GlobalAlignment(object):
-        """ Uses Python to obtain alignment score matrix. """
-
-        def __init__(self, substitution_matrix=[[ 0,-1,-1,-1,-1,-1],
-                                                [-1, 0,-1,-1,-1,-1],
-                                                [-1,-1, 0,-1,-1,-1],
-                                                [-1,-1,-1, 0,-1,-1],
-                                                [-1,-1,-1,-1,-1,-1],
-                                                [-1,-1,-1,-1,-1,-1]]):
-            """ Constructor for GlobalAlignment.
-
-                substitution_matrix: 6 x 6 substitution matrix (list of
-                    lists); rows and columns correspond to ACGTN-, where N is
-                    aNy and - is a gap. Default: +1 for match, -5 for gap,
-                    -1 for everything else.
-            """
-            self.substitution_matrix = substitution_matrix
+'''Maps characters of sequences to be aligned to rows/columns of substitution
+matrices. Lowercase bases are treated like uppercase bases, and anything
+unrecognized is an N.'''
+_substitution_indexes = [4] * 256
+for _i, _char in enumerate('ACGTN-'):
+    _substitution_indexes[ord(_char)] = _i
+for _i, _char in enumerate('acgt'):
+    _substitution_indexes[ord(_char)] = _i
+
+class GlobalAlignment(object):
+    """ Computes global alignment scores of pairs of sequences.
+
+        score() needs only two rows of the score matrix and restricts the
+        dynamic program to a band of diagonals an optimal alignment can
+        visit, so memory is linear in the length of the second sequence and
+        time is usually far below len(first_seq) * len(second_seq). It's
+        plain Python, so it needs no compilation and is JIT-compiled by PyPy.
+    """
 
-        def score_matrix(self, first_seq, second_seq):
-            """ Computes score matrix for global alignment of two sequences.
+    def __init__(self, substitution_matrix=[[ 0,-1,-1,-1,-1,-1],
+                                            [-1, 0,-1,-1,-1,-1],
+                                            [-1,-1, 0,-1,-1,-1],
+                                            [-1,-1,-1, 0,-1,-1],
+                                            [-1,-1,-1,-1,-1,-1],
+                                            [-1,-1,-1,-1,-1,-1]],
+                    initial_band=4):
+        """ Constructor for GlobalAlignment.
+
+            substitution_matrix: 6 x 6 substitution matrix (list of
+                lists); rows and columns correspond to ACGTN-, where N is
+                aNy and - is a gap. Default: 0 for match, -1 for everything
+                else.
+            initial_band: band in which score() first computes scores
+        """
+        self.substitution_matrix = substitution_matrix
+        self.initial_band = initial_band
+        '''Bounds on scores of aligned pairs and of gaps are used to find
+        the band of diagonals an optimal alignment can visit.'''
+        self.max_pair_score = max([substitution_matrix[i][j]
+                                    for i in xrange(5) for j in xrange(5)])
+        self.max_gap_score = max([substitution_matrix[i][5]
+                                    for i in xrange(5)]
+                                 + [substitution_matrix[5][j]
+                                    for j in xrange(5)])
+
+    def exact_band(self, row_count, column_count, lower_bound):
+        """ Finds the band of diagonals an optimal global alignment can visit.
+
+            An alignment that strays k diagonals from the main diagonal
+            includes at least |k| + |k - (column_count - row_count)| gaps.
+            Any alignment with so many gaps that even the best-scoring pairs
+            elsewhere can't bring its score up to lower_bound can't be
+            optimal.
+
+            row_count: length of first sequence
+            column_count: length of second sequence
+            lower_bound: score of some alignment of the sequences
+
+            Return value: maximum number of diagonals an optimal alignment
+                strays outside the diagonals between the first and last
+                cells of the score matrix, or None if there's no bound
+        """
+        denominator = self.max_pair_score - 2 * self.max_gap_score
+        if denominator <= 0:
+            return None
+        max_gaps = ((row_count + column_count) * self.max_pair_score
+                        - 2 * lower_bound) // denominator
+        return max((max_gaps - abs(column_count - row_count)) // 2, 0)
 
-                The substitution matrix is specified when the GlobalAlignment
-                class is instantiated.
+    def banded_score(self, first_seq, second_seq, band):
+        """ Computes score of best global alignment within a band.
 
-                first_seq: first sequence (string).
-                second_seq: second sequence (string).
+            Only cells of the score matrix within band diagonals outside
+            those between its first and last cells are filled, and only two
+            rows are held in memory at once.
 
-                Return value: score_matrix, a numpy array whose dimensions are
-                    (len(first_seq) + 1) x (len(second_seq) + 1). It can be
-                    used to trace back the best global alignment.
-            """
-            first_seq = ['ACGTN-'.index(char) for char in first_seq]
-            second_seq = ['ACGTN-'.index(char) for char in second_seq]
-            row_count = len(first_seq) + 1
-            column_count = len(second_seq) + 1
-            score_matrix = [[0 for i in xrange(column_count)]
-                                for j in xrange(row_count)]
+            first_seq: first sequence (list of substitution matrix indexes)
+            second_seq: second sequence (list of substitution matrix indexes)
+            band: maximum number of diagonals to stray
+
+            Return value: score of best global alignment within band
+        """
+        row_count, column_count = len(first_seq), len(second_seq)
+        substitution_matrix = self.substitution_matrix
+        horizontal_gaps = [substitution_matrix[5][second_seq[j]]
+                            for j in xrange(column_count)]
+        '''Diagonal offsets j - i of cells in band; the first and last cells
+        are on diagonals 0 and column_count - row_count.'''
+        min_offset = min(0, column_count - row_count) - band
+        max_offset = max(0, column_count - row_count) + band
+        # Less than the score of any alignment
+        minimum = -2 * (row_count + column_count + 1) * max(
+                        [abs(score) for row in substitution_matrix
+                            for score in row]
+                    ) - 1
+        previous_row = [minimum] * (column_count + 1)
+        previous_row[0] = 0
+        for j in xrange(1, min(max_offset, column_count) + 1):
+            previous_row[j] = previous_row[j-1] + horizontal_gaps[j-1]
+        for i in xrange(1, row_count + 1):
+            substitution_row = substitution_matrix[first_seq[i-1]]
+            vertical_gap = substitution_row[5]
+            first_column = max(i + min_offset, 0)
+            last_column = min(i + max_offset, column_count)
+            row = [minimum] * (column_count + 1)
+            if first_column == 0:
+                row[0] = previous_row[0] + vertical_gap
+                first_column = 1
+            left = row[first_column-1]
+            for j in xrange(first_column, last_column + 1):
+                left = max(previous_row[j-1]
+                                + substitution_row[second_seq[j-1]],
+                           previous_row[j] + vertical_gap,
+                           left + horizontal_gaps[j-1])
+                row[j] = left
+            previous_row = row
+        return previous_row[column_count]
+
+    def score(self, first_seq, second_seq, band=None):
+        """ Computes score of optimal global alignment of two sequences.
+
+            The substitution matrix is specified when the GlobalAlignment
+            class is instantiated. By default, the score is first computed in
+            a narrow band; if that score can't rule out better alignments
+            outside the band, it's recomputed in the band exact_band() finds
+            for it.
+
+            first_seq: first sequence (string).
+            second_seq: second sequence (string).
+            band: maximum number of diagonals to stray outside those between
+                the first and last cells of the score matrix, or None to
+                always return the score of an optimal alignment. Scores
+                computed with smaller bands may be lower than optimal.
+
+            Return value: score of global alignment
+        """
+        first_seq = [_substitution_indexes[ord(char)] for char in first_seq]
+        second_seq = [_substitution_indexes[ord(char)] for char in second_seq]
+        if band is not None:
+            return self.banded_score(first_seq, second_seq, band)
+        band = self.initial_band
+        score = self.banded_score(first_seq, second_seq, band)
+        exact_band = self.exact_band(len(first_seq), len(second_seq), score)
+        if exact_band is None:
+            return self.banded_score(first_seq, second_seq,
+                                     len(first_seq) + len(second_seq))
+        if exact_band <= band:
+            return score
+        return self.banded_score(first_seq, second_seq, exact_band)
+
+    def score_matrix(self, first_seq, second_seq):
+        """ Computes score matrix for global alignment of two sequences.
+
+            The substitution matrix is specified when the GlobalAlignment
+            class is instantiated. Use score() when only the score of the
+            optimal alignment is needed.
+
+            first_seq: first sequence (string).
+            second_seq: second sequence (string).
+
+            Return value: score_matrix, a list of lists whose dimensions are
+                (len(first_seq) + 1) x (len(second_seq) + 1). It can be
+                used to trace back the best global alignment.
+        """
+        first_seq = [_substitution_indexes[ord(char)] for char in first_seq]
+        second_seq = [_substitution_indexes[ord(char)] for char in second_seq]
+        row_count = len(first_seq) + 1
+        column_count = len(second_seq) + 1
+        score_matrix = [[0 for i in xrange(column_count)]
+                            for j in xrange(row_count)]
+        for j in xrange(1, column_count):
+            score_matrix[0][j] = score_matrix[0][j-1] \
+                + self.substitution_matrix[5][second_seq[j-1]]
+        for i in xrange(1, row_count):
+            score_matrix[i][0] = score_matrix[i-1][0] \
+                + self.substitution_matrix[first_seq[i-1]][5]
+        for i in xrange(1, row_count):
             for j in xrange(1, column_count):
-                score_matrix[0][j] = j \
-                    * self.substitution_matrix[5][second_seq[j-1]]
-            for i in xrange(1, row_count):
-                score_matrix[i][0] = i \
-                    * self.substitution_matrix[first_seq[i-1]][5]
-            for i in xrange(1, row_count):
-                for j in xrange(1, column_count):
-                    score_matrix[i][j] = max(score_matrix[i-1][j-1] 
-                                                + self.substitution_matrix[
-                                                        first_seq[i-1]]
-                                                        [second_seq[j-1]
-                                                    ], # diagonal
-                                             score_matrix[i-1][j]
-                                                + self.substitution_matrix[
-                                                        first_seq[i-1]][5
-                                                    ], # vertical
-                                             score_matrix[i][j-1]
-                                                + self.substitution_matrix[
-                                                        5][second_seq[j-1]
-                                                    ] # horizontal
-                                            )
-            return score_matrix
+                score_matrix[i][j] = max(score_matrix[i-1][j-1]
+                                            + self.substitution_matrix[
+                                                    first_seq[i-1]]
+                                                    [second_seq[j-1]
+                                                ], # diagonal
+                                         score_matrix[i-1][j]
+                                            + self.substitution_matrix[
+                                                    first_seq[i-1]][5
+                                                ], # vertical
+                                         score_matrix[i][j-1]
+                                            + self.substitution_matrix[
+                                                    5][second_seq[j-1]
+                                                ] # horizontal
+                                        )
+        return score_matrix
 
 def maximal_suffix_match(query_seq, search_window,
                             min_cap_size=8, max_cap_count=5):
     """ Finds maximum matching suffix of query_seq closest to start of window.
 
-        query_seq: sequence to search for.
+        query_seq: sequence to search for; must be at least min_cap_size
+            characters long.
         search_window: sequence to search in.
         min_cap_size: minimum size of sequence to search for; this is used to
             enumerate initial possible matches for query_seq (that is, matches
@@ -321,19 +301,21 @@ def maximal_suffix_match(query_seq, search_window,
     query_seq_size = len(query_seq)
     offset = query_seq_size - min_cap_size
     suffix_seq = query_seq[offset:]
+    '''str.find() picks up where the last match left off, so the window is
+    neither copied nor scanned again for each match.'''
     suffixes = []
     first_search = True
     while len(suffixes) <= max_cap_count:
-        suffix = re.search(suffix_seq, search_window[offset:])
-        if suffix is None:
+        match_offset = search_window.find(suffix_seq, offset)
+        if match_offset == -1:
             break
-        elif first_search and not suffix.start():
+        elif first_search and match_offset == offset:
             '''Suffix was found on first search at very beginning of window;
             it's VERY likely just an extension.'''
             return None
         else:
             extra_base_count = 0
-            offset += suffix.start()
+            offset = match_offset
             while min_cap_size + extra_base_count < query_seq_size:
                 if query_seq[-min_cap_size-extra_base_count-1] \
                     == search_window[offset-extra_base_count-1]:
@@ -354,39 +336,47 @@ def maximal_suffix_match(query_seq, search_window,
         # No suffixes found
         return None
 
-def alignment_adjacencies(alignments):
-    """ Generates adjacency matrix for graph described below.
-
-        Consider an undirected graph where each node corresponds to
-        an alignment of a distinct multireadlet. Place an edge between two
-        nodes that are "order-consistent"; that is:
+def occurrences(seq, search_window):
+    """ Finds every occurrence of a sequence in a search window.
 
-        1) They have the same strand label
-        2) If the displacements of the corresponding readlets from the 5' end
-        of the read are equal, their genomic positions on the reference are
-        also equal.
-        3) If the displacement of node A is greater than the displacement of
-        node B, the genomic position of node A is greater than the genomic
-        position of node B.
+        seq: sequence to search for; must not be empty
+        search_window: sequence to search in
 
-        cluster: a list of alignment tuples
-            (rname, reverse_strand, pos, end_pos, displacement), each
-            corresponding to a distinct readlet
-        
-        Yield value: tuple (node A, [list of nodes that connect to A])
+        Return value: list of offsets from beginning of search_window of
+            (possibly overlapping) occurrences of seq, in increasing order
     """
-    for compared_alignment in alignments:
-        yield (compared_alignment, [alignment 
-                                    for alignment in alignments
-                                    if (compared_alignment[:2] == alignment[:2]
-                                    and (compared_alignment[2]
-                                            == alignment[2]
-                                            if compared_alignment[4]
-                                            == alignment[4] else
-                                            ((compared_alignment[2]
-                                                < alignment[2])
-                                            == (compared_alignment[4]
-                                                < alignment[4]))))])
+    offsets = []
+    offset = search_window.find(seq)
+    while offset != -1:
+        offsets.append(offset)
+        offset = search_window.find(seq, offset + 1)
+    return offsets
+
+def capped_occurrences(offsets, search_window, seq_size, left_cap,
+                        right_cap):
+    """ Finds occurrences of a sequence flanked by caps in a search window.
+
+        Matches are the ones re.finditer(left_cap + seq + right_cap,
+        search_window) would find: nonoverlapping and leftmost first. They're
+        found from the occurrences of seq alone, so a window searched for
+        several cap combos is scanned only once.
+
+        offsets: occurrences(seq, search_window)
+        search_window: sequence to search in
+        seq_size: length of seq
+        left_cap: sequence that must precede seq
+        right_cap: sequence that must follow seq
+
+        Yield value: tuple (offset of start of match, offset of end of match)
+    """
+    left_cap_size = len(left_cap)
+    last_end = 0
+    for offset in offsets:
+        start = offset - left_cap_size
+        if start >= last_end and search_window.startswith(left_cap, start) \
+            and search_window.startswith(right_cap, offset + seq_size):
+            last_end = offset + seq_size + len(right_cap)
+            yield start, last_end
 
 def maximum_clique(cluster):
     """ Finds maximum clique of graph of multireadlet alignment cluster.
@@ -403,152 +393,93 @@ def maximum_clique(cluster):
         node B, the genomic position of node A is greater than the genomic
         position of node B.
 
-        Now enumerate maximal cliques. This gives all possible maximal groups
-        of mutually consistent alignments. Return the largest group. If there's
-        a tie, break it at random.
-
-        This code is adapted from NetworkX's find_cliques(), which requires
-        inclusion of the following copyright notice.
-
-        --------
-        Copyright (C) 2004-2012, NetworkX Developers
-        Aric Hagberg <hagberg@lanl.gov>
-        Dan Schult <dschult@colgate.edu>
-        Pieter Swart <swart@lanl.gov>
-        All rights reserved.
-
-        Redistribution and use in source and binary forms, with or without
-        modification, are permitted provided that the following conditions are
-        met:
-
-          * Redistributions of source code must retain the above copyright
-            notice, this list of conditions and the following disclaimer.
-
-          * Redistributions in binary form must reproduce the above
-            copyright notice, this list of conditions and the following
-            disclaimer in the documentation and/or other materials provided
-            with the distribution.
-
-          * Neither the name of the NetworkX Developers nor the names of its
-            contributors may be used to endorse or promote products derived
-            from this software without specific prior written permission.
-
-
-        THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS
-        "AS IS" AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT
-        LIMITED TO, THE IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR
-        A PARTICULAR PURPOSE ARE DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT
-        OWNER OR CONTRIBUTORS BE LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL,
-        SPECIAL, EXEMPLARY, OR CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT
-        LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES; LOSS OF USE,
-        DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER CAUSED AND ON ANY
-        THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT
-        (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE
-        OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
-        --------
+        Alignments with the same strand label, displacement, and position are
+        adjacent to each other and to the same other alignments, so they're
+        either all in a maximal clique or all out of it. Collapsing each such
+        group into a point weighted by the group's size, a clique is a chain
+        of points with the same strand label whose displacements and
+        positions both strictly increase. The maximum clique is therefore a
+        heaviest such chain, found as in the longest increasing subsequence
+        problem with a Fenwick tree over positions rather than by enumerating
+        maximal cliques. Weighing chains takes O(n log n) time for n
+        alignments, and recovering the chosen chain of L points takes
+        O(n L), so the whole is O(n L).
+
+        If there's a tie, one call to random.random() picks one of the
+        largest cliques uniformly, consuming the same randomness
+        random.choice() would if handed the list of them. The list is taken
+        in a fixed order: cliques are compared by their points at the
+        greatest displacement, then at the next greatest, and so on.
 
         cluster: a list of alignment tuples
             (rname, reverse_strand, pos, end_pos, displacement), each
             corresponding to a distinct readlet
-        
-        Return value: maximum clique -- a list of alignments.
+
+        Return value: maximum clique -- a list of alignments in order of
+            displacement.
     """
-    cliques = []
-    # Cache nbrs and find first pivot (highest degree)
-    maxconn=-1
-    nnbrs={}
-    pivotnbrs=set() # handle empty graph
-    for n,nbrs in alignment_adjacencies(cluster):
-        nbrs=set(nbrs)
-        nbrs.discard(n)
-        conn = len(nbrs)
-        if conn > maxconn:
-            nnbrs[n] = pivotnbrs = nbrs
-            maxconn = conn
-        else:
-            nnbrs[n] = nbrs
-    # Initial setup
-    cand=set(nnbrs)
-    smallcand = set(cand - pivotnbrs)
-    done=set()
-    stack=[]
-    clique_so_far=[]
-    # Start main loop
-    while smallcand or stack:
-        try:
-            # Any nodes left to check?
-            n=smallcand.pop()
-        except KeyError:
-            # back out clique_so_far
-            cand,done,smallcand = stack.pop()
-            clique_so_far.pop()
-            continue
-        # Add next node to clique
-        clique_so_far.append(n)
-        cand.remove(n)
-        done.add(n)
-        nn=nnbrs[n]
-        new_cand = cand & nn
-        new_done = done & nn
-        # check if we have more to search
-        if not new_cand:
-            if not new_done:
-                # Found a clique!
-                cliques.append(clique_so_far[:])
-            clique_so_far.pop()
-            continue
-        # Shortcut--only one node left!
-        if not new_done and len(new_cand)==1:
-            cliques.append(clique_so_far + list(new_cand))
-            clique_so_far.pop()
-            continue
-        # find pivot node (max connected in cand)
-        # look in done nodes first
-        numb_cand=len(new_cand)
-        maxconndone=-1
-        for n in new_done:
-            cn = new_cand & nnbrs[n]
-            conn=len(cn)
-            if conn > maxconndone:
-                pivotdonenbrs=cn
-                maxconndone=conn
-                if maxconndone==numb_cand:
-                    break
-        # Shortcut--this part of tree already searched
-        if maxconndone == numb_cand:
-            clique_so_far.pop()
-            continue
-        # still finding pivot node
-        # look in cand nodes second
-        maxconn=-1
-        for n in new_cand:
-            cn = new_cand & nnbrs[n]
-            conn=len(cn)
-            if conn > maxconn:
-                pivotnbrs=cn
-                maxconn=conn
-                if maxconn == numb_cand-1:
-                    break
-        # pivot node is max connected in cand from done or cand
-        if maxconndone > maxconn:
-            pivotnbrs = pivotdonenbrs
-        # save search status for later backout
-        stack.append( (cand, done, smallcand) )
-        cand=new_cand
-        done=new_done
-        smallcand = cand - pivotnbrs
-    try:
-        max_clique_size = max(map(len, cliques))
-    except ValueError:
-        assert not cluster
+    groups = defaultdict(list)
+    for alignment in set(cluster):
+        groups[(alignment[:2], alignment[4], alignment[2])].append(alignment)
+    points = sorted(groups)
+    best, counts = {}, {}
+    for strand, strand_points in itertools.groupby(points,
+                                                   key=lambda x: x[0]):
+        strand_points = list(strand_points)
+        ranks = dict((pos, i + 1) for i, pos in enumerate(
+                            sorted(set([point[2] for point in strand_points]))
+                        ))
+        tree_size = len(ranks)
+        best_tree = [0] * (tree_size + 1)
+        count_tree = [0] * (tree_size + 1)
+        for _, same_displacement_points in itertools.groupby(
+                    strand_points, key=lambda x: x[1]
+                ):
+            same_displacement_points = list(same_displacement_points)
+            '''Query for every point with the same displacement before
+            adding any, since chains can't include two of them.'''
+            for point in same_displacement_points:
+                # Only chains ending at smaller positions can be extended
+                chain_weight, chain_count, i = 0, 1, ranks[point[2]] - 1
+                while i:
+                    if best_tree[i] > chain_weight:
+                        chain_weight, chain_count = best_tree[i], count_tree[i]
+                    elif best_tree[i] == chain_weight and chain_weight:
+                        chain_count += count_tree[i]
+                    i &= i - 1
+                best[point] = chain_weight + len(groups[point])
+                counts[point] = chain_count
+            for point in same_displacement_points:
+                i = ranks[point[2]]
+                while i <= tree_size:
+                    if best[point] > best_tree[i]:
+                        best_tree[i], count_tree[i] = (best[point],
+                                                       counts[point])
+                    elif best[point] == best_tree[i]:
+                        count_tree[i] += counts[point]
+                    i += i & -i
+    if not points:
         return []
-    largest_cliques = [clique for clique in cliques
-                        if len(clique) == max_clique_size]
-    largest_clique_count = len(largest_cliques)
-    assert largest_clique_count >= 1
-    if largest_clique_count == 1:
-        return largest_cliques[0]
-    return random.choice(largest_cliques)
+    max_weight = max(best.itervalues())
+    ends = [point for point in points if best[point] == max_weight]
+    chain_count = sum([counts[point] for point in ends])
+    chain_index = (int(random.random() * chain_count)
+                    if chain_count > 1 else 0)
+    clique, candidates = [], ends
+    while candidates:
+        for point in candidates:
+            if chain_index < counts[point]:
+                break
+            chain_index -= counts[point]
+        clique.extend(sorted(groups[point], reverse=True))
+        weight = best[point] - len(groups[point])
+        candidates = [candidate for candidate in points
+                        if candidate[0] == point[0]
+                        and candidate[1] < point[1]
+                        and candidate[2] < point[2]
+                        and best[candidate] == weight] if weight else []
+    clique.reverse()
+    return clique
 
 def selected_readlet_alignments_by_clustering(readlets, experimental=False):
     """ Selects multireadlet alignment via a correlation clustering algorithm.
@@ -783,9 +714,7 @@ def junctions_from_clique(clique, read_seq, reference_index,
         left_search_motifs = _left_elements
         right_search_motifs = _right_elements
     if reverse_strand:
-        read_seq = read_seq[::-1].translate(
-            _reversed_complement_translation_table
-        )
+        read_seq = reversed_complement(read_seq)
     if reverse_reverse_strand:
         reverse_strand = not reverse_strand
     if sign == 1:
@@ -884,16 +813,14 @@ def junctions_from_clique(clique, read_seq, reference_index,
                                     - left_motif_search_bounds[0]
         right_motif_search_size = right_motif_search_bounds[1] \
                                     - right_motif_search_bounds[0]
-        left_motif_window = reference_index.get_stretch(
-                                        rname,
-                                        left_motif_search_bounds[0] - 1,
-                                        left_motif_search_size
-                                    )
-        right_motif_window = reference_index.get_stretch(
-                                        rname,
-                                        right_motif_search_bounds[0] - 1,
-                                        right_motif_search_size
-                                    )
+        # Motif windows of nearby readlets overlap; decode them together
+        left_motif_window, right_motif_window = \
+            reference_index.get_stretches([
+                    (rname, left_motif_search_bounds[0] - 1,
+                        left_motif_search_size),
+                    (rname, right_motif_search_bounds[0] - 1,
+                        right_motif_search_size)
+                ])
         left_offsets = []
         left_motifs = []
         right_offsets = []
@@ -950,12 +877,12 @@ def junctions_from_clique(clique, read_seq, reference_index,
                                                         - intron_end_pos
                                                     )
                         reference_minus_intron = left_stretch + right_stretch
-                        alignment_score = global_alignment.score_matrix(
+                        alignment_score = global_alignment.score(
                                                 read_seq[
                                                     left_displacement:
                                                     left_displacement+read_span
                                                 ],
-                                                reference_minus_intron)[-1][-1]
+                                                reference_minus_intron)
                         candidate_junctions.append(
                                 (
                                     rname,
@@ -1014,42 +941,47 @@ def junctions_from_clique(clique, read_seq, reference_index,
                                                         intron_size
                                                     )]
                         else:
-                            search_windows = [reference_index.get_stretch(
-                                                        rname,
-                                                        intron_pos - 1,
-                                                        search_window_size
-                                                ),
-                                              reference_index.get_stretch(
-                                                        rname,
-                                                        intron_end_pos
-                                                        - search_window_size
-                                                        - 1,
-                                                        search_window_size
-                                                    )]
+                            search_windows = \
+                                reference_index.get_stretches([
+                                        (rname, intron_pos - 1,
+                                            search_window_size),
+                                        (rname, intron_end_pos
+                                            - search_window_size - 1,
+                                            search_window_size)
+                                    ])
+                        '''Find the small exon in each window once; every
+                        cap combo is then checked against those offsets.'''
+                        small_exon_offsets = [
+                                occurrences(small_exon, search_window)
+                                for search_window in search_windows
+                            ]
                         found_alignment_score = False
                         for cap_combo in cap_combos:
-                            capped_exon \
-                                = cap_combo[0] + small_exon + cap_combo[1]
                             for j, search_window in enumerate(search_windows):
-                                for small_exon_match \
-                                    in re.finditer(capped_exon, search_window):
+                                for (small_exon_match_start,
+                                        small_exon_match_end) \
+                                    in capped_occurrences(
+                                            small_exon_offsets[j],
+                                            search_window, small_exon_size,
+                                            cap_combo[0], cap_combo[1]
+                                        ):
                                     if not found_alignment_score:
                                         alignment_score \
-                                            = global_alignment.score_matrix(
+                                            = global_alignment.score(
                                                     read_seq[
                                                         left_displacement:
                                                         left_displacement
                                                         + read_span
                                                     ],
                                                     reference_minus_introns
-                                                )[-1][-1]
+                                                )
                                         found_alignment_score = True
                                     # Split original intron
                                     if j == 0:
                                         # First search-window type
                                         first_intron_end_pos \
                                             = intron_pos \
-                                                + small_exon_match.start() + 2
+                                                + small_exon_match_start + 2
                                         second_intron_pos \
                                             = first_intron_end_pos \
                                                 + small_exon_size
@@ -1058,7 +990,7 @@ def junctions_from_clique(clique, read_seq, reference_index,
                                         second_intron_pos \
                                             = intron_end_pos \
                                                 - search_window_size \
-                                                + small_exon_match.end() - 2
+                                                + small_exon_match_end - 2
                                         first_intron_end_pos \
                                             = second_intron_pos \
                                                 - small_exon_size
@@ -1181,7 +1113,7 @@ def go(input_stream=sys.stdin, output_stream=sys.stdout,
         max_cap_count: maximum number of possible caps of size
             min_cap_size to consider when searching for caps.
         global_alignment: instance of GlobalAlignment class used for fast
-                realignment via Weave or Pypy.
+                realignment to reference.
         max_gaps_mismatches: maximum number of gaps/mismatches to permit in
             a realignment to reference without intron per 100 bp
             or None if unlimited
@@ -1481,7 +1413,59 @@ elif __name__ == '__main__':
             Return value: string of random nucleotides.
         """
         return ''.join([random.choice('ATCG') for _ in xrange(seq_size)])
-    
+
+    class TestGlobalAlignment(unittest.TestCase):
+        """ Tests GlobalAlignment; needs no fixture. """
+        def test_score_with_indels(self):
+            """ Fails if score of alignment with gaps is incorrect.
+            """
+            global_alignment = GlobalAlignment()
+            self.assertEqual(
+                    global_alignment.score('ACGTACGTTTACGT', 'ACGTACGTACGT'),
+                    -2
+                )
+            self.assertEqual(
+                    global_alignment.score('ACGTNCGT', 'ACGTACGTACGTA'),
+                    -6
+                )
+            self.assertEqual(global_alignment.score('', 'ACG'), -3)
+            self.assertEqual(global_alignment.score('ACG', ''), -3)
+
+        def test_score_matches_score_matrix(self):
+            """ Fails if score() disagrees with the full score matrix.
+            """
+            random.seed(12)
+            global_alignment = GlobalAlignment()
+            for _ in xrange(200):
+                first_seq = random_sequence(random.randint(0, 60))
+                second_seq = list(first_seq)
+                for _ in xrange(random.randint(0, 10)):
+                    position = random.randint(0, len(second_seq))
+                    if random.random() < 0.5:
+                        second_seq.insert(position, random.choice('ACGTN'))
+                    else:
+                        del second_seq[position:position+1]
+                second_seq = ''.join(second_seq)
+                self.assertEqual(
+                    global_alignment.score(first_seq, second_seq),
+                    global_alignment.score_matrix(
+                            first_seq, second_seq
+                        )[-1][-1]
+                )
+
+        def test_band(self):
+            """ Fails if narrow band doesn't bound score of alignment.
+            """
+            global_alignment = GlobalAlignment()
+            self.assertEqual(
+                    global_alignment.score('AAAACCCCGGGG', 'CCCCGGGGTTTT'),
+                    -8
+                )
+            self.assertTrue(
+                    global_alignment.score('AAAACCCCGGGG', 'CCCCGGGGTTTT',
+                                            band=0) < -8
+                )
+
     class TestMaximalSuffixMatch(unittest.TestCase):
         """ Tests maximal_suffix_match(); needs no fixture. """
         def test_one_instance_1(self):
@@ -1528,6 +1512,81 @@ elif __name__ == '__main__':
                     None
                 )
 
+        def test_agreement_with_regex_search(self):
+            """ Fails if results differ from those of repeated regex searches.
+            """
+            import re
+            def regex_maximal_suffix_match(query_seq, search_window,
+                                            min_cap_size=8, max_cap_count=5):
+                query_seq_size = len(query_seq)
+                offset = query_seq_size - min_cap_size
+                suffix_seq = query_seq[offset:]
+                suffixes = []
+                first_search = True
+                while len(suffixes) <= max_cap_count:
+                    suffix = re.search(suffix_seq, search_window[offset:])
+                    if suffix is None:
+                        break
+                    elif first_search and not suffix.start():
+                        return None
+                    extra_base_count = 0
+                    offset += suffix.start()
+                    while min_cap_size + extra_base_count < query_seq_size:
+                        if query_seq[-min_cap_size-extra_base_count-1] \
+                            == search_window[offset-extra_base_count-1]:
+                            extra_base_count += 1
+                        else:
+                            break
+                    suffixes.append((-(extra_base_count + min_cap_size),
+                                        offset - extra_base_count))
+                    offset += 1
+                    first_search = False
+                if suffixes and len(suffixes) <= max_cap_count:
+                    suffix = min(suffixes)
+                    return (suffix[1], -suffix[0])
+                return None
+            random.seed(8)
+            for _ in xrange(2000):
+                # Small alphabet so matches are frequent
+                search_window = ''.join([random.choice('AC')
+                                    for _ in xrange(random.randint(0, 60))])
+                query_seq = ''.join([random.choice('AC')
+                                    for _ in xrange(random.randint(4, 12))])
+                min_cap_size = random.randint(1, len(query_seq))
+                max_cap_count = random.randint(1, 6)
+                self.assertEqual(
+                        maximal_suffix_match(query_seq, search_window,
+                                             min_cap_size, max_cap_count),
+                        regex_maximal_suffix_match(query_seq, search_window,
+                                                   min_cap_size,
+                                                   max_cap_count)
+                    )
+
+        def test_capped_occurrences(self):
+            """ Fails if capped matches differ from those of re.finditer().
+            """
+            import re
+            random.seed(9)
+            for _ in xrange(2000):
+                search_window = ''.join([random.choice('ACG')
+                                    for _ in xrange(random.randint(0, 80))])
+                seq = ''.join([random.choice('ACG')
+                                    for _ in xrange(random.randint(1, 3))])
+                left_cap, right_cap = [
+                        ''.join([random.choice('ACG')
+                                    for _ in xrange(random.randint(0, 2))])
+                        for _ in xrange(2)
+                    ]
+                self.assertEqual(
+                        list(capped_occurrences(
+                                occurrences(seq, search_window),
+                                search_window, len(seq), left_cap, right_cap
+                            )),
+                        [match.span() for match in re.finditer(
+                                left_cap + seq + right_cap, search_window
+                            )]
+                    )
+
     class TestJunctionsFromClique(unittest.TestCase):
         """ Tests junctions_from_clique(). """
         def setUp(self):
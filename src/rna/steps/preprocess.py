@@ -72,6 +72,7 @@ import os
 import sys
 import site
 import string
+import math
 
 base_path = os.path.abspath(
                     os.path.dirname(os.path.dirname(os.path.dirname(
@@ -89,14 +90,16 @@ import tempdel
 import subprocess
 from guess import phred_converter
 from encode import encode, encode_sequence
-
-_reversed_complement_translation_table = string.maketrans('ATCG', 'TAGC')
+from sequence_kernels import reversed_complement
 
 _input_line_count, _output_line_count = 0, 0
 
 # Maximum length of read to ignore if dealing with barcodes
 _max_stubby_read_length = 10
 
+# Number of output lines to accumulate before writing them at once
+_records_per_write = 1024
+
 '''Set Bowtie 2's default quality-based mismatch penalties; see
 http://bowtie-bio.sourceforge.net/bowtie2/manual.shtml#bowtie2-options-mp
 for more information.'''
@@ -104,6 +107,20 @@ _MX, _MN = 6, 2
 '''This table depends on _MX, _MN above; it maps mismatch penalties to quality
 scores, each an "exemplar" from a different bin.'''
 _mismatch_penalties_to_quality_scores = string.maketrans('23456', '#05Hh')
+'''Maps each phred+33 quality character to the exemplar of its bin; see
+round_quality_string() in go(). Quality strings are converted to Sanger format
+by a phred_converter() before they're binned, so they never hold characters
+below "!"; those are binned like "!" here only to keep the table total.'''
+_binned_quality_scores = string.maketrans(
+        ''.join([chr(_i) for _i in xrange(256)]),
+        ''.join([str(int(
+                _MN + math.floor((_MX - _MN) * min(
+                                                max(_i - 33.0, 0.0), 40.0
+                                            ) / 40.0)
+            )) for _i in xrange(256)]).translate(
+                    _mismatch_penalties_to_quality_scores
+                )
+    )
 
 def qname_from_read(qname, seq, sample_label, mate=None):
     """ Returns QNAME including sample label and ID formed from hash.
@@ -239,24 +256,17 @@ def go(nucleotides_per_input=8000000, gzip_output=True, gzip_level=3,
         No return value
     """
     if bin_qualities:
-        import math
         def round_quality_string(qual):
             """ Bins phred+33 quality string to improve compression.
 
-                Uses 5-bin scheme that does not affect Bowtie 2 alignments
+                Uses 5-bin scheme that does not affect Bowtie 2 alignments;
+                see _binned_quality_scores.
 
                 qual: quality string
 
                 Return value: "binned" quality string.
             """
-            return ''.join(
-                [str(int(
-                    _MN + math.floor((_MX - _MN) * min(
-                                                    ord(qual_char) - 33.0, 40.0
-                                                ) / 40.0)
-                        )) for qual_char in qual]).translate(
-                                _mismatch_penalties_to_quality_scores
-                            )
+            return qual.translate(_binned_quality_scores)
     else:
         def round_quality_string(qual):
             """ Leaves quality string unbinned and untouched.
@@ -563,6 +573,7 @@ def go(nucleotides_per_input=8000000, gzip_output=True, gzip_level=3,
                     read_next_line = True
                     nucs_read = 0
                     pairs_read = 0
+                    output_batch = []
                     while True:
                         if read_next_line:
                             # Read next line only if FASTA mode didn't already
@@ -777,12 +788,8 @@ def go(nucleotides_per_input=8000000, gzip_output=True, gzip_level=3,
                             assert quals[1]
                             seqs = [seq.upper() for seq in seqs]
                             reversed_complement_seqs = [
-                                    seqs[0][::-1].translate(
-                                        _reversed_complement_translation_table
-                                    ),
-                                    seqs[1][::-1].translate(
-                                        _reversed_complement_translation_table
-                                    )
+                                    reversed_complement(seqs[0]),
+                                    reversed_complement(seqs[1])
                                 ]
                             if seqs[0] < reversed_complement_seqs[0]:
                                 left_seq = seqs[0]
@@ -808,7 +815,7 @@ def go(nucleotides_per_input=8000000, gzip_output=True, gzip_level=3,
                             else:
                                 left_qname_to_write = original_qnames[0]
                                 right_qname_to_write = original_qnames[1]
-                            print >>output_stream, '\t'.join(
+                            output_batch.append('\t'.join(
                                         [
                                             left_seq,
                                             left_reversed,
@@ -832,15 +839,13 @@ def go(nucleotides_per_input=8000000, gzip_output=True, gzip_level=3,
                                                 ),
                                             round_quality_string(right_qual)
                                         ]
-                                    )
+                                    ))
                             records_printed += 2
                             _output_line_count += 1
                         else:
                             seqs[0] = seqs[0].upper()
                             reversed_complement_seqs = [
-                                    seqs[0][::-1].translate(
-                                        _reversed_complement_translation_table
-                                    )
+                                    reversed_complement(seqs[0])
                                 ]
                             # Single-end write
                             if seqs[0] < reversed_complement_seqs[0]:
@@ -855,7 +860,7 @@ def go(nucleotides_per_input=8000000, gzip_output=True, gzip_level=3,
                                 qname_to_write = encode(read_index)
                             else:
                                 qname_to_write = original_qnames[0]
-                            print >>output_stream, '\t'.join(
+                            output_batch.append('\t'.join(
                                         [
                                             seq,
                                             is_reversed,
@@ -866,12 +871,16 @@ def go(nucleotides_per_input=8000000, gzip_output=True, gzip_level=3,
                                             ),
                                             round_quality_string(qual)
                                         ]
-                                    )
+                                    ))
                             records_printed += 1
                             _output_line_count += 1
                         read_index += 1
                         for seq in seqs:
                             nucs_read += len(seq)
+                        if len(output_batch) >= _records_per_write:
+                            output_stream.write('\n'.join(output_batch))
+                            output_stream.write('\n')
+                            del output_batch[:]
                         if records_printed == records_to_consume:
                             break_outer_loop = True
                             perform_push = True
@@ -880,6 +889,9 @@ def go(nucleotides_per_input=8000000, gzip_output=True, gzip_level=3,
                             nucs_read > nucleotides_per_input:
                             file_number += 1
                             break
+                    if output_batch:
+                        output_stream.write('\n'.join(output_batch))
+                        output_stream.write('\n')
                 if verbose:
                     print >>sys.stderr, (
                             'Exited with statement; line numbers are %s' 
@@ -930,6 +942,22 @@ if __name__ == '__main__':
         def test_empty(self):
             pass
 
+    class TestBinnedQualityScores(unittest.TestCase):
+
+        def test_sanger_range(self):
+            """ Fails if binning table differs from per-character rule. """
+            import math
+            for i in xrange(33, 127):
+                self.assertEqual(
+                        chr(i).translate(_binned_quality_scores),
+                        str(int(
+                            _MN + math.floor(
+                                (_MX - _MN) * min(i - 33.0, 40.0) / 40.0
+                            ))).translate(
+                                _mismatch_penalties_to_quality_scores
+                            )
+                    )
+
     if '--test' in sys.argv:
         unittest.main(argv=[sys.argv[0]])
         sys.exit(0)
@@ -55,7 +55,6 @@ import site
 import tempfile
 import subprocess
 import time
-import string
 
 base_path = os.path.abspath(
                     os.path.dirname(os.path.dirname(os.path.dirname(
@@ -68,15 +67,17 @@ site.addsitedir(base_path)
 
 from dooplicity.tools import xstream, register_cleanup, xopen, \
     make_temp_dir
+from dooplicity.counters import Counter
+from index_cache import IndexCache
 import bowtie
 import argparse
 import tempdel
 import itertools
+from sequence_kernels import reversed_complement
 
 # Initialize global variable for tracking number of input lines
 _input_line_count = 0
 
-_reversed_complement_translation_table = string.maketrans('ATCG', 'TAGC')
 
 def input_files_from_input_stream(input_stream,
                                     output_stream,
@@ -133,9 +134,7 @@ def input_files_from_input_stream(input_stream,
                             else:
                                 print >>read_stream, '\t'.join([
                                             value[2],
-                                            read_seq[::-1].translate(
-                                        _reversed_complement_translation_table
-                                    ),
+                                            reversed_complement(read_seq),
                                             value[3][::-1]])
                         else:
                             # Print unmapped read
@@ -143,9 +142,7 @@ def input_files_from_input_stream(input_stream,
                                 seq_to_write = read_seq
                                 qual_to_write = value[3]
                             else:
-                                seq_to_write = read_seq[::-1].translate(
-                                        _reversed_complement_translation_table
-                                    )
+                                seq_to_write = reversed_complement(read_seq)
                                 qual_to_write = value[3][::-1]
                             '''Write only essentials; handle "formal" writing
                             in next step.'''
@@ -202,7 +199,7 @@ def create_index_from_reference_fasta(bowtie2_build_exe, fasta_file,
     """
     with open(os.devnull) as null_stream:
         bowtie_build_process = subprocess.Popen(
-                                    [args.bowtie2_build_exe,
+                                    [bowtie2_build_exe,
                                         fasta_file,
                                         index_basename],
                                     stderr=null_stream,
@@ -233,7 +230,8 @@ def handle_temporary_directory(archive, temp_dir_path):
 def go(input_stream=sys.stdin, output_stream=sys.stdout, bowtie2_exe='bowtie2',
     bowtie2_build_exe='bowtie2-build', bowtie2_args=None,
     temp_dir_path=None, verbose=False, report_multiplier=1.2, gzip_level=3,
-    count_multiplier=4, tie_margin=0):
+    count_multiplier=4, tie_margin=0, index_cache_dir=None,
+    index_cache_size=0):
     """ Runs Rail-RNA-realign.
 
         Realignment script for MapReduce pipelines that wraps Bowtie2. Creates
@@ -303,12 +301,21 @@ def go(input_stream=sys.stdin, output_stream=sys.stdout, bowtie2_exe='bowtie2',
             alignment_count_to_report is the user-specified bowtie2 -k arg
         tie_margin: allowed score difference per 100 bases among ties in 
              max alignment score.
+        index_cache_dir: directory in which Bowtie 2 indexes are cached for
+            reuse by any task on the node, keyed by digests of the FASTA
+            files they're built from; None for a subdirectory of
+            temp_dir_path
+        index_cache_size: maximum total size of cached indexes in bytes;
+            0 disables the cache
 
         No return value.
     """
     start_time = time.time()
     if temp_dir_path is None: temp_dir_path = tempfile.mkdtemp()
-    bowtie2_index_base = os.path.join(temp_dir_path, 'tempidx')
+    if index_cache_dir is None:
+        index_cache_dir = os.path.join(temp_dir_path, 'index_cache')
+    counter = Counter('realign_reads')
+    index_cache = IndexCache(index_cache_dir, index_cache_size, counter)
     alignment_count_to_report, _, _ \
             = bowtie.parsed_bowtie_args(bowtie2_args)
     reads_filename = os.path.join(temp_dir_path, 'reads.temp')
@@ -318,7 +325,7 @@ def go(input_stream=sys.stdin, output_stream=sys.stdout, bowtie2_exe='bowtie2',
         '{0} --local -t --no-hd --mm -x'.format(
                 '-k {0}'.format(alignment_count_to_report * count_multiplier)
             ),
-        bowtie2_index_base, '--12 -'])
+        '{0}', '--12 -'])
     delegate_command = ''.join(
             [sys.executable, ' ', os.path.realpath(__file__)[:-3],
                 ('_delegate.py --report-multiplier %08f '
@@ -331,6 +338,10 @@ def go(input_stream=sys.stdin, output_stream=sys.stdout, bowtie2_exe='bowtie2',
     full_command = ' | '.join([input_command, 
                                 bowtie_command, delegate_command])
     print >>sys.stderr, 'Bowtie2 command to execute: ' + full_command
+    build_index = lambda fasta_file, index_basename: (
+            create_index_from_reference_fasta(bowtie2_build_exe, fasta_file,
+                                                index_basename)
+        )
     for fasta_file, reads_file in input_files_from_input_stream(
                                                 input_stream,
                                                 output_stream,
@@ -338,33 +349,38 @@ def go(input_stream=sys.stdin, output_stream=sys.stdout, bowtie2_exe='bowtie2',
                                                 temp_dir_path=temp_dir_path,
                                                 gzip_level=gzip_level
                                             ):
-        bowtie_build_return_code = create_index_from_reference_fasta(
-                                        bowtie2_build_exe,
-                                        fasta_file,
-                                        bowtie2_index_base
-                                    )
-        if bowtie_build_return_code == 0:
-            try:
-                os.remove(fasta_file)
-            except OSError:
-                pass
-            bowtie_process = subprocess.Popen(' '.join(
-                        ['set -exo pipefail;', full_command]
-                    ), bufsize=-1,
-                stdout=sys.stdout, stderr=sys.stderr, shell=True,
-                executable='/bin/bash')
-            return_code = bowtie_process.wait()
-            if return_code:
+        with index_cache.index(fasta_file, build_index) as (
+                    bowtie2_index_base, bowtie_build_return_code
+                ):
+            if bowtie_build_return_code == 0:
+                try:
+                    os.remove(fasta_file)
+                except OSError:
+                    pass
+                bowtie_process = subprocess.Popen(' '.join(
+                            ['set -exo pipefail;',
+                                full_command.replace(
+                                    '{0}', bowtie2_index_base
+                                )]
+                        ), bufsize=-1,
+                    stdout=sys.stdout, stderr=sys.stderr, shell=True,
+                    executable='/bin/bash')
+                return_code = bowtie_process.wait()
+                if return_code:
+                    raise RuntimeError(
+                                'Error occurred while reading Bowtie 2 '
+                                'output; exitlevel was %d.' % return_code
+                            )
+            elif bowtie_build_return_code == 1:
+                print >>sys.stderr, ('Bowtie build failed, but probably '
+                                     'because FASTA file was empty. '
+                                     'Continuing...')
+            else:
                 raise RuntimeError(
-                            'Error occurred while reading Bowtie 2 output; '
-                            'exitlevel was %d.' % return_code
-                        )
-        elif bowtie_build_return_code == 1:
-            print >>sys.stderr, ('Bowtie build failed, but probably because '
-                                 'FASTA file was empty. Continuing...')
-        else:
-            raise RuntimeError('Bowtie build process failed with exitlevel %d.'
-                                % bowtie_build_return_code)
+                        'Bowtie build process failed with exitlevel %d.'
+                        % bowtie_build_return_code
+                    )
+    counter.flush()
 
     print >>sys.stderr, 'DONE with realign_reads.py; in=%d; ' \
         'time=%0.3f s' % (_input_line_count, time.time() - start_time)
@@ -405,6 +421,15 @@ if __name__ == '__main__':
     parser.add_argument('--gzip-level', type=int, required=False,
         default=3,
         help='Level of gzip compression to use, if applicable')
+    parser.add_argument('--index-cache-dir', type=str, required=False,
+        default=None,
+        help='Directory in which to cache Bowtie 2 indexes for reuse by any '
+             'task on the node; defaults to a subdirectory of --scratch if '
+             'specified or of the system temporary directory')
+    parser.add_argument('--index-cache-size', type=int, required=False,
+        default=4096,
+        help='Maximum total size of cached Bowtie 2 indexes in MB; 0 '
+             'disables the cache')
 
     # Add command-line arguments for dependencies
     bowtie.add_args(parser)
@@ -451,7 +476,16 @@ if __name__ == '__main__' and not args.test:
         report_multiplier=args.report_multiplier,
         gzip_level=args.gzip_level,
         count_multiplier=args.count_multiplier,
-        tie_margin=args.tie_margin)
+        tie_margin=args.tie_margin,
+        index_cache_dir=(
+            os.path.expandvars(args.index_cache_dir)
+            if args.index_cache_dir is not None
+            else os.path.join(tempdel.silentexpandvars(args.scratch)
+                                if args.scratch is not None
+                                else tempfile.gettempdir(),
+                              'rail-rna.realign_reads.index_cache')
+        ),
+        index_cache_size=args.index_cache_size * 1048576)
 elif __name__ == '__main__':
     # Test units
     del sys.argv[1:] # Don't choke on extra command-line parameters
@@ -25,8 +25,6 @@ site.addsitedir(base_path)
 
 from dooplicity.tools import xstream, xopen
 
-import string
-_reversed_complement_translation_table = string.maketrans('ATCG', 'TAGC')
 
 def go(output_stream=sys.stdout, input_stream=sys.stdin,
         verbose=False, report_multiplier=1.2,
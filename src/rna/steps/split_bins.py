@@ -0,0 +1,222 @@
+#!/usr/bin/env python
+"""
+Rail-RNA-split_bins
+
+Follows Rail-RNA-collapse
+Precedes Rail-RNA-coverage_pre
+
+Map step in MapReduce pipelines that splits genome partitions holding far more
+exon differentials than others into sub-bins so that they can be divided among
+Rail-RNA-coverage_pre's reducers. Which partitions to split and where is read
+from a partition plan (see PartitionPlan in dooplicity/tools.py) drawn up by
+the EMR simulator's plan partitioner from a sample of this step's input; if
+there is no plan, input is passed through unchanged.
+
+Rail-RNA-coverage_pre computes coverage within a partition by summing its
+diffs in order of position, so a sub-bin needs the coverage at its start. For
+each sub-bin after the first, the diffs of the same partition at earlier
+positions are summed by sample index and uniqueness as they pass through, and
+the sums are written at the end as extra diffs at the sub-bin's first
+position. Each sub-bin then holds everything needed to compute its coverage,
+and the only extra output is a handful of diffs per sub-bin. The extra diffs
+are marked as carried so Rail-RNA-coverage_pre doesn't output coverage at
+positions and for samples where the unsplit bin has no diffs; its output is
+the same with and without a plan.
+
+Input (read from stdin)
+----------------------------
+Tab-delimited input tuple columns:
+1. Reference name (RNAME in SAM format) + ';' + bin number
+2. Position at which diff should be subtracted or added to coverage
+3. Sample index
+4. '1' if alignment from which diff originates is "unique" according to
+    --tie-margin criterion; else '0'
+5. A diff -- that is, by how much coverage increases or decreases at the
+    given genomic position: +n or -n for some natural number n.
+
+Hadoop output (written to stdout)
+----------------------------
+Tab-delimited output tuple columns:
+1. Reference name (RNAME in SAM format) + ';' + bin number, followed by
+    '.' + sub-bin number if the bin is split and the sub-bin isn't the first
+2-5. Same as input
+6. 'carried' for the extra diffs at sub-bins' first positions; other lines
+    have only five fields
+"""
+import os
+import sys
+import site
+import argparse
+import time
+from collections import defaultdict
+from bisect import bisect_right
+
+base_path = os.path.abspath(
+                    os.path.dirname(os.path.dirname(os.path.dirname(
+                        os.path.realpath(__file__)))
+                    )
+                )
+utils_path = os.path.join(base_path, 'rna', 'utils')
+site.addsitedir(utils_path)
+site.addsitedir(base_path)
+
+from dooplicity.tools import PartitionPlan
+
+if '--test' in sys.argv:
+    # Test units
+    del sys.argv[1:] # Don't choke on extra command-line parameters
+    import unittest
+    import shutil
+    import tempfile
+    import random
+    import subprocess
+
+    class TestSplitBins(unittest.TestCase):
+        """ Tests split_bins.py together with coverage_pre.py. """
+        def setUp(self):
+            self.temp_dir_path = tempfile.mkdtemp()
+            self.steps_path = os.path.dirname(os.path.realpath(__file__))
+            fasta_file = os.path.join(self.temp_dir_path, 'genome.fa')
+            with open(fasta_file, 'w') as fasta_stream:
+                random.seed(0)
+                print >>fasta_stream, '>chr1'
+                print >>fasta_stream, ''.join(
+                        [random.choice('ACGT') for _ in xrange(3000)]
+                    )
+            self.bowtie_idx = os.path.join(self.temp_dir_path, 'genome')
+            subprocess.check_call(['bowtie-build', fasta_file,
+                                    self.bowtie_idx],
+                                    stdout=open(os.devnull, 'w'))
+            self.manifest_file = os.path.join(self.temp_dir_path,
+                                                'sample.manifest')
+            with open(self.manifest_file, 'w') as manifest_stream:
+                manifest_stream.write(
+                        'file1.fastq\t0\tsample0\n'
+                        'file2.fastq\t0\tsample1\n'
+                        'file3.fastq\t0\tsample2\n'
+                    )
+            self.read_counts_file = os.path.join(self.temp_dir_path,
+                                                    'counts.tsv')
+            with open(self.read_counts_file, 'w') as read_count_stream:
+                read_count_stream.write(
+                        'sample\ttotal\tmapped,unique\tmapped read counts\n'
+                        'sample0\t100\t90,80\t90\n'
+                        'sample1\t200\t150,120\t150\n'
+                        'sample2\t50\t0,0\t0\n'
+                    )
+
+        def coverage(self, diff_lines):
+            """ Runs coverage_pre.py on diffs sorted as Hadoop would.
+
+                diff_lines: list of diff lines, each ending in a newline
+
+                Return value: sorted list of output lines
+            """
+            coverage_pre_process = subprocess.Popen(
+                    [sys.executable,
+                        os.path.join(self.steps_path, 'coverage_pre.py'),
+                        '--bowtie-idx=%s' % self.bowtie_idx,
+                        '--manifest=%s' % self.manifest_file,
+                        '--read-counts=%s' % self.read_counts_file],
+                    stdin=subprocess.PIPE, stdout=subprocess.PIPE,
+                    stderr=open(os.devnull, 'w')
+                )
+            output = coverage_pre_process.communicate(''.join(
+                    sorted(diff_lines, key=lambda line: line.split('\t')[:3])
+                ))[0]
+            self.assertEquals(coverage_pre_process.returncode, 0)
+            return sorted(output.splitlines())
+
+        def test_same_coverage_with_plan(self):
+            """ Fails if splitting bins changes coverage_pre.py's output. """
+            random.seed(1)
+            diff_lines = []
+            for _ in xrange(300):
+                partition_id = 'chr1;%d' % random.randint(0, 1)
+                start = (random.randint(0, 1499)
+                            + 1500 * int(partition_id[-1]))
+                end = min(start + random.randint(1, 100),
+                            1500 * (int(partition_id[-1]) + 1))
+                sample_index = random.choice(['0', '1', '2', '1.A'])
+                uniqueness = random.choice('01')
+                diff_lines.append('\t'.join([partition_id, '%012d' % start,
+                                    sample_index, uniqueness, '1']) + '\n')
+                diff_lines.append('\t'.join([partition_id, '%012d' % end,
+                                    sample_index, uniqueness, '-1']) + '\n')
+            positions = sorted([line.split('\t')[1] for line in diff_lines
+                                    if line.startswith('chr1;0\t')])
+            plan = PartitionPlan()
+            plan.add('chr1;0', 0)
+            # Start a sub-bin where there's a diff and where there's none
+            plan.add('chr1;0', 1, positions[len(positions) // 4])
+            plan.add('chr1;0', 2, '%012d' % 1234)
+            plan_file = os.path.join(self.temp_dir_path, 'partition.plan')
+            plan.write(plan_file)
+            split_bins_process = subprocess.Popen(
+                    [sys.executable, os.path.realpath(__file__),
+                        '--plan=%s' % plan_file],
+                    stdin=subprocess.PIPE, stdout=subprocess.PIPE,
+                    stderr=open(os.devnull, 'w')
+                )
+            split_lines = split_bins_process.communicate(
+                                                ''.join(diff_lines)
+                                            )[0].splitlines(True)
+            self.assertEquals(split_bins_process.returncode, 0)
+            self.assertTrue(
+                    [line for line in split_lines
+                        if line.startswith('chr1;0.2\t')]
+                )
+            self.assertEquals(self.coverage(diff_lines),
+                                self.coverage(split_lines))
+
+        def tearDown(self):
+            # Kill temporary directory
+            shutil.rmtree(self.temp_dir_path)
+
+    unittest.main()
+    sys.exit(0)
+
+# Print file's docstring if -h is invoked
+parser = argparse.ArgumentParser(description=__doc__,
+            formatter_class=argparse.RawDescriptionHelpFormatter)
+parser.add_argument(
+    '--plan', type=str, required=False, default=None,
+    help='Path to partition plan; input is passed through if it\'s missing')
+args = parser.parse_args()
+
+start_time = time.time()
+input_line_count, output_line_count = 0, 0
+plan = PartitionPlan(args.plan)
+'''Sums of diffs preceding each sub-bin after the first; keys are tuples
+(partition, index of sub-bin, sample index, uniqueness)'''
+carried_diffs = defaultdict(int)
+for line in sys.stdin:
+    input_line_count += 1
+    partition_id, _, rest = line.partition('\t')
+    try:
+        bounds = plan.bounds[partition_id]
+    except KeyError:
+        sys.stdout.write(line)
+        output_line_count += 1
+        continue
+    pos, sample_index, uniqueness, diff = rest.rstrip('\n').split('\t')
+    index = bisect_right(bounds, pos)
+    print '\t'.join([PartitionPlan.sub_key(partition_id, index),
+                     rest.rstrip('\n')])
+    output_line_count += 1
+    for later_index in xrange(index + 1, len(bounds) + 1):
+        carried_diffs[(partition_id, later_index, sample_index,
+                        uniqueness)] += int(diff)
+
+for (partition_id, index, sample_index, uniqueness), diff \
+    in sorted(carried_diffs.items()):
+    if diff:
+        print '\t'.join([PartitionPlan.sub_key(partition_id, index),
+                         plan.bounds[partition_id][index - 1],
+                         sample_index, uniqueness, str(diff),
+                         'carried'])
+        output_line_count += 1
+
+print >>sys.stderr, 'DONE with split_bins.py; in/out=%d/%d; time=%0.3f s' \
+                        % (input_line_count, output_line_count,
+                            time.time() - start_time)
@@ -7,7 +7,8 @@ Generic combiner/reducer script for MapReduce pipelines that sums values that
 have the same key. A value is an integer/float/string from the final K fields,
 and a key is the concatenation of fields that precede the final K fields.
 Strings are summed by separating them with '\x1d's. An empty string is
-represented as '\x1c'.
+represented as '\x1c'. Every input line must have as many fields as the
+first.
 
 Input (read from stdin)
 ----------------------------
@@ -65,7 +66,8 @@ utils_path = os.path.join(base_path, 'rna', 'utils')
 site.addsitedir(utils_path)
 site.addsitedir(base_path)
 
-from dooplicity.tools import dlist
+from dooplicity.tools import dlist, xstream
+from itertools import chain
 
 start_time = time.time()
 
@@ -100,97 +102,62 @@ input_line_count, output_line_count = 0, 0
 line = sys.stdin.readline()
 if args.keep_alive: keep_alive_thread.start()
 
-if args.type == 1:
-    last_key, totals, write_line = None, [0]*args.value_count, False
-    while True:
-        if not line:
-            if last_key is None:
-                # Input is empty
-                break
-            else:
-                # Write final line
-                write_line = True
-        else:
+'''A key is every field but the final args.value_count. Lines are taken to
+have as many fields as the first, so values are read raw from xstream and
+split only to check that they have args.value_count fields.'''
+key_fields = line.count('\t') + 1 - args.value_count
+
+def value_fields(value):
+    """ Splits a raw value from xstream into its fields.
+
+        value: the final args.value_count fields of a line, unsplit
+
+        Return value: list of fields
+    """
+    fields = value.split('\t')
+    if len(fields) != args.value_count:
+        raise RuntimeError('Line with %d fields follows a line with %d.'
+                            % (key_fields + len(fields),
+                                key_fields + args.value_count))
+    return fields
+
+if not line:
+    # Input is empty
+    pass
+elif args.type == 1 or args.type == 2:
+    number, number_format = (int, '%d') if args.type == 1 \
+                                else (float, '%0.11f')
+    for key, xpartition in xstream(chain([line], sys.stdin), key_fields,
+                                    raw=True):
+        totals = [0] * args.value_count
+        for value in xpartition:
             input_line_count += 1
-            tokens = line.rstrip().split('\t')
-            key = tokens[:-args.value_count]
-            if key != last_key and last_key is not None:
-                write_line = True
-        if write_line:
-            print '\t'.join(last_key + [('%d' % totals[i])
-                                            for i in xrange(len(totals))])
-            output_line_count += 1
-            totals, write_line = [0]*args.value_count, False
-        if not line: break
-        for i in xrange(1, args.value_count+1):
-            totals[-i] += int(tokens[-i])
-        last_key = key
-        line = sys.stdin.readline()
-elif args.type == 2:
-    last_key, totals, write_line = None, [0.0]*args.value_count, False
-    while True:
-        if not line:
-            if last_key is None:
-                # Input is empty
-                break
-            else:
-                # Write final line
-                write_line = True
-        else:
-            input_line_count += 1
-            tokens = line.rstrip().split('\t')
-            key = tokens[:-args.value_count]
-            if key != last_key and last_key is not None:
-                write_line = True
-        if write_line:
-            print '\t'.join(last_key + [('%0.11f' % totals[i])
-                                            for i in xrange(len(totals))])
-            output_line_count += 1
-            totals, write_line = [0.0]*args.value_count, False
-        if not line: break
-        for i in xrange(1, args.value_count+1):
-            totals[-i] += float(tokens[-i])
-        last_key = key
-        line = sys.stdin.readline()
+            for i, field in enumerate(value_fields(value)):
+                totals[i] += number(field)
+        print '\t'.join(key + tuple([number_format % total
+                                        for total in totals]))
+        output_line_count += 1
 else:
-    last_key, totals, write_line \
-        = None, [dlist() for i in xrange(args.value_count)], False
-    while True:
-        if not line:
-            if last_key is None:
-                # Input is empty
-                break
-            else:
-                # Write final line
-                write_line = True
-        else:
+    for key, xpartition in xstream(chain([line], sys.stdin), key_fields,
+                                    raw=True):
+        totals = [dlist() for i in xrange(args.value_count)]
+        for value in xpartition:
             input_line_count += 1
-            tokens = line.rstrip().split('\t')
-            key = tokens[:-args.value_count]
-            if key != last_key and last_key is not None:
-                write_line = True
-        if write_line:
-            sys.stdout.write('\t'.join(last_key))
-            for total in totals:
-                sys.stdout.write('\t')
-                j = None
-                for j, item in enumerate(total):
-                    if j > 0: sys.stdout.write('\x1d')
-                    sys.stdout.write(item)
-                if j is None:
-                    sys.stdout.write('\x1c')
-            sys.stdout.write('\n')
-            output_line_count += 1
-            for a_list in totals:
-                a_list.tear_down()
-            totals, write_line = [dlist() for i in xrange(args.value_count)], \
-                False
-        if not line: break
-        for i in xrange(1, args.value_count+1):
-            if tokens[-i] != '\x1c':
-                totals[-i].append(tokens[-i])
-        last_key = key
-        line = sys.stdin.readline()
+            for i, field in enumerate(value_fields(value)):
+                if field != '\x1c':
+                    totals[i].append(field)
+        sys.stdout.write('\t'.join(key))
+        for total in totals:
+            sys.stdout.write('\t')
+            j = None
+            for j, item in enumerate(total):
+                if j > 0: sys.stdout.write('\x1d')
+                sys.stdout.write(item)
+            if j is None:
+                sys.stdout.write('\x1c')
+            total.tear_down()
+        sys.stdout.write('\n')
+        output_line_count += 1
     sys.stdout.flush()
 
 print >>sys.stderr, 'DONE with sum.py; in/out=%d/%d; time=%0.3f s' \
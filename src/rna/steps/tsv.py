@@ -1,34 +1,31 @@
 #!/usr/bin/env python
 """
 Rail-RNA-tsv
-Follows Rail-RNA-bed_pre / Rail-RNA-coverage
+Follows Rail-RNA-tsv_pre
 TERMINUS: no steps follow.
 
 Reducer for MapReduce pipelines that writes cross-sample tables storing
-coverages of junctions, insertions, and deletions across samples.
+coverages of junctions, insertions, and deletions across samples. Chunks of
+each table were compressed into BGZF blocks by Rail-RNA-tsv_pre and are only
+concatenated here, in the order of their features, after a block holding the
+table's header; an end-of-file block follows them. A region index of each
+coverage matrix is also written (see bgzf.py).
 
 Input (read from stdin)
 ----------------------------
-Tab-delimited output tuple columns (collect)
+Tab-delimited tuple columns, one line per chunk:
 1. '0' if insertion, '1' if deletion, '2' if junction line, '3'
     if normalization factor
-2. Number string representing RNAME (+ '+ or -' if junction; same as field 6)
-    or sample index if field 1 is '3'
-3. Start position (Last base before insertion, first base of deletion,
-                    or first base of intron)
-    or '\x1c' if field 1 is '3'
-4. End position (Last base before insertion, last base of deletion (exclusive),
-                    or last base of intron (INCLUSIVE))
-    or '\x1c' if field 1 is '3'
-5. '+' or '-' indicating which strand is the sense strand for junctions,
-   inserted sequence for insertions, or deleted sequence for deletions
-   or '\x1c' if field 1 is '3'
-6. Coverage of feature for sample with index N
-    or normalization factor
-...
-N + 6. Coverage of feature in sample with index N
-
-Input is partitioned by field 1 and sorted by fields 2-5.
+2. Shard
+3. Index of chunk in shard, zero-padded
+4. RNAME of chunk's features or '\x1c' if field 1 is '3'
+5. Smallest start position among chunk's features or '\x1c' if field 1 is
+    '3'
+6. Largest start position among chunk's features or '\x1c' if field 1 is
+    '3'
+7. Base64-encoded BGZF blocks containing chunk's lines of TSV
+
+Input is partitioned by field 1 and sorted by fields 2-3.
 
 Hadoop output (written to stdout)
 ----------------------------
@@ -36,8 +33,8 @@ None.
 
 Other output (written to directory specified by command-line parameter --out)
 ----------------------------
-1) Three coverage matrices, each stored in a different TSV file: one is for
-junctions, one is for insertions, and one is for deletions. A given element
+1) Three coverage matrices, each stored in a different BGZF-compressed TSV
+file: one is for junctions, one is for insertions, and one is for deletions. A given element
 (i, j) of a given matrix specifies the number of reads in which the feature
 (junction, insertion, or deletion) i was found in sample j.
 
@@ -48,6 +45,14 @@ insertion, first base of deletion, or first base of intron) + ';' +
 end position (last base before insertion, last base of deletion (exclusive), or
 last base of intron (exclusive))
 
+Each matrix is accompanied by a region index, a file with the same name plus
+".idx" that can be passed to bgzf.region_lines() to read only the features in
+a genomic region. Tab-delimited columns:
+1. Offset in TSV of a chunk of whole lines
+2. RNAME of chunk's features
+3. Smallest start position among chunk's features
+4. Largest start position among chunk's features
+
 2) Normalization factors for sample read coverage distributions
 Tab-delimited tuple columns:
 1. Sample name
@@ -58,6 +63,7 @@ import os
 import sys
 import site
 import argparse
+import base64
 
 if '--test' in sys.argv:
     print("No unit tests")
@@ -74,12 +80,11 @@ site.addsitedir(utils_path)
 site.addsitedir(base_path)
 
 from dooplicity.ansibles import Url
-from dooplicity.tools import xstream, register_cleanup, make_temp_dir, xopen
-import bowtie
-import bowtie_index
+from dooplicity.tools import xstream, register_cleanup, make_temp_dir
 import manifest
 import filemover
 import tempdel
+import bgzf
 
 # Print file's docstring if -h is invoked
 parser = argparse.ArgumentParser(description=__doc__, 
@@ -98,13 +103,12 @@ parser.add_argument(
          'followed by ".[junctions/insertions/deletions].tsv.gz"')
 parser.add_argument('--gzip-level', type=int, required=False,
         default=3,
-        help='Level of gzip compression to use for temporary files')
+        help='Level of gzip compression to use for TSV headers')
 parser.add_argument(
     '--keep-alive', action='store_const', const=True, default=False,
     help='Prints reporter:status:alive messages to stderr to keep EMR '
          'task alive')
 
-bowtie.add_args(parser)
 filemover.add_args(parser)
 tempdel.add_args(parser)
 args = parser.parse_args()
@@ -118,9 +122,6 @@ if args.keep_alive:
 import time
 start_time = time.time()
 
-reference_index = bowtie_index.BowtieIndexReference(
-                        os.path.expandvars(args.bowtie_idx)
-                    )
 # For mapping sample indices back to original sample labels
 manifest_object = manifest.LabelsAndIndices(
                         os.path.expandvars(args.manifest)
@@ -148,44 +149,44 @@ for (line_type,), xpartition in xstream(sys.stdin, 1):
     output_filename = ((args.tsv_basename + '.' 
                           if args.tsv_basename != '' else '')
                           + type_string + '.tsv.gz')
+    index_filename = output_filename + '.idx'
     if output_url.is_local:
         output_path = os.path.join(args.out, output_filename)
+        index_path = os.path.join(args.out, index_filename)
     else:
         output_path = os.path.join(temp_dir_path, output_filename)
-    with xopen(True, output_path, 'w', args.gzip_level) as output_stream:
+        index_path = os.path.join(temp_dir_path, index_filename)
+    with open(output_path, 'wb') as output_stream:
         if line_type != '3':
             '''Print all labels in the order in which they appear in the
             manifest file.'''
             sample_count = len(manifest_object.index_to_label)
-            for i in xrange(sample_count):
-                output_stream.write(
-                        '\t' + manifest_object.index_to_label[str(i)]
-                    )
-            output_stream.write('\n')
-            for coverage_line in xpartition:
-                input_line_count += 1
-                (rname, pos, end_pos, strand_or_seq) = coverage_line[:4]
-                '''Handle missing zeros at end of line here; in previous step,
-                the total number of samples was unknown, so this was not
-                done.'''
-                print >>output_stream, '\t'.join(
-                    (';'.join(
-                        [reference_index.string_to_rname[rname],
-                            strand_or_seq, str(int(pos)), str(int(end_pos))]
-                    ),) + coverage_line[4:] + ('0',)*(-len(coverage_line) + 4
-                                                        + sample_count)
-                )
+            output_stream.write(bgzf.compressed_blocks(
+                    ''.join(['\t' + manifest_object.index_to_label[str(i)]
+                                for i in xrange(sample_count)]) + '\n',
+                    args.gzip_level
+                ))
+            with open(index_path, 'w') as index_stream:
+                print >>index_stream, bgzf.region_index_header
+                for (_, _, rname, min_start, max_start,
+                        blocks) in xpartition:
+                    input_line_count += 1
+                    print >>index_stream, bgzf.region_index_line(
+                            output_stream.tell(), rname, int(min_start),
+                            int(max_start)
+                        )
+                    output_stream.write(base64.b64decode(blocks))
         else:
-            for (sample_index, _, _, _, factor, unique_factor) in xpartition:
+            for (_, _, _, _, _, blocks) in xpartition:
                 input_line_count += 1
-                print >>output_stream, '\t'.join([
-                        manifest_object.index_to_label[sample_index],
-                        factor, unique_factor
-                    ])
-
+                output_stream.write(base64.b64decode(blocks))
+        output_stream.write(bgzf.eof_block)
     if not output_url.is_local:
         mover.put(output_path, output_url.plus(output_filename))
         os.remove(output_path)
+        if line_type != '3':
+            mover.put(index_path, output_url.plus(index_filename))
+            os.remove(index_path)
 
 print >>sys.stderr, 'DONE with tsv.py; in=%d; time=%0.3f s' \
-                        % (input_line_count, time.time() - start_time)
\ No newline at end of file
+                        % (input_line_count, time.time() - start_time)
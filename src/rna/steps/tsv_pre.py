@@ -0,0 +1,182 @@
+#!/usr/bin/env python
+"""
+Rail-RNA-tsv_pre
+Follows Rail-RNA-bed_pre / Rail-RNA-coverage
+Precedes Rail-RNA-tsv
+
+Reducer for MapReduce pipelines that formats and compresses shards of
+cross-sample tables storing coverages of junctions, insertions, and deletions
+across samples. A shard spans a region of the genome (see bed_pre.py), so
+shards are compressed by many tasks at once. Each shard is divided into chunks
+of whole lines, and each chunk is compressed into BGZF blocks (see bgzf.py)
+that Rail-RNA-tsv concatenates without recompressing them.
+
+Input (read from stdin)
+----------------------------
+Tab-delimited output tuple columns (collect)
+1. '0' if insertion, '1' if deletion, '2' if junction line, '3'
+    if normalization factor
+2. Shard; '\x1c' if field 1 is '3'
+3. Number string representing RNAME (+ '+ or -' if junction; same as field 7)
+    or sample index if field 1 is '3'
+4. Start position (Last base before insertion, first base of deletion,
+                    or first base of intron)
+    or '\x1c' if field 1 is '3'
+5. End position (Last base before insertion, last base of deletion (exclusive),
+                    or last base of intron (INCLUSIVE))
+    or '\x1c' if field 1 is '3'
+6. '+' or '-' indicating which strand is the sense strand for junctions,
+   inserted sequence for insertions, or deleted sequence for deletions
+   or '\x1c' if field 1 is '3'
+7. Coverage of feature for sample with index N
+    or normalization factor
+...
+N + 7. Coverage of feature in sample with index N
+
+Input is partitioned by fields 1-2 and sorted by fields 3-6, with positions
+(fields 4-5) compared numerically.
+
+Hadoop output (written to stdout)
+----------------------------
+Tab-delimited tuple columns, one line per chunk:
+1. '0' if insertion, '1' if deletion, '2' if junction line, '3'
+    if normalization factor
+2. Shard
+3. Index of chunk in shard, zero-padded
+4. RNAME of chunk's features or '\x1c' if field 1 is '3'
+5. Smallest start position among chunk's features or '\x1c' if field 1 is
+    '3'
+6. Largest start position among chunk's features or '\x1c' if field 1 is
+    '3'
+7. Base64-encoded BGZF blocks containing chunk's lines of TSV
+"""
+import os
+import sys
+import site
+import argparse
+import base64
+
+if '--test' in sys.argv:
+    print("No unit tests")
+    #unittest.main(argv=[sys.argv[0]])
+    sys.exit(0)
+
+base_path = os.path.abspath(
+                    os.path.dirname(os.path.dirname(os.path.dirname(
+                        os.path.realpath(__file__)))
+                    )
+                )
+utils_path = os.path.join(base_path, 'rna', 'utils')
+site.addsitedir(utils_path)
+site.addsitedir(base_path)
+
+from dooplicity.tools import xstream
+import bowtie
+import bowtie_index
+import manifest
+import bgzf
+
+# Print file's docstring if -h is invoked
+parser = argparse.ArgumentParser(description=__doc__,
+            formatter_class=argparse.RawDescriptionHelpFormatter)
+parser.add_argument('--manifest', type=str, required=False,
+        default='manifest',
+        help='Path to manifest file')
+parser.add_argument('--gzip-level', type=int, required=False,
+        default=3,
+        help='Level of gzip compression to use for TSVs')
+parser.add_argument(
+    '--keep-alive', action='store_const', const=True, default=False,
+    help='Prints reporter:status:alive messages to stderr to keep EMR '
+         'task alive')
+
+bowtie.add_args(parser)
+args = parser.parse_args()
+
+# Start keep_alive thread immediately
+if args.keep_alive:
+    from dooplicity.tools import KeepAlive
+    keep_alive_thread = KeepAlive(sys.stderr)
+    keep_alive_thread.start()
+
+import time
+start_time = time.time()
+
+reference_index = bowtie_index.BowtieIndexReference(
+                        os.path.expandvars(args.bowtie_idx)
+                    )
+# For mapping sample indices back to original sample labels
+manifest_object = manifest.LabelsAndIndices(
+                        os.path.expandvars(args.manifest)
+                    )
+sample_count = len(manifest_object.index_to_label)
+
+def write_chunk(line_type, shard, chunk_index, rname, min_start, max_start,
+                    lines):
+    """ Compresses a chunk of a shard and writes it to stdout.
+
+        line_type: '0', '1', '2', or '3'; see docstring
+        shard: shard
+        chunk_index: index of chunk in shard
+        rname: RNAME of chunk's features or '\x1c' for normalization factors
+        min_start: smallest start position among chunk's features or '\x1c'
+        max_start: largest start position among chunk's features or '\x1c'
+        lines: list of lines of TSV with newlines
+
+        No return value.
+    """
+    print '\t'.join([line_type, shard, '%09d' % chunk_index, rname,
+                        min_start, max_start,
+                        base64.b64encode(bgzf.compressed_blocks(
+                                ''.join(lines), args.gzip_level
+                            ))])
+
+input_line_count, chunk_count = 0, 0
+for (line_type, shard), xpartition in xstream(sys.stdin, 2):
+    chunk_index, lines, chunk_size = 0, [], 0
+    rname, min_start, max_start = '\x1c', None, None
+    for coverage_line in xpartition:
+        input_line_count += 1
+        if line_type != '3':
+            (rname_string, pos, end_pos, strand_or_seq) = coverage_line[:4]
+            rname = reference_index.string_to_rname[rname_string]
+            pos = str(int(pos))
+            '''Handle missing zeros at end of line here; in previous step,
+            the total number of samples was unknown, so this was not
+            done.'''
+            line = '\t'.join(
+                    (';'.join([rname, strand_or_seq, pos, str(int(end_pos))]),)
+                    + coverage_line[4:]
+                    + ('0',)*(-len(coverage_line) + 4 + sample_count)
+                ) + '\n'
+        else:
+            sample_index, _, _, _, factor, unique_factor = coverage_line
+            pos = '\x1c'
+            line = '\t'.join([
+                    manifest_object.index_to_label[sample_index],
+                    factor, unique_factor
+                ]) + '\n'
+        if lines and chunk_size + len(line) > bgzf.max_block_data_size:
+            write_chunk(line_type, shard, chunk_index, rname,
+                            str(min_start), str(max_start), lines)
+            chunk_index += 1
+            lines, chunk_size = [], 0
+        if line_type == '3':
+            min_start = max_start = pos
+        elif not lines:
+            min_start = max_start = int(pos)
+        else:
+            min_start = min(min_start, int(pos))
+            max_start = max(max_start, int(pos))
+        lines.append(line)
+        chunk_size += len(line)
+    if lines:
+        write_chunk(line_type, shard, chunk_index, rname, str(min_start),
+                        str(max_start), lines)
+        chunk_index += 1
+    chunk_count += chunk_index
+
+sys.stdout.flush()
+print >>sys.stderr, 'DONE with tsv_pre.py; in/out=%d/%d; time=%0.3f s' \
+                        % (input_line_count, chunk_count,
+                            time.time() - start_time)
@@ -16,9 +16,7 @@ import sys
 import bisect
 import partition
 import itertools
-import string
-
-_reversed_complement_translation_table = string.maketrans('ATCG', 'TAGC')
+from sequence_kernels import reversed_complement
 
 def add_args(parser):
     parser.add_argument('--tie-margin', type=int, required=False,
@@ -253,9 +251,7 @@ def multiread_to_report(multiread, alignment_count_to_report=1, seed=0,
         random.seed()
     else:
         read_seq = multiread[0][9]
-        reversed_complement_read_seq = multiread[0][9][::-1].translate(
-                        _reversed_complement_translation_table
-                    )
+        reversed_complement_read_seq = reversed_complement(multiread[0][9])
         if read_seq < reversed_complement_read_seq:
             read_seq_for_seed = read_seq
             qual_for_seed = multiread[0][10]
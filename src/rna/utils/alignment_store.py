@@ -0,0 +1,731 @@
+#!/usr/bin/env python
+"""
+alignment_store.py
+Part of Rail-RNA
+
+Persistent store of first-pass Bowtie 2 alignments shared across runs, so a
+read sequence aligned by one run needn't be realigned by the next run that
+uses the same index and Bowtie 2 arguments. A record's key is a digest of the
+sequence aligned and its quality string, since Bowtie 2's penalties depend on
+base qualities; its value is Bowtie 2's SAM output for the sequence, minus
+QNAMEs. Under --ignore-quals, alignments don't depend on qualities, so the key
+is a digest of the sequence alone: reads with the same sequence but different
+qualities then hit, and their own quality strings are written into the stored
+alignments.
+
+Records live in a subdirectory of the store directory named for a digest of
+the index, Bowtie 2's version, and the Bowtie 2 arguments that affect
+alignment (the namespace). Each task that aligns new sequences adds immutable
+runs of records sorted by key. A run is a series of zlib-compressed blocks of
+records followed by a sparse index holding the first key, offset, and size of
+every block and a fixed-size footer. Index entries have fixed width, so a
+lookup binary-searches the index in place through mmap and decompresses one
+block. When a namespace holds more than _max_runs runs, its smallest runs are
+merged; when the store exceeds its size bound, least recently used runs are
+evicted. Tasks coordinate with flock() as in index_cache.py.
+
+align_reads.py consults the store for each representative read sequence and
+writes a plan: the stored alignments of hits and the keys of misses, in read
+order. Only misses are sent to Bowtie 2, and merged_alignments() splices its
+output back into the plan's order for align_reads_delegate.py.
+"""
+import os
+import sys
+import fcntl
+import mmap
+import zlib
+import heapq
+import struct
+import hashlib
+import tempfile
+import time
+from itertools import groupby
+
+from index_cache import locked, file_digest
+
+_magic = 'RAILAS01'
+# Key, value size
+_record_header = struct.Struct('>16sI')
+# First key of block, offset of block, size of block
+_index_entry = struct.Struct('>16sQI')
+# Offset of index, number of blocks, magic
+_footer = struct.Struct('>QQ8s')
+# Uncompressed size at which a block is closed
+_block_size = 16384
+# Maximum number of records a task sorts in memory to write one run
+_run_records = 100000
+# A namespace with more runs than this is compacted
+_max_runs = 16
+# Partial runs older than this many seconds are from tasks that died
+_stale_run_age = 86400
+# Arguments that don't affect alignments
+_ignored_args = set(['--reorder', '-t', '--time', '--mm', '--quiet'])
+_ignored_args_with_values = set(['-p', '--threads'])
+
+def record_key(seq, qual=None):
+    """ Computes store key of a read sequence.
+
+        seq: read sequence
+        qual: quality string or None if Bowtie 2 ignores qualities
+
+        Return value: 16-byte key
+    """
+    if qual is None:
+        return hashlib.sha1(seq).digest()[:16]
+    return hashlib.sha1('\t'.join([seq, qual])).digest()[:16]
+
+def ignores_quals(bowtie2_args):
+    """ Checks whether Bowtie 2 ignores qualities when computing penalties.
+
+        bowtie2_args: string with arguments passed to Bowtie 2
+
+        Return value: True iff --ignore-quals is among bowtie2_args
+    """
+    return '--ignore-quals' in (bowtie2_args or '').split()
+
+def bowtie2_version(bowtie2_exe='bowtie2'):
+    """ Obtains Bowtie 2's version.
+
+        bowtie2_exe: path to Bowtie 2 executable
+
+        Return value: version string
+    """
+    import subprocess
+    return subprocess.check_output(
+                [bowtie2_exe, '--version']
+            ).split('\n', 1)[0].rpartition('version')[2].strip()
+
+def namespace(bowtie2_index_base, bowtie2_args, version):
+    """ Computes name of namespace holding alignments to an index.
+
+        An index is identified by the names and sizes of its files, the
+        contents of its .3.bt2 file, which encodes the reference names,
+        lengths, and stretches of Ns, and a digest of its .4.bt2 file, which
+        holds the packed bases of the reference. Two indexes of references
+        whose names and lengths agree but whose bases differ, like a genome
+        and a variant-substituted copy of it, thus get different namespaces.
+        The .4.bt2 file takes about a quarter of a byte per base, far less
+        than the Burrows-Wheeler transforms, which aren't hashed.
+
+        bowtie2_index_base: basename of Bowtie 2 index
+        bowtie2_args: string with arguments passed to Bowtie 2
+        version: Bowtie 2's version
+
+        Return value: hex digest
+    """
+    digest = hashlib.sha1()
+    index_dir = os.path.dirname(os.path.abspath(bowtie2_index_base))
+    index_name = os.path.basename(bowtie2_index_base) + '.'
+    for filename in sorted(os.listdir(index_dir)):
+        if not (filename.startswith(index_name) and (
+                    filename.endswith('.bt2') or filename.endswith('.bt2l')
+                )):
+            continue
+        path = os.path.join(index_dir, filename)
+        digest.update('%s\t%d\n' % (filename[len(index_name):],
+                                        os.path.getsize(path)))
+        if filename[len(index_name):] in ['3.bt2', '3.bt2l']:
+            with open(path, 'rb') as index_stream:
+                digest.update(index_stream.read())
+        elif filename[len(index_name):] in ['4.bt2', '4.bt2l']:
+            digest.update(file_digest(path))
+    args = []
+    tokens = (bowtie2_args or '').split()
+    i = 0
+    while i < len(tokens):
+        if tokens[i] in _ignored_args_with_values:
+            i += 2
+            continue
+        if tokens[i] not in _ignored_args:
+            args.append(tokens[i])
+        i += 1
+    digest.update('\t'.join(['version', version, 'args'] + args))
+    return digest.hexdigest()
+
+def write_run(records, run_file):
+    """ Writes records sorted by key to a run file.
+
+        The file is written under a temporary name in the same directory and
+        renamed, so readers never see a partial run.
+
+        records: iterable of tuples (key, value) sorted by key
+        run_file: path to run file
+
+        Return value: number of records written
+    """
+    fd, temp_file = tempfile.mkstemp(dir=os.path.dirname(run_file),
+                                        prefix='.run.')
+    record_count = 0
+    try:
+        with os.fdopen(fd, 'wb') as run_stream:
+            index, block, block_size, first_key = [], [], 0, None
+            offset = 0
+            for key, value in records:
+                if first_key is None:
+                    first_key = key
+                block.append(_record_header.pack(key, len(value)))
+                block.append(value)
+                block_size += _record_header.size + len(value)
+                record_count += 1
+                if block_size >= _block_size:
+                    compressed = zlib.compress(''.join(block))
+                    run_stream.write(compressed)
+                    index.append(_index_entry.pack(first_key, offset,
+                                                    len(compressed)))
+                    offset += len(compressed)
+                    block, block_size, first_key = [], 0, None
+            if block:
+                compressed = zlib.compress(''.join(block))
+                run_stream.write(compressed)
+                index.append(_index_entry.pack(first_key, offset,
+                                                len(compressed)))
+                offset += len(compressed)
+            run_stream.write(''.join(index))
+            run_stream.write(_footer.pack(offset, len(index), _magic))
+        os.rename(temp_file, run_file)
+    except:
+        try:
+            os.remove(temp_file)
+        except OSError:
+            pass
+        raise
+    return record_count
+
+class Run(object):
+    """ Read-only view of a run file. """
+
+    def __init__(self, run_file):
+        """
+            run_file: path to run file
+        """
+        self.run_file = run_file
+        with open(run_file, 'rb') as run_stream:
+            self._map = mmap.mmap(run_stream.fileno(), 0,
+                                    access=mmap.ACCESS_READ)
+        self._index_offset, self.block_count, magic = _footer.unpack(
+                self._map[-_footer.size:]
+            )
+        if magic != _magic:
+            self._map.close()
+            raise ValueError('%s is not an alignment store run.' % run_file)
+
+    def _entry(self, block):
+        start = self._index_offset + block * _index_entry.size
+        return _index_entry.unpack(self._map[start:start + _index_entry.size])
+
+    def _records(self, block):
+        _, offset, size = self._entry(block)
+        data = zlib.decompress(self._map[offset:offset + size])
+        i = 0
+        while i < len(data):
+            key, value_size = _record_header.unpack_from(data, i)
+            i += _record_header.size
+            yield key, data[i:i + value_size]
+            i += value_size
+
+    def get(self, key):
+        """ Looks up a key.
+
+            key: 16-byte key
+
+            Return value: value of record with key or None if there is none
+        """
+        # Find last block whose first key is <= key
+        low, high = 0, self.block_count
+        while low < high:
+            middle = (low + high) // 2
+            if self._entry(middle)[0] <= key:
+                low = middle + 1
+            else:
+                high = middle
+        if not low:
+            return None
+        for record_key, value in self._records(low - 1):
+            if record_key == key:
+                return value
+            if record_key > key:
+                break
+        return None
+
+    def __iter__(self):
+        for block in xrange(self.block_count):
+            for record in self._records(block):
+                yield record
+
+    def close(self):
+        self._map.close()
+
+def _run_files(namespace_dir):
+    """ Lists a namespace's run files from oldest to newest.
+
+        namespace_dir: directory of namespace
+
+        Return value: list of paths to run files
+    """
+    try:
+        names = os.listdir(namespace_dir)
+    except OSError:
+        return []
+    return [os.path.join(namespace_dir, name)
+                for name in sorted(names) if name.startswith('run.')]
+
+def _new_run_file(namespace_dir):
+    """ Names a new run file so names sort by time of creation.
+
+        namespace_dir: directory of namespace
+
+        Return value: path to run file
+    """
+    return os.path.join(namespace_dir, 'run.%017.6f.%d.%s' % (
+                                time.time(), os.getpid(),
+                                os.urandom(4).encode('hex')
+                            ))
+
+class AlignmentStore(object):
+    """ Size-bounded persistent store of Bowtie 2 alignments. """
+
+    def __init__(self, store_dir, namespace, max_bytes, counter=None):
+        """
+            store_dir: directory in which to store alignments; it's created if
+                it doesn't exist
+            namespace: name of namespace from namespace()
+            max_bytes: maximum total size of all namespaces' runs
+            counter: dooplicity.counters.Counter object to which store hits
+                and misses are added or None if they shouldn't be counted
+        """
+        self.store_dir = store_dir
+        self.namespace_dir = os.path.join(store_dir, namespace)
+        self.max_bytes = max_bytes
+        self.counter = counter
+        try:
+            os.makedirs(self.namespace_dir)
+        except OSError:
+            if not os.path.isdir(self.namespace_dir):
+                raise
+        self.lock_file = os.path.join(self.store_dir, '.lock')
+        # Newest first, so recent alignments shadow old ones
+        self._runs = []
+        for run_file in reversed(_run_files(self.namespace_dir)):
+            try:
+                self._runs.append(Run(run_file))
+            except (IOError, OSError, ValueError, struct.error):
+                # Evicted or compacted away since it was listed
+                pass
+        self._used = set()
+
+    def _count(self, name):
+        if self.counter is not None:
+            self.counter.add(name, 1)
+
+    def get(self, key):
+        """ Looks up alignments of a read sequence.
+
+            key: key from record_key()
+
+            Return value: concatenated newline-terminated SAM lines without
+                QNAMEs or None if the sequence isn't in the store
+        """
+        for run in self._runs:
+            value = run.get(key)
+            if value is not None:
+                self._used.add(run.run_file)
+                self._count('alignment store hits')
+                return value
+        self._count('alignment store misses')
+        return None
+
+    def add(self, records):
+        """ Adds records to the store.
+
+            Records are sorted in chunks of at most _run_records, and each
+            chunk is written as a run. Then the namespace is compacted and
+            the store is shrunk to its size bound.
+
+            records: iterable of tuples (key, value)
+
+            No return value.
+        """
+        chunk = []
+        for record in records:
+            chunk.append(record)
+            if len(chunk) >= _run_records:
+                chunk.sort()
+                write_run(chunk, _new_run_file(self.namespace_dir))
+                chunk = []
+        if chunk:
+            chunk.sort()
+            write_run(chunk, _new_run_file(self.namespace_dir))
+        self.compact()
+        with locked(self.lock_file):
+            self.evict()
+
+    def compact(self):
+        """ Merges a namespace's smallest runs if it holds too many.
+
+            Returns immediately if another task is compacting the namespace.
+            Where merged runs share a key, the newest run's value is kept.
+
+            No return value.
+        """
+        fd = os.open(os.path.join(self.namespace_dir, '.compact.lock'),
+                        os.O_RDWR | os.O_CREAT, 0644)
+        try:
+            try:
+                fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except IOError:
+                return
+            run_files = _run_files(self.namespace_dir)
+            if len(run_files) <= _max_runs:
+                return
+            ages = dict([(run_file, i) for i, run_file
+                            in enumerate(reversed(run_files))])
+            to_merge = sorted(run_files,
+                                key=os.path.getsize)[:len(run_files)
+                                                        - _max_runs // 2]
+            runs = [Run(run_file) for run_file in to_merge]
+            try:
+                def keyed(run, age):
+                    for key, value in run:
+                        yield key, age, value
+                def newest(merged):
+                    for key, records in groupby(merged,
+                                                key=lambda record: record[0]):
+                        yield key, next(records)[2]
+                '''Name merged run so it sorts right after the newest run it
+                replaces and is still shadowed by runs added after that.'''
+                write_run(newest(heapq.merge(*[keyed(run, ages[run.run_file])
+                                                for run in runs])),
+                          max(to_merge) + '.c')
+            finally:
+                for run in runs:
+                    run.close()
+            for run_file in to_merge:
+                try:
+                    os.remove(run_file)
+                except OSError:
+                    pass
+        finally:
+            os.close(fd)
+
+    def evict(self):
+        """ Evicts least recently used runs until store fits its bound.
+
+            Should be called only while holding the store's lock. Tasks
+            reading an evicted run keep reading it until they close it.
+
+            No return value.
+        """
+        runs = []
+        for name in os.listdir(self.store_dir):
+            namespace_dir = os.path.join(self.store_dir, name)
+            if name.startswith('.') or not os.path.isdir(namespace_dir):
+                continue
+            for run_name in os.listdir(namespace_dir):
+                path = os.path.join(namespace_dir, run_name)
+                try:
+                    if run_name.startswith('.run.'):
+                        if (time.time() - os.path.getmtime(path)
+                                > _stale_run_age):
+                            os.remove(path)
+                        continue
+                    if run_name.startswith('run.'):
+                        runs.append((os.path.getmtime(path), path,
+                                        os.path.getsize(path)))
+                except OSError:
+                    pass
+        total_size = sum([size for _, _, size in runs])
+        runs.sort()
+        for _, path, size in runs:
+            if total_size <= self.max_bytes:
+                break
+            try:
+                os.remove(path)
+            except OSError:
+                pass
+            total_size -= size
+
+    def close(self):
+        """ Marks runs that served hits as recently used and closes runs.
+
+            No return value.
+        """
+        for run_file in self._used:
+            try:
+                os.utime(run_file, None)
+            except OSError:
+                pass
+        for run in self._runs:
+            run.close()
+        self._runs, self._used = [], set()
+
+def plan_hit(plan_stream, qname, alignments, qual=None):
+    """ Writes stored alignments of a read sequence to a plan.
+
+        plan_stream: where to write plan
+        qname: QNAME of read sequence's representative
+        alignments: value from AlignmentStore.get()
+        qual: representative's quality string, which replaces QUAL in
+            alignments, or None if alignments should be written as stored
+
+        No return value.
+    """
+    plan_stream.write('+\t%s\t%d\n' % (qname, alignments.count('\n')))
+    if qual is None:
+        plan_stream.write(alignments)
+        return
+    reversed_qual = qual[::-1]
+    for alignment in alignments.splitlines():
+        tokens = alignment.split('\t')
+        if tokens[9] != '*':
+            # QNAME is omitted, so QUAL is the tenth field
+            tokens[9] = reversed_qual if int(tokens[0]) & 16 else qual
+        plan_stream.write('\t'.join(tokens) + '\n')
+
+def plan_miss(plan_stream, key):
+    """ Writes to a plan that a read sequence is aligned by Bowtie 2.
+
+        plan_stream: where to write plan
+        key: key from record_key()
+
+        No return value.
+    """
+    plan_stream.write('-\t%s\n' % key.encode('hex'))
+
+def merged_alignments(input_stream, plan_stream, new_stream=None):
+    """ Splices Bowtie 2 output for misses into stored alignments for hits.
+
+        input_stream: Bowtie 2 SAM output for misses, in plan order
+        plan_stream: plan from plan_hit() and plan_miss()
+        new_stream: where to write alignments of misses for
+            stored_records() or None if they shouldn't be written
+
+        Yield value: SAM line for every read sequence in the plan, in plan
+            order
+    """
+    sam_groups = groupby(input_stream,
+                            key=lambda line: line.partition('\t')[0])
+    plan_lines = iter(plan_stream)
+    for line in plan_lines:
+        tokens = line.rstrip('\n').split('\t')
+        if tokens[0] == '+':
+            qname = tokens[1]
+            for _ in xrange(int(tokens[2])):
+                yield '\t'.join([qname, next(plan_lines)])
+        else:
+            _, sam_lines = next(sam_groups)
+            sam_lines = list(sam_lines)
+            if new_stream is not None:
+                new_stream.write('%s\t%d\n' % (tokens[1], len(sam_lines)))
+                for sam_line in sam_lines:
+                    new_stream.write(sam_line.partition('\t')[2])
+            for sam_line in sam_lines:
+                yield sam_line
+    if next(sam_groups, None) is not None:
+        raise RuntimeError('Bowtie 2 output has more reads than plan.')
+
+def stored_records(new_stream):
+    """ Reads alignments of misses written by merged_alignments().
+
+        new_stream: where to read alignments
+
+        Yield value: tuple (key, value) for AlignmentStore.add()
+    """
+    new_lines = iter(new_stream)
+    for line in new_lines:
+        key, count = line.rstrip('\n').split('\t')
+        yield (key.decode('hex'),
+                ''.join([next(new_lines) for _ in xrange(int(count))]))
+
+if __name__ == '__main__':
+    import unittest
+    import shutil
+    from StringIO import StringIO
+    site_path = os.path.dirname(os.path.dirname(os.path.dirname(
+                        os.path.realpath(__file__)
+                    )))
+    sys.path.insert(0, site_path)
+    from dooplicity.counters import Counter
+
+    def sam_lines(qname, seq, qual, count=1):
+        """ Fakes Bowtie 2 output for a read; QNAMEs are omitted if qname
+            is None. """
+        return ''.join([('' if qname is None else qname + '\t')
+                            + '%d\tchr1\t%d\t255\t%dM\t*\t0\t0\t%s\t%s\n'
+                            % (i * 256, len(seq) + i, len(seq), seq, qual)
+                            for i in xrange(count)])
+
+    class TestAlignmentStore(unittest.TestCase):
+        """ Tests AlignmentStore and plan merging. """
+        def setUp(self):
+            self.temp_dir_path = tempfile.mkdtemp()
+            self.store_dir = os.path.join(self.temp_dir_path, 'store')
+            self.counter = Counter('align_reads', StringIO())
+
+        def test_namespace(self):
+            """ Fails if irrelevant arguments change namespace. """
+            index_base = os.path.join(self.temp_dir_path, 'genome')
+            for extension, contents in [('.3.bt2', 'chr1'),
+                                        ('.4.bt2', 'ACGT')]:
+                with open(index_base + extension, 'w') as index_stream:
+                    index_stream.write(contents)
+            self.assertEqual(namespace(index_base, '-k 5 -p 8 --reorder',
+                                            '2.2.5'),
+                             namespace(index_base, '-k 5', '2.2.5'))
+            self.assertNotEqual(namespace(index_base, '-k 5', '2.2.5'),
+                                namespace(index_base, '-k 6', '2.2.5'))
+            self.assertNotEqual(namespace(index_base, '-k 5', '2.2.5'),
+                                namespace(index_base, '-k 5', '2.2.6'))
+            before = namespace(index_base, '-k 5', '2.2.5')
+            with open(index_base + '.3.bt2', 'w') as index_stream:
+                index_stream.write('chr2')
+            self.assertNotEqual(namespace(index_base, '-k 5', '2.2.5'),
+                                before)
+
+        def test_namespace_bases(self):
+            """ Fails if indexes differing only in bases share a namespace.
+            """
+            index_base = os.path.join(self.temp_dir_path, 'genome')
+            with open(index_base + '.3.bt2', 'w') as index_stream:
+                index_stream.write('chr1')
+            with open(index_base + '.4.bt2', 'w') as index_stream:
+                index_stream.write('ACGT')
+            before = namespace(index_base, '-k 5', '2.2.5')
+            with open(index_base + '.4.bt2', 'w') as index_stream:
+                index_stream.write('ACTT')
+            self.assertNotEqual(namespace(index_base, '-k 5', '2.2.5'),
+                                before)
+
+        def test_hits_and_misses(self):
+            """ Fails if added records aren't found. """
+            records = dict([(record_key('ACGT' * i, 'I' * (4 * i)),
+                                sam_lines(None, 'ACGT' * i, 'I' * (4 * i),
+                                            i % 3 + 1))
+                            for i in xrange(1, 3000)])
+            store = AlignmentStore(self.store_dir, 'ns', 10 ** 9,
+                                    self.counter)
+            store.add(records.items()[:1000])
+            store.close()
+            store = AlignmentStore(self.store_dir, 'ns', 10 ** 9,
+                                    self.counter)
+            store.add(records.items()[1000:])
+            store.close()
+            store = AlignmentStore(self.store_dir, 'ns', 10 ** 9,
+                                    self.counter)
+            for key, value in records.items():
+                self.assertEqual(store.get(key), value)
+            self.assertEqual(store.get(record_key('A', 'I')), None)
+            self.assertEqual(AlignmentStore(
+                    self.store_dir, 'other', 10 ** 9
+                ).get(records.keys()[0]), None)
+            store.close()
+            self.assertEqual(self.counter.get('alignment store hits'),
+                                len(records))
+            self.assertEqual(self.counter.get('alignment store misses'), 1)
+
+        def test_compaction(self):
+            """ Fails if compaction loses records or leaves too many runs. """
+            store = AlignmentStore(self.store_dir, 'ns', 10 ** 9)
+            for i in xrange(_max_runs + 1):
+                store.add([(record_key(str(i), ''), 'old\n'),
+                           (record_key('shared', ''), '%d\n' % i)])
+            run_files = _run_files(store.namespace_dir)
+            self.assertTrue(len(run_files) <= _max_runs)
+            store.close()
+            store = AlignmentStore(self.store_dir, 'ns', 10 ** 9)
+            for i in xrange(_max_runs + 1):
+                self.assertEqual(store.get(record_key(str(i), '')), 'old\n')
+            self.assertEqual(store.get(record_key('shared', '')),
+                                '%d\n' % _max_runs)
+            store.close()
+
+        def test_eviction(self):
+            """ Fails if least recently used runs aren't evicted. """
+            store = AlignmentStore(self.store_dir, 'ns', 10 ** 9)
+            for i in xrange(3):
+                store.add([(record_key(str(i), ''), 'x' * 1000)])
+            run_files = _run_files(store.namespace_dir)
+            for i, run_file in enumerate(run_files):
+                os.utime(run_file, (0, 1000 * (i + 1)))
+            store.close()
+            store = AlignmentStore(self.store_dir, 'ns', 10 ** 9)
+            self.assertTrue(store.get(record_key('0', '')) is not None)
+            store.close()
+            store = AlignmentStore(self.store_dir, 'ns',
+                                    2 * os.path.getsize(run_files[0]) + 1)
+            store.add([])
+            store.close()
+            store = AlignmentStore(self.store_dir, 'ns', 10 ** 9)
+            self.assertTrue(store.get(record_key('0', '')) is not None)
+            self.assertTrue(store.get(record_key('1', '')) is None)
+            self.assertTrue(store.get(record_key('2', '')) is not None)
+            store.close()
+
+        def test_merged_alignments(self):
+            """ Fails if plan and Bowtie 2 output aren't spliced in order. """
+            reads = [('0\x1dread%d' % i, 'ACGTA' * (i + 1), 'I' * 5 * (i + 1),
+                        i % 2 + 1) for i in xrange(6)]
+            store = AlignmentStore(self.store_dir, 'ns', 10 ** 9)
+            store.add([(record_key(seq, qual),
+                            sam_lines(None, seq, qual, count))
+                        for _, seq, qual, count in reads[::2]])
+            plan_stream, bowtie_output = StringIO(), []
+            for qname, seq, qual, count in reads:
+                key = record_key(seq, qual)
+                alignments = store.get(key)
+                if alignments is None:
+                    plan_miss(plan_stream, key)
+                    bowtie_output.append(sam_lines(qname, seq, qual, count))
+                else:
+                    plan_hit(plan_stream, qname, alignments)
+            store.close()
+            plan_stream.seek(0)
+            new_stream = StringIO()
+            self.assertEqual(
+                    ''.join(merged_alignments(
+                            StringIO(''.join(bowtie_output)), plan_stream,
+                            new_stream
+                        )),
+                    ''.join([sam_lines(*read) for read in reads])
+                )
+            new_stream.seek(0)
+            store = AlignmentStore(self.store_dir, 'ns', 10 ** 9)
+            store.add(stored_records(new_stream))
+            store.close()
+            store = AlignmentStore(self.store_dir, 'ns', 10 ** 9)
+            for _, seq, qual, count in reads:
+                self.assertEqual(store.get(record_key(seq, qual)),
+                                 sam_lines(None, seq, qual, count))
+            store.close()
+
+        def test_ignore_quals(self):
+            """ Fails if qualities aren't ignored under --ignore-quals. """
+            self.assertFalse(ignores_quals('-k 5 --local'))
+            self.assertTrue(ignores_quals('-k 5 --ignore-quals'))
+            self.assertNotEqual(record_key('ACGT', 'IIII'),
+                                record_key('ACGT', 'IIIH'))
+            self.assertEqual(record_key('ACGT'), record_key('ACGT'))
+            self.assertNotEqual(record_key('ACGT'), record_key('ACGA'))
+            store = AlignmentStore(self.store_dir, 'ns', 10 ** 9)
+            stored = sam_lines(None, 'ACGT', 'ABCD', 2).replace(
+                                    '256\t', '272\t'
+                                ) + '4\t*\t0\t0\t*\t*\t0\t0\tACGT\t*\n'
+            store.add([(record_key('ACGT'), stored)])
+            store.close()
+            store = AlignmentStore(self.store_dir, 'ns', 10 ** 9)
+            plan_stream = StringIO()
+            plan_hit(plan_stream, 'read', store.get(record_key('ACGT')),
+                        'WXYZ')
+            store.close()
+            plan_stream.seek(0)
+            self.assertEqual(
+                    [line.split('\t')[:2] + line.split('\t')[9:11]
+                        for line in merged_alignments([], plan_stream)],
+                    [['read', '0', 'ACGT', 'WXYZ\n'],
+                     ['read', '272', 'ACGT', 'ZYXW\n'],
+                     ['read', '4', 'ACGT', '*\n']]
+                )
+
+        def tearDown(self):
+            shutil.rmtree(self.temp_dir_path)
+
+    unittest.main(argv=[sys.argv[0]])
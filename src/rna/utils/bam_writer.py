@@ -0,0 +1,573 @@
+#!/usr/bin/env python
+"""
+bam_writer.py
+Part of Rail-RNA
+
+Writes BAM files and their BAI indexes from SAM fields without a samtools
+subprocess. Records are encoded straight from the fields Rail-RNA already
+holds rather than formatted as SAM text to be parsed again, BGZF blocks are
+compressed on a pool of threads (see bgzf.py), and the index is built as
+records are written, so no second pass over a finished BAM is needed.
+Records must be written in coordinate order for the index to be valid.
+
+The BAM and BAI formats are described in the SAM specification at
+https://samtools.github.io/hts-specs/SAMv1.pdf .
+"""
+import struct
+import re
+import string
+from binascii import unhexlify
+import bgzf
+
+_cigar_ops = dict((op, i) for i, op in enumerate('MIDNSHP=X'))
+# Operations that consume the reference
+_reference_ops = set('MDN=X')
+_cigar_pattern = re.compile(r'(\d+)([MIDNSHP=X])')
+# Bases to their 4-bit codes as hex digits, so unhexlify() packs sequences
+_seq_codes = '=ACMGRSVTWYHKDBN'
+_seq_translation_table = string.maketrans(_seq_codes + _seq_codes.lower(),
+                                          '0123456789abcdef' * 2)
+_qual_translation_table = string.maketrans(
+                                ''.join([chr(i) for i in xrange(33, 127)]),
+                                ''.join([chr(i) for i in xrange(94)])
+                            )
+_record = struct.Struct('<iiiBBHHHiiii')
+_int32 = struct.Struct('<i')
+_uint32 = struct.Struct('<I')
+_uint64 = struct.Struct('<Q')
+_chunk = struct.Struct('<QQ')
+_array_types = {'c' : 'b', 'C' : 'B', 's' : 'h', 'S' : 'H', 'i' : 'i',
+                'I' : 'I', 'f' : 'f'}
+# Bin holding metadata of each reference in index
+_metadata_bin = 37450
+_linear_shift = 14
+
+def reg2bin(beg, end):
+    """ Computes smallest UCSC bin containing an interval.
+
+        Copied from the SAM spec.
+
+        beg: 0-based start of interval (inclusive)
+        end: 0-based end of interval (exclusive)
+
+        Return value: bin
+    """
+    end -= 1
+    if beg >> 14 == end >> 14: return ((1 << 15) - 1) // 7 + (beg >> 14)
+    if beg >> 17 == end >> 17: return ((1 << 12) - 1) // 7 + (beg >> 17)
+    if beg >> 20 == end >> 20: return ((1 << 9) - 1) // 7 + (beg >> 20)
+    if beg >> 23 == end >> 23: return ((1 << 6) - 1) // 7 + (beg >> 23)
+    if beg >> 26 == end >> 26: return ((1 << 3) - 1) // 7 + (beg >> 26)
+    return 0
+
+def reg2bins(beg, end):
+    """ Computes every UCSC bin that may overlap an interval.
+
+        Copied from the SAM spec.
+
+        beg: 0-based start of interval (inclusive)
+        end: 0-based end of interval (exclusive)
+
+        Return value: list of bins
+    """
+    end -= 1
+    bins = [0]
+    for first, shift in [(1, 26), (9, 23), (73, 20), (585, 17),
+                         (4681, 14)]:
+        bins.extend(xrange(first + (beg >> shift), first + (end >> shift) + 1))
+    return bins
+
+def tag_bytes(tag):
+    """ Encodes an optional field of a SAM record.
+
+        Integers are stored in the smallest type that holds them, as
+        samtools does.
+
+        tag: optional field as in SAM, e.g., NM:i:2
+
+        Return value: encoded field
+    """
+    name, value_type, value = tag[:2], tag[3], tag[5:]
+    if value_type == 'i':
+        value = int(value)
+        if value < 0:
+            if value >= -0x80:
+                return name + 'c' + struct.pack('<b', value)
+            if value >= -0x8000:
+                return name + 's' + struct.pack('<h', value)
+            return name + 'i' + _int32.pack(value)
+        if value <= 0xff:
+            return name + 'C' + chr(value)
+        if value <= 0xffff:
+            return name + 'S' + struct.pack('<H', value)
+        return name + 'I' + _uint32.pack(value)
+    if value_type == 'A':
+        return name + 'A' + value
+    if value_type in 'ZH':
+        return name + value_type + value + '\x00'
+    if value_type == 'f':
+        return name + 'f' + struct.pack('<f', float(value))
+    if value_type == 'B':
+        values = value.split(',')
+        subtype, values = values[0], values[1:]
+        return ''.join([name, 'B', subtype, _int32.pack(len(values)),
+                        struct.pack('<%d%s' % (len(values),
+                                                _array_types[subtype]),
+                                    *[(float(item) if subtype == 'f'
+                                        else int(item))
+                                        for item in values])])
+    raise ValueError('Optional field "%s" has unknown type.' % tag)
+
+class SamWriter(object):
+    """ Writes SAM records as text; interface matches BamWriter's. """
+    def __init__(self, output_stream, header):
+        """
+            output_stream: where to write SAM
+            header: SAM header without trailing newline
+        """
+        self.output_stream = output_stream
+        print >>self.output_stream, header
+
+    def write(self, fields):
+        """ Writes a record.
+
+            fields: list of SAM fields
+
+            No return value.
+        """
+        print >>self.output_stream, '\t'.join(fields)
+
+    def close(self):
+        """ Leaves output stream open; present to match BamWriter. """
+        pass
+
+class BamWriter(object):
+    """ Writes a BAM file and, optionally, its BAI index. """
+    def __init__(self, filename, header, rnames, rname_lengths,
+                    index_filename=None, level=6, threads=1):
+        """
+            filename: path to BAM to write
+            header: SAM header without trailing newline
+            rnames: list of RNAMEs in order of @SQ lines of header
+            rname_lengths: dictionary mapping RNAMEs to their lengths
+            index_filename: path to BAI to write or None if there should be
+                no index
+            level: zlib compression level
+            threads: number of threads on which to compress BGZF blocks
+        """
+        self.output_stream = open(filename, 'wb')
+        self.bgzf_writer = bgzf.Writer(self.output_stream, level=level,
+                                        threads=threads)
+        self.reference_ids = dict((rname, i)
+                                    for i, rname in enumerate(rnames))
+        self.index_filename = index_filename
+        self.bgzf_writer.write(''.join(
+                ['BAM\x01', _int32.pack(len(header)), header,
+                 _int32.pack(len(rnames))]
+                + [_int32.pack(len(rname) + 1) + rname + '\x00'
+                    + _int32.pack(rname_lengths[rname]) for rname in rnames]
+            ))
+        # Start a new block for records, as samtools does
+        self.bgzf_writer.flush()
+        if index_filename is not None:
+            '''Per reference: dictionary mapping bins to lists of chunks
+            [start position, end position]; linear index as list of
+            positions; list [start of first record, end of last record,
+            mapped count, unmapped count]. Positions are those of the BGZF
+            writer and are converted to virtual offsets on close.'''
+            self._bins = [{} for _ in rnames]
+            self._linear_index = [[] for _ in rnames]
+            self._metadata = [None for _ in rnames]
+            self._no_coordinate_count = 0
+        self.closed = False
+
+    def write(self, fields):
+        """ Writes a record.
+
+            fields: list of SAM fields: QNAME, FLAG, RNAME, POS, MAPQ, CIGAR,
+                RNEXT, PNEXT, TLEN, SEQ, QUAL, and optional fields
+
+            No return value.
+        """
+        (qname, flag, rname, pos, mapq, cigar, rnext, pnext, tlen, seq,
+            qual) = fields[:11]
+        flag = int(flag)
+        reference_id = self.reference_ids.get(rname, -1)
+        pos = int(pos) - 1
+        if cigar == '*':
+            cigar_ops, reference_length = [], 0
+        else:
+            cigar_ops = _cigar_pattern.findall(cigar)
+            reference_length = sum([int(size) for size, op in cigar_ops
+                                        if op in _reference_ops])
+        end = pos + (reference_length or 1)
+        if rnext == '=':
+            next_reference_id = reference_id
+        else:
+            next_reference_id = self.reference_ids.get(rnext, -1)
+        if seq == '*':
+            seq_size, packed_seq = 0, ''
+        else:
+            seq_size = len(seq)
+            packed_seq = unhexlify(seq.translate(_seq_translation_table)
+                                    + ('0' if seq_size & 1 else ''))
+        if qual == '*':
+            qual = '\xff' * seq_size
+        else:
+            qual = qual.translate(_qual_translation_table)
+        data = ''.join(
+                [qname, '\x00']
+                + [_uint32.pack((int(size) << 4) | _cigar_ops[op])
+                    for size, op in cigar_ops]
+                + [packed_seq, qual]
+                + [tag_bytes(tag) for tag in fields[11:]]
+            )
+        bin = reg2bin(pos, end) if pos >= 0 else 4680
+        record = _record.pack(
+                    _record.size - 4 + len(data), reference_id, pos,
+                    len(qname) + 1, int(mapq), bin, len(cigar_ops), flag,
+                    seq_size, next_reference_id, int(pnext) - 1, int(tlen)
+                ) + data
+        self.bgzf_writer.make_room(len(record))
+        start = self.bgzf_writer.position()
+        self.bgzf_writer.write(record)
+        if self.index_filename is None:
+            return
+        if reference_id < 0:
+            self._no_coordinate_count += 1
+            return
+        end_position = self.bgzf_writer.position()
+        chunks = self._bins[reference_id].setdefault(bin, [])
+        if chunks and chunks[-1][1] == start:
+            chunks[-1][1] = end_position
+        else:
+            chunks.append([start, end_position])
+        linear_index = self._linear_index[reference_id]
+        last_window = (end - 1) >> _linear_shift
+        if len(linear_index) <= last_window:
+            linear_index.extend(
+                    [None] * (last_window + 1 - len(linear_index))
+                )
+        for window in xrange(pos >> _linear_shift, last_window + 1):
+            if linear_index[window] is None:
+                linear_index[window] = start
+        metadata = self._metadata[reference_id]
+        if metadata is None:
+            metadata = self._metadata[reference_id] = [start, None, 0, 0]
+        metadata[1] = end_position
+        if flag & 4:
+            metadata[3] += 1
+        else:
+            metadata[2] += 1
+
+    def _write_index(self):
+        """ Writes BAI index. No return value. """
+        virtual_offset = self.bgzf_writer.virtual_offset
+        with open(self.index_filename, 'wb') as index_stream:
+            index_stream.write('BAI\x01' + _int32.pack(len(self._bins)))
+            for bins, linear_index, metadata in zip(self._bins,
+                                                    self._linear_index,
+                                                    self._metadata):
+                index_stream.write(_int32.pack(len(bins)
+                                        + (metadata is not None)))
+                for bin in sorted(bins):
+                    chunks = bins[bin]
+                    index_stream.write(_uint32.pack(bin)
+                                        + _int32.pack(len(chunks)))
+                    for start, end in chunks:
+                        index_stream.write(_chunk.pack(virtual_offset(start),
+                                                        virtual_offset(end)))
+                if metadata is not None:
+                    index_stream.write(
+                            _uint32.pack(_metadata_bin) + _int32.pack(2)
+                            + _chunk.pack(virtual_offset(metadata[0]),
+                                            virtual_offset(metadata[1]))
+                            + _chunk.pack(metadata[2], metadata[3])
+                        )
+                index_stream.write(_int32.pack(len(linear_index)))
+                # Windows no record overlaps take the previous window's offset
+                offset = 0
+                for position in linear_index:
+                    if position is not None:
+                        offset = virtual_offset(position)
+                    index_stream.write(_uint64.pack(offset))
+            index_stream.write(_uint64.pack(self._no_coordinate_count))
+
+    def close(self):
+        """ Finishes BAM and writes index. No return value. """
+        if self.closed:
+            return
+        self.bgzf_writer.close()
+        self.output_stream.close()
+        if self.index_filename is not None:
+            self._write_index()
+        self.closed = True
+
+if __name__ == '__main__':
+    import sys
+    import os
+    import random
+    import shutil
+    import tempfile
+    import unittest
+    import gzip
+    import zlib
+
+    def parsed_bam(filename):
+        """ Decodes a BAM file written by BamWriter.
+
+            filename: path to BAM
+
+            Return value: tuple (header, list of RNAMEs, list of records as
+                lists of SAM fields)
+        """
+        data = gzip.open(filename).read()
+        assert data[:4] == 'BAM\x01'
+        header_size, = _int32.unpack_from(data, 4)
+        header = data[8:8+header_size]
+        offset = 8 + header_size
+        reference_count, = _int32.unpack_from(data, offset)
+        offset += 4
+        rnames = []
+        for _ in xrange(reference_count):
+            name_size, = _int32.unpack_from(data, offset)
+            rnames.append(data[offset+4:offset+3+name_size])
+            offset += 8 + name_size
+        records = []
+        while offset < len(data):
+            (block_size, reference_id, pos, name_size, mapq, _, cigar_count,
+                flag, seq_size, next_reference_id, next_pos,
+                tlen) = _record.unpack_from(data, offset)
+            end = offset + 4 + block_size
+            offset += _record.size
+            qname = data[offset:offset+name_size-1]
+            offset += name_size
+            cigar = ''.join(['%d%s' % (op >> 4, 'MIDNSHP=X'[op & 15])
+                                for op in struct.unpack_from(
+                                        '<%dI' % cigar_count, data, offset
+                                    )]) or '*'
+            offset += 4 * cigar_count
+            seq = ''.join([_seq_codes[ord(data[offset + i // 2])
+                                        >> (4 * (1 - i % 2)) & 15]
+                                for i in xrange(seq_size)]) or '*'
+            offset += (seq_size + 1) // 2
+            qual = data[offset:offset+seq_size]
+            if not qual or qual[0] == '\xff':
+                qual = '*'
+            else:
+                qual = ''.join([chr(ord(char) + 33) for char in qual])
+            offset += seq_size
+            tags = []
+            while offset < end:
+                name, value_type = data[offset:offset+2], data[offset+2]
+                offset += 3
+                if value_type in 'ZH':
+                    value_end = data.index('\x00', offset)
+                    tags.append('%s:%s:%s' % (name, value_type,
+                                                data[offset:value_end]))
+                    offset = value_end + 1
+                elif value_type == 'A':
+                    tags.append('%s:A:%s' % (name, data[offset]))
+                    offset += 1
+                elif value_type == 'B':
+                    subtype = data[offset]
+                    count, = _int32.unpack_from(data, offset + 1)
+                    values = struct.unpack_from(
+                            '<%d%s' % (count, _array_types[subtype]),
+                            data, offset + 5
+                        )
+                    tags.append('%s:B:%s' % (name, ','.join(
+                            [subtype] + [str(value) for value in values]
+                        )))
+                    offset += 5 + count * struct.calcsize(
+                                                _array_types[subtype]
+                                            )
+                else:
+                    type_format = '<' + _array_types.get(value_type, 'f')
+                    value, = struct.unpack_from(type_format, data, offset)
+                    tags.append('%s:%s:%s' % (name,
+                                              'f' if value_type == 'f'
+                                              else 'i', value))
+                    offset += struct.calcsize(type_format)
+            rname = rnames[reference_id] if reference_id >= 0 else '*'
+            if next_reference_id < 0:
+                rnext = '*'
+            elif next_reference_id == reference_id:
+                rnext = '='
+            else:
+                rnext = rnames[next_reference_id]
+            records.append([qname, str(flag), rname, str(pos + 1), str(mapq),
+                            cigar, rnext, str(next_pos + 1), str(tlen), seq,
+                            qual] + tags)
+        return header, rnames, records
+
+    def indexed_records(bam_file, index_file, rname_index, beg, end):
+        """ Finds records overlapping a region using only the index.
+
+            bam_file: path to BAM
+            index_file: path to BAI
+            rname_index: index of RNAME of region
+            beg: 0-based start of region (inclusive)
+            end: 0-based end of region (exclusive)
+
+            Return value: set of QNAMEs of records in chunks of bins that
+                overlap the region and that start at or after linear index's
+                offset
+        """
+        with open(index_file, 'rb') as index_stream:
+            index = index_stream.read()
+        with open(bam_file, 'rb') as bam_stream:
+            bam = bam_stream.read()
+        assert index[:4] == 'BAI\x01'
+        offset = 8
+        for i in xrange(rname_index + 1):
+            bins = {}
+            bin_count, = _int32.unpack_from(index, offset)
+            offset += 4
+            for _ in xrange(bin_count):
+                bin, chunk_count = struct.unpack_from('<Ii', index, offset)
+                offset += 8
+                bins[bin] = [_chunk.unpack_from(index, offset + 16 * j)
+                                for j in xrange(chunk_count)]
+                offset += 16 * chunk_count
+            interval_count, = _int32.unpack_from(index, offset)
+            linear_index = struct.unpack_from('<%dQ' % interval_count,
+                                                index, offset + 4)
+            offset += 4 + 8 * interval_count
+        min_offset = (linear_index[beg >> _linear_shift]
+                        if beg >> _linear_shift < len(linear_index) else 0)
+        qnames, blocks = set(), {}
+        for bin in reg2bins(beg, end):
+            for chunk_start, chunk_end in bins.get(bin, []):
+                chunk_start = max(chunk_start, min_offset)
+                while chunk_start < chunk_end:
+                    # Records written whole lie in one block
+                    block_offset = chunk_start >> 16
+                    if block_offset not in blocks:
+                        block_size = struct.unpack_from(
+                                        '<H', bam, block_offset + 16
+                                    )[0] + 1
+                        blocks[block_offset] = (block_size, zlib.decompress(
+                                bam[block_offset+18:block_offset+block_size-8],
+                                -zlib.MAX_WBITS
+                            ))
+                    block_size, data = blocks[block_offset]
+                    record_offset = chunk_start & 0xffff
+                    record_size, = _int32.unpack_from(data, record_offset)
+                    name_size = ord(data[record_offset + 12])
+                    qnames.add(data[record_offset+36:
+                                        record_offset+35+name_size])
+                    record_end = record_offset + 4 + record_size
+                    if record_end < len(data):
+                        chunk_start = (block_offset << 16) | record_end
+                    else:
+                        chunk_start = (block_offset + block_size) << 16
+        return qnames
+
+    from StringIO import StringIO
+
+    class TestBamWriter(unittest.TestCase):
+        """ Tests BamWriter by decoding its output. """
+        def setUp(self):
+            self.temp_dir_path = tempfile.mkdtemp()
+            random.seed(8)
+            self.rnames = ['chr1', 'chr2', 'chrM']
+            self.rname_lengths = {'chr1' : 2000000, 'chr2' : 300000,
+                                  'chrM' : 16000}
+            self.header = '\n'.join(
+                    ['@HD\tVN:1.0\tSO:coordinate']
+                    + ['@SQ\tSN:%s\tLN:%d' % (rname, self.rname_lengths[rname])
+                        for rname in self.rnames]
+                )
+            self.records = []
+            for rname in self.rnames:
+                positions = sorted([random.randint(1,
+                                        self.rname_lengths[rname] - 200)
+                                    for _ in xrange(1500)])
+                for i, pos in enumerate(positions):
+                    seq_size = random.randint(20, 101)
+                    if i % 3:
+                        cigar = '%dM' % seq_size
+                    else:
+                        cigar = '%dM%dN%dM' % (seq_size // 2,
+                                                random.randint(1, 40000),
+                                                seq_size - seq_size // 2)
+                    self.records.append([
+                            '%s_%d' % (rname, i), str(random.choice([0, 16,
+                                                                     256])),
+                            rname, str(pos), str(random.randint(0, 255)),
+                            cigar, random.choice(['=', '*', 'chr1']),
+                            str(random.randint(0, 1000)),
+                            str(random.randint(-500, 500)),
+                            ''.join([random.choice('ACGTN')
+                                        for _ in xrange(seq_size)]),
+                            ''.join([chr(random.randint(33, 74))
+                                        for _ in xrange(seq_size)]),
+                            'AS:i:%d' % random.randint(-300, 0),
+                            'XS:A:+', 'NM:i:%d' % random.randint(0, 70000),
+                            'MD:Z:%d' % seq_size
+                        ])
+            self.records.append(['unplaced', '4', '*', '0', '0', '*', '*',
+                                    '0', '0', 'ACGTA', '*', 'YF:Z:NS',
+                                    'ZB:B:s,-3,4,500', 'ZF:f:0.5'])
+            self.bam_file = os.path.join(self.temp_dir_path, 'test.bam')
+            self.index_file = self.bam_file + '.bai'
+
+        def write(self, threads):
+            bam_writer = BamWriter(self.bam_file, self.header, self.rnames,
+                                    self.rname_lengths,
+                                    index_filename=self.index_file,
+                                    level=3, threads=threads)
+            for record in self.records:
+                bam_writer.write(record)
+            bam_writer.close()
+
+        def test_records(self):
+            """ Fails if records don't decode to what was written. """
+            for threads in [1, 4]:
+                self.write(threads)
+                header, rnames, records = parsed_bam(self.bam_file)
+                self.assertEqual(header, self.header)
+                self.assertEqual(rnames, self.rnames)
+                self.assertEqual(len(records), len(self.records))
+                for record, expected in zip(records, self.records):
+                    if expected[6] == 'chr1' and expected[2] == 'chr1':
+                        expected = expected[:6] + ['='] + expected[7:]
+                    self.assertEqual(record, expected)
+
+        def test_index(self):
+            """ Fails if index misses records overlapping a region. """
+            self.write(3)
+            for _ in xrange(50):
+                rname_index = random.randint(0, 2)
+                rname = self.rnames[rname_index]
+                beg = random.randint(0, self.rname_lengths[rname] - 5000)
+                end = beg + random.randint(1, 5000)
+                expected = set()
+                for record in self.records:
+                    if record[2] != rname:
+                        continue
+                    pos = int(record[3]) - 1
+                    record_end = pos + sum([
+                            int(size) for size, op
+                            in _cigar_pattern.findall(record[5])
+                            if op in _reference_ops
+                        ])
+                    if pos < end and record_end > beg:
+                        expected.add(record[0])
+                found = indexed_records(self.bam_file, self.index_file,
+                                        rname_index, beg, end)
+                self.assertTrue(expected <= found)
+
+        def test_reg2bin(self):
+            """ Fails if bins differ from known values. """
+            self.assertEqual(reg2bin(0, 1), 4681)
+            self.assertEqual(reg2bin(16383, 16385), 585)
+            self.assertEqual(reg2bin(0, 1 << 29), 0)
+            self.assertTrue(reg2bin(100000, 100100)
+                                in reg2bins(100050, 100051))
+
+        def tearDown(self):
+            shutil.rmtree(self.temp_dir_path)
+
+    unittest.main(argv=[sys.argv[0]])
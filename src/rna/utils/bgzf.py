@@ -0,0 +1,408 @@
+#!/usr/bin/env python
+"""
+bgzf.py
+Part of Rail-RNA
+
+Writes and reads BGZF, the blocked gzip format of BAM files and tabix. A BGZF
+file is a series of gzip members ("blocks"), each holding at most 64 KB of
+uncompressed data and recording its own compressed size in a gzip extra
+field, followed by an empty block that marks the end of the file. Any gzip
+reader decompresses it as one stream; files are concatenated without
+recompression by dropping all but the last end-of-file block; and reading can
+start at the first byte of any block.
+
+Writer compresses blocks on a pool of threads, which zlib permits because it
+releases the GIL while compressing. Since block sizes are known only once
+blocks are compressed, Writer hands out positions (index of block, offset in
+block's uncompressed data) that are converted to BGZF virtual file offsets
+once the file is closed.
+
+Rail-RNA writes cross-sample TSVs this way so shards compressed by different
+tasks are concatenated into one file. Alongside each TSV is a region index
+with one line per chunk of blocks: the chunk's offset in the TSV, the RNAME
+of the features it holds, and the smallest and largest start positions of
+those features. A chunk holds only whole lines, so region_lines() seeks
+straight to the chunks that could hold features in a region.
+"""
+import struct
+import zlib
+import gzip
+from collections import deque
+
+# Largest amount of data compressed into one block, as in htslib
+max_block_data_size = 0xff00
+# Largest block
+_max_block_size = 0x10000
+# Empty block that ends a BGZF file
+eof_block = ('\x1f\x8b\x08\x04\x00\x00\x00\x00\x00\xff\x06\x00\x42\x43\x02'
+             '\x00\x1b\x00\x03\x00\x00\x00\x00\x00\x00\x00\x00\x00')
+# Gzip header with extra subfield BC holding block size - 1, as in SAM spec
+_header = struct.Struct('<4BI2BH2BHH')
+_trailer = struct.Struct('<II')
+
+def _block(data, level):
+    """ Compresses data into a single block.
+
+        data: at most max_block_data_size bytes
+        level: zlib compression level
+
+        Return value: block
+    """
+    compressor = zlib.compressobj(level, zlib.DEFLATED, -zlib.MAX_WBITS)
+    compressed = compressor.compress(data) + compressor.flush()
+    block_size = _header.size + len(compressed) + _trailer.size
+    if block_size > _max_block_size:
+        # Incompressible; split it
+        middle = len(data) // 2
+        return _block(data[:middle], level) + _block(data[middle:], level)
+    return ''.join([
+            _header.pack(31, 139, 8, 4, 0, 0, 255, 6, 66, 67, 2,
+                            block_size - 1),
+            compressed,
+            _trailer.pack(zlib.crc32(data) & 0xffffffff,
+                            len(data) & 0xffffffff)
+        ])
+
+def compressed_blocks(data, level=6):
+    """ Compresses data into as many blocks as it takes.
+
+        No end-of-file block is added.
+
+        data: string to compress
+        level: zlib compression level
+
+        Return value: concatenated blocks
+    """
+    return ''.join([_block(data[i:i+max_block_data_size], level)
+                    for i in xrange(0, len(data), max_block_data_size)])
+
+class Writer(object):
+    """ Writes a BGZF file, compressing blocks on a pool of threads. """
+    def __init__(self, output_stream, level=6, threads=1):
+        """
+            output_stream: binary stream to which to write blocks
+            level: zlib compression level
+            threads: number of threads on which to compress blocks; if 1,
+                blocks are compressed as they're filled
+        """
+        self.output_stream = output_stream
+        self.level = level
+        if threads > 1:
+            from multiprocessing.pool import ThreadPool
+            self._pool = ThreadPool(threads)
+        else:
+            self._pool = None
+        self._max_pending = 2 * threads
+        self._pending = deque()
+        self._buffer = []
+        self._buffer_size = 0
+        # Compressed offsets of blocks written, by block index
+        self._offsets = []
+        self._offset = 0
+        self.closed = False
+
+    def _write_blocks(self, blocks):
+        """ Writes compressed data of the next block index.
+
+            blocks: blocks
+
+            No return value.
+        """
+        self._offsets.append(self._offset)
+        self.output_stream.write(blocks)
+        self._offset += len(blocks)
+
+    def flush(self):
+        """ Ends the current block so the next write starts a new one.
+
+            Data exceeding max_block_data_size is split among several blocks
+            that share the same block index.
+
+            No return value.
+        """
+        if not self._buffer_size:
+            return
+        data = ''.join(self._buffer)
+        self._buffer, self._buffer_size = [], 0
+        if self._pool is None:
+            self._write_blocks(compressed_blocks(data, self.level))
+            return
+        self._pending.append(
+                self._pool.apply_async(compressed_blocks, (data, self.level))
+            )
+        while len(self._pending) > self._max_pending:
+            self._write_blocks(self._pending.popleft().get())
+
+    def make_room(self, size):
+        """ Ends the current block if it can't fit more data.
+
+            Call before position() and write() so that data isn't split
+            between blocks unless it's longer than max_block_data_size.
+
+            size: size of data to be written
+
+            No return value.
+        """
+        if (self._buffer_size
+                and self._buffer_size + size > max_block_data_size):
+            self.flush()
+
+    def write(self, data):
+        """ Writes data.
+
+            data: string
+
+            No return value.
+        """
+        self._buffer.append(data)
+        self._buffer_size += len(data)
+        if self._buffer_size >= max_block_data_size:
+            self.flush()
+
+    def position(self):
+        """ Gets position of the next byte written.
+
+            Return value: tuple (index of block, offset in block's
+                uncompressed data); pass to virtual_offset() after closing
+        """
+        return len(self._offsets) + len(self._pending), self._buffer_size
+
+    def virtual_offset(self, position):
+        """ Converts a position to a BGZF virtual file offset.
+
+            position: tuple returned by position()
+
+            Return value: virtual file offset
+        """
+        assert self.closed
+        return (self._offsets[position[0]] << 16) | position[1]
+
+    def close(self):
+        """ Writes all pending blocks and the end-of-file block.
+
+            The output stream is left open.
+
+            No return value.
+        """
+        if self.closed:
+            return
+        self.flush()
+        while self._pending:
+            self._write_blocks(self._pending.popleft().get())
+        if self._pool is not None:
+            self._pool.close()
+            self._pool.join()
+        # Position at end of file is start of end-of-file block
+        self._offsets.append(self._offset)
+        self.output_stream.write(eof_block)
+        self.closed = True
+
+def region_index_line(offset, rname, min_start, max_start):
+    """ Formats a line of a region index.
+
+        offset: offset of a chunk in its TSV
+        rname: RNAME of the chunk's features
+        min_start: smallest start position among chunk's features
+        max_start: largest start position among chunk's features
+
+        Return value: line without newline
+    """
+    return '%d\t%s\t%d\t%d' % (offset, rname, min_start, max_start)
+
+region_index_header = '#offset\trname\tmin start\tmax start'
+
+def region_lines(tsv_file, index_file, rname, start, end):
+    """ Reads lines of a cross-sample TSV for features in a region.
+
+        Only the chunks whose ranges of start positions overlap the region
+        are decompressed. A feature is in the region if its start position
+        is. Lines are right whatever the order of features in the TSV, but
+        few chunks are read only if features on an RNAME are sorted by start
+        position.
+
+        tsv_file: path to BGZF TSV whose lines begin with features
+            formatted as RNAME;strand or sequence;start;end
+        index_file: path to region index of tsv_file
+        rname: RNAME of region
+        start: start position of region (inclusive)
+        end: end position of region (inclusive)
+
+        Yield value: line of TSV with newline
+    """
+    '''Byte ranges [start, end) of runs of consecutive overlapping chunks;
+    an end of None is the end of the file'''
+    ranges, overlapping = [], False
+    with open(index_file) as index_stream:
+        for line in index_stream:
+            if line[0] == '#':
+                continue
+            (chunk_offset, chunk_rname,
+                min_start, max_start) = line.rstrip('\n').split('\t')
+            chunk_offset = int(chunk_offset)
+            previous_overlapping = overlapping
+            overlapping = (chunk_rname == rname and int(max_start) >= start
+                            and int(min_start) <= end)
+            if overlapping and not previous_overlapping:
+                ranges.append([chunk_offset, None])
+            elif previous_overlapping and not overlapping:
+                ranges[-1][1] = chunk_offset
+    if not ranges:
+        return
+    from StringIO import StringIO
+    with open(tsv_file, 'rb') as binary_stream:
+        for range_start, range_end in ranges:
+            binary_stream.seek(range_start)
+            blocks = (binary_stream.read() if range_end is None
+                        else binary_stream.read(range_end - range_start))
+            for line in gzip.GzipFile(fileobj=StringIO(blocks)):
+                feature_rname, _, feature_start, _ = line.partition(
+                                                            '\t'
+                                                        )[0].rsplit(';', 3)
+                if (feature_rname == rname
+                        and start <= int(feature_start) <= end):
+                    yield line
+
+if __name__ == '__main__':
+    import sys
+    import os
+    import random
+    import shutil
+    import tempfile
+    import unittest
+    from StringIO import StringIO
+
+    class TestBgzf(unittest.TestCase):
+        """ Tests BGZF writing and region lookups. """
+        def setUp(self):
+            self.temp_dir_path = tempfile.mkdtemp()
+            random.seed(5)
+
+        def test_round_trip(self):
+            """ Fails if blocks don't decompress to the original data. """
+            for data in ['', 'ACGT\n' * 50000,
+                         ''.join([chr(random.randint(0, 255))
+                                    for _ in xrange(200000)])]:
+                blocks = compressed_blocks(data, 3)
+                self.assertEqual(
+                        gzip.GzipFile(
+                                fileobj=StringIO(blocks + eof_block)
+                            ).read(), data
+                    )
+                offset = 0
+                while offset < len(blocks):
+                    (_, _, _, flags, _, _, _, extra_size, first, second,
+                        _, block_size) = _header.unpack_from(blocks, offset)
+                    self.assertEqual((flags, extra_size, first, second),
+                                        (4, 6, 66, 67))
+                    self.assertTrue(block_size < _max_block_size)
+                    offset += block_size + 1
+                self.assertEqual(offset, len(blocks))
+
+        def test_writer(self):
+            """ Fails if Writer's output or virtual offsets are wrong. """
+            pieces = [''.join([random.choice('ACGT\n')
+                                for _ in xrange(random.randint(0, 3000))])
+                        for _ in xrange(200)] + ['N' * 150000, 'ACGT']
+            for threads in [1, 3]:
+                output_stream = StringIO()
+                writer = Writer(output_stream, level=3, threads=threads)
+                positions = []
+                for piece in pieces:
+                    writer.make_room(len(piece))
+                    positions.append(writer.position())
+                    writer.write(piece)
+                end_position = writer.position()
+                writer.close()
+                blocks = output_stream.getvalue()
+                self.assertTrue(blocks.endswith(eof_block))
+                self.assertEqual(
+                        gzip.GzipFile(fileobj=StringIO(blocks)).read(),
+                        ''.join(pieces)
+                    )
+                for i, position in enumerate(positions + [end_position]):
+                    # Data from position to end of file is all later pieces
+                    virtual_offset = writer.virtual_offset(position)
+                    uncompressed = gzip.GzipFile(fileobj=StringIO(
+                            blocks[virtual_offset >> 16:]
+                        )).read()
+                    self.assertEqual(uncompressed[virtual_offset & 0xffff:],
+                                     ''.join(pieces[i:]))
+
+        def test_region_lines(self):
+            """ Fails if region lookups return the wrong lines. """
+            tsv_file = os.path.join(self.temp_dir_path, 'junctions.tsv.gz')
+            index_file = tsv_file + '.idx'
+            lines = []
+            with open(tsv_file, 'wb') as tsv_stream, \
+                open(index_file, 'w') as index_stream:
+                print >>index_stream, region_index_header
+                tsv_stream.write(compressed_blocks('\tsample\n'))
+                for rname in ['chr2', 'chr1']:
+                    for chunk in xrange(5):
+                        chunk_lines = [
+                                '%s;+;%d;%d\t%d\n' % (rname, pos, pos + 100,
+                                                        chunk)
+                                for pos in xrange(chunk * 1000,
+                                                    chunk * 1000 + 1000, 10)
+                            ]
+                        lines.extend(chunk_lines)
+                        print >>index_stream, region_index_line(
+                                tsv_stream.tell(), rname, chunk * 1000,
+                                chunk * 1000 + 990
+                            )
+                        tsv_stream.write(compressed_blocks(
+                                                ''.join(chunk_lines), 3
+                                            ))
+                tsv_stream.write(eof_block)
+            for rname, start, end in [('chr1', 1500, 2500), ('chr2', 0, 0),
+                                      ('chr2', 4995, 10000),
+                                      ('chr1', 6000, 7000),
+                                      ('chr3', 0, 100)]:
+                self.assertEqual(
+                        list(region_lines(tsv_file, index_file, rname,
+                                            start, end)),
+                        [line for line in lines
+                            if line.split(';')[0] == rname
+                            and start <= int(line.split(';')[2]) <= end]
+                    )
+
+        def test_region_lines_mixed_widths(self):
+            """ Fails if region lookups miss features whose unpadded start
+                positions have different numbers of digits. """
+            positions = ([random.randint(1, 99999) for _ in xrange(300)]
+                            + [9, 10, 99, 100, 999, 1000, 9999, 10000])
+            for order in [lambda pos: pos, str]:
+                tsv_file = os.path.join(self.temp_dir_path,
+                                        'deletions.tsv.gz')
+                index_file = tsv_file + '.idx'
+                lines = ['chr1;AC;%d;%d\t1\n' % (pos, pos + 2)
+                            for pos in sorted(positions, key=order)]
+                with open(tsv_file, 'wb') as tsv_stream, \
+                    open(index_file, 'w') as index_stream:
+                    print >>index_stream, region_index_header
+                    tsv_stream.write(compressed_blocks('\tsample\n'))
+                    for i in xrange(0, len(lines), 7):
+                        chunk_starts = [int(line.split(';')[2])
+                                            for line in lines[i:i+7]]
+                        print >>index_stream, region_index_line(
+                                tsv_stream.tell(), 'chr1',
+                                min(chunk_starts), max(chunk_starts)
+                            )
+                        tsv_stream.write(compressed_blocks(
+                                                ''.join(lines[i:i+7]), 3
+                                            ))
+                    tsv_stream.write(eof_block)
+                for start, end in [(1, 99999), (9, 10), (50, 5000),
+                                   (1000, 1000), (20000, 30000),
+                                   (100000, 200000)]:
+                    self.assertEqual(
+                            list(region_lines(tsv_file, index_file, 'chr1',
+                                                start, end)),
+                            [line for line in lines
+                                if start <= int(line.split(';')[2]) <= end]
+                        )
+
+        def tearDown(self):
+            shutil.rmtree(self.temp_dir_path)
+
+    unittest.main(argv=[sys.argv[0]])
@@ -0,0 +1,681 @@
+#!/usr/bin/env python
+"""
+bigwig_writer.py
+Part of Rail-RNA
+
+Writes bigWig files from bedGraph-style intervals without temporary
+bedGraphs or a bedGraphToBigWig subprocess. Intervals are added one at a time
+in order of chromosome name and then position, just as bedGraphToBigWig
+requires of its input. Full-resolution data is compressed and written as it
+arrives, and every zoom level is built alongside it: the finest level
+summarizes intervals directly, and each coarser level summarizes the finer
+level's summaries as they're completed, as bedGraphToBigWig does once its
+first reduction is done. Only compressed zoom blocks and the locations of
+data blocks are held in memory until the file is closed, when the indexes and
+zoom levels are written and the header is filled in.
+
+The format is described in Kent et al., "BigWig and BigBed: enabling browsing
+of large distributed datasets," Bioinformatics 26(17) (2010), and implemented
+in the Kent source tree's bbiWrite.c and bedGraphToBigWig.c, which this
+module follows. Zoom levels start at a fixed reduction rather than one
+computed from the mean interval size, which isn't known until all intervals
+are seen.
+"""
+import struct
+import zlib
+
+_bigwig_magic = 0x888ffc26
+_bpt_magic = 0x78ca8c91
+_cir_tree_magic = 0x2468ace0
+_version = 4
+_max_zoom_levels = 10
+_zoom_increment = 4
+_header = struct.Struct('<IHHQQQHHQQIQ')
+_zoom_header = struct.Struct('<IIQQ')
+_summary = struct.Struct('<Qdddd')
+_section_header = struct.Struct('<IIIIIBBH')
+_bedgraph_item = struct.Struct('<IIf')
+_zoom_record = struct.Struct('<IIIIffff')
+_bpt_header = struct.Struct('<IIIIQQ')
+_cir_tree_header = struct.Struct('<IIQIIIIQII')
+_node_header = struct.Struct('<BBH')
+_cir_tree_bounds = struct.Struct('<IIII')
+# bedGraph section type
+_bedgraph_type = 1
+
+def _levels(items, block_size):
+    """ Groups items into the levels of a tree, leaves first.
+
+        items: list of leaf items
+        block_size: maximum number of children of a node
+
+        Return value: list of levels, each a list of nodes, each a list of
+            indexes of items (for leaves) or nodes of the level below
+    """
+    levels = [[range(i, min(i + block_size, len(items)))
+                for i in xrange(0, len(items), block_size)] or [[]]]
+    while len(levels[-1]) > 1:
+        levels.append([range(i, min(i + block_size, len(levels[-1])))
+                        for i in xrange(0, len(levels[-1]), block_size)])
+    return levels
+
+def bpt_bytes(chroms, offset, block_size=256):
+    """ Encodes the B+ tree mapping chromosome names to IDs and sizes.
+
+        chroms: list of tuples (name, ID, size) sorted by name
+        offset: offset in file at which tree will be written; child offsets
+            are absolute
+        block_size: maximum number of children of a node
+
+        Return value: encoded tree
+    """
+    block_size = max(min(block_size, len(chroms)), 1)
+    key_size = max([len(name) for name, _, _ in chroms] or [1])
+    levels = _levels(chroms, block_size)
+    # First key under each node, level by level, leaves first
+    first_keys = [[chroms[node[0]][0] if node else '' for node in levels[0]]]
+    for level in levels[1:]:
+        first_keys.append([first_keys[-1][node[0]] for node in level])
+    # Nodes are written root first
+    node_offsets = [None] * len(levels)
+    offset += _bpt_header.size
+    for level_index in xrange(len(levels) - 1, -1, -1):
+        node_offsets[level_index] = []
+        for node in levels[level_index]:
+            node_offsets[level_index].append(offset)
+            offset += _node_header.size + len(node) * (key_size + 8)
+    encoded = []
+    for level_index in xrange(len(levels) - 1, -1, -1):
+        for node in levels[level_index]:
+            encoded.append(_node_header.pack(level_index == 0, 0,
+                                                len(node)))
+            for i in node:
+                if level_index == 0:
+                    name, chrom_id, size = chroms[i]
+                    encoded.append(name.ljust(key_size, '\x00')
+                                    + struct.pack('<II', chrom_id, size))
+                else:
+                    encoded.append(
+                            first_keys[level_index - 1][i].ljust(key_size,
+                                                                 '\x00')
+                            + struct.pack('<Q',
+                                            node_offsets[level_index - 1][i])
+                        )
+    return _bpt_header.pack(_bpt_magic, block_size, key_size, 8,
+                            len(chroms), 0) + ''.join(encoded)
+
+def cir_tree_bytes(blocks, offset, end_file_offset, items_per_slot,
+                    block_size=256):
+    """ Encodes the R tree that indexes data blocks by genomic region.
+
+        blocks: list of tuples (start chromosome ID, start, end chromosome
+            ID, end, offset of block in file, size of block) sorted by
+            region
+        offset: offset in file at which tree will be written; child offsets
+            are absolute
+        end_file_offset: offset in file of end of data indexed
+        items_per_slot: maximum number of items in a data block
+        block_size: maximum number of children of a node
+
+        Return value: encoded tree
+    """
+    levels = _levels(blocks, block_size)
+    # Bounds of nodes, level by level, leaves first
+    bounds = [[(blocks[node[0]][:2], max([blocks[i][2:4] for i in node]))
+                for node in levels[0] if node]]
+    for level in levels[1:]:
+        bounds.append([(bounds[-1][node[0]][0],
+                        max([bounds[-1][i][1] for i in node]))
+                        for node in level])
+    node_offsets = []
+    node_offset = offset + _cir_tree_header.size
+    for level_index in xrange(len(levels) - 1, -1, -1):
+        node_offsets.append([])
+        item_size = 32 if level_index == 0 else 24
+        for node in levels[level_index]:
+            node_offsets[-1].append(node_offset)
+            node_offset += _node_header.size + len(node) * item_size
+    node_offsets.reverse()
+    encoded = []
+    for level_index in xrange(len(levels) - 1, -1, -1):
+        for node in levels[level_index]:
+            encoded.append(_node_header.pack(level_index == 0, 0, len(node)))
+            for i in node:
+                if level_index == 0:
+                    encoded.append(struct.pack('<IIIIQQ', *blocks[i]))
+                else:
+                    (start_chrom_id, start), (end_chrom_id, end) = (
+                            bounds[level_index - 1][i]
+                        )
+                    encoded.append(_cir_tree_bounds.pack(
+                                            start_chrom_id, start,
+                                            end_chrom_id, end
+                                        ) + struct.pack(
+                                            '<Q',
+                                            node_offsets[level_index - 1][i]
+                                        ))
+    if blocks:
+        (start_chrom_id, start), (end_chrom_id, end) = bounds[-1][0]
+    else:
+        start_chrom_id, start, end_chrom_id, end = 0, 0, 0, 0
+    return _cir_tree_header.pack(_cir_tree_magic, block_size, len(blocks),
+                                    start_chrom_id, start, end_chrom_id, end,
+                                    end_file_offset, items_per_slot, 0) \
+                + ''.join(encoded)
+
+class ZoomLevel(object):
+    """ Summarizes data at one resolution, passing completed summaries on to
+        the next coarser level. """
+    def __init__(self, reduction, items_per_slot, compression_level,
+                    coarser=None):
+        """
+            reduction: number of bases summarized by a record
+            items_per_slot: maximum number of records in a block
+            compression_level: zlib compression level
+            coarser: ZoomLevel to which to pass completed records or None
+        """
+        self.reduction = reduction
+        self.items_per_slot = items_per_slot
+        self.compression_level = compression_level
+        self.coarser = coarser
+        # Current record: [chrom ID, start, end, valid count, min, max, sum,
+        #                  sum of squares]
+        self.record = None
+        self.records = []
+        # Compressed blocks and their bounds
+        self.blocks = []
+        self.record_count = 0
+        self.max_block_size = 0
+
+    def _finish_record(self):
+        """ Queues current record for compression and passes it on. """
+        record = self.record
+        self.record = None
+        self.records.append(record)
+        self.record_count += 1
+        if len(self.records) == self.items_per_slot:
+            self._finish_block()
+        if self.coarser is not None:
+            self.coarser.add_record(record)
+
+    def _finish_block(self):
+        """ Compresses queued records into a block. """
+        if not self.records:
+            return
+        data = ''.join([_zoom_record.pack(*record)
+                        for record in self.records])
+        self.max_block_size = max(self.max_block_size, len(data))
+        self.blocks.append((self.records[0][0], self.records[0][1],
+                            self.records[-1][0], self.records[-1][2],
+                            zlib.compress(data, self.compression_level)))
+        self.records = []
+
+    def add_interval(self, chrom_id, chrom_size, start, end, value):
+        """ Adds an interval with a constant value.
+
+            Follows bbiAddRangeToSummary() from the Kent source; a record
+            starts at the first base with data after the previous record
+            ends.
+
+            chrom_id: chromosome ID
+            chrom_size: chromosome size
+            start: start of interval (0-based, inclusive)
+            end: end of interval (0-based, exclusive)
+            value: value of every base in interval
+
+            No return value.
+        """
+        record = self.record
+        if record is not None and (record[0] != chrom_id
+                                    or record[2] <= start):
+            self._finish_record()
+            record = None
+        while True:
+            if record is None:
+                record = self.record = [chrom_id, start,
+                                        min(start + self.reduction,
+                                            chrom_size),
+                                        0, value, value, 0.0, 0.0]
+            overlap = min(end, record[2]) - start
+            record[3] += overlap
+            if value < record[4]:
+                record[4] = value
+            if value > record[5]:
+                record[5] = value
+            record[6] += value * overlap
+            record[7] += value * value * overlap
+            if end <= record[2]:
+                break
+            start = record[2]
+            self._finish_record()
+            record = None
+
+    def add_record(self, finer):
+        """ Adds a completed record of the next finer level.
+
+            Follows bbiSummarySimpleReduce() from the Kent source.
+
+            finer: record of finer level
+
+            No return value.
+        """
+        record = self.record
+        if record is not None and (record[0] != finer[0]
+                                    or finer[2] > record[1] + self.reduction):
+            self._finish_record()
+            record = None
+        if record is None:
+            self.record = list(finer)
+            return
+        record[2] = finer[2]
+        record[3] += finer[3]
+        if finer[4] < record[4]:
+            record[4] = finer[4]
+        if finer[5] > record[5]:
+            record[5] = finer[5]
+        record[6] += finer[6]
+        record[7] += finer[7]
+
+    def finish(self):
+        """ Completes last record and block. No return value. """
+        if self.record is not None:
+            self._finish_record()
+        self._finish_block()
+
+class BigWigWriter(object):
+    """ Writes a bigWig file from bedGraph-style intervals. """
+    def __init__(self, filename, chrom_sizes, items_per_slot=1024,
+                    block_size=256, initial_reduction=100,
+                    compression_level=6):
+        """
+            filename: path to bigWig to write
+            chrom_sizes: dictionary mapping chromosome names to sizes; IDs
+                are assigned in order of name
+            items_per_slot: maximum number of intervals or zoom records in a
+                compressed block
+            block_size: maximum number of children of a node of an index
+            initial_reduction: number of bases summarized by a record of the
+                finest zoom level; each coarser level summarizes
+                _zoom_increment times as many
+            compression_level: zlib compression level
+        """
+        self.output_stream = open(filename, 'wb')
+        self.items_per_slot = items_per_slot
+        self.block_size = block_size
+        self.compression_level = compression_level
+        self.chroms = [(name, i, chrom_sizes[name])
+                        for i, name in enumerate(sorted(chrom_sizes))]
+        self.chrom_ids = dict((name, (i, size))
+                                for name, i, size in self.chroms)
+        self.zoom_levels = []
+        coarser = None
+        for i in xrange(_max_zoom_levels - 1, -1, -1):
+            coarser = ZoomLevel(initial_reduction * _zoom_increment**i,
+                                items_per_slot, compression_level, coarser)
+            self.zoom_levels.append(coarser)
+        self.zoom_levels.reverse()
+        # Header, zoom headers, and total summary are written on close
+        self.summary_offset = (_header.size
+                                + _max_zoom_levels * _zoom_header.size)
+        self.chrom_tree_offset = self.summary_offset + _summary.size
+        self.output_stream.write('\x00' * self.chrom_tree_offset)
+        self.output_stream.write(bpt_bytes(self.chroms,
+                                            self.chrom_tree_offset,
+                                            block_size))
+        self.data_offset = self.output_stream.tell()
+        # Number of sections is filled in on close
+        self.output_stream.write('\x00' * 8)
+        self.sections = []
+        self.items = []
+        self.item_chrom_id = None
+        self.max_block_size = 0
+        # Valid count, min, max, sum, sum of squares
+        self.total_summary = [0, float('inf'), float('-inf'), 0.0, 0.0]
+        self.closed = False
+
+    def _write_section(self):
+        """ Compresses and writes buffered intervals. """
+        if not self.items:
+            return
+        data = _section_header.pack(self.item_chrom_id, self.items[0][0],
+                                    self.items[-1][1], 0, 0, _bedgraph_type,
+                                    0, len(self.items)) + ''.join(
+                    [_bedgraph_item.pack(*item) for item in self.items]
+                )
+        self.max_block_size = max(self.max_block_size, len(data))
+        compressed = zlib.compress(data, self.compression_level)
+        self.sections.append((self.item_chrom_id, self.items[0][0],
+                              self.item_chrom_id, self.items[-1][1],
+                              self.output_stream.tell(), len(compressed)))
+        self.output_stream.write(compressed)
+        self.items = []
+
+    def add(self, chrom, start, end, value):
+        """ Adds an interval with a constant value.
+
+            Intervals must be added in order of chromosome name and then
+            start position and may not overlap.
+
+            chrom: chromosome name
+            start: start of interval (0-based, inclusive)
+            end: end of interval (0-based, exclusive)
+            value: value of every base in interval
+
+            No return value.
+        """
+        if end <= start:
+            return
+        chrom_id, chrom_size = self.chrom_ids[chrom]
+        if (chrom_id != self.item_chrom_id
+                or len(self.items) == self.items_per_slot):
+            self._write_section()
+            self.item_chrom_id = chrom_id
+        self.items.append((start, end, value))
+        self.zoom_levels[0].add_interval(chrom_id, chrom_size, start, end,
+                                            value)
+        size = end - start
+        total_summary = self.total_summary
+        total_summary[0] += size
+        if value < total_summary[1]:
+            total_summary[1] = value
+        if value > total_summary[2]:
+            total_summary[2] = value
+        total_summary[3] += value * size
+        total_summary[4] += value * value * size
+
+    def close(self):
+        """ Writes indexes, zoom levels, and header. No return value. """
+        if self.closed:
+            return
+        self._write_section()
+        self.zoom_levels[0].finish()
+        for zoom_level in self.zoom_levels[1:]:
+            zoom_level.finish()
+        output_stream = self.output_stream
+        index_offset = output_stream.tell()
+        output_stream.write(cir_tree_bytes(self.sections, index_offset,
+                                            index_offset,
+                                            self.items_per_slot,
+                                            self.block_size))
+        '''Keep a zoom level only if it has fewer than half as many records
+        as the last level kept, as bedGraphToBigWig does.'''
+        zoom_headers = []
+        last_record_count = None
+        max_block_size = self.max_block_size
+        for zoom_level in self.zoom_levels:
+            if not zoom_level.record_count or (
+                    last_record_count is not None
+                    and 2 * zoom_level.record_count >= last_record_count
+                ):
+                break
+            last_record_count = zoom_level.record_count
+            max_block_size = max(max_block_size, zoom_level.max_block_size)
+            zoom_data_offset = output_stream.tell()
+            output_stream.write(struct.pack('<I', zoom_level.record_count))
+            blocks = []
+            for (start_chrom_id, start, end_chrom_id, end,
+                    compressed) in zoom_level.blocks:
+                blocks.append((start_chrom_id, start, end_chrom_id, end,
+                               output_stream.tell(), len(compressed)))
+                output_stream.write(compressed)
+            zoom_index_offset = output_stream.tell()
+            output_stream.write(cir_tree_bytes(blocks, zoom_index_offset,
+                                                zoom_index_offset,
+                                                self.items_per_slot,
+                                                self.block_size))
+            zoom_headers.append(_zoom_header.pack(zoom_level.reduction, 0,
+                                                    zoom_data_offset,
+                                                    zoom_index_offset))
+        output_stream.seek(0)
+        output_stream.write(_header.pack(
+                _bigwig_magic, _version, len(zoom_headers),
+                self.chrom_tree_offset, self.data_offset, index_offset, 0, 0,
+                0, self.summary_offset, max_block_size, 0
+            ))
+        output_stream.write(''.join(zoom_headers))
+        valid_count, min_value, max_value, sum_data, sum_squares = (
+                self.total_summary
+            )
+        if not valid_count:
+            min_value, max_value = 0.0, 0.0
+        output_stream.seek(self.summary_offset)
+        output_stream.write(_summary.pack(valid_count, min_value, max_value,
+                                            sum_data, sum_squares))
+        output_stream.seek(self.data_offset)
+        output_stream.write(struct.pack('<Q', len(self.sections)))
+        output_stream.close()
+        self.closed = True
+
+if __name__ == '__main__':
+    import sys
+    import os
+    import random
+    import shutil
+    import tempfile
+    import unittest
+    import bisect
+
+    class BigWigReader(object):
+        """ Reads bigWig files by following their indexes. """
+        def __init__(self, filename):
+            with open(filename, 'rb') as bigwig_stream:
+                self.data = bigwig_stream.read()
+            (magic, self.version, zoom_level_count, chrom_tree_offset,
+                self.data_offset, self.index_offset, _, _, _,
+                summary_offset, self.uncompress_buf_size,
+                _) = _header.unpack_from(self.data, 0)
+            assert magic == _bigwig_magic
+            self.zoom_levels = [
+                    _zoom_header.unpack_from(self.data,
+                                                _header.size
+                                                + i * _zoom_header.size)
+                    for i in xrange(zoom_level_count)
+                ]
+            self.summary = _summary.unpack_from(self.data, summary_offset)
+            (magic, _, key_size, value_size, item_count,
+                _) = _bpt_header.unpack_from(self.data, chrom_tree_offset)
+            assert magic == _bpt_magic and value_size == 8
+            self.chroms = {}
+            self._read_bpt_node(chrom_tree_offset + _bpt_header.size,
+                                key_size)
+            assert len(self.chroms) == item_count
+
+        def _read_bpt_node(self, offset, key_size):
+            leaf, _, count = _node_header.unpack_from(self.data, offset)
+            offset += _node_header.size
+            for _ in xrange(count):
+                key = self.data[offset:offset+key_size].rstrip('\x00')
+                offset += key_size
+                if leaf:
+                    self.chroms[key] = struct.unpack_from('<II', self.data,
+                                                            offset)
+                else:
+                    self._read_bpt_node(
+                            struct.unpack_from('<Q', self.data, offset)[0],
+                            key_size
+                        )
+                offset += 8
+
+        def _blocks(self, offset, chrom_id, start, end):
+            """ Finds data blocks overlapping a region using an R tree. """
+            leaf, _, count = _node_header.unpack_from(self.data, offset)
+            offset += _node_header.size
+            blocks = []
+            for _ in xrange(count):
+                (start_chrom_id, block_start, end_chrom_id,
+                    block_end) = _cir_tree_bounds.unpack_from(self.data,
+                                                                offset)
+                overlaps = ((start_chrom_id, block_start) < (chrom_id, end)
+                            and (end_chrom_id, block_end)
+                                > (chrom_id, start))
+                if leaf:
+                    if overlaps:
+                        blocks.append(struct.unpack_from('<QQ', self.data,
+                                                            offset + 16))
+                    offset += 32
+                else:
+                    if overlaps:
+                        blocks.extend(self._blocks(
+                                struct.unpack_from('<Q', self.data,
+                                                    offset + 16)[0],
+                                chrom_id, start, end
+                            ))
+                    offset += 24
+            return blocks
+
+        def _tree_blocks(self, index_offset, chrom, start, end):
+            magic = _cir_tree_header.unpack_from(self.data, index_offset)[0]
+            assert magic == _cir_tree_magic
+            return self._blocks(index_offset + _cir_tree_header.size,
+                                self.chroms[chrom][0], start, end)
+
+        def intervals(self, chrom, start, end):
+            """ Gets intervals overlapping a region. """
+            chrom_id = self.chroms[chrom][0]
+            intervals = []
+            for offset, size in self._tree_blocks(self.index_offset, chrom,
+                                                    start, end):
+                data = zlib.decompress(self.data[offset:offset+size])
+                assert len(data) <= self.uncompress_buf_size
+                (section_chrom_id, _, _, _, _, section_type, _,
+                    count) = _section_header.unpack_from(data, 0)
+                assert section_type == _bedgraph_type
+                for i in xrange(count):
+                    item = _bedgraph_item.unpack_from(
+                            data,
+                            _section_header.size + i * _bedgraph_item.size
+                        )
+                    if (section_chrom_id == chrom_id and item[0] < end
+                            and item[1] > start):
+                        intervals.append(item)
+            return intervals
+
+        def zoom_records(self, level, chrom, start, end):
+            """ Gets zoom records overlapping a region. """
+            chrom_id = self.chroms[chrom][0]
+            records = []
+            for offset, size in self._tree_blocks(self.zoom_levels[level][3],
+                                                    chrom, start, end):
+                data = zlib.decompress(self.data[offset:offset+size])
+                assert len(data) <= self.uncompress_buf_size
+                for i in xrange(len(data) // _zoom_record.size):
+                    record = _zoom_record.unpack_from(
+                                        data, i * _zoom_record.size
+                                    )
+                    if (record[0] == chrom_id and record[1] < end
+                            and record[2] > start):
+                        records.append(record)
+            return records
+
+    class TestBigWigWriter(unittest.TestCase):
+        """ Tests BigWigWriter by reading its output. """
+        def setUp(self):
+            self.temp_dir_path = tempfile.mkdtemp()
+            self.bigwig_file = os.path.join(self.temp_dir_path, 'test.bw')
+            random.seed(11)
+
+        def write(self, chrom_sizes, intervals, **kwargs):
+            bigwig_writer = BigWigWriter(self.bigwig_file, chrom_sizes,
+                                            **kwargs)
+            for interval in intervals:
+                bigwig_writer.add(*interval)
+            bigwig_writer.close()
+            return BigWigReader(self.bigwig_file)
+
+        def test_intervals(self):
+            """ Fails if intervals found with index aren't those added. """
+            chrom_sizes = dict(('chr%d' % i, random.randint(10000, 400000))
+                                for i in xrange(1, 40))
+            intervals = []
+            for chrom in sorted(chrom_sizes):
+                if random.random() < 0.2:
+                    # Leave some chromosomes without data
+                    continue
+                pos = 0
+                while pos < chrom_sizes[chrom]:
+                    end = min(pos + random.randint(1, 300),
+                              chrom_sizes[chrom])
+                    intervals.append((chrom, pos, end,
+                                        float(random.randint(0, 50))))
+                    pos = end
+            # Small slots and blocks make for deep trees
+            reader = self.write(chrom_sizes, intervals, items_per_slot=16,
+                                block_size=4, initial_reduction=50)
+            self.assertEqual(sorted(reader.chroms.items()),
+                             sorted([(chrom, (i, chrom_sizes[chrom]))
+                                     for i, chrom
+                                     in enumerate(sorted(chrom_sizes))]))
+            for _ in xrange(100):
+                chrom = random.choice(chrom_sizes.keys())
+                start = random.randint(0, chrom_sizes[chrom] - 1)
+                end = start + random.randint(1, 5000)
+                self.assertEqual(
+                        reader.intervals(chrom, start, end),
+                        [interval[1:] for interval in intervals
+                            if interval[0] == chrom
+                            and interval[1] < end and interval[2] > start]
+                    )
+            self.assertEqual(reader.summary[0],
+                             sum([end - start
+                                  for _, start, end, _ in intervals]))
+            self.assertEqual(reader.summary[2],
+                             max([value for _, _, _, value in intervals]))
+
+        def test_zoom_levels(self):
+            """ Fails if zoom records don't summarize intervals. """
+            chrom_sizes = {'chrA' : 2000000, 'chrB' : 500000}
+            intervals = []
+            for chrom in sorted(chrom_sizes):
+                pos = random.randint(0, 1000)
+                while pos < chrom_sizes[chrom] - 2000:
+                    end = pos + random.randint(1, 50)
+                    intervals.append((chrom, pos, end,
+                                        float(random.randint(1, 9))))
+                    pos = end + random.randint(0, 100)
+            reader = self.write(chrom_sizes, intervals)
+            self.assertTrue(len(reader.zoom_levels) > 2)
+            reductions = [level[0] for level in reader.zoom_levels]
+            self.assertEqual(reductions,
+                             [100 * 4**i for i in xrange(len(reductions))])
+            for level in xrange(len(reader.zoom_levels)):
+                for chrom in chrom_sizes:
+                    records = reader.zoom_records(level, chrom, 0,
+                                                  chrom_sizes[chrom])
+                    chrom_intervals = [interval for interval in intervals
+                                        if interval[0] == chrom]
+                    # Records tile data without overlapping
+                    for record, next_record in zip(records, records[1:]):
+                        self.assertTrue(record[2] <= next_record[1])
+                    self.assertEqual(
+                        sum([record[3] for record in records]),
+                        sum([end - start
+                             for _, start, end, _ in chrom_intervals])
+                    )
+                    self.assertAlmostEqual(
+                        sum([record[6] for record in records]),
+                        sum([(end - start) * value
+                             for _, start, end, value in chrom_intervals]),
+                        places=0
+                    )
+                    starts = [start for _, start, _, _ in chrom_intervals]
+                    ends = [end for _, _, end, _ in chrom_intervals]
+                    for record in records:
+                        values = [value for _, _, _, value
+                                    in chrom_intervals[
+                                        bisect.bisect_right(ends, record[1]):
+                                        bisect.bisect_left(starts, record[2])
+                                    ]]
+                        self.assertEqual((record[4], record[5]),
+                                         (min(values), max(values)))
+
+        def test_empty(self):
+            """ Fails if a bigWig without data is malformed. """
+            reader = self.write({'chr1' : 1000}, [])
+            self.assertEqual(reader.zoom_levels, [])
+            self.assertEqual(reader.intervals('chr1', 0, 1000), [])
+            self.assertEqual(reader.summary[0], 0)
+
+        def tearDown(self):
+            shutil.rmtree(self.temp_dir_path)
+
+    unittest.main(argv=[sys.argv[0]])
@@ -1,6 +1,8 @@
 import os
 import struct
 import mmap
+from bowtie_index import (stretch_arrays, stretch_from_arrays,
+                            stretches_from_requests)
 
 
 class Bowtie2IndexReference(object):
@@ -92,27 +94,24 @@ class Bowtie2IndexReference(object):
 
         running_unambig_preceding, running_length = 0, 0
         recs = []
-        starting_offsets = []
-        unambig_preceding, lengths = [], []
+        lengths = []
 
         for i in xrange(nrecs):
             off = struct_unsigned.unpack(fh3.read(sz))[0]
             ln = struct_unsigned.unpack(fh3.read(sz))[0]
             first = ord(fh3.read(1)) != 0
-            recs.append((off, ln, first))
             if first:
-                starting_offsets.append(len(recs)-1)
-                unambig_preceding.append(running_unambig_preceding)
+                recs.append([])
                 if i > 0:
                     lengths.append(running_length)
                 running_length = 0
+            recs[-1].append((off, ln, running_unambig_preceding))
             running_length += (off + ln)
             running_unambig_preceding += ln
 
         lengths.append(running_length)
-        starting_offsets.append(len(recs))
         tot_unambig_len = running_unambig_preceding
-        assert len(recs) == nrecs
+        assert sum(map(len, recs)) == nrecs
 
         #
         # Memory-map the .4.bt2 file
@@ -120,52 +119,30 @@ class Bowtie2IndexReference(object):
         ln_bytes = (tot_unambig_len + 3) // 4
         self.fh4mm = mmap.mmap(fh4.fileno(), ln_bytes, flags=mmap.MAP_SHARED, prot=mmap.PROT_READ)
 
-        # These are per-unambiguous-stretch
-        self.recs = recs
-
         # These are per-reference
-        self.unambig_preceding = unambig_preceding
+        self.stretches = map(stretch_arrays, recs)
         self.lengths = lengths
-        self.starting_offsets = starting_offsets
         self.refnames = refnames
         self.ref_id_to_offset = {self.refnames[i]: i for i in xrange(len(self.refnames))}
 
     def get_stretch(self, ref_id, ref_off, count):
         assert ref_id in self.ref_id_to_offset
-        ref_idx = self.ref_id_to_offset[ref_id]
-        rec_i, rec_f = self.starting_offsets[ref_idx], self.starting_offsets[ref_idx + 1]
-        cur, off = 0, 0
-        buf_off = self.unambig_preceding[ref_idx]
-        stretch = []
-        # Naive to scan these records linearly; obvious speedup is binary search
-        for i in xrange(rec_i, rec_f):
-            off += self.recs[i][0]
-            while ref_off < off and count > 0:
-                stretch.append('N')
-                count -= 1
-                ref_off += 1
-            if count == 0:
-                break
-            if ref_off < off + self.recs[i][1]:
-                # stretch extends through part of the unambiguous stretch
-                buf_off += (ref_off - off)
-            else:
-                buf_off += self.recs[i][1]
-            off += self.recs[i][1]
-            while ref_off < off and count > 0:
-                buf_elt = buf_off >> 2
-                shift_amt = (buf_off & 3) << 1
-                stretch.append('ACGT'[(ord(self.fh4mm[buf_elt]) >> shift_amt) & 3])
-                buf_off += 1
-                count -= 1
-                ref_off += 1
-            if count == 0:
-                break
-        while count > 0:
-            count -= 1
-            stretch.append('N')
-        return ''.join(stretch)
-
+        return stretch_from_arrays(
+                self.fh4mm, self.stretches[self.ref_id_to_offset[ref_id]],
+                ref_off, count
+            )
+
+    def get_stretches(self, requests):
+        """
+        Return many stretches of characters from the reference at once.
+        Overlapping requests are decoded only once.
+
+        @param requests: list of tuples (name of ref seq, 0-based offset into
+            reference, # of characters)
+        @return: list of strings extracted from reference, in the order of
+            requests
+        """
+        return stretches_from_requests(self.get_stretch, requests)
 
 def which(program):
     import os
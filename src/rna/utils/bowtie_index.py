@@ -1,9 +1,194 @@
 import os
+import sys
 import struct
 import mmap
+import tempfile
 from operator import itemgetter
 from collections import defaultdict
 from bisect import bisect_right
+from array import array
+
+'''Bases packed in each possible byte of a .4.ebwt/.4.bt2 file; the first base
+is in the least significant two bits.'''
+_unpacked_bytes = [''.join(['ACGT'[(byte >> shift) & 3]
+                            for shift in (0, 2, 4, 6)])
+                    for byte in xrange(256)]
+
+def unpacked_bases(packed, buf_off, count):
+    """ Decodes a stretch of 2-bit packed unambiguous bases.
+
+        Whole bytes are decoded at once with a lookup table.
+
+        packed: str or mmap with 2-bit packed bases
+        buf_off: offset of first base to decode
+        count: number of bases to decode
+
+        Return value: string of count bases
+    """
+    start = buf_off & 3
+    return ''.join(map(_unpacked_bytes.__getitem__,
+                        bytearray(packed[buf_off >> 2:
+                                         (buf_off + count + 3) >> 2])
+                    ))[start:start+count]
+
+def stretch_arrays(records):
+    """ Converts a reference's stretch records into arrays for lookups.
+
+        records: list of tuples (number of ambiguous characters preceding
+            unambiguous stretch, length of unambiguous stretch, offset of
+            unambiguous stretch in packed sequence) for a reference
+
+        Return value: tuple (array of offsets in reference of starts of
+            unambiguous stretches, array of offsets in reference of ends of
+            unambiguous stretches, array of offsets in packed sequence of
+            starts of unambiguous stretches)
+    """
+    starts, ends, buf_offs = array('l'), array('l'), array('l')
+    running_length = 0
+    for off, ln, buf_off in records:
+        running_length += off
+        starts.append(running_length)
+        running_length += ln
+        ends.append(running_length)
+        buf_offs.append(buf_off)
+    return starts, ends, buf_offs
+
+def stretch_from_arrays(packed, stretches, ref_off, count):
+    """ Extracts a stretch of characters from a reference.
+
+        Ambiguous characters and characters off either end of the reference
+        are Ns.
+
+        packed: str or mmap with 2-bit packed bases
+        stretches: arrays returned by stretch_arrays() for reference
+        ref_off: offset into reference, 0-based
+        count: # of characters
+
+        Return value: string extracted from reference
+    """
+    starts, ends, buf_offs = stretches
+    end_off = ref_off + count
+    stretch = []
+    if ref_off < 0:
+        stretch.append('N' * min(-ref_off, count))
+        ref_off = 0
+    i, stretch_count = bisect_right(ends, ref_off), len(ends)
+    while ref_off < end_off and i < stretch_count:
+        start = starts[i]
+        if start >= end_off:
+            break
+        if start > ref_off:
+            stretch.append('N' * (start - ref_off))
+            ref_off = start
+        end = min(ends[i], end_off)
+        if end > ref_off:
+            stretch.append(unpacked_bases(packed,
+                                          buf_offs[i] + ref_off - start,
+                                          end - ref_off))
+            ref_off = end
+        i += 1
+    if ref_off < end_off:
+        stretch.append('N' * (end_off - ref_off))
+    return ''.join(stretch)
+
+def stretches_from_requests(get_stretch, requests):
+    """ Extracts many stretches of characters from a reference at once.
+
+        Requests are sorted, and overlapping or abutting requests on the same
+        reference are served by a single call to get_stretch.
+
+        get_stretch: get_stretch method of index reference object
+        requests: list of tuples (ref seq name, offset into reference,
+            # of characters)
+
+        Return value: list of strings extracted from reference, one for each
+            request in the order of requests
+    """
+    stretches = [''] * len(requests)
+    spans = []
+    for i in sorted(xrange(len(requests)),
+                    key=lambda i: requests[i][:2]):
+        ref_id, ref_off, count = requests[i]
+        if count <= 0:
+            continue
+        if spans and ref_id == spans[-1][0] and ref_off <= spans[-1][2]:
+            spans[-1][2] = max(spans[-1][2], ref_off + count)
+            spans[-1][3].append(i)
+        else:
+            spans.append([ref_id, ref_off, ref_off + count, [i]])
+    for ref_id, span_start, span_end, members in spans:
+        span = get_stretch(ref_id, span_start, span_end - span_start)
+        for i in members:
+            offset = requests[i][1] - span_start
+            stretches[i] = span[offset:offset+requests[i][2]]
+    return stretches
+
+'''Compiled references are written next to Bowtie indexes with this extension.
+See BowtieIndexReference.write_compiled() for the layout.'''
+compiled_extension = '.rail.ref'
+_compiled_header = struct.Struct('<8sqqdqdqqqq')
+_compiled_magic = 'RAILREF1'
+'''Size of array('l') items, negated on big-endian machines, so compiled
+references are rebuilt rather than misread on a different platform.'''
+_compiled_itemsize = array('l').itemsize * (
+                            1 if sys.byteorder == 'little' else -1
+                        )
+
+def index_fingerprint(idx_prefix):
+    """ Identifies the version of a Bowtie index a compiled reference is from.
+
+        idx_prefix: Bowtie index basename
+
+        Return value: tuple (size of .1.ebwt, mtime of .1.ebwt, size of
+            .3.ebwt, mtime of .3.ebwt)
+    """
+    stat1 = os.stat(idx_prefix + '.1.ebwt')
+    stat3 = os.stat(idx_prefix + '.3.ebwt')
+    return (stat1.st_size, stat1.st_mtime, stat3.st_size, stat3.st_mtime)
+
+class CompiledStretches(dict):
+    """ Maps reference names to arrays returned by stretch_arrays(), reading
+        the arrays for a given reference from a compiled reference only when
+        they are first needed.
+    """
+
+    def __init__(self, compiled, offset, record_count, bounds):
+        """
+            compiled: mmap of compiled reference
+            offset: offset in compiled of starts column
+            record_count: total number of stretch records in compiled
+            bounds: dictionary mapping reference names to tuples (index of
+                first record, index of last record + 1)
+        """
+        dict.__init__(self)
+        self.compiled = compiled
+        self.offset = offset
+        self.record_count = record_count
+        self.bounds = bounds
+
+    def __missing__(self, ref_name):
+        first, last = self.bounds[ref_name]
+        itemsize = abs(_compiled_itemsize)
+        columns = []
+        for column in xrange(3):
+            start = self.offset + (
+                    column * self.record_count + first
+                ) * itemsize
+            columns.append(array('l'))
+            columns[-1].fromstring(
+                    self.compiled[start:start + (last - first) * itemsize]
+                )
+        self[ref_name] = tuple(columns)
+        return self[ref_name]
+
+    def __contains__(self, ref_name):
+        return ref_name in self.bounds
+
+    def __iter__(self):
+        return iter(self.bounds)
+
+    def __len__(self):
+        return len(self.bounds)
 
 class BowtieIndexReference(object):
     """
@@ -12,19 +197,67 @@ class BowtieIndexReference(object):
     the unambiguous-stretch sequences.  get_stretch member function can
     retrieve stretches of characters from the reference, even if the stretch
     contains ambiguous characters.
+
+    Everything but the unambiguous-stretch sequences is also saved in a
+    compiled reference next to the index the first time the index is loaded.
+    Later loads memory-map the compiled reference instead of parsing the
+    index, so reducers spend next to no time starting up and share the
+    compiled reference's pages through the OS page cache.
     """
 
-    def __init__(self, idx_prefix):
+    def __init__(self, idx_prefix, compiled=True):
+        """
+        @param idx_prefix: Bowtie index basename
+        @param compiled: True iff a compiled reference should be loaded or,
+            if it doesn't exist or is stale, written
+        """
+        if not os.path.exists(idx_prefix + '.3.ebwt'):
+            raise RuntimeError('No Bowtie index files with prefix "%s"' % idx_prefix)
+        fingerprint = index_fingerprint(idx_prefix)
+        compiled_path = idx_prefix + compiled_extension
+        if not (compiled
+                and self.load_compiled(compiled_path, fingerprint)):
+            self.parse_index(idx_prefix)
+            if compiled:
+                self.write_compiled(compiled_path, fingerprint)
+
+        #
+        # Memory-map the .4.bt2 file
+        #
+        ln_bytes = (self.unambig_length + 3) // 4
+        with open(idx_prefix + '.4.ebwt', 'rb') as fh4:
+            self.fh4mm = mmap.mmap(fh4.fileno(), ln_bytes, flags=mmap.MAP_SHARED, prot=mmap.PROT_READ)
+
+        self.rname_to_string, self.l_rname_to_string = {}, {}
+        self.string_to_rname, self.l_string_to_rname = {}, {}
+        for i, rname in enumerate(self.sorted_rnames):
+            rname_string = ('%012d' % i)
+            self.rname_to_string[rname] = rname_string
+            self.string_to_rname[rname_string] = rname
+        for i, rname in enumerate(self.lexicographically_sorted_rnames):
+            rname_string = ('%012d' % i)
+            self.l_rname_to_string[rname] = rname_string
+            self.l_string_to_rname[rname_string] = rname
+        # Handle unmapped reads
+        unmapped_string = ('%012d' % len(self.sorted_rnames))
+        self.rname_to_string['*'] = unmapped_string
+        self.string_to_rname[unmapped_string] = '*'
 
+        # For compatibility
+        self.rname_lengths = self.length
+
+    def parse_index(self, idx_prefix):
+        """
+        Parses reference names and extents of unambiguous stretches from
+        a Bowtie index.
+
+        @param idx_prefix: Bowtie index basename
+        """
         # Open file handles
-        if os.path.exists(idx_prefix + '.3.ebwt'):
-            # Small index (32-bit offsets)
-            fh1 = open(idx_prefix + '.1.ebwt', 'rb')  # for ref names
-            fh3 = open(idx_prefix + '.3.ebwt', 'rb')  # for stretch extents
-            fh4 = open(idx_prefix + '.4.ebwt', 'rb')  # for unambiguous sequence
-            sz, struct_unsigned = 4, struct.Struct('I')
-        else:
-            raise RuntimeError('No Bowtie index files with prefix "%s"' % idx_prefix)
+        # Small index (32-bit offsets)
+        fh1 = open(idx_prefix + '.1.ebwt', 'rb')  # for ref names
+        fh3 = open(idx_prefix + '.3.ebwt', 'rb')  # for stretch extents
+        sz, struct_unsigned = 4, struct.Struct('I')
 
         #
         # Parse .1.bt2 file
@@ -89,9 +322,7 @@ class BowtieIndexReference(object):
         nrecs = struct_unsigned.unpack(fh3.read(sz))[0]
 
         running_unambig, running_length = 0, 0
-        self.recs = defaultdict(list)
-        self.offset_in_ref = defaultdict(list)
-        self.unambig_preceding = defaultdict(list)
+        recs = defaultdict(list)
         length = {}
 
         ref_id, ref_namenrecs_added = 0, None
@@ -106,51 +337,156 @@ class BowtieIndexReference(object):
                 ref_id += 1
                 running_length = 0
             assert ref_name is not None
-            self.recs[ref_name].append((off, ln, first_of_chromosome))
-            self.offset_in_ref[ref_name].append(running_length)
-            self.unambig_preceding[ref_name].append(running_unambig)
+            recs[ref_name].append((off, ln, running_unambig))
             running_length += (off + ln)
             running_unambig += ln
 
         length[ref_name] = running_length
-        assert nrecs == sum(map(len, self.recs.itervalues()))
+        assert nrecs == sum(map(len, recs.itervalues()))
+        fh1.close()
+        fh3.close()
 
-        #
-        # Memory-map the .4.bt2 file
-        #
-        ln_bytes = (running_unambig + 3) // 4
-        self.fh4mm = mmap.mmap(fh4.fileno(), ln_bytes, flags=mmap.MAP_SHARED, prot=mmap.PROT_READ)
+        # Per-reference arrays of unambiguous stretch extents
+        self.stretches = {}
+        for ref_name in recs:
+            self.stretches[ref_name] = stretch_arrays(recs[ref_name])
+        self.unambig_length = running_unambig
 
         # These are per-reference
         self.length = length
         self.refnames = refnames
 
         # To facilitate sorting reference names in order of descending length
-        sorted_rnames = sorted(self.length.items(),
-                               key=lambda x: itemgetter(1)(x), reverse=True)
+        self.sorted_rnames = [rname for rname, _ in
+                                sorted(self.length.items(),
+                                       key=lambda x: itemgetter(1)(x),
+                                       reverse=True)]
         '''A case-sensitive sort is also necessary here because new versions of
         bedGraphToBigWig complain on encountering a nonlexicographic sort
         order.'''
-        lexicographically_sorted_rnames = sorted(self.length.items(),
+        self.lexicographically_sorted_rnames = [rname for rname, _ in
+                                                sorted(self.length.items(),
                                                     key=lambda x:
-                                                    itemgetter(0)(x))
-        self.rname_to_string, self.l_rname_to_string = {}, {}
-        self.string_to_rname, self.l_string_to_rname = {}, {}
-        for i, (rname, _) in enumerate(sorted_rnames):
-            rname_string = ('%012d' % i)
-            self.rname_to_string[rname] = rname_string
-            self.string_to_rname[rname_string] = rname
-        for i, (rname, _) in enumerate(lexicographically_sorted_rnames):
-            rname_string = ('%012d' % i)
-            self.l_rname_to_string[rname] = rname_string
-            self.l_string_to_rname[rname_string] = rname
-        # Handle unmapped reads
-        unmapped_string = ('%012d' % len(sorted_rnames))
-        self.rname_to_string['*'] = unmapped_string
-        self.string_to_rname[unmapped_string] = '*'
+                                                    itemgetter(0)(x))]
 
-        # For compatibility
-        self.rname_lengths = self.length
+    def write_compiled(self, compiled_path, fingerprint):
+        """
+        Writes a compiled reference that load_compiled() can read back. It's
+        written to a temporary file that's then renamed, so concurrent
+        writers and readers never see a partial compiled reference. Failure
+        to write (e.g., because the index directory is read-only) is ignored.
+
+        The compiled reference is a header, the reference names separated
+        by NULs, and then the following columns of native longs: reference
+        lengths (-1 for references with no stretch records), indexes of
+        each reference's first stretch record (plus the total number of
+        records), indexes of references in descending order of length,
+        indexes of references in lexicographic order, and the starts, ends,
+        and offsets in the packed sequence of all unambiguous stretches.
+
+        @param compiled_path: where to write compiled reference
+        @param fingerprint: index_fingerprint() of index
+        """
+        refname_index = dict(
+                (refname, i) for i, refname in enumerate(self.refnames)
+            )
+        lengths, bounds = array('l'), array('l', [0])
+        columns = (array('l'), array('l'), array('l'))
+        for refname in self.refnames:
+            lengths.append(self.length.get(refname, -1))
+            if refname in self.stretches:
+                for column, ref_column in zip(columns,
+                                              self.stretches[refname]):
+                    column.extend(ref_column)
+            bounds.append(len(columns[0]))
+        names = '\x00'.join(self.refnames)
+        compiled_dir, compiled_name = os.path.split(compiled_path)
+        try:
+            temp_fd, temp_path = tempfile.mkstemp(dir=(compiled_dir or '.'),
+                                                  prefix=compiled_name)
+        except (IOError, OSError):
+            return
+        try:
+            with os.fdopen(temp_fd, 'wb') as compiled_stream:
+                compiled_stream.write(_compiled_header.pack(
+                        _compiled_magic, _compiled_itemsize, fingerprint[0],
+                        fingerprint[1], fingerprint[2], fingerprint[3],
+                        len(self.refnames), len(columns[0]),
+                        self.unambig_length, len(names)
+                    ))
+                compiled_stream.write(names)
+                for column in ([lengths, bounds]
+                                + [array('l',
+                                    [refname_index[rname] for rname in rnames])
+                                    for rnames in (
+                                        self.sorted_rnames,
+                                        self.lexicographically_sorted_rnames
+                                    )]
+                                + list(columns)):
+                    column.tofile(compiled_stream)
+            os.chmod(temp_path, 0644)
+            os.rename(temp_path, compiled_path)
+        except (IOError, OSError):
+            try:
+                os.remove(temp_path)
+            except OSError:
+                pass
+
+    def load_compiled(self, compiled_path, fingerprint):
+        """
+        Memory-maps a compiled reference written by write_compiled().
+
+        @param compiled_path: path to compiled reference
+        @param fingerprint: index_fingerprint() of index
+        @return: True iff compiled reference exists, is from the same
+            version of the index, and was loaded
+        """
+        try:
+            with open(compiled_path, 'rb') as compiled_stream:
+                compiled = mmap.mmap(compiled_stream.fileno(), 0,
+                                     flags=mmap.MAP_SHARED,
+                                     prot=mmap.PROT_READ)
+        except (IOError, OSError, ValueError, mmap.error):
+            return False
+        if len(compiled) < _compiled_header.size:
+            return False
+        (magic, itemsize, size1, mtime1, size3, mtime3, nref, nrecs,
+            unambig_length, names_length) = _compiled_header.unpack_from(
+                                                        compiled, 0
+                                                    )
+        itemsize_bytes = abs(_compiled_itemsize)
+        names_end = _compiled_header.size + names_length
+        if (magic != _compiled_magic or itemsize != _compiled_itemsize
+                or (size1, mtime1, size3, mtime3) != fingerprint
+                or len(compiled) != names_end + (
+                        (4 * nref + 1 + 3 * nrecs) * itemsize_bytes
+                    )):
+            return False
+        self.refnames = compiled[_compiled_header.size:names_end].split(
+                                                                    '\x00'
+                                                                ) if nref \
+                            else []
+        columns = array('l')
+        columns.fromstring(
+                compiled[names_end:names_end
+                                    + (4 * nref + 1) * itemsize_bytes]
+            )
+        lengths, bounds = columns[:nref], columns[nref:2*nref+1]
+        self.length, stretch_bounds = {}, {}
+        for i, refname in enumerate(self.refnames):
+            if lengths[i] >= 0:
+                self.length[refname] = lengths[i]
+                stretch_bounds[refname] = (bounds[i], bounds[i+1])
+        self.sorted_rnames = [self.refnames[i]
+                                for i in columns[2*nref+1:3*nref+1]]
+        self.lexicographically_sorted_rnames = [self.refnames[i]
+                                                for i in columns[3*nref+1:]]
+        self.stretches = CompiledStretches(
+                compiled, names_end + (4 * nref + 1) * itemsize_bytes,
+                nrecs, stretch_bounds
+            )
+        self.unambig_length = unambig_length
+        return True
 
     def get_stretch(self, ref_id, ref_off, count):
         """
@@ -162,50 +498,21 @@ class BowtieIndexReference(object):
         @param count: # of characters
         @return: string extracted from reference
         """
-        assert ref_id in self.recs
-        # Account for negative reference offsets by padding with Ns
-        N_count = min(abs(min(ref_off, 0)), count)
-        stretch = ['N'] * N_count
-        count -= N_count
-        if not count: return ''.join(stretch)
-        ref_off = max(ref_off, 0)
-        starting_rec = bisect_right(self.offset_in_ref[ref_id], ref_off) - 1
-        assert starting_rec >= 0
-        off = self.offset_in_ref[ref_id][starting_rec]
-        buf_off = self.unambig_preceding[ref_id][starting_rec]
-        # Naive to scan these records linearly; obvious speedup is binary search
-        for rec in self.recs[ref_id][starting_rec:]:
-            off += rec[0]
-            while ref_off < off and count > 0:
-                stretch.append('N')
-                count -= 1
-                ref_off += 1
-            if count == 0:
-                break
-            if ref_off < off + rec[1]:
-                # stretch extends through part of the unambiguous stretch
-                buf_off += (ref_off - off)
-            else:
-                buf_off += rec[1]
-            off += rec[1]
-            while ref_off < off and count > 0:
-                buf_elt = buf_off >> 2
-                shift_amt = (buf_off & 3) << 1
-                stretch.append(
-                    'ACGT'[(ord(self.fh4mm[buf_elt]) >> shift_amt) & 3]
-                )
-                buf_off += 1
-                count -= 1
-                ref_off += 1
-            if count == 0:
-                break
-        # If the requested stretch went past the last unambiguous
-        # character in the chromosome, pad with Ns
-        while count > 0:
-            count -= 1
-            stretch.append('N')
-        return ''.join(stretch)
+        assert ref_id in self.stretches
+        return stretch_from_arrays(self.fh4mm, self.stretches[ref_id],
+                                   ref_off, count)
 
+    def get_stretches(self, requests):
+        """
+        Return many stretches of characters from the reference at once.
+        Overlapping requests are decoded only once.
+
+        @param requests: list of tuples (name of ref seq, 0-based offset into
+            reference, # of characters)
+        @return: list of strings extracted from reference, in the order of
+            requests
+        """
+        return stretches_from_requests(self.get_stretch, requests)
 
 def which(program):
     def is_exe(fp):
@@ -234,9 +541,17 @@ if __name__ == "__main__":
 
     parser = argparse.ArgumentParser()
     parser.add_argument('--test', action='store_const', const=True, default=False, help='Do unit tests')
+    parser.add_argument('--compile', metavar='<idx>', type=str, required=False, default=None,
+        help='Write compiled reference for Bowtie index with basename <idx> ahead of time')
 
     args = parser.parse_args()
 
+    if args.compile is not None:
+        BowtieIndexReference(args.compile)
+        if not os.path.exists(args.compile + compiled_extension):
+            raise RuntimeError('Could not write compiled reference "%s"'
+                                % (args.compile + compiled_extension))
+
     if args.test:
         import unittest
 
@@ -316,4 +631,28 @@ CA
                 self.assertEqual('NNNNNNNNN', ref.get_stretch('short_name1', 85, 9))
                 self.assertEqual('ANNNNNNNN', ref.get_stretch('short_name1', 80, 9))
 
+            def test_get_stretches(self):
+                ref = BowtieIndexReference(self.fa_fn_1)
+                requests = [('short_name4', 35, 10), ('short_name1', 72, 11),
+                            ('short_name4', 30, 10), ('short_name4', 240, 42),
+                            ('short_name2', 3, 13), ('short_name4', 45, 0),
+                            ('short_name4', 40, 5)]
+                self.assertEqual([ref.get_stretch(*request)
+                                    for request in requests],
+                                 ref.get_stretches(requests))
+
+            def test_compiled(self):
+                parsed = BowtieIndexReference(self.fa_fn_1, compiled=False)
+                self.assertFalse(os.path.exists(self.fa_fn_1 + compiled_extension))
+                BowtieIndexReference(self.fa_fn_1)
+                self.assertTrue(os.path.exists(self.fa_fn_1 + compiled_extension))
+                ref = BowtieIndexReference(self.fa_fn_1)
+                self.assertTrue(isinstance(ref.stretches, CompiledStretches))
+                self.assertEqual(parsed.length, ref.length)
+                self.assertEqual(parsed.rname_to_string, ref.rname_to_string)
+                self.assertEqual(parsed.l_rname_to_string, ref.l_rname_to_string)
+                self.assertEqual('NNNNNNNNNNNNNNNNNNNNNNNNNNNNNNNNNNNNNNNA', ref.get_stretch('short_name4', 1, 40))
+                self.assertEqual('TCAGTCAGTCAGT', ref.get_stretch('short_name2', 3, 13))
+                self.assertEqual('CANNNNNNNN', ref.get_stretch('short_name3', 0, 10))
+
         unittest.main(argv=[sys.argv[0]])
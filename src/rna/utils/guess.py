@@ -8,6 +8,7 @@ Tools for inferring the properties of samples.
 from itertools import islice
 import math
 import random
+import string
 import sys
 
 '''Ranges of possible quality values.
@@ -94,7 +95,8 @@ def phred_converter(fastq_stream=None, phred_format=None, sample_size=10000):
         Return value: a function that converts a quality string in one of
             {Sanger, Solexa, Phred64} formats to Sanger format. Scores that
             are not in the expected range are rounded to the nearest acceptable
-            value.
+            value. Each character is converted independently, so conversion
+            is a single str.translate() with a precomputed table.
     """
     assert fastq_stream is not None or phred_format is not None, (
         'Either a fastq stream must be provided to infer phred format '
@@ -103,20 +105,18 @@ def phred_converter(fastq_stream=None, phred_format=None, sample_size=10000):
         phred_format = inferred_phred_format(fastq_stream,
                                                 sample_size=sample_size)[0]
     if phred_format == 'Solexa':
-       def final_converter(qual):
-           return ''.join([
-                               chr(int(round(
-                           10*math.log(1+10**((min(max(ord(char), 59), 104)-64)
-                            /10.0),10)
-                   )+33)) for char in qual
-                ])
+        converted = [chr(int(round(
+                        10*math.log(1+10**((min(max(i, 59), 104)-64)/10.0),10)
+                    )+33)) for i in xrange(256)]
     elif phred_format == 'Sanger':
-        def final_converter(qual):
-            return ''.join(chr(min(max(ord(char), 33), 93)) for char in qual)
+        converted = [chr(min(max(i, 33), 93)) for i in xrange(256)]
     else:
         assert phred_format == 'Phred64'
         # It's Phred64
-        def final_converter(qual):
-            return ''.join(chr(min(max(ord(char), 64), 104) - 31)
-                                for char in qual)
+        converted = [chr(min(max(i, 64), 104) - 31) for i in xrange(256)]
+    conversion_table = string.maketrans(
+            ''.join([chr(i) for i in xrange(256)]), ''.join(converted)
+        )
+    def final_converter(qual):
+        return qual.translate(conversion_table)
     return final_converter
\ No newline at end of file
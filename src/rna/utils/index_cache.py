@@ -0,0 +1,321 @@
+#!/usr/bin/env python
+"""
+index_cache.py
+Part of Rail-RNA
+
+Content-addressed cache of Bowtie 2 indexes shared by all tasks on a node.
+An index is stored in a subdirectory of the cache directory named for the
+SHA-1 digest of the FASTA file from which it was built, so any task that
+would build an index from the same FASTA uses the cached one instead. When
+the cache exceeds its size bound, least recently used indexes are evicted.
+
+Tasks coordinate with flock(): the lock file .lock in the cache directory is
+held exclusively while entries are looked up, inserted, or evicted, and an
+entry's lock file <digest>.lock is held shared while the entry is in use so
+it's never evicted out from under a task.
+"""
+import os
+import fcntl
+import hashlib
+import shutil
+import tempfile
+import time
+import contextlib
+
+# Partial builds older than this many seconds are from tasks that died
+_stale_build_age = 86400
+
+def file_digest(filename, block_size=1048576):
+    """ Computes SHA-1 digest of a file's contents.
+
+        filename: path to file
+        block_size: number of bytes to read at once
+
+        Return value: hex digest
+    """
+    digest = hashlib.sha1()
+    with open(filename, 'rb') as input_stream:
+        while True:
+            block = input_stream.read(block_size)
+            if not block:
+                break
+            digest.update(block)
+    return digest.hexdigest()
+
+def directory_size(path):
+    """ Computes total size of files in a directory tree.
+
+        path: directory
+
+        Return value: size in bytes
+    """
+    size = 0
+    for root, _, filenames in os.walk(path):
+        for filename in filenames:
+            try:
+                size += os.path.getsize(os.path.join(root, filename))
+            except OSError:
+                pass
+    return size
+
+@contextlib.contextmanager
+def locked(lock_file, exclusive=True):
+    """ Holds flock() on a file, creating it if necessary.
+
+        lock_file: path to lock file
+        exclusive: True for an exclusive lock, False for a shared lock
+
+        Yield value: file descriptor of lock file
+    """
+    fd = os.open(lock_file, os.O_RDWR | os.O_CREAT, 0644)
+    try:
+        fcntl.flock(fd, fcntl.LOCK_EX if exclusive else fcntl.LOCK_SH)
+        yield fd
+    finally:
+        os.close(fd)
+
+class IndexCache(object):
+    """ Size-bounded LRU cache of Bowtie 2 indexes keyed by FASTA digest. """
+
+    def __init__(self, cache_dir, max_bytes, counter=None):
+        """
+            cache_dir: directory in which to store indexes; it's created if
+                it doesn't exist
+            max_bytes: maximum total size of cached indexes; if 0, indexes
+                aren't cached
+            counter: dooplicity.counters.Counter object to which cache hits
+                and misses are added or None if they shouldn't be counted
+        """
+        self.cache_dir = cache_dir
+        self.max_bytes = max_bytes
+        self.counter = counter
+        if self.max_bytes > 0:
+            try:
+                os.makedirs(self.cache_dir)
+            except OSError:
+                if not os.path.isdir(self.cache_dir):
+                    raise
+        self.lock_file = os.path.join(self.cache_dir, '.lock')
+
+    def _count(self, name):
+        if self.counter is not None:
+            self.counter.add(name, 1)
+
+    def evict(self, keep=None):
+        """ Evicts least recently used indexes until cache fits its bound.
+
+            Should be called only while holding the cache's lock. Entries in
+            use by any task are skipped.
+
+            keep: digest of entry that shouldn't be evicted or None
+
+            No return value.
+        """
+        entries = []
+        for name in os.listdir(self.cache_dir):
+            path = os.path.join(self.cache_dir, name)
+            if name.startswith('.building.'):
+                try:
+                    if time.time() - os.path.getmtime(path) > _stale_build_age:
+                        shutil.rmtree(path, ignore_errors=True)
+                except OSError:
+                    pass
+                continue
+            if name.startswith('.') or not os.path.isdir(path):
+                continue
+            entries.append((os.path.getmtime(path), name,
+                                directory_size(path)))
+        total_size = sum([size for _, _, size in entries])
+        entries.sort()
+        for _, name, size in entries:
+            if total_size <= self.max_bytes:
+                break
+            if name == keep:
+                continue
+            entry_lock_file = os.path.join(self.cache_dir, name + '.lock')
+            fd = os.open(entry_lock_file, os.O_RDWR | os.O_CREAT, 0644)
+            try:
+                try:
+                    fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                except IOError:
+                    # In use
+                    continue
+                shutil.rmtree(os.path.join(self.cache_dir, name),
+                                ignore_errors=True)
+                os.remove(entry_lock_file)
+                total_size -= size
+            finally:
+                os.close(fd)
+
+    @contextlib.contextmanager
+    def index(self, fasta_file, build):
+        """ Obtains Bowtie 2 index of a FASTA file, building it on a miss.
+
+            fasta_file: path to FASTA file
+            build: function that takes fasta_file and an index basename,
+                builds the index, and returns bowtie2-build's exit level
+
+            Yield value: tuple (index basename, exit level of build or 0 if
+                index was cached); the index is valid only if the exit level
+                is 0 and only within the with statement
+        """
+        if self.max_bytes <= 0:
+            build_dir = tempfile.mkdtemp(dir=os.path.dirname(fasta_file))
+            try:
+                index_basename = os.path.join(build_dir, 'index')
+                yield index_basename, build(fasta_file, index_basename)
+            finally:
+                shutil.rmtree(build_dir, ignore_errors=True)
+            return
+        digest = file_digest(fasta_file)
+        entry = os.path.join(self.cache_dir, digest)
+        entry_lock_file = entry + '.lock'
+        index_basename = os.path.join(entry, 'index')
+        with locked(self.lock_file):
+            if os.path.isdir(entry):
+                entry_lock = os.open(entry_lock_file,
+                                        os.O_RDWR | os.O_CREAT, 0644)
+                fcntl.flock(entry_lock, fcntl.LOCK_SH)
+                os.utime(entry, None)
+            else:
+                entry_lock = None
+        if entry_lock is not None:
+            self._count('index cache hits')
+            try:
+                yield index_basename, 0
+            finally:
+                os.close(entry_lock)
+            return
+        self._count('index cache misses')
+        build_dir = tempfile.mkdtemp(dir=self.cache_dir, prefix='.building.')
+        try:
+            return_code = build(fasta_file, os.path.join(build_dir, 'index'))
+            if return_code:
+                yield os.path.join(build_dir, 'index'), return_code
+                return
+            with locked(self.lock_file):
+                if not os.path.isdir(entry):
+                    os.rename(build_dir, entry)
+                # Else another task built the same index meanwhile; use it
+                entry_lock = os.open(entry_lock_file,
+                                        os.O_RDWR | os.O_CREAT, 0644)
+                fcntl.flock(entry_lock, fcntl.LOCK_SH)
+                os.utime(entry, None)
+                self.evict(keep=digest)
+            try:
+                yield index_basename, 0
+            finally:
+                os.close(entry_lock)
+        finally:
+            shutil.rmtree(build_dir, ignore_errors=True)
+
+if __name__ == '__main__':
+    import sys
+    import unittest
+    from StringIO import StringIO
+    site_path = os.path.dirname(os.path.dirname(os.path.dirname(
+                        os.path.realpath(__file__)
+                    )))
+    sys.path.insert(0, site_path)
+    from dooplicity.counters import Counter
+
+    class TestIndexCache(unittest.TestCase):
+        """ Tests IndexCache with a fake bowtie2-build. """
+        def setUp(self):
+            self.temp_dir_path = tempfile.mkdtemp()
+            self.cache_dir = os.path.join(self.temp_dir_path, 'cache')
+            self.builds = []
+            self.counter = Counter('realign_reads', StringIO())
+
+        def build(self, fasta_file, index_basename):
+            self.builds.append(fasta_file)
+            with open(fasta_file) as fasta_stream:
+                sequence = fasta_stream.read()
+            if not sequence:
+                return 1
+            with open(index_basename + '.1.bt2', 'w') as index_stream:
+                index_stream.write(sequence)
+            return 0
+
+        def fasta(self, name, sequence):
+            fasta_file = os.path.join(self.temp_dir_path, name)
+            with open(fasta_file, 'w') as fasta_stream:
+                fasta_stream.write(sequence)
+            return fasta_file
+
+        def test_hits_and_misses(self):
+            """ Fails if identical FASTAs aren't served from the cache. """
+            cache = IndexCache(self.cache_dir, 1000000, self.counter)
+            for name, sequence in [('a.fa', '>a\nACGT\n'),
+                                   ('b.fa', '>a\nACGT\n'),
+                                   ('c.fa', '>c\nGGGG\n')]:
+                with cache.index(self.fasta(name, sequence),
+                                    self.build) as (basename, return_code):
+                    self.assertEqual(return_code, 0)
+                    with open(basename + '.1.bt2') as index_stream:
+                        self.assertEqual(index_stream.read(), sequence)
+            self.assertEqual(len(self.builds), 2)
+            self.assertEqual(self.counter.get('index cache hits'), 1)
+            self.assertEqual(self.counter.get('index cache misses'), 2)
+
+        def test_failed_build(self):
+            """ Fails if failed builds are cached. """
+            cache = IndexCache(self.cache_dir, 1000000, self.counter)
+            fasta_file = self.fasta('empty.fa', '')
+            for _ in xrange(2):
+                with cache.index(fasta_file, self.build) as (_, return_code):
+                    self.assertEqual(return_code, 1)
+            self.assertEqual(len(self.builds), 2)
+            self.assertEqual(
+                    [name for name in os.listdir(self.cache_dir)
+                        if not name.startswith('.')], []
+                )
+
+        def test_eviction(self):
+            """ Fails if least recently used index isn't evicted. """
+            cache = IndexCache(self.cache_dir, 250, self.counter)
+            sequences = ['>%d\n%s\n' % (i, 'ACGT' * 25) for i in xrange(3)]
+            for i in [0, 1, 0, 2]:
+                with cache.index(self.fasta('%d.fa' % i, sequences[i]),
+                                    self.build) as (_, return_code):
+                    self.assertEqual(return_code, 0)
+                # Make modification times distinct
+                time.sleep(0.01)
+                for name in os.listdir(self.cache_dir):
+                    path = os.path.join(self.cache_dir, name)
+                    os.utime(path, (os.path.getatime(path),
+                                    os.path.getmtime(path) - 10))
+            cached = set([name for name in os.listdir(self.cache_dir)
+                            if not name.startswith('.')
+                            and not name.endswith('.lock')])
+            self.assertEqual(cached, set([file_digest(self.fasta(
+                                    '%d.fa' % i, sequences[i]
+                                )) for i in [0, 2]]))
+            self.assertEqual(self.counter.get('index cache misses'), 3)
+
+        def test_entry_in_use(self):
+            """ Fails if an index in use is evicted. """
+            cache = IndexCache(self.cache_dir, 1, self.counter)
+            with cache.index(self.fasta('a.fa', '>a\nACGT\n'),
+                                self.build) as (basename, _):
+                with cache.index(self.fasta('b.fa', '>b\nTTTT\n'),
+                                    self.build) as (_, return_code):
+                    self.assertEqual(return_code, 0)
+                self.assertTrue(os.path.exists(basename + '.1.bt2'))
+
+        def test_disabled(self):
+            """ Fails if indexes are cached when the size bound is 0. """
+            cache = IndexCache(self.cache_dir, 0, self.counter)
+            fasta_file = self.fasta('a.fa', '>a\nACGT\n')
+            for _ in xrange(2):
+                with cache.index(fasta_file, self.build) as (basename,
+                                                                return_code):
+                    self.assertEqual(return_code, 0)
+                    self.assertTrue(os.path.exists(basename + '.1.bt2'))
+            self.assertEqual(len(self.builds), 2)
+            self.assertFalse(os.path.exists(self.cache_dir))
+
+        def tearDown(self):
+            shutil.rmtree(self.temp_dir_path)
+
+    unittest.main(argv=[sys.argv[0]])
@@ -0,0 +1,316 @@
+#!/usr/bin/env python
+"""
+sequence_kernels.py
+Part of Rail-RNA
+
+Sequence operations shared by Rail-RNA steps: reverse complementation,
+canonicalization, readletization, and poly(A) detection. The batch
+functions take many sequences at once and do their work in a few operations
+on a single buffer rather than a few operations per sequence. For example,
+reversed_complements() joins sequences, reverses and complements the
+result in one pass, and splits it; the reversed concatenation of
+sequences is the concatenation of their reversals in the opposite order.
+
+A sequence's canonical form is the lesser of the sequence and its reversed
+complement.
+"""
+import string
+
+_reversed_complement_translation_table = string.maketrans('ATCG', 'TAGC')
+
+def reversed_complement(seq):
+    """ Reverse-complements a sequence.
+
+        seq: sequence; characters other than ACGT are only reversed
+
+        Return value: reversed complement of seq
+    """
+    return seq[::-1].translate(_reversed_complement_translation_table)
+
+def reversed_complements(seqs):
+    """ Reverse-complements sequences in bulk.
+
+        seqs: list of sequences, none of which may contain a newline
+
+        Return value: list of reversed complements of seqs
+    """
+    if not seqs:
+        return []
+    reversed_complements = '\n'.join(seqs)[::-1].translate(
+                                    _reversed_complement_translation_table
+                                ).split('\n')
+    reversed_complements.reverse()
+    return reversed_complements
+
+def canonical(seq):
+    """ Finds canonical form of a sequence.
+
+        seq: sequence
+
+        Return value: tuple (canonical form of seq, True iff it's the
+            reversed complement of seq)
+    """
+    reversed_complement_seq = seq[::-1].translate(
+                                    _reversed_complement_translation_table
+                                )
+    if seq < reversed_complement_seq:
+        return seq, False
+    return reversed_complement_seq, True
+
+def canonicalized(seqs):
+    """ Finds canonical forms of sequences in bulk.
+
+        seqs: list of sequences, none of which may contain a newline
+
+        Return value: list of tuples (canonical form of sequence, True iff
+            it's the reversed complement of the sequence), one per sequence
+    """
+    return [(seq, False) if seq < reversed_complement_seq
+                else (reversed_complement_seq, True)
+                for seq, reversed_complement_seq
+                in zip(seqs, reversed_complements(seqs))]
+
+def is_poly_a(seq):
+    """ Checks whether a sequence is a nonempty run of As.
+
+        seq: sequence
+
+        Return value: True iff seq is all As
+    """
+    return bool(seq) and not seq.strip('A')
+
+def poly_a_flags(seqs):
+    """ Checks whether sequences are nonempty runs of As in bulk.
+
+        seqs: list of sequences
+
+        Return value: list of bools, True iff the corresponding sequence is
+            all As
+    """
+    return [bool(seq) and not seq.strip('A') for seq in seqs]
+
+def readlet_extents(seq_size, cap_sizes, max_readlet_size, readlet_interval):
+    """ Finds where readlets of a read sequence start and end.
+
+        Capping readlets include a read's ends. For each cap size, the cap
+        at the 5' end and then the cap at the 3' end are included; a cap
+        longer than the read is the entire read. Noncapping readlets have
+        size max_readlet_size and start every readlet_interval bases from
+        the 5' end, stopping before one would reach the 3' end.
+
+        seq_size: length of read sequence
+        cap_sizes: list of sizes of capping readlets
+        max_readlet_size: size of every noncapping readlet
+        readlet_interval: number of bases separating successive readlets
+            along the read
+
+        Return value: list of tuples (displacement of readlet's 5' end from
+            read's 5' end, displacement of readlet's 3' end from read's 3'
+            end)
+    """
+    extents = []
+    for cap_size in cap_sizes:
+        extents.append((0, seq_size - cap_size))
+        extents.append((seq_size - cap_size, 0))
+    for j in xrange(readlet_interval, seq_size - max_readlet_size,
+                        readlet_interval):
+        extents.append((j, seq_size - j - max_readlet_size))
+    return extents
+
+class Readletizer(object):
+    """ Divides read sequences into canonicalized readlets.
+
+        Where readlets start and end depends only on a read's length, and
+        reads in a run have few distinct lengths, so the layout of readlets
+        for each length is computed once and cached. A read is then
+        readletized by reverse-complementing it once and slicing both it and
+        its reversed complement.
+    """
+    def __init__(self, cap_sizes, max_readlet_size=25, readlet_interval=5,
+                    drop_poly_a=False):
+        """
+            cap_sizes: list of sizes of capping readlets
+            max_readlet_size: size of every noncapping readlet
+            readlet_interval: number of bases separating successive readlets
+                along a read
+            drop_poly_a: True iff readlets whose canonical forms are all As
+                should be omitted
+        """
+        self.cap_sizes = list(cap_sizes)
+        self.max_readlet_size = max_readlet_size
+        self.readlet_interval = readlet_interval
+        self.drop_poly_a = drop_poly_a
+        self._layouts = {}
+
+    def layout(self, seq_size):
+        """ Finds where readlets of a read of a given length lie.
+
+            seq_size: length of read sequence
+
+            Return value: list of tuples (start of readlet in read, end of
+                readlet in read, start of readlet's reversed complement in
+                read's reversed complement, end of same, displacement of
+                readlet's 5' end from read's 5' end, displacement of readlet's
+                3' end from read's 3' end)
+        """
+        try:
+            return self._layouts[seq_size]
+        except KeyError:
+            pass
+        layout = []
+        for five_prime_displacement, three_prime_displacement in \
+                readlet_extents(seq_size, self.cap_sizes,
+                                    self.max_readlet_size,
+                                    self.readlet_interval):
+            # A cap longer than the read is the whole read
+            start = max(five_prime_displacement, 0)
+            end = min(seq_size - three_prime_displacement, seq_size)
+            layout.append((start, end, seq_size - end, seq_size - start,
+                            five_prime_displacement,
+                            three_prime_displacement))
+        self._layouts[seq_size] = layout
+        return layout
+
+    def readlets(self, seq, reversed_complement_seq=None):
+        """ Readletizes a read sequence.
+
+            seq: read sequence
+            reversed_complement_seq: reversed complement of seq if it's
+                already known or None to compute it here
+
+            Return value: list of tuples (canonical readlet sequence, True
+                iff it's the reversed complement of the readlet, displacement
+                of readlet's 5' end from read's 5' end, displacement of
+                readlet's 3' end from read's 3' end)
+        """
+        if reversed_complement_seq is None:
+            reversed_complement_seq = seq[::-1].translate(
+                                        _reversed_complement_translation_table
+                                    )
+        readlets = []
+        for (start, end, reversed_start, reversed_end,
+                five_prime_displacement, three_prime_displacement) \
+                in self.layout(len(seq)):
+            readlet_seq = seq[start:end]
+            reversed_complement_readlet_seq = reversed_complement_seq[
+                                                    reversed_start:reversed_end
+                                                ]
+            if readlet_seq < reversed_complement_readlet_seq:
+                reversed_readlet = False
+            else:
+                readlet_seq = reversed_complement_readlet_seq
+                reversed_readlet = True
+            if (self.drop_poly_a and readlet_seq
+                    and not readlet_seq.strip('A')):
+                continue
+            readlets.append((readlet_seq, reversed_readlet,
+                                five_prime_displacement,
+                                three_prime_displacement))
+        return readlets
+
+    def readletized(self, seqs):
+        """ Readletizes read sequences in bulk.
+
+            All reads are reverse-complemented together with
+            reversed_complements() before they're sliced.
+
+            seqs: list of read sequences, none of which may contain a newline
+
+            Return value: list with one item per read: the list readlets()
+                returns for it
+        """
+        return [self.readlets(seq, reversed_complement_seq)
+                    for seq, reversed_complement_seq
+                    in zip(seqs, reversed_complements(seqs))]
+
+def readletized(seqs, cap_sizes, max_readlet_size=25, readlet_interval=5,
+                    drop_poly_a=False):
+    """ Divides read sequences into canonicalized readlets in bulk.
+
+        See readlet_extents() for how readlets are placed.
+
+        seqs: list of read sequences
+        cap_sizes: list of sizes of capping readlets
+        max_readlet_size: size of every noncapping readlet
+        readlet_interval: number of bases separating successive readlets
+            along a read
+        drop_poly_a: True iff readlets whose canonical forms are all As
+            should be omitted
+
+        Return value: list with one item per read: a list of tuples
+            (canonical readlet sequence, True iff it's the reversed complement
+            of the readlet, displacement of readlet's 5' end from read's 5'
+            end, displacement of readlet's 3' end from read's 3' end)
+    """
+    return Readletizer(cap_sizes, max_readlet_size, readlet_interval,
+                        drop_poly_a).readletized(seqs)
+
+if __name__ == '__main__':
+    import sys
+    import random
+    import unittest
+
+    class TestSequenceKernels(unittest.TestCase):
+        """ Compares bulk kernels with one-sequence-at-a-time versions. """
+        def setUp(self):
+            random.seed(17)
+            self.seqs = [''.join([random.choice('ACGTN')
+                                    for _ in xrange(random.randint(0, 60))])
+                            for _ in xrange(500)] + ['AAAAAAAA', 'TTTTTTTT']
+
+        def test_reversed_complements(self):
+            """ Fails if bulk reverse complementation is wrong. """
+            self.assertEqual(reversed_complements(self.seqs),
+                             [reversed_complement(seq) for seq in self.seqs])
+            self.assertEqual(reversed_complements([]), [])
+            self.assertEqual(reversed_complements(['']), [''])
+            self.assertEqual(reversed_complement('AACGTN'), 'NACGTT')
+
+        def test_canonicalized(self):
+            """ Fails if bulk canonicalization is wrong. """
+            self.assertEqual(canonicalized(self.seqs),
+                             [canonical(seq) for seq in self.seqs])
+            self.assertEqual(canonical('TTTT'), ('AAAA', True))
+            self.assertEqual(canonical('ACGT'), ('ACGT', True))
+
+        def test_poly_a(self):
+            """ Fails if poly(A) isn't detected properly. """
+            self.assertEqual(poly_a_flags(['AAAA', 'AAAT', '', 'A']),
+                             [True, False, False, True])
+            self.assertEqual(poly_a_flags(self.seqs),
+                             [is_poly_a(seq) for seq in self.seqs])
+
+        def test_readletized(self):
+            """ Fails if readlets differ from those of a direct loop. """
+            cap_sizes = [8, 12, 20, 70]
+            for drop_poly_a in [False, True]:
+                readlets = readletized(self.seqs, cap_sizes, 25, 5,
+                                        drop_poly_a=drop_poly_a)
+                for seq, read_readlets in zip(self.seqs, readlets):
+                    seq_size = len(seq)
+                    expected = []
+                    for cap_size in cap_sizes:
+                        expected.append(canonical(seq[:cap_size])
+                                            + (0, seq_size - cap_size))
+                        expected.append(canonical(seq[-cap_size:])
+                                            + (seq_size - cap_size, 0))
+                    for j in xrange(5, seq_size - 25, 5):
+                        expected.append(canonical(seq[j:j+25])
+                                            + (j, seq_size - j - 25))
+                    if drop_poly_a:
+                        expected = [readlet for readlet in expected
+                                        if not is_poly_a(readlet[0])]
+                    self.assertEqual(read_readlets, expected)
+                    self.assertEqual(read_readlets,
+                                     Readletizer(cap_sizes, 25, 5,
+                                                 drop_poly_a).readlets(seq))
+
+        def test_layout_cache(self):
+            """ Fails if layouts aren't reused across reads of a length. """
+            readletizer = Readletizer([8, 12, 25], 25, 5)
+            self.assertTrue(readletizer.layout(50) is readletizer.layout(50))
+            self.assertEqual(sorted(readletizer._layouts.keys()), [50])
+            self.assertEqual(readletizer.readlets('ACGTT' * 10),
+                             readletized(['ACGTT' * 10], [8, 12, 25])[0])
+
+    unittest.main(argv=[sys.argv[0]])
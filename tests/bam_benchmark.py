@@ -0,0 +1,204 @@
+#!/usr/bin/env python
+"""
+bam_benchmark.py
+
+Compares Rail-RNA's native BAM writer (src/rna/utils/bam_writer.py) with the
+samtools path it replaced, where SAM text is piped into samtools view -bS and
+the finished BAM is indexed with samtools index. Each is timed writing and
+indexing the same coordinate-sorted records. Pass a SAM file (e.g., from
+running Rail-RNA with --output-sam on the example data in ex/) or omit it to
+synthesize --records records. The samtools path is skipped if samtools can't
+be found. Also reported is how long compressing the BAM's data into BGZF
+blocks takes on one thread: this is the share of the native writer's work
+that its compression threads take off the thread encoding records.
+"""
+import argparse
+import os
+import sys
+import random
+import shutil
+import subprocess
+import tempfile
+import time
+
+base_path = os.path.abspath(
+                    os.path.join(os.path.dirname(__file__), os.pardir, 'src')
+                )
+sys.path.insert(0, os.path.join(base_path, 'rna', 'utils'))
+from bam_writer import BamWriter
+import bgzf
+
+def synthesized_sam(temp_dir, records):
+    """ Writes a SAM file with coordinate-sorted random records.
+
+        temp_dir: where to write file
+        records: number of records
+
+        Return value: path to file
+    """
+    rname_lengths = [('chr%d' % (i + 1), 50000000) for i in xrange(4)]
+    sam_file = os.path.join(temp_dir, 'synthetic.sam')
+    with open(sam_file, 'w') as sam_stream:
+        print >>sam_stream, '@HD\tVN:1.0\tSO:coordinate'
+        for rname, length in rname_lengths:
+            print >>sam_stream, '@SQ\tSN:%s\tLN:%d' % (rname, length)
+        for rname, length in rname_lengths:
+            for i, pos in enumerate(sorted(
+                        [random.randint(1, length - 1000)
+                            for _ in xrange(records // len(rname_lengths))]
+                    )):
+                cigar = random.choice(['76M', '76M', '76M', '30M2000N46M'])
+                print >>sam_stream, '\t'.join([
+                        'read%d' % i, random.choice(['0', '16', '256']),
+                        rname, str(pos), '255', cigar, '*', '0', '0',
+                        ''.join([random.choice('ACGT') for _ in xrange(76)]),
+                        ''.join([random.choice('ABCDEFGHIJ')
+                                    for _ in xrange(76)]),
+                        'NM:i:%d' % random.randint(0, 3), 'MD:Z:76',
+                        'XS:A:+', 'NH:i:1'
+                    ])
+    return sam_file
+
+def header_and_records(sam_file):
+    """ Reads a SAM file into memory.
+
+        sam_file: path to SAM
+
+        Return value: tuple (header, list of RNAMEs, dictionary mapping
+            RNAMEs to lengths, list of records as lists of fields)
+    """
+    header, rnames, rname_lengths, records = [], [], {}, []
+    with open(sam_file) as sam_stream:
+        for line in sam_stream:
+            if line[0] == '@':
+                header.append(line.rstrip('\n'))
+                if line.startswith('@SQ'):
+                    tokens = dict(token.split(':', 1)
+                                    for token
+                                    in line.rstrip('\n').split('\t')[1:])
+                    rnames.append(tokens['SN'])
+                    rname_lengths[tokens['SN']] = int(tokens['LN'])
+            else:
+                records.append(line.rstrip('\n').split('\t'))
+    return '\n'.join(header), rnames, rname_lengths, records
+
+def time_native(temp_dir, header, rnames, rname_lengths, records, threads,
+                    level):
+    """ Times writing a BAM and its index with BamWriter.
+
+        temp_dir: where to write BAM
+        header, rnames, rname_lengths, records: from header_and_records()
+        threads: number of compression threads
+        level: zlib compression level
+
+        Return value: tuple (seconds elapsed, size of BAM)
+    """
+    bam_file = os.path.join(temp_dir, 'native.bam')
+    start_time = time.time()
+    bam_writer = BamWriter(bam_file, header, rnames, rname_lengths,
+                            index_filename=bam_file + '.bai', level=level,
+                            threads=threads)
+    for record in records:
+        bam_writer.write(record)
+    bam_writer.close()
+    return time.time() - start_time, os.path.getsize(bam_file)
+
+def time_compression(bam_file, level):
+    """ Times compressing a BAM's uncompressed data into BGZF blocks.
+
+        bam_file: path to BAM
+        level: zlib compression level
+
+        Return value: tuple (seconds elapsed, number of bytes compressed)
+    """
+    import gzip
+    data = gzip.open(bam_file).read()
+    start_time = time.time()
+    bgzf.compressed_blocks(data, level)
+    return time.time() - start_time, len(data)
+
+def time_samtools(temp_dir, samtools_exe, header, records):
+    """ Times writing a BAM and its index the way Rail-RNA used to.
+
+        temp_dir: where to write BAM
+        samtools_exe: path to samtools
+        header: SAM header
+        records: list of records as lists of fields
+
+        Return value: tuple (seconds elapsed, size of BAM)
+    """
+    bam_file = os.path.join(temp_dir, 'samtools.bam')
+    start_time = time.time()
+    with open(bam_file, 'wb') as bam_stream:
+        samtools_process = subprocess.Popen(
+                    [samtools_exe, 'view', '-bS', '-'],
+                    stdin=subprocess.PIPE,
+                    stdout=bam_stream
+                )
+        print >>samtools_process.stdin, header
+        for record in records:
+            print >>samtools_process.stdin, '\t'.join(record)
+        samtools_process.stdin.close()
+        if samtools_process.wait():
+            raise RuntimeError('samtools view failed.')
+    subprocess.check_call([samtools_exe, 'index', bam_file])
+    return time.time() - start_time, os.path.getsize(bam_file)
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__,
+                formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--sam', type=str, required=False, default=None,
+            help='Coordinate-sorted SAM; records are synthesized if omitted')
+    parser.add_argument('--records', type=int, required=False,
+            default=400000,
+            help='Number of records to synthesize')
+    parser.add_argument('--threads', type=int, nargs='+', required=False,
+            default=[1, 2, 4],
+            help='Numbers of compression threads with which to write BAMs')
+    parser.add_argument('--gzip-level', type=int, required=False,
+            default=6,
+            help='Level of gzip compression for native writer')
+    parser.add_argument('--samtools', type=str, required=False,
+            default='samtools',
+            help='Path to samtools executable')
+    args = parser.parse_args()
+    random.seed(0)
+    temp_dir = tempfile.mkdtemp()
+    try:
+        sam_file = args.sam
+        if sam_file is None:
+            sam_file = synthesized_sam(temp_dir, args.records)
+        header, rnames, rname_lengths, records = header_and_records(
+                                                                sam_file
+                                                            )
+        for threads in args.threads:
+            elapsed, size = time_native(temp_dir, header, rnames,
+                                        rname_lengths, records, threads,
+                                        args.gzip_level)
+            print >>sys.stderr, (
+                    'native, %d thread(s): %d records in %.3f s; '
+                    '%.0f records/s; %d bytes' % (
+                            threads, len(records), elapsed,
+                            len(records) / max(elapsed, 1e-9), size
+                        )
+                )
+        elapsed, size = time_compression(os.path.join(temp_dir,
+                                                        'native.bam'),
+                                            args.gzip_level)
+        print >>sys.stderr, (
+                'BGZF compression alone, 1 thread: %d bytes in %.3f s'
+                % (size, elapsed)
+            )
+        try:
+            elapsed, size = time_samtools(temp_dir, args.samtools, header,
+                                            records)
+        except OSError:
+            print >>sys.stderr, 'samtools not found; skipping samtools path.'
+        else:
+            print >>sys.stderr, (
+                    'samtools: %d records in %.3f s; %.0f records/s; '
+                    '%d bytes' % (len(records), elapsed,
+                                    len(records) / max(elapsed, 1e-9), size)
+                )
+    finally:
+        shutil.rmtree(temp_dir)
@@ -0,0 +1,149 @@
+#!/usr/bin/env python
+"""
+get_stretch_benchmark.py
+
+Measures how fast reference sequence is extracted from a Bowtie index by
+BowtieIndexReference.get_stretch(), which decodes whole bytes of the packed
+reference at once, and by get_stretches(), which serves overlapping requests
+with a single decode. Both are compared with the per-base decoding loop
+get_stretch() previously used, and all three must return the same stretches.
+
+Example:
+
+python get_stretch_benchmark.py --bowtie-idx /path/to/genome
+
+Pass --bowtie2-idx to benchmark Bowtie2IndexReference as well.
+"""
+import argparse
+import os
+import sys
+import random
+import time
+from bisect import bisect_right
+
+base_path = os.path.abspath(
+                    os.path.join(os.path.dirname(__file__), os.pardir, 'src')
+                )
+sys.path.insert(0, os.path.join(base_path, 'rna', 'utils'))
+from bowtie_index import BowtieIndexReference
+from bowtie2_index import Bowtie2IndexReference
+
+def legacy_get_stretch(packed, (starts, ends, buf_offs), ref_off, count):
+    """ Extracts a stretch of characters from the reference one base at a time.
+
+        This is how get_stretch() decoded the packed reference before it was
+        vectorized.
+
+        packed: str or mmap with 2-bit packed bases
+        (starts, ends, buf_offs): arrays returned by
+            bowtie_index.stretch_arrays() for reference
+        ref_off: offset into reference, 0-based
+        count: # of characters
+
+        Return value: string extracted from reference
+    """
+    N_count = min(abs(min(ref_off, 0)), count)
+    stretch = ['N'] * N_count
+    count -= N_count
+    if not count: return ''.join(stretch)
+    ref_off = max(ref_off, 0)
+    for i in xrange(max(bisect_right(ends, ref_off) - 1, 0), len(starts)):
+        while ref_off < starts[i] and count > 0:
+            stretch.append('N')
+            count -= 1
+            ref_off += 1
+        if count == 0:
+            break
+        buf_off = buf_offs[i] + ref_off - starts[i]
+        while ref_off < ends[i] and count > 0:
+            stretch.append(
+                'ACGT'[(ord(packed[buf_off >> 2]) >> ((buf_off & 3) << 1)) & 3]
+            )
+            buf_off += 1
+            count -= 1
+            ref_off += 1
+        if count == 0:
+            break
+    stretch.extend(['N'] * count)
+    return ''.join(stretch)
+
+def benchmark(reference_index, stretches, lengths, request_count,
+                request_length):
+    """ Times extraction of random stretches from a reference.
+
+        reference_index: BowtieIndexReference or Bowtie2IndexReference
+        stretches: dictionary mapping reference names to arrays returned by
+            bowtie_index.stretch_arrays()
+        lengths: dictionary mapping reference names to their lengths
+        request_count: number of stretches to extract
+        request_length: maximum length of each stretch
+
+        Return value: tuple (legacy requests/s, get_stretch requests/s,
+            get_stretches requests/s)
+    """
+    rnames = lengths.keys()
+    weights = [lengths[rname] for rname in rnames]
+    total_weight = float(sum(weights))
+    requests = []
+    for _ in xrange(request_count):
+        # Sample references in proportion to their lengths
+        pick, rname = random.random() * total_weight, rnames[-1]
+        for candidate, weight in zip(rnames, weights):
+            if pick < weight:
+                rname = candidate
+                break
+            pick -= weight
+        requests.append((rname,
+                         random.randint(-10, lengths[rname]),
+                         random.randint(1, request_length)))
+    start_time = time.time()
+    legacy = [legacy_get_stretch(reference_index.fh4mm, stretches[rname],
+                                  ref_off, count)
+                for rname, ref_off, count in requests]
+    legacy_time = time.time() - start_time
+    start_time = time.time()
+    single = [reference_index.get_stretch(*request) for request in requests]
+    single_time = time.time() - start_time
+    start_time = time.time()
+    batched = reference_index.get_stretches(requests)
+    batched_time = time.time() - start_time
+    assert legacy == single == batched
+    return (request_count / legacy_time, request_count / single_time,
+            request_count / batched_time)
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__,
+                formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--bowtie-idx', type=str, required=True,
+            help='path to Bowtie index basename')
+    parser.add_argument('--bowtie2-idx', type=str, required=False,
+            default=None,
+            help='path to Bowtie 2 index basename')
+    parser.add_argument('--requests', type=int, required=False,
+            default=200000,
+            help='number of stretches to extract')
+    parser.add_argument('--lengths', type=str, required=False,
+            default='50,200,1000,10000',
+            help='comma-separated list of maximum stretch lengths to try')
+    args = parser.parse_args()
+    random.seed(0)
+    print '\t'.join(['index', 'max length', 'legacy (req/s)',
+                     'get_stretch (req/s)', 'get_stretches (req/s)'])
+    reference_index = BowtieIndexReference(args.bowtie_idx)
+    indexes = [('bowtie', reference_index, reference_index.stretches,
+                reference_index.length)]
+    if args.bowtie2_idx is not None:
+        reference_index = Bowtie2IndexReference(args.bowtie2_idx)
+        indexes.append(('bowtie2', reference_index,
+                        dict(zip(reference_index.refnames,
+                                 reference_index.stretches)),
+                        dict(zip(reference_index.refnames,
+                                 reference_index.lengths))))
+    for name, reference_index, stretches, lengths in indexes:
+        for request_length in [int(length) for length
+                                in args.lengths.split(',')]:
+            results = benchmark(reference_index, stretches, lengths,
+                                args.requests, request_length)
+            print '\t'.join([name, str(request_length)]
+                            + ['%.0f' % result for result in results])
+            sys.stdout.flush()
@@ -0,0 +1,453 @@
+#!/usr/bin/env python
+"""
+maximum_clique_regression.py
+
+Checks junction_search.maximum_clique(), which finds a heaviest chain of
+order-consistent alignments, against the Bron-Kerbosch enumeration of maximal
+cliques it replaced. alignment_adjacencies() and maximum_clique() below are
+junction_search.py's code from before the replacement, verbatim, including
+the random.choice() that broke ties among largest cliques. Recorded readlet
+alignments are replayed through selected_readlet_alignments_by_clustering(),
+seeding the random number generator with each read's sequence just as
+junction_search.py does, and both selectors are run on every cluster it forms
+from the same random state.
+
+Record junction_search.py's input by running Rail-RNA with
+--keep-intermediates and pass the input files to the "Search for junctions"
+step, e.g.,
+
+python maximum_clique_regression.py intermediates/align_readlets/*
+
+If no files are passed, --synthesize reads with repetitive readlet alignments
+are generated instead.
+
+Where the old enumeration found exactly one largest clique, the heaviest chain
+must be that clique. Ties can't be expected to resolve identically: the old
+code picked from the largest cliques in the order its sets iterated, which
+the heaviest chain can't reproduce without enumerating. For a tied cluster,
+only the number of alignments in the chosen clique (its weight) and its
+number of distinct (strand, displacement, position) points (its size) are
+compared. Both selectors must consume the same randomness either way, so
+later selections for a read are made from the same random state.
+
+The old enumeration's test of order consistency wasn't symmetric for two
+alignments on the same strand at the same position with different
+displacements: the one with the smaller displacement counted the other as a
+neighbor, but not vice versa. On a cluster with such a pair, the cliques the
+old code found depended on the order in which its sets iterated, and the one
+it chose could hold both alignments of the pair, breaking the rule that
+positions increase with displacement. maximum_clique() applies the rule
+strictly, so these clusters are tallied as asymmetric rather than compared.
+
+Exit level is 1 iff the selectors disagree on any other cluster.
+"""
+import argparse
+import os
+import sys
+import random
+import time
+from collections import defaultdict
+
+base_path = os.path.abspath(
+                    os.path.join(os.path.dirname(__file__), os.pardir, 'src')
+                )
+sys.path.insert(0, os.path.join(base_path, 'rna', 'steps'))
+import junction_search
+from dooplicity.tools import xopen
+
+def alignment_adjacencies(alignments):
+    """ Generates adjacency matrix for graph described below.
+
+        Consider an undirected graph where each node corresponds to
+        an alignment of a distinct multireadlet. Place an edge between two
+        nodes that are "order-consistent"; that is:
+
+        1) They have the same strand label
+        2) If the displacements of the corresponding readlets from the 5' end
+        of the read are equal, their genomic positions on the reference are
+        also equal.
+        3) If the displacement of node A is greater than the displacement of
+        node B, the genomic position of node A is greater than the genomic
+        position of node B.
+
+        cluster: a list of alignment tuples
+            (rname, reverse_strand, pos, end_pos, displacement), each
+            corresponding to a distinct readlet
+        
+        Yield value: tuple (node A, [list of nodes that connect to A])
+    """
+    for compared_alignment in alignments:
+        yield (compared_alignment, [alignment 
+                                    for alignment in alignments
+                                    if (compared_alignment[:2] == alignment[:2]
+                                    and (compared_alignment[2]
+                                            == alignment[2]
+                                            if compared_alignment[4]
+                                            == alignment[4] else
+                                            ((compared_alignment[2]
+                                                < alignment[2])
+                                            == (compared_alignment[4]
+                                                < alignment[4]))))])
+
+def maximum_clique(cluster):
+    """ Finds maximum clique of graph of multireadlet alignment cluster.
+
+        Consider an undirected graph where each node corresponds to
+        an alignment of a distinct multireadlet. Place an edge between two
+        nodes that are "order-consistent"; that is:
+
+        1) They have the same strand label
+        2) If the displacements of the corresponding readlets from the 5' end
+        of the read are equal, their genomic positions on the reference are
+        also equal.
+        3) If the displacement of node A is greater than the displacement of
+        node B, the genomic position of node A is greater than the genomic
+        position of node B.
+
+        Now enumerate maximal cliques. This gives all possible maximal groups
+        of mutually consistent alignments. Return the largest group. If there's
+        a tie, break it at random.
+
+        This code is adapted from NetworkX's find_cliques(), which requires
+        inclusion of the following copyright notice.
+
+        --------
+        Copyright (C) 2004-2012, NetworkX Developers
+        Aric Hagberg <hagberg@lanl.gov>
+        Dan Schult <dschult@colgate.edu>
+        Pieter Swart <swart@lanl.gov>
+        All rights reserved.
+
+        Redistribution and use in source and binary forms, with or without
+        modification, are permitted provided that the following conditions are
+        met:
+
+          * Redistributions of source code must retain the above copyright
+            notice, this list of conditions and the following disclaimer.
+
+          * Redistributions in binary form must reproduce the above
+            copyright notice, this list of conditions and the following
+            disclaimer in the documentation and/or other materials provided
+            with the distribution.
+
+          * Neither the name of the NetworkX Developers nor the names of its
+            contributors may be used to endorse or promote products derived
+            from this software without specific prior written permission.
+
+
+        THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS
+        "AS IS" AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT
+        LIMITED TO, THE IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR
+        A PARTICULAR PURPOSE ARE DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT
+        OWNER OR CONTRIBUTORS BE LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL,
+        SPECIAL, EXEMPLARY, OR CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT
+        LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES; LOSS OF USE,
+        DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER CAUSED AND ON ANY
+        THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT
+        (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE
+        OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+        --------
+
+        cluster: a list of alignment tuples
+            (rname, reverse_strand, pos, end_pos, displacement), each
+            corresponding to a distinct readlet
+        
+        Return value: maximum clique -- a list of alignments.
+    """
+    cliques = []
+    # Cache nbrs and find first pivot (highest degree)
+    maxconn=-1
+    nnbrs={}
+    pivotnbrs=set() # handle empty graph
+    for n,nbrs in alignment_adjacencies(cluster):
+        nbrs=set(nbrs)
+        nbrs.discard(n)
+        conn = len(nbrs)
+        if conn > maxconn:
+            nnbrs[n] = pivotnbrs = nbrs
+            maxconn = conn
+        else:
+            nnbrs[n] = nbrs
+    # Initial setup
+    cand=set(nnbrs)
+    smallcand = set(cand - pivotnbrs)
+    done=set()
+    stack=[]
+    clique_so_far=[]
+    # Start main loop
+    while smallcand or stack:
+        try:
+            # Any nodes left to check?
+            n=smallcand.pop()
+        except KeyError:
+            # back out clique_so_far
+            cand,done,smallcand = stack.pop()
+            clique_so_far.pop()
+            continue
+        # Add next node to clique
+        clique_so_far.append(n)
+        cand.remove(n)
+        done.add(n)
+        nn=nnbrs[n]
+        new_cand = cand & nn
+        new_done = done & nn
+        # check if we have more to search
+        if not new_cand:
+            if not new_done:
+                # Found a clique!
+                cliques.append(clique_so_far[:])
+            clique_so_far.pop()
+            continue
+        # Shortcut--only one node left!
+        if not new_done and len(new_cand)==1:
+            cliques.append(clique_so_far + list(new_cand))
+            clique_so_far.pop()
+            continue
+        # find pivot node (max connected in cand)
+        # look in done nodes first
+        numb_cand=len(new_cand)
+        maxconndone=-1
+        for n in new_done:
+            cn = new_cand & nnbrs[n]
+            conn=len(cn)
+            if conn > maxconndone:
+                pivotdonenbrs=cn
+                maxconndone=conn
+                if maxconndone==numb_cand:
+                    break
+        # Shortcut--this part of tree already searched
+        if maxconndone == numb_cand:
+            clique_so_far.pop()
+            continue
+        # still finding pivot node
+        # look in cand nodes second
+        maxconn=-1
+        for n in new_cand:
+            cn = new_cand & nnbrs[n]
+            conn=len(cn)
+            if conn > maxconn:
+                pivotnbrs=cn
+                maxconn=conn
+                if maxconn == numb_cand-1:
+                    break
+        # pivot node is max connected in cand from done or cand
+        if maxconndone > maxconn:
+            pivotnbrs = pivotdonenbrs
+        # save search status for later backout
+        stack.append( (cand, done, smallcand) )
+        cand=new_cand
+        done=new_done
+        smallcand = cand - pivotnbrs
+    try:
+        max_clique_size = max(map(len, cliques))
+    except ValueError:
+        assert not cluster
+        return []
+    largest_cliques = [clique for clique in cliques
+                        if len(clique) == max_clique_size]
+    largest_clique_count = len(largest_cliques)
+    assert largest_clique_count >= 1
+    if largest_clique_count == 1:
+        return largest_cliques[0]
+    return random.choice(largest_cliques)
+
+def clique_weight_and_size(clique):
+    """ Measures a clique for comparison when a tie was broken.
+
+        clique: list of alignment tuples
+            (rname, reverse_strand, pos, end_pos, displacement)
+
+        Return value: tuple (number of alignments, number of distinct
+            (strand label, displacement, position) points)
+    """
+    return len(clique), len(set([(alignment[:2], alignment[4], alignment[2])
+                                    for alignment in clique]))
+
+def has_same_position_pair(cluster):
+    """ Checks whether old order-consistency test was asymmetric on a
+        cluster.
+
+        cluster: a list of alignment tuples
+            (rname, reverse_strand, pos, end_pos, displacement)
+
+        Return value: True iff two alignments have the same strand label and
+            position but different displacements
+    """
+    displacements = {}
+    for alignment in cluster:
+        if displacements.setdefault(alignment[:3],
+                                    alignment[4]) != alignment[4]:
+            return True
+    return False
+
+class Comparison(object):
+    """ Runs both selectors on each cluster and tallies how they compare. """
+
+    def __init__(self, maximum_clique):
+        """
+            maximum_clique: heaviest chain selector
+        """
+        self.maximum_clique = maximum_clique
+        self.tallies = defaultdict(int)
+        self.enumeration_time = 0
+        self.chain_time = 0
+        self.regressions = []
+
+    def __call__(self, cluster):
+        """ Compares selectors on cluster.
+
+            Random state afterward is what the enumeration would have left,
+            so replay of a read proceeds as it once did.
+
+            cluster: a list of alignment tuples
+                (rname, reverse_strand, pos, end_pos, displacement), each
+                corresponding to a distinct readlet
+
+            Return value: clique selected by enumeration
+        """
+        random_state = random.getstate()
+        start_time = time.time()
+        old_clique = maximum_clique(cluster)
+        self.enumeration_time += time.time() - start_time
+        old_random_state = random.getstate()
+        # random.choice() was called iff largest cliques were tied
+        tied = (old_random_state != random_state)
+        random.setstate(random_state)
+        start_time = time.time()
+        new_clique = self.maximum_clique(cluster)
+        self.chain_time += time.time() - start_time
+        # Later selections depend on both consuming the same randomness
+        same_random_state = (random.getstate() == old_random_state)
+        random.setstate(old_random_state)
+        if sorted(new_clique) == sorted(old_clique) and same_random_state:
+            outcome = 'identical'
+        elif (tied and same_random_state
+                and clique_weight_and_size(new_clique)
+                    == clique_weight_and_size(old_clique)):
+            outcome = 'equivalent'
+        elif has_same_position_pair(cluster):
+            outcome = 'asymmetric'
+        else:
+            outcome = 'different'
+            self.regressions.append((cluster, old_clique, new_clique))
+        if tied:
+            self.tallies['tied'] += 1
+        self.tallies[outcome] += 1
+        return old_clique
+
+def recorded_reads(input_files, max_reads=None):
+    """ Reads junction_search.py input into multireadlet alignments.
+
+        input_files: list of files, possibly gzipped, with junction_search.py
+            input lines
+        max_reads: maximum number of reads to yield or None if unlimited
+
+        Yield value: tuple (read sequence, list of multireadlet alignments
+            as passed to selected_readlet_alignments_by_clustering())
+    """
+    readlets, sequences = defaultdict(list), {}
+    for input_file in input_files:
+        with xopen(None, input_file) as input_stream:
+            for line in input_stream:
+                tokens = line.rstrip('\n').split('\t')
+                if len(tokens) != 5:
+                    continue
+                seq_id, seq_info, rnames, flags, poses = tokens
+                seq_info = seq_info.split('\x1e')
+                if len(seq_info) > 2:
+                    sequences[seq_id] = seq_info[2]
+                if poses != '\x1c':
+                    readlets[seq_id].append(
+                            (int(seq_info[0]), int(seq_info[1]),
+                                zip(rnames.split('\x1f'),
+                                    [(int(flag) & 16) != 0
+                                        for flag in flags.split('\x1f')],
+                                    [int(pos) for pos in poses.split('\x1f')]))
+                        )
+    for read_count, seq_id in enumerate(sorted(readlets)):
+        if max_reads is not None and read_count >= max_reads:
+            break
+        if seq_id not in sequences:
+            continue
+        seq = sequences[seq_id]
+        seq_size = len(seq)
+        yield seq, [[(rname, reverse_strand, pos,
+                        pos + seq_size - right_displacement
+                        - left_displacement,
+                        right_displacement if reverse_strand
+                        else left_displacement)
+                        for rname, reverse_strand, pos in alignments]
+                        for left_displacement, right_displacement, alignments
+                        in readlets[seq_id]]
+
+def synthesized_reads(read_count, readlet_size=25, read_size=100,
+                        interval=4, repeat_count=8):
+    """ Generates reads whose readlets align to tandem repeats.
+
+        read_count: number of reads to generate
+        readlet_size: size of each readlet
+        read_size: size of each read
+        interval: distance between starts of successive readlets
+        repeat_count: maximum number of repeat copies each readlet aligns to
+
+        Yield value: tuple (read sequence, list of multireadlet alignments
+            as passed to selected_readlet_alignments_by_clustering())
+    """
+    for _ in xrange(read_count):
+        seq = ''.join([random.choice('ACGT') for _ in xrange(read_size)])
+        start = random.randint(1, 100000000)
+        period = random.randint(2, 60)
+        intron_size = random.choice([0, random.randint(50, 20000)])
+        split = random.randint(0, read_size)
+        multireadlets = []
+        for displacement in xrange(0, read_size - readlet_size + 1, interval):
+            pos = start + displacement + (intron_size
+                                            if displacement > split else 0)
+            copies = random.randint(1, repeat_count)
+            multireadlets.append(
+                    [('chr1', False, pos + period * copy,
+                        pos + period * copy + readlet_size, displacement)
+                        for copy in xrange(-copies // 2, copies - copies // 2)]
+                )
+        yield seq, multireadlets
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__,
+                formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('input_files', nargs='*',
+            help='files with recorded junction_search.py input')
+    parser.add_argument('--max-reads', type=int, required=False,
+            default=None,
+            help='maximum number of recorded reads to replay')
+    parser.add_argument('--synthesize', type=int, required=False,
+            default=2000,
+            help='number of reads to synthesize if no input files are passed')
+    args = parser.parse_args()
+    random.seed(0)
+    if args.input_files:
+        reads = recorded_reads(args.input_files, args.max_reads)
+    else:
+        reads = list(synthesized_reads(args.synthesize))
+    comparison = Comparison(junction_search.maximum_clique)
+    junction_search.maximum_clique = comparison
+    read_count = 0
+    for seq, multireadlets in reads:
+        random.seed(seq)
+        junction_search.selected_readlet_alignments_by_clustering(
+                multireadlets
+            )
+        read_count += 1
+    print 'reads replayed: %d' % read_count
+    for outcome in ['identical', 'equivalent', 'asymmetric', 'different',
+                    'tied']:
+        print '%s clusters: %d' % (outcome, comparison.tallies[outcome])
+    print 'maximal clique enumeration time: %.3f s' % (
+            comparison.enumeration_time
+        )
+    print 'heaviest chain time: %.3f s' % comparison.chain_time
+    for cluster, old_clique, new_clique in comparison.regressions[:10]:
+        print >>sys.stderr, 'Regression on cluster %r: enumeration chose ' \
+                            '%r, but heaviest chain chose %r.' % (
+                                    cluster, old_clique, new_clique
+                                )
+    sys.exit(1 if comparison.regressions else 0)
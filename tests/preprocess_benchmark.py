@@ -0,0 +1,160 @@
+#!/usr/bin/env python
+"""
+preprocess_benchmark.py
+
+Measures throughput of Rail-RNA's preprocess step in reads/second. FASTQ
+files listed in a Rail-RNA manifest (e.g., one from ex/) are preprocessed
+with --stdout, and the time taken is reported along with the number of reads
+written. Manifests in ex/ list URLs; download the files they reference and
+pass a manifest of local paths, or omit the manifest to synthesize --reads
+random paired-end reads.
+
+Quality conversion and binning are also timed in isolation, comparing the
+character-by-character implementations preprocess used to use with the
+translation tables it uses now.
+"""
+import argparse
+import os
+import sys
+import math
+import random
+import string
+import shutil
+import subprocess
+import tempfile
+import time
+
+base_path = os.path.abspath(
+                    os.path.join(os.path.dirname(__file__), os.pardir, 'src')
+                )
+sys.path.insert(0, os.path.join(base_path, 'rna', 'utils'))
+sys.path.insert(0, os.path.join(base_path, 'rna', 'steps'))
+from guess import phred_converter
+import preprocess
+
+def synthesized_manifest(temp_dir, reads, read_length):
+    """ Writes random paired-end FASTQs and a manifest referencing them.
+
+        temp_dir: where to write files
+        reads: number of read pairs
+        read_length: length of each mate
+
+        Return value: path to manifest
+    """
+    fastqs = [os.path.join(temp_dir, 'synthetic_%d.fastq' % mate)
+                for mate in (1, 2)]
+    streams = [open(fastq, 'w') for fastq in fastqs]
+    try:
+        for i in xrange(reads):
+            for mate, stream in enumerate(streams):
+                print >>stream, '@read%d/%d' % (i, mate + 1)
+                print >>stream, ''.join([random.choice('ACGTN')
+                                            for _ in xrange(read_length)])
+                print >>stream, '+'
+                print >>stream, ''.join([chr(random.randint(35, 74))
+                                            for _ in xrange(read_length)])
+    finally:
+        for stream in streams:
+            stream.close()
+    manifest = os.path.join(temp_dir, 'synthetic.manifest')
+    with open(manifest, 'w') as manifest_stream:
+        print >>manifest_stream, '\t'.join([fastqs[0], '0', fastqs[1], '0',
+                                            'synthetic-1-1'])
+    return manifest
+
+def legacy_converted_and_binned(qual):
+    """ Converts a Sanger quality string and bins it the way preprocess
+        used to, one character at a time.
+
+        qual: quality string
+
+        Return value: binned quality string
+    """
+    qual = ''.join(chr(min(max(ord(char), 33), 93)) for char in qual)
+    return ''.join(
+            [str(int(
+                preprocess._MN + math.floor(
+                        (preprocess._MX - preprocess._MN) * min(
+                                        ord(qual_char) - 33.0, 40.0
+                                    ) / 40.0)
+                )) for qual_char in qual]).translate(
+                    preprocess._mismatch_penalties_to_quality_scores
+                )
+
+def time_quality_transforms(quals):
+    """ Times legacy and table-driven quality conversion and binning.
+
+        quals: list of quality strings
+
+        No return value.
+    """
+    converter = phred_converter(phred_format='Sanger')
+    start_time = time.time()
+    legacy = [legacy_converted_and_binned(qual) for qual in quals]
+    legacy_time = time.time() - start_time
+    start_time = time.time()
+    tabled = [converter(qual).translate(preprocess._binned_quality_scores)
+                for qual in quals]
+    tabled_time = time.time() - start_time
+    assert legacy == tabled
+    for name, elapsed in [('per-character', legacy_time),
+                          ('translation tables', tabled_time)]:
+        print >>sys.stderr, (
+                'Quality conversion and binning with %s: %.3f s; '
+                '%.0f reads/s' % (name, elapsed,
+                                    len(quals) / max(elapsed, 1e-9))
+            )
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__,
+                formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--manifest', type=str, required=False,
+            default=None,
+            help='Manifest listing local FASTQs; reads are synthesized if '
+                 'omitted')
+    parser.add_argument('--reads', type=int, required=False, default=100000,
+            help='Number of read pairs to synthesize')
+    parser.add_argument('--read-length', type=int, required=False,
+            default=100,
+            help='Length of each synthesized mate')
+    parser.add_argument('--python', type=str, required=False,
+            default=sys.executable,
+            help='Python interpreter with which to run preprocess.py')
+    args = parser.parse_args()
+    random.seed(0)
+    temp_dir = tempfile.mkdtemp()
+    try:
+        manifest = args.manifest
+        if manifest is None:
+            manifest = synthesized_manifest(temp_dir, args.reads,
+                                                args.read_length)
+        quals = [''.join([chr(random.randint(33, 80))
+                            for _ in xrange(args.read_length)])
+                    for _ in xrange(min(args.reads, 100000))]
+        time_quality_transforms(quals)
+        with open(manifest) as manifest_stream:
+            manifest_lines = ['\t'.join(['0', line])
+                                for line in manifest_stream
+                                if line.strip() and line[0] != '#']
+        start_time = time.time()
+        preprocess_process = subprocess.Popen(
+                [args.python, os.path.join(base_path, 'rna', 'steps',
+                                            'preprocess.py'),
+                 '--stdout', '--bin-qualities', '--scratch', temp_dir],
+                stdin=subprocess.PIPE, stdout=subprocess.PIPE,
+                stderr=open(os.devnull, 'w'), bufsize=-1
+            )
+        preprocess_process.stdin.write(''.join(manifest_lines))
+        preprocess_process.stdin.close()
+        read_count = 0
+        for line in preprocess_process.stdout:
+            read_count += 1
+        elapsed = time.time() - start_time
+        if preprocess_process.wait():
+            raise RuntimeError('preprocess.py failed.')
+        print >>sys.stderr, (
+                'preprocess.py: %d reads in %.3f s; %.0f reads/s'
+                % (read_count, elapsed, read_count / max(elapsed, 1e-9))
+            )
+    finally:
+        shutil.rmtree(temp_dir)
@@ -0,0 +1,198 @@
+#!/usr/bin/env python
+"""
+shuffle_benchmark.py
+
+Measures throughput of Dooplicity's shuffle engines, i.e., how fast map output
+is partitioned into tasks, presorted, and merge-fed to reducers in local mode.
+Both the in-process "python" engine and the UNIX "sort" engine are run on
+every step of a job flow JSON that has a reducer, and lines/second are
+reported for each.
+
+Obtain a job flow JSON by running Rail-RNA with --json, e.g.,
+
+rail-rna go local -x <idx> -m <manifest> --json >flow.json
+
+If the step inputs referenced by the JSON exist (for instance, because a run
+was performed with --keep-intermediates), they are used as benchmark input.
+Otherwise, --lines random lines are synthesized per step with as many key
+fields as the step's partition/sort options reference.
+"""
+import argparse
+import os
+import sys
+import glob
+import json
+import random
+import shutil
+import tempfile
+import time
+
+base_path = os.path.abspath(
+                    os.path.join(os.path.dirname(__file__), os.pardir, 'src')
+                )
+sys.path.insert(0, os.path.join(base_path, 'dooplicity'))
+from emr_simulator import (presorted_tasks, step_runner_with_error_return,
+                            yopen)
+
+def step_options(step):
+    """ Extracts shuffle-relevant options from a step in a job flow JSON.
+
+        step: step dictionary from job flow JSON
+
+        Return value: tuple (name, inputs, key fields, partition options,
+            sort options, task count, mod partitioner?) or None if step has
+            no reducer
+    """
+    args = step['HadoopJarStep']['Args']
+    options = {'key_fields' : 1, 'partition' : '-k1', 'tasks' : 1,
+                'inputs' : [], 'reducer' : None, 'mod' : False}
+    for i, arg in enumerate(args[:-1]):
+        if arg == '-D':
+            name, _, value = args[i+1].partition('=')
+            if name in ['mapred.reduce.tasks', 'mapreduce.job.reduces']:
+                options['tasks'] = max(int(value), 1)
+            elif name == 'stream.num.map.output.key.fields':
+                options['key_fields'] = int(value)
+            elif name in ['mapred.text.key.partitioner.options',
+                          'mapreduce.partition.keypartitioner.options']:
+                options['partition'] = value
+            elif name in ['mapred.text.key.comparator.options',
+                          'mapreduce.partition.keycomparator.options']:
+                options['sort'] = value
+        elif arg == '-input':
+            options['inputs'].extend(args[i+1].split(','))
+        elif arg == '-reducer':
+            options['reducer'] = args[i+1]
+        elif arg == '-partitioner':
+            options['mod'] = (args[i+1] == 'edu.jhu.cs.ModPartitioner')
+    if options['reducer'] in [None, 'cat',
+                              'org.apache.hadoop.mapred.lib.IdentityReducer']:
+        return None
+    if 'sort' not in options:
+        options['sort'] = '-k1,%d' % options['key_fields']
+    return (step['Name'], options['inputs'], options['key_fields'],
+            options['partition'], options['sort'], options['tasks'],
+            options['mod'])
+
+def synthesized_input(path, key_fields, lines):
+    """ Writes random Rail-like intermediate lines.
+
+        path: where to write lines
+        key_fields: number of key fields per line
+        lines: number of lines to write
+
+        No return value.
+    """
+    rnames = ['chr%s' % el for el in range(1, 23) + ['X', 'Y', 'M']]
+    with open(path, 'w') as output_stream:
+        for _ in xrange(lines):
+            fields = [random.choice(rnames)]
+            for _ in xrange(key_fields):
+                fields.append('%012d' % random.randint(0, 250000000))
+            fields.append(''.join(random.choice('ACGT') for _ in xrange(20)))
+            print >>output_stream, '\t'.join(fields)
+
+def benchmark(input_files, key_fields, partition_options, sort_options,
+                task_count, mod_partition, engine, processes, memcap, gzip,
+                temp_dir):
+    """ Times shuffle of input files with a given engine.
+
+        Return value: tuple (seconds for partitioning/presorting, seconds for
+            merging into reducers)
+    """
+    task_dir = tempfile.mkdtemp(dir=temp_dir)
+    output_dir = tempfile.mkdtemp(dir=temp_dir)
+    err_dir = tempfile.mkdtemp(dir=temp_dir)
+    groups = [input_files[i::processes] for i in xrange(processes)]
+    start_time = time.time()
+    for i, group in enumerate([group for group in groups if group]):
+        error = presorted_tasks(group, i, sort_options, task_dir, key_fields,
+                                '\t', partition_options, task_count, memcap,
+                                gzip, 3, None, False, 'sort', mod_partition,
+                                engine)
+        if error is not None:
+            raise RuntimeError(error)
+    partition_time = time.time() - start_time
+    start_time = time.time()
+    for task in xrange(task_count):
+        task_glob = os.path.join(task_dir, '%d.*' % task)
+        if not glob.glob(task_glob):
+            continue
+        error = step_runner_with_error_return(
+                'cat >/dev/null', task_glob, output_dir, err_dir, task, False,
+                '\t', sort_options, memcap, gzip, 3, None, False, 'sort',
+                None, engine
+            )
+        if error is not None:
+            raise RuntimeError(error)
+    merge_time = time.time() - start_time
+    for directory in [task_dir, output_dir, err_dir]:
+        shutil.rmtree(directory)
+    return partition_time, merge_time
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__,
+                formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--json', type=str, required=True,
+            help='job flow JSON output by rail-rna with --json')
+    parser.add_argument('--lines', type=int, required=False, default=500000,
+            help='number of lines to synthesize per step if its inputs '
+                 'don\'t exist')
+    parser.add_argument('--files', type=int, required=False, default=8,
+            help='number of map output files to synthesize per step')
+    parser.add_argument('--processes', type=int, required=False, default=4,
+            help='number of partitioning processes to simulate')
+    parser.add_argument('--tasks', type=int, required=False, default=None,
+            help='overrides reduce task count of every step')
+    parser.add_argument('--memcap', type=int, required=False,
+            default=(1024*300),
+            help='memory cap in kilobytes passed to each engine')
+    parser.add_argument('--gzip', action='store_const', const=True,
+            default=False,
+            help='gzip intermediates as with --gzip-intermediates')
+    args = parser.parse_args()
+    random.seed(0)
+    with open(args.json) as json_stream:
+        job_flow = json.load(json_stream)['Steps']
+    temp_dir = tempfile.mkdtemp()
+    try:
+        print '\t'.join(['step', 'lines', 'engine', 'partition (lines/s)',
+                         'merge (lines/s)', 'total (s)'])
+        for step in job_flow:
+            options = step_options(step)
+            if options is None:
+                continue
+            (name, inputs, key_fields, partition_options, sort_options,
+                task_count, mod_partition) = options
+            if args.tasks is not None:
+                task_count = args.tasks
+            input_files = [input_file for step_input in inputs
+                            for input_file in (
+                                glob.glob(os.path.join(step_input, '*'))
+                                if os.path.isdir(step_input)
+                                else [step_input]
+                            ) if os.path.isfile(input_file)]
+            if not input_files:
+                for i in xrange(args.files):
+                    input_files.append(os.path.join(temp_dir, 'input.%d' % i))
+                    synthesized_input(input_files[-1], key_fields,
+                                      args.lines / args.files)
+            line_count = 0
+            for input_file in input_files:
+                with yopen(None, input_file) as input_stream:
+                    line_count += sum(1 for _ in input_stream)
+            for engine in ['sort', 'python']:
+                partition_time, merge_time = benchmark(
+                        input_files, key_fields, partition_options,
+                        sort_options, task_count, mod_partition, engine,
+                        args.processes, args.memcap, args.gzip, temp_dir
+                    )
+                print '\t'.join([name, str(line_count), engine,
+                                 '%.0f' % (line_count / partition_time),
+                                 '%.0f' % (line_count / merge_time),
+                                 '%.2f' % (partition_time + merge_time)])
+                sys.stdout.flush()
+            for input_file in glob.glob(os.path.join(temp_dir, 'input.*')):
+                os.remove(input_file)
+    finally:
+        shutil.rmtree(temp_dir)
@@ -0,0 +1,92 @@
+#!/usr/bin/env python
+"""
+xstream_benchmark.py
+
+Measures throughput of Dooplicity's xstream, the grouped-stream reader at the
+head of every Rail-RNA reducer, in lines/second. A sorted input file is read
+with each requested number of key fields both into tuples of fields, as most
+steps read it, and in raw mode, where values are left unsplit. Pass a file of
+reducer input (e.g., from a run performed with --keep-intermediates) or omit
+it to synthesize --lines sorted lines.
+"""
+import argparse
+import os
+import sys
+import random
+import shutil
+import tempfile
+import time
+
+base_path = os.path.abspath(
+                    os.path.join(os.path.dirname(__file__), os.pardir, 'src')
+                )
+sys.path.insert(0, os.path.join(base_path, 'dooplicity'))
+from tools import xstream
+
+def synthesized_input(temp_dir, lines):
+    """ Writes sorted random lines resembling coverage_pre.py input.
+
+        temp_dir: where to write file
+        lines: number of lines
+
+        Return value: path to file
+    """
+    input_file = os.path.join(temp_dir, 'synthetic.tsv')
+    with open(input_file, 'w') as input_stream:
+        for i in xrange(lines):
+            print >>input_stream, '\t'.join([
+                    'chr%d' % (i * 25 / lines), '%012d' % (i / 3),
+                    str(random.randint(0, 1000)),
+                    ''.join([random.choice('ACGT') for _ in xrange(20)]),
+                    str(i)
+                ])
+    return input_file
+
+def time_xstream(input_file, key_fields, raw):
+    """ Times iteration through every value of a file with xstream.
+
+        input_file: path to sorted input
+        key_fields: number of key fields
+        raw: True iff values should be left unsplit
+
+        Return value: tuple (number of lines, seconds elapsed)
+    """
+    line_count = 0
+    start_time = time.time()
+    with open(input_file) as input_stream:
+        for _, xpartition in xstream(input_stream, key_fields, raw=raw):
+            for _ in xpartition:
+                line_count += 1
+    return line_count, time.time() - start_time
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__,
+                formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--input', type=str, required=False, default=None,
+            help='Sorted reducer input; lines are synthesized if omitted')
+    parser.add_argument('--lines', type=int, required=False,
+            default=1000000,
+            help='Number of lines to synthesize')
+    parser.add_argument('--key-fields', type=int, nargs='+', required=False,
+            default=[1, 2],
+            help='Numbers of key fields with which to read input')
+    args = parser.parse_args()
+    random.seed(0)
+    temp_dir = tempfile.mkdtemp()
+    try:
+        input_file = args.input
+        if input_file is None:
+            input_file = synthesized_input(temp_dir, args.lines)
+        for key_fields in args.key_fields:
+            for raw in [False, True]:
+                line_count, elapsed = time_xstream(input_file, key_fields,
+                                                    raw)
+                print >>sys.stderr, (
+                        'key fields=%d, %s: %d lines in %.3f s; '
+                        '%.0f lines/s' % (key_fields,
+                                            'raw' if raw else 'tuples',
+                                            line_count, elapsed,
+                                            line_count / max(elapsed, 1e-9))
+                    )
+    finally:
+        shutil.rmtree(temp_dir)